@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Admission Control
+Giới hạn số webhook xử lý đồng thời trong mỗi process: vượt ngưỡng thì trả
+503 + Retry-After ngay (LiveAgent sẽ gửi lại) thay vì để request dồn lại đến
+khi worker hết bộ nhớ
+
+Giới hạn chỉ có tác dụng khi một process xử lý nhiều webhook cùng lúc:
+async_app.py, hoặc app.py với gunicorn --worker-class gthread (đặt
+ADMISSION_MAX_IN_FLIGHT bằng --threads). Worker sync của gunicorn chỉ chạy
+một request mỗi lúc nên không bao giờ chạm ngưỡng (có cảnh báo một lần).
+
+Hai mức ưu tiên:
+- high: agent reply từ On-Premise, tin nhắn khách hàng và agent reply từ
+  Cloud (cần chuyển sang hệ thống bên kia) - được dùng toàn bộ
+  ADMISSION_MAX_IN_FLIGHT
+- low: webhook Cloud sẽ bị bỏ qua (echo, event hệ thống) - chỉ được dùng
+  ADMISSION_LOW_PRIORITY_SHARE của giới hạn, và bị từ chối khi hàng đợi
+  fan-out upstream vượt ADMISSION_MAX_QUEUED
+
+Mức ưu tiên của webhook Cloud chỉ biết sau khi parse body (đã giới hạn kích
+thước, xem webhook_parser.py); kết quả parse được giữ trên request để handler
+dùng lại.
+"""
+
+import inspect
+import functools
+import logging
+import threading
+from typing import Callable
+
+import fanout
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+HIGH = 'high'
+LOW = 'low'
+
+_multithread_checked = False
+
+
+class AdmissionController:
+    """Đếm webhook đang xử lý và quyết định nhận/từ chối theo mức ưu tiên"""
+
+    def __init__(self, max_in_flight: int, low_priority_share: float, max_queued: int):
+        self.max_in_flight = max_in_flight
+        self.low_priority_limit = max(1, int(max_in_flight * low_priority_share))
+        self.max_queued = max_queued
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_in_flight > 0
+
+    def try_acquire(self, priority: str) -> bool:
+        """Nhận webhook nếu còn chỗ cho mức ưu tiên này"""
+        if not self.enabled:
+            return True
+        with self._lock:
+            if priority == LOW:
+                if self.in_flight >= self.low_priority_limit:
+                    return False
+                if self.max_queued > 0 and fanout.pending() >= self.max_queued:
+                    return False
+            elif self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.in_flight -= 1
+
+
+controller = AdmissionController(
+    max_in_flight=Config.ADMISSION_MAX_IN_FLIGHT,
+    low_priority_share=Config.ADMISSION_LOW_PRIORITY_SHARE,
+    max_queued=Config.ADMISSION_MAX_QUEUED
+)
+
+
+def rejection():
+    """(payload, status, headers) trả về khi từ chối webhook"""
+    payload = {"status": "shed", "error": "Server busy, retry later"}
+    return payload, 503, {'Retry-After': str(Config.ADMISSION_RETRY_AFTER)}
+
+
+def _check_multithread():
+    """Cảnh báo một lần nếu worker WSGI chỉ chạy một request mỗi lúc (gunicorn sync)"""
+    global _multithread_checked
+    # Import muộn: module này không phụ thuộc Flask (dùng chung với async_app)
+    from flask import request
+    _multithread_checked = True
+    if not request.environ.get('wsgi.multithread'):
+        logger.warning("⚠️ Admission control has no effect in a single-threaded WSGI worker, "
+                       "use gunicorn --worker-class gthread --threads N with ADMISSION_MAX_IN_FLIGHT=N")
+
+
+def admit(route: str, priority) -> Callable:
+    """Decorator kiểm tra admission trước khi chạy webhook handler (sync hoặc async)
+
+    priority là HIGH/LOW, hoặc hàm nhận cùng tham số với handler và trả về
+    mức ưu tiên của request (coroutine với handler async); hàm chỉ được gọi
+    khi admission đang bật.
+
+    Đặt dưới metrics.track_webhook (để webhook bị từ chối vẫn được đếm với
+    outcome=shed) và trên webhook_timing.track (để không ghi SQLite khi quá tải).
+    Handler async nhận lại (payload, status, headers) để json_endpoint tạo response.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                level = priority
+                if callable(priority) and controller.enabled:
+                    level = await priority(*args, **kwargs)
+                if not controller.try_acquire(level):
+                    # INFO để SamplingFilter giới hạn log khi quá tải (số lượng đã có trong metrics)
+                    logger.info("⚠️ Shedding %s webhook (priority=%s, in_flight=%s, queued=%s)",
+                                route, level, controller.in_flight, fanout.pending())
+                    return rejection()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    controller.release()
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if controller.enabled and not _multithread_checked:
+                _check_multithread()
+            level = priority
+            if callable(priority) and controller.enabled:
+                level = priority(*args, **kwargs)
+            if not controller.try_acquire(level):
+                # INFO để SamplingFilter giới hạn log khi quá tải (số lượng đã có trong metrics)
+                logger.info("⚠️ Shedding %s webhook (priority=%s, in_flight=%s, queued=%s)",
+                            route, level, controller.in_flight, fanout.pending())
+                payload, status, headers = rejection()
+                from flask import jsonify
+                return jsonify(payload), status, headers
+            try:
+                return func(*args, **kwargs)
+            finally:
+                controller.release()
+        return wrapper
+    return decorator
@@ -2,87 +2,189 @@
 """
 Agent Mapping Configuration
 Quản lý mapping giữa agent ID On-Premise và user identifier Cloud
+
+Mapping lưu trong bảng SQLite (AGENT_MAPPING_DB_PATH) thay vì viết lại cả file
+JSON mỗi lần sửa:
+- Mỗi lần ghi (add/remove/apply_batch) là một transaction và tăng version
+  trong bảng agent_mapping_meta
+- Mỗi process giữ bản copy trong bộ nhớ (kèm index ngược Cloud -> On-Premise)
+  và chỉ đọc lại khi version đổi; version được kiểm tra tối đa một lần mỗi
+  AGENT_MAPPING_CHECK_INTERVAL giây, nên worker đang chạy thấy thay đổi từ
+  CLI mà không phải đọc database ở mỗi lookup
+- Lần đầu tạo database, mapping được import từ agent_mapping.json (nếu có)
 """
 
 import json
 import os
-from typing import Dict, Optional
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Optional
 import logging
+from config import Config
+from lazy import LazyProxy
 
 logger = logging.getLogger(__name__)
 
+# Mapping mặc định khi chưa có database lẫn file JSON
+DEFAULT_MAPPING = {
+    "k6citev3": "1pkaew79",  # Keith Nguyen: On-Premise -> Cloud
+}
+
 class AgentMappingConfig:
-    """Quản lý mapping agent từ file config"""
-    
-    def __init__(self, config_file: str = "agent_mapping.json"):
-        self.config_file = config_file
-        self.mapping = self._load_mapping()
-    
-    def _load_mapping(self) -> Dict[str, str]:
-        """Load mapping từ file JSON"""
+    """Quản lý mapping agent trong SQLite, tự reload khi process khác sửa"""
+
+    def __init__(self, db_path: str = None, legacy_json: str = None, check_interval: float = None):
+        self.db_path = db_path or Config.AGENT_MAPPING_DB_PATH
+        self.legacy_json = legacy_json or Config.AGENT_MAPPING_JSON
+        self.check_interval = Config.AGENT_MAPPING_CHECK_INTERVAL if check_interval is None else check_interval
+        self.mapping: Dict[str, str] = {}
+        self.reverse: Dict[str, str] = {}
+        self.version = -1
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._init_db()
+        self.reload_mapping()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10.0)
+
+    def _init_db(self):
+        """Tạo bảng nếu chưa có, import agent_mapping.json ở lần đầu"""
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS agent_mappings (
+                    onpremise_agent_id TEXT PRIMARY KEY,
+                    cloud_userid TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_agent_mappings_cloud_userid
+                ON agent_mappings(cloud_userid)
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS agent_mapping_meta (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    version INTEGER NOT NULL
+                )
+            ''')
+            created = conn.execute('INSERT OR IGNORE INTO agent_mapping_meta (id, version) VALUES (1, 0)').rowcount
+        if created:
+            self.apply_batch(self._load_legacy_json())
+
+    def _load_legacy_json(self) -> Dict[str, str]:
+        """Đọc mapping từ file JSON cũ (chỉ dùng khi tạo database lần đầu)"""
         try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
+            if os.path.exists(self.legacy_json):
+                with open(self.legacy_json, 'r', encoding='utf-8') as f:
                     mapping = json.load(f)
-                    logger.info(f"✅ Loaded {len(mapping)} agent mappings from {self.config_file}")
-                    return mapping
-            else:
-                # Tạo file mặc định nếu chưa có
-                default_mapping = {
-                    "k6citev3": "1pkaew79",  # Keith Nguyen: On-Premise -> Cloud
-                    # Thêm các mapping khác ở đây
-                }
-                self._save_mapping(default_mapping)
-                logger.info(f"✅ Created default mapping file: {self.config_file}")
-                return default_mapping
+                logger.info("✅ Imported %s agent mappings from %s", len(mapping), self.legacy_json)
+                return mapping
         except Exception as e:
-            logger.error(f"❌ Error loading mapping: {e}")
+            logger.error("❌ Error loading legacy mapping file %s: %s", self.legacy_json, e)
             return {}
-    
-    def _save_mapping(self, mapping: Dict[str, str]):
-        """Lưu mapping vào file JSON"""
-        try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(mapping, f, indent=2, ensure_ascii=False)
-            logger.info(f"✅ Saved mapping to {self.config_file}")
-        except Exception as e:
-            logger.error(f"❌ Error saving mapping: {e}")
-    
+        logger.info("✅ Created default agent mapping in %s", self.db_path)
+        return dict(DEFAULT_MAPPING)
+
+    def _refresh(self, force: bool = False):
+        """Đọc lại mapping nếu version trong database khác bản trong bộ nhớ"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if not force and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            try:
+                with self._connect() as conn:
+                    version = conn.execute('SELECT version FROM agent_mapping_meta WHERE id = 1').fetchone()[0]
+                    if version == self.version and not force:
+                        return
+                    rows = conn.execute(
+                        'SELECT onpremise_agent_id, cloud_userid FROM agent_mappings ORDER BY onpremise_agent_id'
+                    ).fetchall()
+            except Exception as e:
+                # Giữ bản cũ trong bộ nhớ, lần kiểm tra sau thử lại
+                logger.error("❌ Error reloading agent mappings: %s", e)
+                return
+            mapping = dict(rows)
+            reverse: Dict[str, str] = {}
+            for onpremise_id, cloud_id in rows:
+                reverse.setdefault(cloud_id, onpremise_id)
+            # Gán nguyên dict mới để thread đang đọc không thấy trạng thái dở dang
+            self.mapping, self.reverse = mapping, reverse
+            if version != self.version:
+                logger.info("✅ Loaded %s agent mappings (version %s)", len(mapping), version)
+            self.version = version
+
     def get_cloud_userid(self, onpremise_agent_id: str) -> Optional[str]:
         """Lấy Cloud user identifier từ On-Premise agent ID"""
+        self._refresh()
         return self.mapping.get(onpremise_agent_id)
-    
-    def add_mapping(self, onpremise_agent_id: str, cloud_userid: str) -> bool:
-        """Thêm mapping mới"""
+
+    def get_onpremise_id(self, cloud_userid: str) -> Optional[str]:
+        """Lấy On-Premise agent ID từ Cloud user identifier (index ngược)"""
+        self._refresh()
+        return self.reverse.get(cloud_userid)
+
+    def apply_batch(self, upserts: Dict[str, str] = None, removals: Iterable[str] = (),
+                    replace: bool = False) -> bool:
+        """Ghi nhiều thay đổi trong một transaction (replace=True: xóa mapping không có trong upserts)"""
+        upserts = upserts or {}
+        now = datetime.now().isoformat()
         try:
-            self.mapping[onpremise_agent_id] = cloud_userid
-            self._save_mapping(self.mapping)
-            logger.info(f"✅ Added mapping: {onpremise_agent_id} -> {cloud_userid}")
-            return True
+            with self._connect() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                changes_before = conn.total_changes
+                if replace:
+                    conn.execute('DELETE FROM agent_mappings')
+                conn.executemany(
+                    'DELETE FROM agent_mappings WHERE onpremise_agent_id = ?',
+                    [(onpremise_id,) for onpremise_id in removals]
+                )
+                conn.executemany('''
+                    INSERT INTO agent_mappings (onpremise_agent_id, cloud_userid, updated_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(onpremise_agent_id) DO UPDATE SET
+                        cloud_userid = excluded.cloud_userid, updated_at = excluded.updated_at
+                    WHERE cloud_userid != excluded.cloud_userid
+                ''', [(str(k), str(v), now) for k, v in upserts.items()])
+                # Không có gì thay đổi thì giữ nguyên version, worker không phải đọc lại
+                if conn.total_changes > changes_before:
+                    conn.execute('UPDATE agent_mapping_meta SET version = version + 1 WHERE id = 1')
         except Exception as e:
-            logger.error(f"❌ Error adding mapping: {e}")
+            logger.error("❌ Error saving agent mappings: %s", e)
             return False
-    
+        self._refresh(force=True)
+        return True
+
+    def add_mapping(self, onpremise_agent_id: str, cloud_userid: str) -> bool:
+        """Thêm mapping mới"""
+        if self.apply_batch({onpremise_agent_id: cloud_userid}):
+            logger.info("✅ Added mapping: %s -> %s", onpremise_agent_id, cloud_userid)
+            return True
+        return False
+
     def remove_mapping(self, onpremise_agent_id: str) -> bool:
         """Xóa mapping"""
-        try:
-            if onpremise_agent_id in self.mapping:
-                del self.mapping[onpremise_agent_id]
-                self._save_mapping(self.mapping)
-                logger.info(f"✅ Removed mapping: {onpremise_agent_id}")
-                return True
-            return False
-        except Exception as e:
-            logger.error(f"❌ Error removing mapping: {e}")
+        self._refresh(force=True)
+        if onpremise_agent_id not in self.mapping:
             return False
-    
+        if self.apply_batch(removals=[onpremise_agent_id]):
+            logger.info("✅ Removed mapping: %s", onpremise_agent_id)
+            return True
+        return False
+
     def list_mappings(self) -> Dict[str, str]:
         """Liệt kê tất cả mappings"""
+        self._refresh()
         return self.mapping.copy()
-    
+
     def reload_mapping(self):
-        """Reload mapping từ file"""
-        self.mapping = self._load_mapping()
+        """Đọc lại mapping từ database ngay (không chờ check_interval)"""
+        self._refresh(force=True)
 
-# Instance toàn cục
-agent_mapping = AgentMappingConfig() 
\ No newline at end of file
+# Instance toàn cục, chỉ mở database mapping ở lần dùng đầu tiên
+agent_mapping = LazyProxy(AgentMappingConfig)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Ladesk Integration API - Async Version
+Cùng hai webhook route với app.py nhưng chạy trên aiohttp: lời gọi Ladesk dùng
+client async (ladesk_async.py), SQLite chạy qua asyncio.to_thread, nên một
+process xử lý được hàng trăm webhook đang chờ upstream cùng lúc
+
+    python async_app.py
+    gunicorn async_app:app --worker-class aiohttp.GunicornWebWorker --bind 0.0.0.0:3000
+"""
+
+import os
+import asyncio
+import functools
+import logging
+from datetime import datetime
+from aiohttp import web
+from config import Config
+import database_simple
+from database_simple import db
+from storage import (create_storage, MAPPING_QUERY_FILTERS, MAPPING_PREFIX_FILTERS, WEBHOOK_LOG_QUERY_FILTERS,
+                     WEBHOOK_LOG_GROUP_COLUMNS)
+import agent_mapping_config
+from lazy import LazyProxy
+import metrics
+import webhook_timing
+from profiling import maybe_profile
+import webhook_logic
+import attachments
+from records import WebhookEvent
+import webhook_parser
+import admission
+import query_api
+import data_export
+from webhook_parser import WebhookBodyTooLarge
+from logging_setup import setup_logging
+from ladesk_async import AsyncLadeskCloudAPI, AsyncLadeskOnPremiseAPI, close_session
+
+# Logging (queue + JSON, xem logging_setup.py) được cấu hình trong create_app()
+LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs')
+LOG_FILE = os.path.join(LOG_DIR, 'app.log')
+
+logger = logging.getLogger(__name__)
+
+# API instances, tạo ở lần dùng đầu tiên (create_app có thể thay bằng instance khác)
+cloud_api = LazyProxy(AsyncLadeskCloudAPI)
+onpremise_api = LazyProxy(AsyncLadeskOnPremiseAPI)
+
+
+def json_endpoint(handler):
+    """Handler trả về (payload, status[, headers]) như các route Flask, chuyển thành JSON response"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        payload, status, *headers = await handler(request)
+        return web.json_response(payload, status=status, headers=headers[0] if headers else None)
+    return wrapper
+
+
+async def parse_webhook_data(request):
+    """Parse webhook từ request (xem webhook_parser.py), trả về WebhookEvent hoặc None"""
+    try:
+        data = await webhook_parser.parse_request_async(request)
+        if data is not None:
+            logger.info("✅ JSON parsed successfully")
+        return WebhookEvent.parse(data)
+
+    except WebhookBodyTooLarge:
+        raise
+    except Exception as e:
+        logger.error("Webhook parsing error: %s", e)
+        return None
+
+
+async def cloud_webhook_priority(request) -> str:
+    """Mức ưu tiên admission của webhook Cloud: parse body (có giới hạn, handler dùng lại) rồi phân loại event"""
+    try:
+        data = await webhook_parser.parse_request_async(request)
+        return webhook_logic.cloud_event_priority(WebhookEvent.parse(data))
+    except Exception:
+        # Body lỗi hoặc quá lớn: handler trả 400/413 ngay
+        return admission.LOW
+
+
+async def health_check(request):
+    """Health check endpoint"""
+    return web.json_response({
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "service": "Ladesk Integration API",
+        "mode": "async"
+    })
+
+
+async def metrics_endpoint(request):
+    """Prometheus metrics endpoint"""
+    payload, content_type = metrics.render_latest()
+    # aiohttp tách charset khỏi content_type
+    mimetype, _, params = content_type.partition(';')
+    charset = params.split('charset=')[-1].strip() if 'charset=' in params else None
+    return web.Response(body=payload, content_type=mimetype.strip(), charset=charset)
+
+
+@json_endpoint
+async def query_mappings(request):
+    """Mapping theo conversation/ticket/prefix ticket/email/thời gian, phân trang bằng before_id (chỉ đọc)"""
+    return await asyncio.to_thread(query_api.handle, db.query_mappings,
+                                   {**MAPPING_QUERY_FILTERS, **MAPPING_PREFIX_FILTERS},
+                                   request.query, request.headers)
+
+
+@json_endpoint
+async def query_webhook_logs(request):
+    """Webhook log theo conversation/ticket/type/status/thời gian, phân trang bằng before_id (chỉ đọc)"""
+    return await asyncio.to_thread(query_api.handle, db.query_webhook_logs, WEBHOOK_LOG_QUERY_FILTERS,
+                                   request.query, request.headers)
+
+
+@json_endpoint
+async def count_webhook_logs(request):
+    """Số webhook log theo group_by (agent_id, channel_type, status...), cùng bộ lọc với /api/webhook-logs"""
+    return await asyncio.to_thread(query_api.handle_counts, db.count_webhook_logs, WEBHOOK_LOG_QUERY_FILTERS,
+                                   WEBHOOK_LOG_GROUP_COLUMNS, request.query, request.headers)
+
+
+async def export_data(request):
+    """Export toàn bộ mappings/webhook_logs dạng NDJSON stream (gzip=1 để nén), after_id để tiếp tục"""
+    kind = request.match_info['kind']
+    options, status = query_api.export_options(kind, request.query, request.headers)
+    if status != 200:
+        return web.json_response(options, status=status)
+
+    response = web.StreamResponse(headers=options['headers'])
+    await response.prepare(request)
+    chunks = data_export.stream_export(db, kind, options['after_id'], options['compress'])
+    # Mỗi lô đọc SQLite trong thread để không chặn event loop
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            break
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+@json_endpoint
+@metrics.track_webhook('ladesk_cloud')
+@admission.admit('ladesk_cloud', cloud_webhook_priority)
+@webhook_timing.track('cloud_incoming')
+@maybe_profile
+async def ladesk_cloud_webhook(request):
+    """Webhook nhận data từ Ladesk Cloud (Facebook)"""
+    try:
+        with webhook_timing.stage('parse'):
+            event = await parse_webhook_data(request)
+        if not event:
+            return {"error": "Invalid webhook data"}, 400
+
+        webhook_timing.current().webhook_log_id = await asyncio.to_thread(db.log_webhook, 'cloud_incoming', event.payload)
+
+        with webhook_timing.stage('classify'):
+            action, skip_reason = webhook_logic.route_cloud_event(event)
+
+        if action == webhook_logic.AGENT_REPLY:
+            return await asyncio.to_thread(webhook_logic.cloud_agent_reply, db, event)
+        if action == webhook_logic.SKIP:
+            return {"status": "skipped", "reason": skip_reason}, 200
+
+        conversation_id = event.conversation_id
+        contact_id = event.contact_id
+
+        # Bước 1 (song song): mapping hiện tại (SQLite, qua thread), contact từ Cloud và chuyển file
+        # đính kèm sang On-Premise
+        attachment_refs = attachments.attachment_refs(event.attachments)
+        attachments_task = asyncio.ensure_future(attachments.forward_attachments_async(
+            attachment_refs, cloud_api, onpremise_api, 'onpremise')) if attachment_refs else None
+        try:
+            if contact_id:
+                existing_mapping, contact_result = await asyncio.gather(
+                    asyncio.to_thread(db.get_mapping_by_conversation, conversation_id),
+                    cloud_api.get_contact_details(contact_id)
+                )
+            else:
+                existing_mapping = await asyncio.to_thread(db.get_mapping_by_conversation, conversation_id)
+                contact_result = None
+            attachment_result = await attachments_task if attachments_task is not None else None
+        finally:
+            # Bước 1 lỗi: không để task chuyển file chạy tiếp (và lỗi của nó không được await)
+            if attachments_task is not None and not attachments_task.done():
+                attachments_task.cancel()
+                await asyncio.gather(attachments_task, return_exceptions=True)
+
+        ticket = webhook_logic.prepare_customer_ticket(event, existing_mapping, contact_result, attachment_refs,
+                                                       attachment_result)
+
+        # Bước 2 (song song): ticket chỉ cần email/tên khách hàng, không cần contact_id On-Premise
+        upsert_result, ticket_result = await asyncio.gather(
+            onpremise_api.create_contact(ticket['contact_data']),
+            onpremise_api.create_ticket(ticket['ticket_data'])
+        )
+
+        return await asyncio.to_thread(webhook_logic.complete_customer_ticket, db, conversation_id, ticket,
+                                       upsert_result, ticket_result)
+
+    except WebhookBodyTooLarge as e:
+        logger.warning("⚠️ Rejected oversized Cloud webhook: %s", e)
+        return {"error": "Webhook body too large"}, 413
+    except Exception as e:
+        logger.error("❌ Cloud webhook error: %s", e)
+        return {"error": str(e)}, 500
+
+
+@json_endpoint
+@metrics.track_webhook('ladesk_onpremise')
+@admission.admit('ladesk_onpremise', admission.HIGH)
+@webhook_timing.track('onpremise_incoming')
+@maybe_profile
+async def ladesk_onpremise_webhook(request):
+    """Webhook nhận data từ Ladesk On-Premise (Agent reply)"""
+    try:
+        with webhook_timing.stage('parse'):
+            event = await parse_webhook_data(request)
+        if not event:
+            return {"error": "Invalid webhook data"}, 400
+
+        webhook_timing.current().webhook_log_id = await asyncio.to_thread(db.log_webhook, 'onpremise_incoming', event.payload)
+
+        with webhook_timing.stage('classify'):
+            valid_agent_id, skip_reason = webhook_logic.onpremise_reply_agent(event)
+        if skip_reason:
+            return {"status": "skipped", "reason": skip_reason}, 200
+
+        agent_name = webhook_logic.clean_agent_name(event.agent_name)
+
+        logger.info("🔄 Processing agent reply: %s, agent: %s, valid_agent_id: %s", event.conversation_id, agent_name, valid_agent_id)
+
+        mapping = await asyncio.to_thread(webhook_logic.find_mapping_for_onpremise_reply, db, event.ticket_id,
+                                          event.conversation_id, event.customer_email)
+        if not mapping:
+            return {"error": "No mapping found"}, 404
+
+        cloud_conversation_id = mapping.cloud_conversation_id
+
+        # File agent đính kèm được chuyển sang Cloud trước, file lỗi được thêm link vào nội dung
+        attachment_refs = attachments.attachment_refs(event.attachments)
+        file_ids, failed_attachments = await attachments.forward_attachments_async(
+            attachment_refs, onpremise_api, cloud_api, 'cloud') if attachment_refs else ([], [])
+        reply_message = webhook_logic.agent_reply_message(event.message, attachment_refs, failed_attachments)
+
+        logger.info("🔄 Sending reply with valid_agent_id: %s", valid_agent_id)
+
+        reply_result = await cloud_api.send_reply(cloud_conversation_id, reply_message, valid_agent_id, file_ids)
+
+        return await asyncio.to_thread(webhook_logic.complete_agent_reply, db, cloud_conversation_id, event.message,
+                                       agent_name, reply_result, file_ids, failed_attachments)
+
+    except WebhookBodyTooLarge as e:
+        logger.warning("⚠️ Rejected oversized On-Premise webhook: %s", e)
+        return {"error": "Webhook body too large"}, 413
+    except Exception as e:
+        logger.error("❌ On-Premise webhook error: %s", e)
+        return {"error": str(e)}, 500
+
+
+async def _on_cleanup(app):
+    await close_session()
+
+
+def create_app(config=None, db=None, cloud_api=None, onpremise_api=None,
+               mapping_store=None, configure_logging: bool = True) -> web.Application:
+    """Tạo aiohttp application với các route giống app.py (service tạo lazy như app.create_app)"""
+    config = config or Config
+
+    if configure_logging:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        setup_logging(LOG_FILE)
+
+    if db is not None:
+        database_simple.db.set_instance(db)
+    elif config is not Config:
+        database_simple.db.reset(lambda: create_storage(config))
+    if cloud_api is not None:
+        globals()['cloud_api'].set_instance(cloud_api)
+    if onpremise_api is not None:
+        globals()['onpremise_api'].set_instance(onpremise_api)
+    if mapping_store is not None:
+        agent_mapping_config.agent_mapping.set_instance(mapping_store)
+
+    application = web.Application()
+    application.router.add_get('/health', health_check)
+    application.router.add_get('/metrics', metrics_endpoint)
+    application.router.add_get('/api/mappings', query_mappings)
+    application.router.add_get('/api/webhook-logs', query_webhook_logs)
+    application.router.add_get('/api/webhook-logs/counts', count_webhook_logs)
+    application.router.add_get('/api/export/{kind}', export_data)
+    application.router.add_post('/webhook/ladesk-cloud', ladesk_cloud_webhook)
+    application.router.add_post('/webhook/ladesk-onpremise', ladesk_onpremise_webhook)
+    application.on_cleanup.append(_on_cleanup)
+    return application
+
+
+def __getattr__(name):
+    # `gunicorn async_app:app`: chỉ tạo app khi thực sự cần
+    if name == 'app':
+        application = create_app()
+        globals()['app'] = application
+        return application
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if __name__ == '__main__':
+    logger.info("🚀 Starting Ladesk Integration API (async)...")
+    web.run_app(create_app(), host=Config.HOST, port=Config.PORT)
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+Attachments
+Chuyển tiếp file đính kèm giữa Cloud và On-Premise: ảnh/file khách hàng gửi
+qua Facebook đi cùng ticket On-Premise, file agent đính kèm đi cùng reply về
+Cloud
+
+- Webhook mang danh sách file trong trường `attachments`: list object
+  {url, name, type, size}, list URL, hoặc chuỗi (JSON hay URL cách nhau bởi
+  dấu phẩy/xuống dòng) khi là biến template của LiveAgent
+- Tải về theo chunk vào SpooledAttachment: giữ trong RAM tới
+  ATTACHMENT_SPOOL_BYTES, lớn hơn thì chuyển sang file tạm; vượt
+  ATTACHMENT_MAX_BYTES thì dừng ngay (Content-Length được kiểm tra trước)
+- Upload (POST /api/v3/files của service đích) đọc dần từ file, không nạp cả
+  file vào RAM; file id được gửi trong trường attachments của ticket/message
+- Cache dùng chung (shared_cache.py) theo URL nguồn và theo sha256 nội dung:
+  cùng URL không tải lại, cùng nội dung ở URL khác không upload lại
+- File không chuyển được không làm hỏng message: link của file được thêm vào
+  cuối nội dung để người nhận vẫn mở được
+- Chỉ tải từ server Ladesk đã cấu hình (chỉ các path file trong
+  ATTACHMENT_LADESK_PATHS, vì request tới server Ladesk kèm apikey) và các host
+  trong ATTACHMENT_ALLOWED_HOSTS (host này phải trỏ tới địa chỉ public); redirect
+  được kiểm tra lại từng bước, webhook không dùng được server này để đọc API
+  Ladesk hay dịch vụ nội bộ
+"""
+
+import io
+import os
+import html
+import json
+import uuid
+import socket
+import asyncio
+import hashlib
+import logging
+import ipaddress
+import mimetypes
+import tempfile
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urljoin, urlsplit
+
+import metrics
+from config import Config
+from shared_cache import cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NAME = 'attachment'
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+_MAX_NAME_LENGTH = 200
+
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class AttachmentTooLarge(Exception):
+    """File đính kèm vượt quá ATTACHMENT_MAX_BYTES"""
+
+
+class AttachmentForbidden(Exception):
+    """URL file đính kèm không được phép tải (host ngoài allowlist hoặc địa chỉ nội bộ)"""
+
+
+def same_origin(url: str, base_url: str) -> bool:
+    """URL có nằm trên cùng server với base_url không (chỉ khi đó mới gửi kèm apikey)"""
+    target, base = urlsplit(url), urlsplit(base_url)
+    return (target.scheme, target.netloc.lower()) == (base.scheme, base.netloc.lower())
+
+
+def _origin(url: str) -> Tuple[str, str, int]:
+    parts = urlsplit(url)
+    return parts.scheme, (parts.hostname or '').lower(), parts.port or _DEFAULT_PORTS.get(parts.scheme, 0)
+
+
+def _ladesk_origins() -> set:
+    """Server Ladesk đã cấu hình: được tải kể cả khi nằm trong mạng nội bộ (On-Premise)"""
+    return {_origin(url) for url in (Config.LADESK_CLOUD_BASE_URL_V1, Config.LADESK_CLOUD_BASE_URL_V3,
+                                     Config.LADESK_ONPREMISE_BASE_URL_V1, Config.LADESK_ONPREMISE_BASE_URL_V3)}
+
+
+def _allowed_host(host: str) -> bool:
+    """Host nằm trong ATTACHMENT_ALLOWED_HOSTS ('.fbcdn.net' khớp cả fbcdn.net và mọi subdomain)"""
+    for pattern in Config.ATTACHMENT_ALLOWED_HOSTS.split(','):
+        pattern = pattern.strip().lower()
+        if not pattern:
+            continue
+        if pattern.startswith('.'):
+            if host == pattern[1:] or host.endswith(pattern):
+                return True
+        elif host == pattern:
+            return True
+    return False
+
+
+def _ladesk_download_path(path: str) -> bool:
+    """Path nằm dưới một prefix file của ATTACHMENT_LADESK_PATHS (không có '..' để thoát ra ngoài)"""
+    segments = unquote(path).replace('\\', '/').split('/')
+    if '..' in segments or '.' in segments:
+        return False
+    return any(path.startswith(prefix.strip()) for prefix in Config.ATTACHMENT_LADESK_PATHS.split(',')
+               if prefix.strip())
+
+
+def _host_to_resolve(url: str) -> Optional[Tuple[str, int]]:
+    """(host, port) cần kiểm tra địa chỉ, None nếu là file trên server Ladesk; AttachmentForbidden nếu không được phép"""
+    scheme, host, port = _origin(url)
+    if scheme not in ('http', 'https') or not host:
+        raise AttachmentForbidden(f"Unsupported attachment URL: {url}")
+    if (scheme, host, port) in _ladesk_origins():
+        # URL từ webhook được tải kèm apikey: chỉ cho phép path file, không cho đọc API
+        if not _ladesk_download_path(urlsplit(url).path):
+            raise AttachmentForbidden(f"Attachment path not allowed on Ladesk server: {urlsplit(url).path}")
+        return None
+    if not _allowed_host(host):
+        raise AttachmentForbidden(f"Attachment host not allowed: {host}")
+    return host, port
+
+
+def _check_addresses(host: str, infos) -> None:
+    """Mọi địa chỉ của host phải là địa chỉ public (không private/loopback/link-local/reserved)"""
+    if not infos:
+        raise AttachmentForbidden(f"Attachment host does not resolve: {host}")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise AttachmentForbidden(f"Attachment host {host} resolves to non-public address {address}")
+
+
+def check_download_url(url: str) -> None:
+    """Kiểm tra URL trước khi tải (và trước mỗi redirect); raise AttachmentForbidden nếu không được phép"""
+    target = _host_to_resolve(url)
+    if target:
+        try:
+            infos = socket.getaddrinfo(target[0], target[1], type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise AttachmentForbidden(f"Attachment host does not resolve: {target[0]} ({e})")
+        _check_addresses(target[0], infos)
+
+
+async def check_download_url_async(url: str) -> None:
+    target = _host_to_resolve(url)
+    if target:
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(target[0], target[1], type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise AttachmentForbidden(f"Attachment host does not resolve: {target[0]} ({e})")
+        _check_addresses(target[0], infos)
+
+
+def redirect_target(url: str, location: str, headers: dict) -> Tuple[str, dict]:
+    """URL tiếp theo của redirect; apikey chỉ giữ khi vẫn cùng server"""
+    if not location:
+        raise AttachmentForbidden(f"Redirect without Location: {url}")
+    next_url = urljoin(url, location)
+    return next_url, (headers if same_origin(next_url, url) else {})
+
+
+def _safe_name(name: str) -> str:
+    """Tên file không chứa đường dẫn/ký tự điều khiển, dùng được trong header multipart"""
+    name = os.path.basename(name.replace('\\', '/'))
+    name = ''.join(char for char in name if char.isprintable() and char != '"').strip()
+    return name[-_MAX_NAME_LENGTH:] or DEFAULT_NAME
+
+
+def _name_from_url(url: str) -> str:
+    return _safe_name(unquote(urlsplit(url).path))
+
+
+def _ref(url, name=None, content_type=None, size=None) -> Optional[Dict]:
+    url = str(url or '').strip()
+    if urlsplit(url).scheme not in ('http', 'https'):
+        return None
+    try:
+        size = int(size) if size not in (None, '') else None
+    except (TypeError, ValueError):
+        size = None
+    return {
+        'url': url,
+        'name': _safe_name(str(name)) if name else _name_from_url(url),
+        'type': content_type or None,
+        'size': size,
+    }
+
+
+def attachment_refs(value) -> List[Dict]:
+    """Danh sách file đính kèm {url, name, type, size} từ trường attachments của webhook,
+    bỏ qua phần tử không có URL http(s), tối đa ATTACHMENT_MAX_FILES file"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        text = value.strip()
+        if text.startswith('['):
+            try:
+                value = json.loads(text)
+            except ValueError:
+                value = []
+        else:
+            value = text.replace('\n', ',').split(',')
+    if isinstance(value, dict):
+        value = [value]
+    if not isinstance(value, list):
+        return []
+
+    refs, seen = [], set()
+    for item in value:
+        if isinstance(item, dict):
+            ref = _ref(item.get('url') or item.get('download_url') or item.get('link'),
+                       item.get('name') or item.get('filename'),
+                       item.get('type') or item.get('mimetype') or item.get('content_type'),
+                       item.get('size') or item.get('filesize'))
+        else:
+            ref = _ref(item)
+        if ref and ref['url'] not in seen:
+            seen.add(ref['url'])
+            refs.append(ref)
+    if len(refs) > Config.ATTACHMENT_MAX_FILES:
+        logger.warning("⚠️ Webhook has %s attachments, forwarding the first %s", len(refs), Config.ATTACHMENT_MAX_FILES)
+    return refs[:Config.ATTACHMENT_MAX_FILES]
+
+
+class SpooledAttachment:
+    """Nội dung một file đang chuyển: SpooledTemporaryFile (RAM tới spool_bytes, sau đó là file
+    tạm), kích thước và sha256 tính trong lúc ghi; ghi quá max_bytes thì AttachmentTooLarge"""
+
+    def __init__(self, name: str, content_type: str = None, max_bytes: int = None, spool_bytes: int = None):
+        self.name = _safe_name(name or DEFAULT_NAME)
+        self.content_type = (content_type or mimetypes.guess_type(self.name)[0] or DEFAULT_CONTENT_TYPE)
+        self.max_bytes = Config.ATTACHMENT_MAX_BYTES if max_bytes is None else max_bytes
+        self.file = tempfile.SpooledTemporaryFile(
+            max_size=Config.ATTACHMENT_SPOOL_BYTES if spool_bytes is None else spool_bytes, prefix='ladesk-attachment-')
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def check_declared_size(self, content_length):
+        """Từ chối trước khi tải nếu Content-Length đã vượt giới hạn"""
+        if content_length and int(content_length) > self.max_bytes:
+            raise AttachmentTooLarge(f"{self.name}: {content_length} bytes > {self.max_bytes}")
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise AttachmentTooLarge(f"{self.name}: more than {self.max_bytes} bytes")
+        self._hash.update(chunk)
+        self.file.write(chunk)
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def on_disk(self) -> bool:
+        """Đã chuyển sang file tạm chưa"""
+        return self.file._rolled
+
+    def rewind(self):
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self) -> 'SpooledAttachment':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"SpooledAttachment(name={self.name!r}, size={self.size}, on_disk={self.on_disk})"
+
+
+class MultipartStream:
+    """Body multipart/form-data (một field file) đọc dần từ SpooledAttachment: requests biết trước
+    Content-Length qua len() và gửi từng block thay vì dựng cả body trong RAM"""
+
+    def __init__(self, attachment: SpooledAttachment, field: str = 'file'):
+        self.boundary = uuid.uuid4().hex
+        head = (f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{field}"; filename="{attachment.name}"\r\n'
+                f'Content-Type: {attachment.content_type}\r\n\r\n').encode('utf-8')
+        tail = f'\r\n--{self.boundary}--\r\n'.encode('ascii')
+        attachment.rewind()
+        self._parts = [io.BytesIO(head), attachment.file, io.BytesIO(tail)]
+        self.length = len(head) + attachment.size + len(tail)
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b''.join(part.read() for part in self._parts)
+        data = b''
+        while self._parts and len(data) < size:
+            chunk = self._parts[0].read(size - len(data))
+            if chunk:
+                data += chunk
+            else:
+                self._parts.pop(0)
+        return data
+
+
+def message_with_attachments(message: str, refs: List[Dict], failed: List[Dict], as_html: bool = False) -> str:
+    """Nội dung message kèm link các file không chuyển được; message rỗng (chỉ gửi file) thì dùng tên file.
+    as_html: message là HTML (reply của agent) nên link được thêm dạng <p><a>...</a></p>"""
+    if as_html:
+        links = ''.join(f'<p>📎 <a href="{html.escape(ref["url"])}">{html.escape(ref["name"])}</a></p>'
+                        for ref in failed)
+        return (message or '') + links
+    lines = [message] if message and message.strip() else []
+    lines.extend(f"📎 {ref['name']}: {ref['url']}" for ref in failed)
+    if not lines and refs:
+        lines.append('📎 ' + ', '.join(ref['name'] for ref in refs))
+    return '\n'.join(lines)
+
+
+def _cache_enabled() -> bool:
+    return Config.ATTACHMENT_CACHE_TTL > 0
+
+
+def _too_large(ref: Dict) -> Optional[Dict]:
+    if ref['size'] and ref['size'] > Config.ATTACHMENT_MAX_BYTES:
+        return {'success': False, 'error': f"{ref['name']}: {ref['size']} bytes > {Config.ATTACHMENT_MAX_BYTES}",
+                'status_code': 413}
+    return None
+
+
+def _uploaded(target: str, attachment: SpooledAttachment, upload_result: Dict) -> Dict:
+    if not upload_result['success']:
+        return upload_result
+    data = upload_result['data'].get('response', upload_result['data'])
+    if not data.get('id'):
+        return {'success': False, 'error': f"Upload response without file id: {upload_result['data']}"}
+    logger.info("✅ Uploaded attachment %s (%s bytes, %s) to %s: %s", attachment.name, attachment.size,
+                'spooled to disk' if attachment.on_disk else 'in memory', target, data['id'])
+    return {'success': True, 'file_id': str(data['id']), 'name': attachment.name, 'size': attachment.size,
+            'sha256': attachment.sha256}
+
+
+def _finish(target: str, ref: Dict, result: Dict, outcome: str, failed: List[Dict], file_ids: List[str]):
+    if result['success']:
+        file_ids.append(result['file_id'])
+    else:
+        outcome = {413: 'too_large', 403: 'forbidden'}.get(result.get('status_code'), 'failed')
+        logger.warning("⚠️ Could not forward attachment %s to %s: %s", ref['url'], target, result['error'])
+        failed.append(ref)
+    metrics.record_attachment(target, outcome)
+
+
+def _transfer(ref: Dict, source, target_api, target: str, state: Dict) -> Dict:
+    """Tải ref từ source rồi upload lên target_api (bỏ qua upload nếu nội dung đã có trên target)"""
+    result = _too_large(ref)
+    if result:
+        return result
+    download = source.download_attachment(ref['url'], ref['name'], ref['type'])
+    if not download['success']:
+        return download
+    with download['attachment'] as attachment:
+        metrics.record_attachment_bytes(target, 'download', attachment.size)
+        hash_key = f"attachment_hash:{target}:{attachment.sha256}"
+        if _cache_enabled():
+            existing = cache.get(hash_key)
+            if existing:
+                state['outcome'] = 'deduplicated'
+                return existing
+        result = _uploaded(target, attachment, target_api.upload_attachment(attachment))
+        if result['success']:
+            metrics.record_attachment_bytes(target, 'upload', attachment.size)
+            if _cache_enabled():
+                cache.set(hash_key, result, Config.ATTACHMENT_CACHE_TTL)
+        return result
+
+
+def forward_attachments(refs: List[Dict], source, target_api, target: str) -> Tuple[List[str], List[Dict]]:
+    """Chuyển các file (tuần tự, mỗi lúc chỉ một file trong RAM/file tạm) sang target ('cloud'/'onpremise');
+    trả về (file id trên target, các ref không chuyển được)"""
+    file_ids, failed = [], []
+    for ref in refs:
+        state = {'outcome': 'uploaded'}
+        try:
+            if _cache_enabled():
+                state['outcome'] = 'cached'
+
+                def compute(ref=ref):
+                    state['outcome'] = 'uploaded'
+                    return _transfer(ref, source, target_api, target, state)
+
+                result = cache.get_or_compute(f"attachment:{target}:{ref['url']}", compute,
+                                              Config.ATTACHMENT_CACHE_TTL, cache_name='attachment')
+            else:
+                result = _transfer(ref, source, target_api, target, state)
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        _finish(target, ref, result, state['outcome'], failed, file_ids)
+    return file_ids, failed
+
+
+async def _transfer_async(ref: Dict, source, target_api, target: str, state: Dict) -> Dict:
+    result = _too_large(ref)
+    if result:
+        return result
+    download = await source.download_attachment(ref['url'], ref['name'], ref['type'])
+    if not download['success']:
+        return download
+    with download['attachment'] as attachment:
+        metrics.record_attachment_bytes(target, 'download', attachment.size)
+        hash_key = f"attachment_hash:{target}:{attachment.sha256}"
+        if _cache_enabled():
+            existing = await asyncio.to_thread(cache.get, hash_key)
+            if existing:
+                state['outcome'] = 'deduplicated'
+                return existing
+        result = _uploaded(target, attachment, await target_api.upload_attachment(attachment))
+        if result['success']:
+            metrics.record_attachment_bytes(target, 'upload', attachment.size)
+            if _cache_enabled():
+                await asyncio.to_thread(cache.set, hash_key, result, Config.ATTACHMENT_CACHE_TTL)
+        return result
+
+
+async def forward_attachments_async(refs: List[Dict], source, target_api,
+                                    target: str) -> Tuple[List[str], List[Dict]]:
+    """forward_attachments cho client async"""
+    file_ids, failed = [], []
+    for ref in refs:
+        state = {'outcome': 'uploaded'}
+        try:
+            if _cache_enabled():
+                state['outcome'] = 'cached'
+
+                async def compute(ref=ref):
+                    state['outcome'] = 'uploaded'
+                    return await _transfer_async(ref, source, target_api, target, state)
+
+                result = await cache.get_or_compute_async(f"attachment:{target}:{ref['url']}", compute,
+                                                          Config.ATTACHMENT_CACHE_TTL, cache_name='attachment')
+            else:
+                result = await _transfer_async(ref, source, target_api, target, state)
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        _finish(target, ref, result, state['outcome'], failed, file_ids)
+    return file_ids, failed
@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+"""
+Backfill
+Đồng bộ lại lịch sử conversation Cloud sang On-Premise: dùng khi onboard một
+On-Premise mới hoặc sau sự cố làm mất webhook.
+
+Với mỗi conversation: lấy chi tiết (get_conversation_details) và toàn bộ
+message (get_conversation_messages), chọn các tin của khách hàng (type M,
+người gửi là owner của conversation) trong khoảng [--since, --until), rồi:
+- conversation đã có mapping: thêm các tin còn thiếu vào ticket mới nhất
+  của mapping (update_ticket_message). Nếu mapping do webhook Cloud tạo thì
+  các tin khác đã được gửi trực tiếp: chỉ thêm tin sau lúc tạo mapping
+  (created_at, UTC) và trong [--since, --until); không có --since thì bỏ qua
+  conversation (status skipped) thay vì gửi lại toàn bộ lịch sử
+
+Mọi so sánh thời gian dùng UTC: datecreated của Cloud được đổi từ
+LADESK_CLOUD_TIMEZONE, --since/--until/--changed-since không ghi timezone
+cũng được hiểu theo giờ Cloud.
+- chưa có mapping: tạo contact + ticket với tin đầu tiên như webhook Cloud,
+  tạo mapping, các tin sau được thêm vào ticket đó
+
+Idempotent: mỗi tin đã gửi sang On-Premise được ghi vào checkpoint SQLite
+(BACKFILL_DB_PATH) ngay sau khi gửi thành công nên chạy lại (cùng hoặc khác
+--job) không tạo ticket/tin trùng; nếu process chết giữa lúc gửi và lúc ghi
+thì tối đa một tin bị gửi lại. Trạng thái từng conversation và trang đã liệt
+kê được lưu theo --job: chạy lại cùng lệnh sẽ bỏ qua conversation đã xong và
+thử lại conversation lỗi. Job ghi nhớ conversation đã xong theo khoảng
+--since/--until của lần chạy đầu: đổi khoảng thời gian thì dùng --job mới.
+
+Chạy BACKFILL_CONCURRENCY conversation song song (tin trong một conversation
+gửi tuần tự để giữ thứ tự), mỗi service giới hạn BACKFILL_RATE_LIMIT
+request/giây; 429/5xx/lỗi kết nối được thử lại BACKFILL_RETRIES lần với thời
+gian chờ tăng gấp đôi (tạo contact/ticket/tin chỉ thử lại khi 429 để không tạo
+trùng). Mỗi --job chỉ nên chạy bởi một process.
+
+    python backfill.py --conversations k8s9d7f6,a1b2c3d4 --job onboard
+    python backfill.py --file conversations.txt --since 2024-05-01T08:00:00 --until 2024-05-01T12:30:00
+    python backfill.py --changed-since 2024-05-01 --since 2024-05-01T08:00:00 --job outage-0501 --concurrency 8
+    python backfill.py --since 2024-05-01T08:00:00 --job outage-0501   # tiếp tục các conversation chưa xong
+    python backfill.py --job outage-0501 --status
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+
+import time
+import sqlite3
+import argparse
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone, tzinfo
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import webhook_logic
+from config import Config
+from query_api import normalize_timestamp, parse_timezone, utc_to_local
+
+logger = logging.getLogger(__name__)
+
+# Loại message được coi là tin của khách hàng (N = note, các loại khác là header/hệ thống)
+CUSTOMER_MESSAGE_TYPES = ('M',)
+
+DEFAULT_SUBJECT = 'Facebook Message'
+
+
+def _now() -> str:
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class RateLimiter:
+    """Token bucket dùng chung giữa các thread: tối đa rate request/giây (rate <= 0 là không giới hạn)"""
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Chờ đến khi có token"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class BackfillCheckpoint:
+    """Trạng thái backfill trong SQLite: tin đã đồng bộ và ticket đã tạo (dùng chung mọi job), trạng thái
+    từng conversation và trang liệt kê của mỗi job"""
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or Config.BACKFILL_DB_PATH
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10.0)
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS backfill_messages (
+                    conversation_id TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    ticket_id TEXT NOT NULL,
+                    synced_at TEXT NOT NULL,
+                    PRIMARY KEY (conversation_id, message_id)
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS backfill_tickets (
+                    conversation_id TEXT NOT NULL,
+                    ticket_id TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    PRIMARY KEY (conversation_id, ticket_id)
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS backfill_conversations (
+                    job TEXT NOT NULL,
+                    conversation_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    tickets_created INTEGER NOT NULL DEFAULT 0,
+                    messages_synced INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (job, conversation_id)
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_backfill_conversations_status
+                ON backfill_conversations(job, status)
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS backfill_jobs (
+                    job TEXT PRIMARY KEY,
+                    next_page INTEGER NOT NULL,
+                    listing_done INTEGER NOT NULL DEFAULT 0,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+
+    # Tin đã đồng bộ
+    def synced_messages(self, conversation_id: str) -> List[Tuple[str, str]]:
+        """(message_id, ticket_id) đã gửi sang On-Premise, theo thứ tự gửi"""
+        with self._connect() as conn:
+            return conn.execute(
+                'SELECT message_id, ticket_id FROM backfill_messages WHERE conversation_id = ? ORDER BY rowid',
+                (conversation_id,)
+            ).fetchall()
+
+    def record_message(self, conversation_id: str, message_id: str, ticket_id: str, created_ticket: bool = False):
+        """created_ticket: ticket vừa được backfill tạo với tin này"""
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO backfill_messages (conversation_id, message_id, ticket_id, synced_at) '
+                'VALUES (?, ?, ?, ?)', (conversation_id, message_id, ticket_id, _now())
+            )
+            if created_ticket:
+                conn.execute(
+                    'INSERT OR IGNORE INTO backfill_tickets (conversation_id, ticket_id, created_at) VALUES (?, ?, ?)',
+                    (conversation_id, ticket_id, _now())
+                )
+
+    def created_tickets(self, conversation_id: str) -> List[str]:
+        """Ticket do backfill tạo cho conversation (ticket khác là của luồng webhook)"""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                'SELECT ticket_id FROM backfill_tickets WHERE conversation_id = ?', (conversation_id,)
+            )]
+
+    # Trạng thái conversation theo job
+    def conversation_status(self, job: str, conversation_id: str) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT status FROM backfill_conversations WHERE job = ? AND conversation_id = ?',
+                (job, conversation_id)
+            ).fetchone()
+        return row[0] if row else None
+
+    def enqueue(self, job: str, conversation_id: str):
+        """Ghi nhận conversation của job (status pending) trước khi xử lý, để lần chạy sau tiếp tục được"""
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO backfill_conversations (job, conversation_id, status, updated_at) '
+                "VALUES (?, ?, 'pending', ?)", (job, conversation_id, _now())
+            )
+
+    def finish(self, job: str, conversation_id: str, status: str, tickets_created: int, error: str = None):
+        """Kết quả một lần xử lý; messages_synced là tổng số tin đã đồng bộ của conversation"""
+        with self._connect() as conn:
+            conn.execute('''
+                INSERT INTO backfill_conversations
+                (job, conversation_id, status, tickets_created, messages_synced, error, updated_at)
+                VALUES (?, ?, ?, ?, (SELECT COUNT(*) FROM backfill_messages WHERE conversation_id = ?), ?, ?)
+                ON CONFLICT (job, conversation_id) DO UPDATE SET
+                    status = excluded.status,
+                    tickets_created = tickets_created + excluded.tickets_created,
+                    messages_synced = excluded.messages_synced,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at
+            ''', (job, conversation_id, status, tickets_created, conversation_id, error, _now()))
+
+    def unfinished(self, job: str) -> List[str]:
+        """Conversation của job chưa xong (pending hoặc failed) từ các lần chạy trước"""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT conversation_id FROM backfill_conversations WHERE job = ? AND status != 'done' ORDER BY rowid",
+                (job,)
+            )]
+
+    # Trang liệt kê conversation
+    def listing_page(self, job: str) -> Tuple[int, bool]:
+        """(trang tiếp theo, đã liệt kê hết)"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT next_page, listing_done FROM backfill_jobs WHERE job = ?', (job,)).fetchone()
+        return (row[0], bool(row[1])) if row else (1, False)
+
+    def save_listing_page(self, job: str, next_page: int, done: bool):
+        with self._connect() as conn:
+            conn.execute('''
+                INSERT INTO backfill_jobs (job, next_page, listing_done, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (job) DO UPDATE SET
+                    next_page = excluded.next_page, listing_done = excluded.listing_done, updated_at = excluded.updated_at
+            ''', (job, next_page, int(done), _now()))
+
+    def summary(self, job: str) -> Dict[str, Dict[str, int]]:
+        """Theo status: số conversation, ticket đã tạo, tin đã đồng bộ"""
+        with self._connect() as conn:
+            rows = conn.execute('''
+                SELECT status, COUNT(*), SUM(tickets_created), SUM(messages_synced)
+                FROM backfill_conversations WHERE job = ? GROUP BY status
+            ''', (job,)).fetchall()
+        return {status: {'conversations': count, 'tickets_created': tickets or 0, 'messages_synced': messages or 0}
+                for status, count, tickets, messages in rows}
+
+
+def customer_messages(messages: List[Dict], owner_id: Optional[str], since: str = None,
+                      until: str = None, cloud_tz: tzinfo = timezone.utc) -> List[Dict]:
+    """Tin của khách hàng trong [since, until) (UTC) theo thứ tự thời gian; không biết owner thì lấy mọi
+    tin type M. datecreated theo giờ Cloud (cloud_tz), mỗi tin trả về có thêm created_utc"""
+    selected = []
+    for message in messages:
+        if (message['type'] not in CUSTOMER_MESSAGE_TYPES or not message['message'].strip() or not message['id']
+                or owner_id and message['userid'] != owner_id):
+            continue
+        created_utc = normalize_timestamp(message['datecreated'], cloud_tz)
+        if (not since or created_utc >= since) and (not until or created_utc < until):
+            selected.append(dict(message, created_utc=created_utc))
+    return sorted(selected, key=lambda message: message['created_utc'])  # sort ổn định: giữ thứ tự của API
+
+
+def _retryable(result: Dict, idempotent: bool) -> bool:
+    """429 luôn thử lại; 5xx/lỗi kết nối chỉ thử lại với request đọc"""
+    status_code = result.get('status_code')
+    if status_code == 429:
+        return True
+    return idempotent and (status_code is None or status_code >= 500)
+
+
+class BackfillJob:
+    """Đồng bộ một tập conversation Cloud sang On-Premise với số luồng và tốc độ giới hạn"""
+
+    def __init__(self, storage, checkpoint: BackfillCheckpoint, job: str, cloud_api=None, onpremise_api=None,
+                 concurrency: int = None, rate_limit: float = None, retries: int = None,
+                 retry_backoff: float = None, since: str = None, until: str = None, dry_run: bool = False,
+                 cloud_tz: tzinfo = None):
+        from ladesk_api import LadeskCloudAPI, LadeskOnPremiseAPI
+        self.storage = storage
+        self.checkpoint = checkpoint
+        self.job = job
+        self.cloud_api = cloud_api or LadeskCloudAPI()
+        self.onpremise_api = onpremise_api or LadeskOnPremiseAPI()
+        self.concurrency = max(1, concurrency or Config.BACKFILL_CONCURRENCY)
+        rate = Config.BACKFILL_RATE_LIMIT if rate_limit is None else rate_limit
+        self.limiters = {'cloud': RateLimiter(rate), 'onpremise': RateLimiter(rate)}
+        self.retries = Config.BACKFILL_RETRIES if retries is None else retries
+        self.retry_backoff = Config.BACKFILL_RETRY_BACKOFF if retry_backoff is None else retry_backoff
+        # since/until là UTC như created_at của mapping, datecreated của Cloud được đổi từ cloud_tz
+        self.since = since
+        self.until = until
+        self.cloud_tz = cloud_tz or parse_timezone(Config.LADESK_CLOUD_TIMEZONE)
+        self.dry_run = dry_run
+        self.stats = {'conversations': 0, 'done': 0, 'failed': 0, 'skipped': 0, 'tickets_created': 0,
+                      'messages_synced': 0, 'messages_pending': 0, 'retries': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                self.stats[name] += delta
+
+    def _call(self, service: str, func, *args, idempotent: bool = True) -> Dict:
+        """Gọi API qua rate limiter, thử lại với thời gian chờ tăng gấp đôi"""
+        for attempt in range(self.retries + 1):
+            self.limiters[service].acquire()
+            result = func(*args)
+            if result.get('success') or attempt == self.retries or not _retryable(result, idempotent):
+                return result
+            delay = self.retry_backoff * 2 ** attempt
+            logger.warning("⚠️ %s.%s failed (%s), retry %s/%s in %.1fs", service, func.__name__,
+                           result.get('status_code', result.get('error')), attempt + 1, self.retries, delay)
+            self._count(retries=1)
+            time.sleep(delay)
+        return result
+
+    # Một conversation
+    def sync_conversation(self, conversation_id: str) -> Dict:
+        """Đồng bộ các tin còn thiếu của một conversation, trả về {'status', 'tickets', 'messages', 'error'}"""
+        outcome = {'status': 'done', 'tickets': 0, 'messages': 0, 'pending': 0, 'error': None}
+        if not self.dry_run and self.checkpoint.conversation_status(self.job, conversation_id) == 'done':
+            outcome['status'] = 'skipped'
+            return outcome
+        try:
+            self._sync(conversation_id, outcome)
+        except Exception as e:
+            logger.error("❌ Backfill error for conversation %s: %s", conversation_id, e)
+            outcome.update(status='failed', error=str(e))
+        if not self.dry_run:
+            self.checkpoint.finish(self.job, conversation_id, outcome['status'], outcome['tickets'], outcome['error'])
+        return outcome
+
+    def _sync(self, conversation_id: str, outcome: Dict):
+        details_result = self._call('cloud', self.cloud_api.get_conversation_details, conversation_id)
+        if not details_result['success']:
+            outcome.update(status='failed', error=f"get_conversation_details: {details_result['error']}")
+            return
+        details = details_result['data'].get('response', details_result['data'])
+        messages_result = self._call('cloud', self.cloud_api.get_conversation_messages, conversation_id)
+        if not messages_result['success']:
+            outcome.update(status='failed', error=f"get_conversation_messages: {messages_result['error']}")
+            return
+
+        owner_id = details.get('owner_contactid') or details.get('ownerid') or details.get('contactid')
+        synced = self.checkpoint.synced_messages(conversation_id)
+        synced_ids = {message_id for message_id, _ in synced}
+        mapping = self.storage.get_mapping_by_conversation(conversation_id)
+        # Mapping do webhook Cloud tạo (ticket không phải của backfill): các tin tới lúc tạo mapping đã có
+        # trên On-Premise, tin sau đó chỉ thiếu trong khoảng mất webhook nên bắt buộc có --since
+        live_mapping = mapping and mapping.onpremise_ticket_id not in self.checkpoint.created_tickets(conversation_id)
+        if live_mapping and not self.since:
+            logger.warning("⚠️ Conversation %s already mapped to ticket %s, skipped (needs --since)",
+                           conversation_id, mapping.onpremise_ticket_id)
+            outcome.update(status='skipped', error='mapped conversation requires --since')
+            return
+        pending = [message for message in customer_messages(messages_result['data'], owner_id, self.since,
+                                                            self.until, self.cloud_tz)
+                   if message['id'] not in synced_ids
+                   and not (live_mapping and message['created_utc'] <= mapping.created_at)]
+        outcome['pending'] = len(pending)
+        if not pending or self.dry_run:
+            return
+
+        # Ticket để thêm tin: ticket mới nhất của mapping, hoặc ticket đã tạo ở lần chạy trước
+        # (mapping chưa kịp lưu), nếu không thì tạo ticket với tin đầu tiên
+        if mapping:
+            ticket_id, customer_email = mapping.onpremise_ticket_id, mapping.customer_email
+        else:
+            ticket_id, customer_email = self._create_ticket(conversation_id, details, owner_id, pending, synced, outcome)
+            if ticket_id is None:
+                return
+
+        for message in pending:
+            result = self._call('onpremise', self.onpremise_api.update_ticket_message, {
+                'ticketid': ticket_id, 'message': webhook_logic.onpremise_message(message['message']),
+                'useridentifier': customer_email
+            }, idempotent=False)
+            if not result['success']:
+                outcome.update(status='failed', error=f"update_ticket_message: {result['error']}")
+                return
+            self.checkpoint.record_message(conversation_id, message['id'], ticket_id)
+            outcome['messages'] += 1
+
+    def _create_ticket(self, conversation_id: str, details: Dict, owner_id: Optional[str], pending: List[Dict],
+                       synced: List[Tuple[str, str]], outcome: Dict) -> Tuple[Optional[str], Optional[str]]:
+        """Tạo contact + ticket (tin đầu tiên của pending bị lấy ra) và mapping như webhook Cloud"""
+        contact_result = self._call('cloud', self.cloud_api.get_contact_details, owner_id) if owner_id else None
+        contact_data_cloud, customer_name, customer_email = webhook_logic.customer_from_contact(
+            contact_result, conversation_id)
+        contact_data = webhook_logic.build_contact_data(contact_data_cloud, customer_name, customer_email)
+        contact_id = webhook_logic.contact_id_from_result(
+            self._call('onpremise', self.onpremise_api.create_contact, contact_data, idempotent=False))
+
+        if synced:
+            ticket_id = synced[-1][1]
+        else:
+            first = pending.pop(0)
+            ticket_data = webhook_logic.build_ticket_data(conversation_id, details.get('subject') or DEFAULT_SUBJECT,
+                                                          first['message'], customer_name, customer_email)
+            ticket_result = self._call('onpremise', self.onpremise_api.create_ticket, ticket_data, idempotent=False)
+            if not ticket_result['success']:
+                outcome.update(status='failed', error=f"create_ticket: {ticket_result['error']}")
+                return None, None
+            ticket_id = ticket_result['data'].get('code', ticket_result['data']['id'])
+            self.checkpoint.record_message(conversation_id, first['id'], ticket_id, created_ticket=True)
+            outcome['tickets'] += 1
+            outcome['messages'] += 1
+
+        # Contact tạo thất bại vẫn lưu mapping để reply của agent tìm được conversation
+        if not self.storage.create_mapping(conversation_id, ticket_id, contact_id or '', customer_name, customer_email):
+            outcome.update(status='failed', error='create_mapping failed')
+            return None, None
+        logger.info("✅ Backfill created ticket %s for conversation %s", ticket_id, conversation_id)
+        return ticket_id, customer_email
+
+    # Nhiều conversation
+    def listed_conversations(self, changed_since: str, per_page: int = 100) -> Iterator[str]:
+        """Id các conversation Cloud có thay đổi từ changed_since, tiếp tục từ trang đã lưu của job"""
+        page, done = self.checkpoint.listing_page(self.job)
+        while not done:
+            result = self._call('cloud', self.cloud_api.list_conversations, changed_since, page, per_page)
+            if not result['success']:
+                raise RuntimeError(f"list_conversations page {page}: {result['error']}")
+            tickets = result['data'] if isinstance(result['data'], list) else result['data'].get('response', [])
+            # Conversation của trang được enqueue khi lấy ra, trước khi lấy phần tử đầu của trang sau
+            for ticket in tickets:
+                yield ticket.get('conversationid') or ticket['id']
+            page, done = page + 1, len(tickets) < per_page
+            if not self.dry_run:
+                self.checkpoint.save_listing_page(self.job, page, done)
+
+    def _record(self, conversation_id: str, outcome: Dict):
+        self._count(conversations=1, tickets_created=outcome['tickets'], messages_synced=outcome['messages'],
+                    messages_pending=outcome['pending'], **{outcome['status']: 1})
+        if outcome['status'] == 'failed':
+            logger.warning("⚠️ Conversation %s failed: %s", conversation_id, outcome['error'])
+
+    def run(self, conversation_ids: Iterable[str], progress_every: int = 100) -> Dict:
+        """Xử lý các conversation (cùng các conversation chưa xong của job), tối đa concurrency
+        conversation cùng lúc; chỉ giữ tối đa 2 x concurrency conversation trong hàng đợi"""
+        start = time.perf_counter()
+        seen = set()
+        in_flight: Dict = {}
+
+        def collect(futures):
+            for future in futures:
+                self._record(in_flight.pop(future), future.result())
+                if progress_every and self.stats['conversations'] % progress_every == 0:
+                    self._print_progress(start)
+
+        previous = [] if self.dry_run else self.checkpoint.unfinished(self.job)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='backfill') as pool:
+            for conversation_id in _chain(previous, conversation_ids):
+                conversation_id = conversation_id.strip()
+                if not conversation_id or conversation_id in seen:
+                    continue
+                seen.add(conversation_id)
+                if not self.dry_run:
+                    self.checkpoint.enqueue(self.job, conversation_id)
+                if len(in_flight) >= self.concurrency * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight[pool.submit(self.sync_conversation, conversation_id)] = conversation_id
+            collect(list(in_flight))
+        self.stats['elapsed'] = time.perf_counter() - start
+        return self.stats
+
+    def _print_progress(self, start: float):
+        elapsed = time.perf_counter() - start
+        stats = self.stats
+        print(f"  ... {stats['conversations']} conversation ({stats['done']} xong, {stats['skipped']} bỏ qua, "
+              f"{stats['failed']} lỗi), {stats['tickets_created']} ticket, {stats['messages_synced']} tin, "
+              f"{stats['conversations'] / elapsed if elapsed else 0:.1f} conversation/s")
+
+
+def _chain(*iterables: Iterable[str]) -> Iterator[str]:
+    for iterable in iterables:
+        yield from iterable
+
+
+def read_conversation_ids(path: str) -> Iterator[str]:
+    """Mỗi dòng một id ('-' là stdin), bỏ dòng trống và dòng bắt đầu bằng #"""
+    handle = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        for line in handle:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def print_summary(job: str, summary: Dict[str, Dict[str, int]]):
+    print(f"📋 Backfill job '{job}'")
+    print("-" * 60)
+    print(f"  {'status':<12} {'conversations':>14} {'tickets':>10} {'messages':>10}")
+    print("-" * 60)
+    for status, values in sorted(summary.items()):
+        print(f"  {status:<12} {values['conversations']:>14} {values['tickets_created']:>10} "
+              f"{values['messages_synced']:>10}")
+    print("-" * 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đồng bộ lịch sử conversation Cloud sang On-Premise")
+    parser.add_argument('--job', default='default', help='Tên job (checkpoint và resume theo tên này)')
+    parser.add_argument('--conversations', help='Danh sách id conversation Cloud, cách nhau bởi dấu phẩy')
+    parser.add_argument('--file', help="File id conversation, mỗi dòng một id ('-' là stdin)")
+    parser.add_argument('--changed-since', help='Liệt kê conversation Cloud có thay đổi từ thời điểm này (ISO 8601)')
+    parser.add_argument('--since', help='Chỉ đồng bộ tin từ thời điểm này (ISO 8601)')
+    parser.add_argument('--until', help='Chỉ đồng bộ tin trước thời điểm này (ISO 8601)')
+    parser.add_argument('--concurrency', type=int, help=f'Số conversation song song (mặc định: {Config.BACKFILL_CONCURRENCY})')
+    parser.add_argument('--rate-limit', type=float,
+                        help=f'Request/giây mỗi service, 0 là không giới hạn (mặc định: {Config.BACKFILL_RATE_LIMIT})')
+    parser.add_argument('--retries', type=int, help=f'Số lần thử lại mỗi request (mặc định: {Config.BACKFILL_RETRIES})')
+    parser.add_argument('--per-page', type=int, default=100, help='Số conversation mỗi trang khi liệt kê')
+    parser.add_argument('--checkpoint', help=f'File checkpoint SQLite (mặc định: {Config.BACKFILL_DB_PATH})')
+    parser.add_argument('--dry-run', action='store_true', help='Chỉ đọc từ Cloud và đếm tin cần đồng bộ')
+    parser.add_argument('--status', action='store_true', help='In trạng thái của job rồi thoát')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        cloud_tz = parse_timezone(Config.LADESK_CLOUD_TIMEZONE)
+        since, until, changed_since = (normalize_timestamp(value, cloud_tz) if value else None
+                                       for value in (args.since, args.until, args.changed_since))
+    except ValueError as e:
+        parser.error(str(e))
+
+    checkpoint = BackfillCheckpoint(args.checkpoint)
+    if args.status:
+        print_summary(args.job, checkpoint.summary(args.job))
+        return
+
+    from database_simple import db
+    job = BackfillJob(db, checkpoint, args.job, concurrency=args.concurrency, rate_limit=args.rate_limit,
+                      retries=args.retries, since=since, until=until, dry_run=args.dry_run, cloud_tz=cloud_tz)
+    sources = []
+    if args.conversations:
+        sources.append(args.conversations.split(','))
+    if args.file:
+        sources.append(read_conversation_ids(args.file))
+    if changed_since:
+        # Bộ lọc date_changed của Cloud dùng giờ Cloud
+        sources.append(job.listed_conversations(utc_to_local(changed_since, cloud_tz), args.per_page))
+
+    print(f"🔄 Backfill job '{args.job}' ({job.concurrency} song song, "
+          f"{job.limiters['cloud'].rate or 'không giới hạn'} request/s mỗi service{', dry run' if args.dry_run else ''})")
+    stats = job.run(_chain(*sources))
+    print(f"✅ {stats['conversations']} conversation trong {stats['elapsed']:.1f}s: {stats['done']} xong, "
+          f"{stats['skipped']} bỏ qua, {stats['failed']} lỗi, {stats['tickets_created']} ticket mới, "
+          f"{stats['messages_synced']} tin đã đồng bộ, {stats['retries']} lần thử lại")
+    if args.dry_run:
+        print(f"🔍 Dry run: {stats['messages_pending']} tin cần đồng bộ")
+    else:
+        print_summary(args.job, checkpoint.summary(args.job))
+    if stats['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Benchmark SimpleDatabaseManager ở kích thước thật
+Sinh database với N mapping (kèm các conversation dài: một conversation nhiều
+ticket) và M webhook log trải đều trong --days ngày, rồi đo từng thao tác của
+database_simple.py với 1 thread và với nhiều thread đồng thời:
+
+- create_mapping, get_mapping_by_conversation/ticket/email/ticket_pattern (LIKE)/
+  ticket_prefix (khoảng trên index NOCASE)
+- update_mapping trên conversation dài (cập nhật mọi ticket của conversation)
+- log_webhook, get_webhook_logs, get_stats
+- query_webhook_logs/count_webhook_logs theo cột payload (agent_id, channel_type)
+
+In query plan (EXPLAIN QUERY PLAN của đúng câu SQL mà thao tác chạy, ⚠️ nếu
+SCAN cả bảng/index, chỉ rẻ khi LIMIT dừng sớm, hoặc phải sort bằng temp b-tree)
+và phân bố latency.
+
+    python benchmarks/bench_database.py --mappings 500000 --logs 5000000 --db /data/bench.db --threads 1,8
+    python benchmarks/bench_database.py --ops get_stats,get_mapping_by_ticket_pattern -n 200 -o db.json
+
+Database đã sinh được giữ lại khi truyền --db và dùng lại ở lần chạy sau
+(--regenerate để sinh lại).
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import json
+import time
+import random
+import string
+import sqlite3
+import argparse
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+import database_simple
+from database_simple import SimpleDatabaseManager
+from webhook_timing import percentile
+
+BATCH_SIZE = 10000
+
+# Conversation dài: id có prefix này để tìm lại khi dùng lại database có sẵn
+LONG_PREFIX = 'fb-long-'
+
+# Biên trên (ms) các bucket của histogram latency, bucket cuối là phần còn lại
+HISTOGRAM_BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+MESSAGES = ['Xin chào, tôi cần hỗ trợ đơn hàng', 'Đơn hàng của tôi chưa được giao',
+            'Cho tôi hỏi giá sản phẩm này', 'Shop ơi, còn hàng size M không?']
+
+
+def ticket_code(rng: random.Random) -> str:
+    letters = ''.join(rng.choices(string.ascii_uppercase, k=8))
+    return f"{letters[:3]}-{letters[3:]}-{rng.randint(0, 999):03d}"
+
+
+def webhook_payload(rng: random.Random, conversation_id: str, ticket: str = None) -> Dict:
+    if ticket:
+        return {'event_type': 'agent_reply', 'channel_type': 'E', 'ticket_id': ticket,
+                'conversation_id': conversation_id, 'agent_id': f"agent{rng.randrange(50)}",
+                'agent_name': 'Nguyễn Lan', 'message': '<p>Dạ, em đã kiểm tra đơn hàng ạ.</p>'}
+    return {'event_type': 'message_added', 'message_type': 'M', 'status': 'C', 'channel_type': 'A',
+            'conversation_id': conversation_id, 'contact_id': f"contact-{conversation_id}",
+            'agent_id': '{$user_id}', 'agent_name': '{$user_firstname} {$user_lastname}',
+            'message': rng.choice(MESSAGES), 'subject': 'Facebook Message'}
+
+
+# Sinh dữ liệu
+
+def _timestamps(count: int, days: int, start: datetime):
+    """count mốc thời gian tăng dần trong days ngày tính đến start (id tăng theo created_at như thật)"""
+    step = days * 86400 / max(count, 1)
+    origin = start - timedelta(days=days)
+    for i in range(count):
+        yield (origin + timedelta(seconds=i * step)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _mapping_rows(rng: random.Random, mappings: int, long_conversations: int, long_length: int, days: int):
+    long_total = long_conversations * long_length
+    # Vị trí các ticket của conversation dài, rải trong toàn bộ khoảng thời gian
+    long_slots = {}
+    if long_total:
+        for slot, position in enumerate(sorted(rng.sample(range(mappings), min(long_total, mappings)))):
+            long_slots[position] = slot % long_conversations
+    for i, created_at in enumerate(_timestamps(mappings, days, datetime.utcnow())):
+        if i in long_slots:
+            conversation_id = f"{LONG_PREFIX}{long_slots[i]:05d}"
+        else:
+            conversation_id = f"fb{i:08d}"
+        email = f"facebook_{conversation_id}@facebook.com" if rng.random() < 0.6 else f"khach{i}@example.com"
+        yield (conversation_id, ticket_code(rng), f"contact{i}", 'Facebook Customer', email, created_at, created_at)
+
+
+def _log_rows(rng: random.Random, logs: int, mappings: int, days: int):
+    for i, created_at in enumerate(_timestamps(logs, days, datetime.utcnow())):
+        conversation_id = f"fb{rng.randrange(max(mappings, 1)):08d}"
+        onpremise = rng.random() < 0.3
+        payload = webhook_payload(rng, conversation_id, ticket_code(rng) if onpremise else None)
+        raw = json.dumps(payload)
+        yield ('onpremise_incoming' if onpremise else 'cloud_incoming', payload.get('conversation_id'),
+               payload.get('ticket_id'), payload.get('contact_id'), payload['event_type'], raw, raw,
+               'received', None, created_at)
+
+
+def _insert_batches(conn: sqlite3.Connection, sql: str, rows, total: int, label: str):
+    batch, done = [], 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(sql, batch)
+            done += len(batch)
+            batch = []
+            if done % (BATCH_SIZE * 20) == 0:
+                print(f"  ... {label}: {done}/{total}")
+    if batch:
+        conn.executemany(sql, batch)
+
+
+def generate(path: str, mappings: int, logs: int, long_conversations: int, long_length: int,
+             days: int, seed: int):
+    """Tạo schema bằng SimpleDatabaseManager rồi ghi dữ liệu theo lô (không fsync, chỉ dùng cho benchmark)"""
+    rng = random.Random(seed)
+    SimpleDatabaseManager(path, auto_migrate=True)
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('BEGIN')
+        _insert_batches(conn, '''
+            INSERT INTO conversation_mappings
+            (cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id, customer_name, customer_email,
+             created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', _mapping_rows(rng, mappings, long_conversations, long_length, days), mappings, 'mappings')
+        _insert_batches(conn, '''
+            INSERT INTO webhook_logs
+            (webhook_type, conversation_id, ticket_id, contact_id, event_type, raw_data, processed_data,
+             status, error_message, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', _log_rows(rng, logs, mappings, days), logs, 'webhook_logs')
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+def row_counts(path: str) -> Dict[str, int]:
+    with sqlite3.connect(path) as conn:
+        return {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                for table in ('conversation_mappings', 'webhook_logs')}
+
+
+class Keys:
+    """Giá trị có thật trong database để tra cứu (mẫu ngẫu nhiên theo id)"""
+
+    def __init__(self, path: str, rng: random.Random, sample: int = 2000):
+        with sqlite3.connect(path) as conn:
+            max_id = conn.execute('SELECT MAX(id) FROM conversation_mappings').fetchone()[0] or 0
+            ids = [rng.randint(1, max_id) for _ in range(sample)] if max_id else []
+            rows = []
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows += conn.execute(
+                    'SELECT cloud_conversation_id, onpremise_ticket_id, customer_email FROM conversation_mappings '
+                    f"WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall()
+            self.long_conversations = [row[0] for row in conn.execute(
+                'SELECT DISTINCT cloud_conversation_id FROM conversation_mappings '
+                'WHERE cloud_conversation_id >= ? AND cloud_conversation_id < ?',
+                (LONG_PREFIX, LONG_PREFIX[:-1] + chr(ord(LONG_PREFIX[-1]) + 1))
+            )]
+        if not rows:
+            raise SystemExit('❌ Database không có mapping nào')
+        self.conversations = [row[0] for row in rows]
+        self.tickets = [row[1] for row in rows]
+        self.emails = [row[2] for row in rows]
+        # Pattern như khi tra ticket theo 2 đoạn đầu của code (ví dụ: QQX-DGGBS-%)
+        self.ticket_prefixes = [ticket[:9] for ticket in self.tickets]
+        self.ticket_patterns = [f"{prefix}-%" for prefix in self.ticket_prefixes]
+
+
+# Các thao tác: hàm (db, rng, keys) -> kết quả; kết quả falsy được tính là lỗi/không tìm thấy
+
+def _create_mapping(db, rng, keys):
+    suffix = ''.join(rng.choices(string.ascii_lowercase + string.digits, k=12))
+    return db.create_mapping(f"bench-{suffix}", ticket_code(rng), f"contact-{suffix}",
+                             'Facebook Customer', f"facebook_bench-{suffix}@facebook.com")
+
+
+def _update_long(db, rng, keys):
+    conversation_id = rng.choice(keys.long_conversations or keys.conversations)
+    return db.update_mapping(conversation_id, last_agent_reply='Dạ, em đã kiểm tra ạ.',
+                             last_agent_name='Nguyễn Lan', last_reply_time=datetime.now().isoformat())
+
+
+def _log_webhook(db, rng, keys):
+    return db.log_webhook('cloud_incoming', webhook_payload(rng, rng.choice(keys.conversations)))
+
+
+OPERATIONS: Dict[str, Callable] = {
+    'create_mapping': _create_mapping,
+    'get_mapping_by_conversation': lambda db, rng, keys: db.get_mapping_by_conversation(
+        rng.choice(keys.conversations)),
+    'get_mapping_by_ticket': lambda db, rng, keys: db.get_mapping_by_ticket(rng.choice(keys.tickets)),
+    'get_mapping_by_email': lambda db, rng, keys: db.get_mapping_by_email(rng.choice(keys.emails)),
+    'get_mapping_by_ticket_pattern': lambda db, rng, keys: db.get_mapping_by_ticket_pattern(
+        rng.choice(keys.ticket_patterns)),
+    'get_mapping_by_ticket_prefix': lambda db, rng, keys: db.get_mapping_by_ticket_prefix(
+        rng.choice(keys.ticket_prefixes)),
+    'update_mapping_long': _update_long,
+    'log_webhook': _log_webhook,
+    'get_webhook_logs': lambda db, rng, keys: db.get_webhook_logs(50),
+    'query_webhook_logs_by_agent': lambda db, rng, keys: db.query_webhook_logs(
+        limit=50, agent_id=f"agent{rng.randrange(50)}")[0],
+    'count_webhook_logs_by_channel': lambda db, rng, keys: db.count_webhook_logs(
+        'channel_type', agent_id=f"agent{rng.randrange(50)}"),
+    'get_stats': lambda db, rng, keys: db.get_stats(),
+}
+
+
+# Query plan
+
+class _TracingSqlite:
+    """Thay module sqlite3 trong database_simple trong lúc ghi lại câu SQL của một thao tác"""
+
+    def __init__(self, statements: List[str]):
+        self._statements = statements
+
+    def connect(self, *args, **kwargs):
+        conn = sqlite3.connect(*args, **kwargs)
+        conn.set_trace_callback(self._statements.append)
+        return conn
+
+    def __getattr__(self, name):
+        return getattr(sqlite3, name)
+
+
+def query_plans(path: str, db, operation: Callable, rng: random.Random, keys: Keys) -> List[Dict]:
+    """EXPLAIN QUERY PLAN của các câu SELECT/INSERT/UPDATE/DELETE mà thao tác chạy"""
+    statements: List[str] = []
+    database_simple.sqlite3 = _TracingSqlite(statements)
+    try:
+        operation(db, rng, keys)
+    finally:
+        database_simple.sqlite3 = sqlite3
+
+    plans = []
+    with sqlite3.connect(path) as conn:
+        for sql in statements:
+            if sql.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+                continue
+            steps = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+            plans.append({
+                'sql': ' '.join(sql.split()),
+                'plan': steps,
+                'scan': any(step.startswith('SCAN') for step in steps),
+                'temp_sort': any('TEMP B-TREE' in step for step in steps),
+            })
+    return plans
+
+
+# Đo latency
+
+def histogram(latencies_ms: List[float]) -> Dict[str, int]:
+    counts = {}
+    for value in latencies_ms:
+        for bound in HISTOGRAM_BUCKETS_MS:
+            if value <= bound:
+                label = f"<={bound}"
+                break
+        else:
+            label = f">{HISTOGRAM_BUCKETS_MS[-1]}"
+        counts[label] = counts.get(label, 0) + 1
+    return counts
+
+
+def run_operation(db, operation: Callable, keys: Keys, count: int, threads: int, seed: int) -> Dict:
+    """Chạy count lần, chia đều cho threads thread; latency tính theo từng lần gọi"""
+    latencies: List[float] = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def worker(index: int, n: int):
+        rng = random.Random(seed * 1000 + index)
+        local, failed = [], 0
+        for _ in range(n):
+            start = time.perf_counter()
+            result = operation(db, rng, keys)
+            local.append((time.perf_counter() - start) * 1000)
+            if not result:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            failures[0] += failed
+
+    shares = [count // threads + (1 if i < count % threads else 0) for i in range(threads)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for future in [pool.submit(worker, i, n) for i, n in enumerate(shares)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    values = sorted(latencies)
+    return {
+        'threads': threads,
+        'count': len(values),
+        'failures': failures[0],
+        'ops_per_s': len(values) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(values) / len(values) if values else 0.0,
+        'p50_ms': percentile(values, 50),
+        'p95_ms': percentile(values, 95),
+        'p99_ms': percentile(values, 99),
+        'max_ms': values[-1] if values else 0.0,
+        'histogram': histogram(values),
+    }
+
+
+def print_plans(name: str, plans: List[Dict]):
+    print(f"🔍 {name}")
+    for entry in plans:
+        flags = ' '.join(flag for flag, on in (('⚠️ scan', entry['scan']),
+                                                ('⚠️ temp sort', entry['temp_sort'])) if on)
+        print(f"    {entry['sql'][:110]}{'...' if len(entry['sql']) > 110 else ''}")
+        for step in entry['plan']:
+            print(f"      {step}")
+        if flags:
+            print(f"      {flags}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SimpleDatabaseManager ở kích thước thật")
+    parser.add_argument('--db', help='File database (giữ lại và dùng lại); mặc định file tạm')
+    parser.add_argument('--regenerate', action='store_true', help='Sinh lại dữ liệu dù --db đã có')
+    parser.add_argument('--mappings', type=int, default=100000, help='Số mapping')
+    parser.add_argument('--logs', type=int, default=500000, help='Số webhook log')
+    parser.add_argument('--long-conversations', type=int, default=20, help='Số conversation dài')
+    parser.add_argument('--long-length', type=int, default=500, help='Số ticket mỗi conversation dài')
+    parser.add_argument('--days', type=int, default=90, help='Dữ liệu trải trong bao nhiêu ngày')
+    parser.add_argument('--ops', default=','.join(OPERATIONS),
+                        help=f"Các thao tác, cách nhau bởi dấu phẩy (mặc định tất cả: {', '.join(OPERATIONS)})")
+    parser.add_argument('--iterations', '-n', type=int, default=1000, help='Số lần gọi mỗi thao tác')
+    parser.add_argument('--threads', default='1,8', help='Số thread đồng thời, ví dụ 1,4,16')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-plans', action='store_true', help='Không in query plan')
+    parser.add_argument('--output', '-o', help='Ghi kết quả (kèm histogram) ra file JSON')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Hiện log của database_simple')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.ops.split(',') if name.strip()]
+    unknown = [name for name in names if name not in OPERATIONS]
+    if unknown:
+        parser.error(f"Thao tác không hợp lệ: {', '.join(unknown)}")
+    thread_counts = [int(value) for value in args.threads.split(',')]
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = args.db or os.path.join(workdir, 'bench.db')
+        if args.regenerate and os.path.exists(path):
+            for name in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(name):
+                    os.remove(name)
+        if not os.path.exists(path):
+            print(f"🏗️ Sinh dữ liệu: {args.mappings} mapping, {args.logs} webhook log -> {path}")
+            start = time.perf_counter()
+            generate(path, args.mappings, args.logs, args.long_conversations, args.long_length,
+                     args.days, args.seed)
+            print(f"  xong trong {time.perf_counter() - start:.1f}s")
+
+        counts = row_counts(path)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        db = SimpleDatabaseManager(path)
+        keys = Keys(path, random.Random(args.seed))
+
+        plans = {}
+        if not args.no_plans:
+            print(f"📋 Query plan ({counts['conversation_mappings']} mapping, {counts['webhook_logs']} log, "
+                  f"{size_mb:.0f} MB)")
+            for name in names:
+                plans[name] = query_plans(path, db, OPERATIONS[name], random.Random(args.seed), keys)
+                print_plans(name, plans[name])
+            print()
+
+        results: Dict[str, List[Dict]] = {}
+        print(f"📊 SimpleDatabaseManager ({counts['conversation_mappings']} mapping, "
+              f"{counts['webhook_logs']} log, {args.iterations} lần mỗi thao tác)")
+        print("-" * 100)
+        print(f"  {'operation':<30} {'threads':>7} {'ops/s':>9} {'mean ms':>9} {'p50 ms':>9} "
+              f"{'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'fail':>5}")
+        print("-" * 100)
+        for name in names:
+            for threads in thread_counts:
+                result = run_operation(db, OPERATIONS[name], keys, args.iterations, threads, args.seed)
+                results.setdefault(name, []).append(result)
+                print(f"  {name:<30} {threads:>7} {result['ops_per_s']:>9.0f} {result['mean_ms']:>9.2f} "
+                      f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+                      f"{result['max_ms']:>9.2f} {result['failures']:>5}")
+        print("-" * 100)
+
+        if args.output:
+            report = {
+                'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+                'database': {'path': path, 'size_bytes': os.path.getsize(path), 'rows': counts},
+                'options': vars(args),
+                'plans': plans,
+                'results': results,
+            }
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"💾 Đã lưu kết quả: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+"""
+Benchmark end-to-end
+Gửi webhook thật qua HTTP tới /webhook/ladesk-cloud và /webhook/ladesk-onpremise,
+app gọi Ladesk giả lập (ladesk_simulator.py) thay vì server thật. Traffic gồm:
+
+- Conversation Facebook: khách gửi liên tiếp --messages tin (mỗi tin tạo một
+  ticket), sau đó agent On-Premise trả lời --replies lần theo ticket_code vừa nhận
+- Noise bị bỏ qua: note nội bộ, conversation đã đóng, event On-Premise không
+  phải agent_reply, agent_id còn là template
+- Hoặc phát lại webhook_logs.raw_data của một database có sẵn (--replay), ticket_id
+  của agent reply được đổi sang ticket_code mới theo conversation_mappings gốc
+
+Báo cáo throughput, p50/p95/p99 latency, số request gọi Ladesk trên mỗi message
+(từ /_sim/stats) và dung lượng database tăng thêm; kết quả lưu JSON để so sánh
+giữa các bản release (--compare):
+
+    python benchmarks/bench_e2e.py --conversations 200 --concurrency 16 -o e2e.json
+    python benchmarks/bench_e2e.py --app async --latency-ms 50 --latency-p99-ms 300 --error-rate 0.01
+    python benchmarks/bench_e2e.py --replay ladesk_integration.db --limit 5000
+    python benchmarks/bench_e2e.py --compare e2e-release.json --max-regression 10   # exit 1 nếu chậm hơn 10%
+
+    # Deployment có sẵn đã trỏ vào `python ladesk_simulator.py --port 9100`
+    python benchmarks/bench_e2e.py --url http://127.0.0.1:3000 --simulator-url http://127.0.0.1:9100 \\
+        --db ladesk_integration.db
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import logging
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from config import Config
+from ladesk_simulator import FaultProfile, LadeskSimulator, SimulatorThread
+from webhook_timing import percentile
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+WEBHOOK_PATHS = {
+    'cloud': '/webhook/ladesk-cloud',
+    'onpremise': '/webhook/ladesk-onpremise',
+}
+
+# webhook_type trong webhook_logs -> route
+REPLAY_ROUTES = {
+    'cloud_incoming': 'cloud',
+    'onpremise_incoming': 'onpremise',
+}
+
+CUSTOMER_MESSAGES = [
+    'Xin chào, tôi cần hỗ trợ đơn hàng',
+    'Đơn hàng của tôi chưa được giao',
+    'Cho tôi hỏi giá sản phẩm này',
+    'Tôi muốn đổi địa chỉ nhận hàng',
+    'Shop ơi, còn hàng size M không?',
+    'Cảm ơn shop!',
+]
+AGENT_REPLIES = [
+    '<p>Chào anh/chị, em đã kiểm tra đơn hàng ạ.</p>',
+    'Dạ, đơn hàng sẽ được giao trong 2-3 ngày tới.',
+    '<div>Sản phẩm hiện còn hàng, anh/chị đặt trực tiếp trên website nhé.</div>',
+]
+
+# Các chỉ số so sánh với --compare: (đường dẫn trong results, True nếu càng lớn càng tốt)
+COMPARE_METRICS = [
+    ('throughput_rps', True),
+    ('latency_ms.all.p50', False),
+    ('latency_ms.all.p95', False),
+    ('latency_ms.all.p99', False),
+    ('upstream.per_message', False),
+    ('db.bytes_per_request', False),
+]
+
+
+class Step:
+    """Một webhook trong script của một conversation
+
+    fill_ticket: thay ticket_id bằng ticket_code mới nhất mà app trả về cho
+    conversation này (agent reply chỉ biết ticket sau khi message đã được xử lý).
+    """
+    __slots__ = ('route', 'payload', 'fill_ticket')
+
+    def __init__(self, route: str, payload: Dict, fill_ticket: bool = False):
+        self.route = route
+        self.payload = payload
+        self.fill_ticket = fill_ticket
+
+
+class Sample:
+    __slots__ = ('route', 'status', 'outcome', 'latency')
+
+    def __init__(self, route: str, status: int, outcome: str, latency: float):
+        self.route = route
+        self.status = status
+        self.outcome = outcome
+        self.latency = latency
+
+
+# Traffic tổng hợp
+
+def customer_message(conversation_id: str, contact_id: str, message: str) -> Dict:
+    return {
+        'event_type': 'message_added', 'message_type': 'M', 'status': 'C', 'channel_type': 'A',
+        'conversation_id': conversation_id, 'contact_id': contact_id,
+        'agent_id': '{$user_id}', 'agent_name': '{$user_firstname} {$user_lastname}',
+        'message': message, 'subject': 'Facebook Message',
+    }
+
+
+def agent_reply(agent: Dict, message: str, conversation_id: str) -> Dict:
+    return {
+        'event_type': 'agent_reply', 'channel_type': 'E',
+        'conversation_id': conversation_id, 'ticket_id': None,
+        'agent_id': agent['contactid'], 'contactid': agent['contactid'], 'userid': agent['userid'],
+        'agent_name': f"{agent['firstname']} {agent['lastname']}", 'message': message,
+    }
+
+
+def noise_step(rng: random.Random, index: int, agents: List[Dict]) -> Step:
+    """Webhook mà app nhận, ghi log rồi bỏ qua"""
+    conversation_id = f"noise{index}"
+    kind = rng.randrange(4)
+    if kind == 0:
+        payload = customer_message(conversation_id, f"contact-noise{index}", 'Ghi chú nội bộ')
+        payload['message_type'] = 'N'
+        return Step('cloud', payload)
+    if kind == 1:
+        payload = customer_message(conversation_id, f"contact-noise{index}", rng.choice(CUSTOMER_MESSAGES))
+        payload['status'] = 'X'
+        return Step('cloud', payload)
+    if kind == 2:
+        return Step('onpremise', {'event_type': 'ticket_status_changed', 'ticket_id': f"NOI-SE{index:06d}",
+                                  'status': 'R'})
+    payload = agent_reply(rng.choice(agents), rng.choice(AGENT_REPLIES), conversation_id)
+    payload.update(agent_id='{$user_id}', contactid='', userid='')
+    return Step('onpremise', payload)
+
+
+def synthetic_scripts(rng: random.Random, conversations: int, messages: int, replies: int,
+                      noise_ratio: float, agents: List[Dict]) -> List[List[Step]]:
+    """Mỗi script là các webhook gửi tuần tự; các script chạy song song"""
+    scripts = []
+    for i in range(conversations):
+        conversation_id = f"fb{i:06d}{rng.randrange(16 ** 4):04x}"
+        contact_id = f"contact{i:06d}"
+        steps = [Step('cloud', customer_message(conversation_id, contact_id, rng.choice(CUSTOMER_MESSAGES)))
+                 for _ in range(messages)]
+        steps += [Step('onpremise', agent_reply(rng.choice(agents), rng.choice(AGENT_REPLIES), f"op-{conversation_id}"),
+                       fill_ticket=True)
+                  for _ in range(replies)]
+        scripts.append(steps)
+
+    real = conversations * (messages + replies)
+    noise = int(real * noise_ratio / (1 - noise_ratio)) if noise_ratio < 1 else 0
+    scripts += [[noise_step(rng, i, agents)] for i in range(noise)]
+    rng.shuffle(scripts)
+    return scripts
+
+
+# Phát lại webhook_logs
+
+def replay_scripts(db_path: str, agents: List[Dict], limit: int = None) -> List[List[Step]]:
+    """Nhóm webhook đã ghi theo conversation Cloud, giữ thứ tự id trong mỗi nhóm
+
+    Database nguồn chỉ được mở read-only. Agent id thật trong agent reply được
+    đổi lần lượt sang agent của simulator (cùng id gốc -> cùng agent) để app
+    tra agent mapping như khi chạy thật.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        ticket_conversations = dict(conn.execute(
+            'SELECT onpremise_ticket_id, cloud_conversation_id FROM conversation_mappings'
+        ).fetchall())
+        sql = ('SELECT webhook_type, raw_data FROM webhook_logs '
+               'WHERE webhook_type IN (?, ?) ORDER BY id')
+        params: list = list(REPLAY_ROUTES)
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+    groups: Dict[str, List[Step]] = {}
+    singles: List[List[Step]] = []
+    replay_agents: Dict[str, Dict] = {}
+    for webhook_type, raw_data in rows:
+        try:
+            payload = json.loads(raw_data)
+        except (TypeError, ValueError):
+            continue
+        if not isinstance(payload, dict):
+            continue
+        route = REPLAY_ROUTES[webhook_type]
+        if route == 'cloud':
+            key = payload.get('conversation_id')
+            step = Step(route, payload)
+        else:
+            for field in ('agent_id', 'contactid', 'userid'):
+                value = payload.get(field)
+                if value and '{' not in str(value):
+                    agent = replay_agents.setdefault(value, agents[len(replay_agents) % len(agents)])
+                    payload[field] = agent['contactid']
+            key = ticket_conversations.get(payload.get('ticket_id'))
+            step = Step(route, payload, fill_ticket=key is not None)
+        if key is None:
+            singles.append([step])
+        else:
+            groups.setdefault(key, []).append(step)
+    return list(groups.values()) + singles
+
+
+# Chạy app trong process
+
+class AppServer:
+    """App Flask (werkzeug, mỗi request một thread) hoặc aiohttp chạy trong thread nền"""
+
+    def __init__(self, kind: str, db, mapping_store):
+        self.kind = kind
+        self.port = None
+        self._started = threading.Event()
+        if kind == 'flask':
+            from werkzeug.serving import make_server
+            import app as flask_app
+            application = flask_app.create_app(db=db, mapping_store=mapping_store, configure_logging=False)
+            self._server = make_server('127.0.0.1', 0, application, threaded=True)
+            self.port = self._server.server_port
+            self._thread = threading.Thread(target=self._server.serve_forever, name='bench-app', daemon=True)
+        else:
+            from aiohttp import web
+            import async_app
+            application = async_app.create_app(db=db, mapping_store=mapping_store, configure_logging=False)
+            self._loop = asyncio.new_event_loop()
+            self._runner = web.AppRunner(application, access_log=None)
+            self._site_factory = lambda: web.TCPSite(self._runner, '127.0.0.1', 0)
+            self._thread = threading.Thread(target=self._run_async, name='bench-app', daemon=True)
+
+    def _run_async(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._start_async())
+        self._started.set()
+        self._loop.run_forever()
+
+    async def _start_async(self):
+        await self._runner.setup()
+        await self._site_factory().start()
+        self.port = self._runner.addresses[0][1]
+
+    def start(self) -> 'AppServer':
+        self._thread.start()
+        if self.kind != 'flask':
+            self._started.wait()
+        return self
+
+    def stop(self):
+        if self.kind == 'flask':
+            self._server.shutdown()
+        else:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+
+def configure_app(workdir: str, base_urls: Dict[str, str], backend: str, shards: int):
+    """Trỏ Config vào simulator và các file tạm (database, cache, agent mapping)"""
+    for name, value in base_urls.items():
+        setattr(Config, name, value)
+    Config.STORAGE_BACKEND = backend
+    Config.STORAGE_SHARDS = shards
+    Config.DB_PATH = os.path.join(workdir, 'bench.db')
+    Config.SHARED_CACHE_PATH = os.path.join(workdir, 'shared_cache.db')
+
+
+def agent_mapping_store(workdir: str, cloud_agents: List[Dict], onpremise_agents: List[Dict]):
+    """Agent mapping On-Premise -> Cloud ghép theo email, như manage_agent_mapping.py sync"""
+    from agent_mapping_config import AgentMappingConfig
+    store = AgentMappingConfig(db_path=os.path.join(workdir, 'agent_mapping.db'),
+                               legacy_json=os.path.join(workdir, 'agent_mapping.json'))
+    cloud_by_email = {agent['email']: agent['contactid'] for agent in cloud_agents}
+    store.apply_batch({agent['contactid']: cloud_by_email[agent['email']]
+                       for agent in onpremise_agents if agent['email'] in cloud_by_email})
+    return store
+
+
+def database_size(paths: List[str]) -> int:
+    """Tổng dung lượng các file database kể cả WAL"""
+    total = 0
+    for path in paths:
+        for name in (path, path + '-wal'):
+            if os.path.exists(name):
+                total += os.path.getsize(name)
+    return total
+
+
+# Load generator
+
+def response_outcome(status: int, body: bytes) -> Tuple[str, Dict]:
+    """success / skipped / shed (503) / http_<status> / connection_error"""
+    if status == 0:
+        return 'connection_error', {}
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    if status == 503:
+        return 'shed', data
+    if status == 200 and data.get('status') in ('success', 'skipped'):
+        return data['status'], data
+    return f"http_{status}", data
+
+
+async def run_load(url: str, scripts: List[List[Step]], concurrency: int,
+                   timeout: float) -> Tuple[List[Sample], float]:
+    samples: List[Sample] = []
+    pending = iter(scripts)
+    headers = {'Content-Type': 'application/json'}
+
+    async def worker(session: aiohttp.ClientSession):
+        for script in pending:
+            ticket_code = None
+            for step in script:
+                payload = step.payload
+                if step.fill_ticket and ticket_code:
+                    payload = dict(payload, ticket_id=ticket_code)
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                start = time.perf_counter()
+                try:
+                    async with session.post(url + WEBHOOK_PATHS[step.route], data=body, headers=headers) as response:
+                        status, content = response.status, await response.read()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    status, content = 0, b''
+                latency = time.perf_counter() - start
+                outcome, data = response_outcome(status, content)
+                ticket_code = data.get('ticket_code') or ticket_code
+                samples.append(Sample(step.route, status, outcome, latency))
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return samples, elapsed
+
+
+async def simulator_get(session: aiohttp.ClientSession, url: str) -> Dict:
+    async with session.get(url) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def simulator_snapshot(simulator_url: str) -> Tuple[Dict, List[Dict], List[Dict]]:
+    """(/_sim/stats, agent Cloud, agent On-Premise); gọi /agents trước nên không tính vào stats"""
+    async with aiohttp.ClientSession() as session:
+        cloud = await simulator_get(session, f"{simulator_url}/cloud/api/agents")
+        onpremise = await simulator_get(session, f"{simulator_url}/onpremise/api/agents")
+        stats = await simulator_get(session, f"{simulator_url}/_sim/stats")
+    return stats['requests'], cloud['response'], onpremise['response']
+
+
+async def simulator_stats(simulator_url: str) -> Dict:
+    async with aiohttp.ClientSession() as session:
+        return (await simulator_get(session, f"{simulator_url}/_sim/stats"))['requests']
+
+
+# Kết quả
+
+def latency_summary(latencies: List[float]) -> Dict:
+    values = sorted(latency * 1000 for latency in latencies)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else 0.0,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else 0.0,
+    }
+
+
+def upstream_delta(before: Dict, after: Dict) -> Dict[str, Dict[str, int]]:
+    """'service.operation' -> {status: số request} trong lúc chạy benchmark"""
+    delta = {}
+    for service, operations in after.items():
+        for operation, statuses in operations.items():
+            previous = before.get(service, {}).get(operation, {})
+            counts = {status: count - previous.get(status, 0) for status, count in statuses.items()
+                      if count - previous.get(status, 0)}
+            if counts:
+                delta[f"{service}.{operation}"] = counts
+    return delta
+
+
+def summarize(samples: List[Sample], elapsed: float, upstream: Dict[str, Dict[str, int]],
+              db_before: Optional[int], db_after: Optional[int]) -> Dict:
+    outcomes: Dict[str, int] = {}
+    for sample in samples:
+        outcomes[sample.outcome] = outcomes.get(sample.outcome, 0) + 1
+    messages = outcomes.get('success', 0)
+    requests = len(samples)
+    total_upstream = sum(sum(statuses.values()) for statuses in upstream.values())
+
+    latency = {'all': latency_summary([s.latency for s in samples])}
+    for route in WEBHOOK_PATHS:
+        latency[route] = latency_summary([s.latency for s in samples if s.route == route])
+
+    db = None
+    if db_before is not None and db_after is not None:
+        db = {
+            'before_bytes': db_before,
+            'after_bytes': db_after,
+            'growth_bytes': db_after - db_before,
+            'bytes_per_request': (db_after - db_before) / requests if requests else 0.0,
+        }
+
+    return {
+        'requests': requests,
+        'messages': messages,
+        'duration_s': elapsed,
+        'throughput_rps': requests / elapsed if elapsed else 0.0,
+        'messages_per_s': messages / elapsed if elapsed else 0.0,
+        'outcomes': dict(sorted(outcomes.items())),
+        'latency_ms': latency,
+        'upstream': {
+            'total': total_upstream,
+            'per_message': total_upstream / messages if messages else 0.0,
+            'operations': {
+                name: {'calls': sum(statuses.values()),
+                       'per_message': sum(statuses.values()) / messages if messages else 0.0,
+                       'statuses': statuses}
+                for name, statuses in sorted(upstream.items())
+            },
+        },
+        'db': db,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metric(results: Dict, path: str) -> Optional[float]:
+    value = results
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(results: Dict, baseline: Dict, max_regression: Optional[float]) -> bool:
+    """In chênh lệch so với baseline, trả về False nếu có chỉ số xấu đi quá max_regression %"""
+    ok = True
+    print(f"📊 So với baseline {baseline.get('meta', {}).get('git_commit') or ''}")
+    print("-" * 72)
+    print(f"  {'metric':<26} {'baseline':>12} {'current':>12} {'change':>9}")
+    print("-" * 72)
+    for path, higher_is_better in COMPARE_METRICS:
+        old, new = metric(baseline.get('results', {}), path), metric(results, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        regression = -change if higher_is_better else change
+        flag = ''
+        if max_regression is not None and regression > max_regression:
+            flag, ok = ' ❌', False
+        print(f"  {path:<26} {old:>12.2f} {new:>12.2f} {change:>+8.1f}%{flag}")
+    print("-" * 72)
+    return ok
+
+
+def print_results(results: Dict, title: str):
+    print(f"📊 {title}")
+    print("-" * 72)
+    print(f"  {'route':<12} {'requests':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    print("-" * 72)
+    for route, stats in results['latency_ms'].items():
+        print(f"  {route:<12} {stats['count']:>9} {stats['mean']:>9.1f} {stats['p50']:>9.1f} "
+              f"{stats['p95']:>9.1f} {stats['p99']:>9.1f} {stats['max']:>9.1f}")
+    print("-" * 72)
+    print(f"  throughput: {results['throughput_rps']:.1f} webhook/s, "
+          f"{results['messages_per_s']:.1f} message xử lý/s ({results['duration_s']:.2f}s)")
+    print(f"  outcomes: {', '.join(f'{k}={v}' for k, v in results['outcomes'].items())}")
+
+    upstream = results['upstream']
+    print(f"  upstream: {upstream['total']} request, {upstream['per_message']:.2f} / message")
+    for name, operation in upstream['operations'].items():
+        statuses = ', '.join(f"{status}={count}" for status, count in sorted(operation['statuses'].items()))
+        print(f"    {name:<28} {operation['calls']:>7} {operation['per_message']:>7.2f} / message  ({statuses})")
+
+    db = results['db']
+    if db:
+        print(f"  database: {db['before_bytes'] / 1024:.0f} KB -> {db['after_bytes'] / 1024:.0f} KB "
+              f"(+{db['growth_bytes'] / 1024:.0f} KB, {db['bytes_per_request']:.0f} bytes/webhook)")
+    print("-" * 72)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end webhook -> Ladesk giả lập")
+    parser.add_argument('--app', choices=['flask', 'async'], default='flask', help='App chạy trong process')
+    parser.add_argument('--backend', choices=['sqlite', 'sharded'], default='sqlite', help='STORAGE_BACKEND')
+    parser.add_argument('--shards', type=int, default=4, help='STORAGE_SHARDS khi --backend sharded')
+    parser.add_argument('--url', help='Benchmark app đang chạy ở URL này thay vì chạy trong process')
+    parser.add_argument('--simulator-url', help='Simulator mà app ở --url đang dùng (bắt buộc với --url)')
+    parser.add_argument('--db', help='DB_PATH của app ở --url để đo dung lượng tăng thêm')
+
+    traffic = parser.add_argument_group('traffic')
+    traffic.add_argument('--conversations', type=int, default=200, help='Số conversation Facebook')
+    traffic.add_argument('--messages', type=int, default=3, help='Số tin khách gửi liên tiếp mỗi conversation')
+    traffic.add_argument('--replies', type=int, default=1, help='Số agent reply mỗi conversation')
+    traffic.add_argument('--noise-ratio', type=float, default=0.2, help='Tỉ lệ webhook bị bỏ qua trên tổng số')
+    traffic.add_argument('--replay', metavar='DB', help='Phát lại webhook_logs của database này')
+    traffic.add_argument('--limit', type=int, help='Số webhook tối đa khi --replay')
+    traffic.add_argument('--concurrency', '-c', type=int, default=16, help='Số conversation gửi đồng thời')
+    traffic.add_argument('--timeout', type=float, default=60, help='Timeout mỗi webhook (giây)')
+    traffic.add_argument('--seed', type=int, default=1, help='Seed cho traffic và simulator')
+
+    faults = parser.add_argument_group('simulator (khi chạy trong process)')
+    faults.add_argument('--agents', type=int, default=10, help='Số agent mỗi service')
+    faults.add_argument('--latency-ms', type=float, default=0, help='Median độ trễ Ladesk (ms)')
+    faults.add_argument('--latency-p99-ms', type=float, default=0, help='p99 độ trễ Ladesk (ms)')
+    faults.add_argument('--error-rate', type=float, default=0, help='Tỉ lệ response 500')
+    faults.add_argument('--throttle-rate', type=float, default=0, help='Tỉ lệ response 429')
+    faults.add_argument('--rate-limit', type=float, default=0, help='Request/giây mỗi service')
+
+    parser.add_argument('--output', '-o', help='Ghi kết quả JSON ra file này')
+    parser.add_argument('--compare', metavar='JSON', help='So sánh với kết quả JSON của lần chạy trước')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='Ngưỡng xấu đi (%%) của mỗi chỉ số khi --compare, exit 1 nếu vượt')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Hiện log của app')
+    args = parser.parse_args()
+    if args.url and not args.simulator_url:
+        parser.error('--url cần --simulator-url để đếm request gọi Ladesk')
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    if not args.verbose:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # access log của mỗi request
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        simulator, server = None, None
+        if args.url:
+            url, simulator_url = args.url.rstrip('/'), args.simulator_url.rstrip('/')
+        else:
+            profile = {name: getattr(args, name) for name in FaultProfile.FIELDS if hasattr(args, name)}
+            simulator = SimulatorThread(LadeskSimulator(args.agents, seed=args.seed, faults=profile)).start()
+            simulator_url = f"http://{simulator.host}:{simulator.port}"
+            configure_app(workdir, simulator.base_urls, args.backend, args.shards)
+
+        stats_before, cloud_agents, onpremise_agents = asyncio.run(simulator_snapshot(simulator_url))
+
+        if args.replay:
+            scripts = replay_scripts(args.replay, onpremise_agents, args.limit)
+        else:
+            scripts = synthetic_scripts(rng, args.conversations, args.messages, args.replies,
+                                        args.noise_ratio, onpremise_agents)
+
+        db_paths = None
+        if not args.url:
+            from storage import create_storage
+            from db_maintenance import database_paths
+            db = create_storage(Config)
+            server = AppServer(args.app, db, agent_mapping_store(workdir, cloud_agents, onpremise_agents)).start()
+            url = server.url
+            db_paths = database_paths()
+        elif args.db:
+            from db_maintenance import database_paths
+            db_paths = database_paths(args.db)
+
+        try:
+            db_before = database_size(db_paths) if db_paths else None
+            samples, elapsed = asyncio.run(run_load(url, scripts, args.concurrency, args.timeout))
+            db_after = database_size(db_paths) if db_paths else None
+            stats_after = asyncio.run(simulator_stats(simulator_url))
+        finally:
+            if server is not None:
+                server.stop()
+            if simulator is not None:
+                simulator.stop()
+
+    results = summarize(samples, elapsed, upstream_delta(stats_before, stats_after), db_before, db_after)
+    target = args.url or f"{args.app}, {args.backend}"
+    traffic_name = f"replay {args.replay}" if args.replay else f"{args.conversations} conversation"
+    print_results(results, f"End-to-end ({target}, {traffic_name}, {args.concurrency} đồng thời)")
+
+    if args.output:
+        report = {
+            'meta': {
+                'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'git_commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': vars(args),
+            },
+            'results': results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Đã lưu kết quả: {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
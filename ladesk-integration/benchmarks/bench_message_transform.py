@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmark chuyển đổi nội dung message
+So sánh strip HTML cũ (regex <[^>]+> + html.unescape) với message_transform
+trên reply của agent từ ngắn đến rất lớn (kèm lịch sử email), cùng số dòng/link
+giữ được, và throughput text -> HTML cho tin của khách hàng
+
+    python benchmarks/bench_message_transform.py --iterations 200
+    python benchmarks/bench_message_transform.py --max-length 0   # parse toàn bộ, không cắt
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import re
+import html
+import timeit
+import argparse
+
+from config import Config
+import message_transform
+
+_URL_COUNT = re.compile(r'https?://')
+STREAM_CHUNK = 64 * 1024
+
+
+def legacy_clean(message: str) -> str:
+    """clean_agent_message cũ (trước message_transform)"""
+    return html.unescape(re.sub(r'<[^>]+>', '', message)).strip()
+
+
+def streamed(message: str, max_length: int) -> str:
+    """html_to_text nhưng feed từng chunk như khi đọc body theo stream"""
+    if not message_transform.looks_like_html(message):
+        return message_transform.html_to_text(message, max_length)
+    converter = message_transform.HtmlToText(max_length)
+    for start in range(0, len(message), STREAM_CHUNK):
+        converter.feed(message[start:start + STREAM_CHUNK])
+    return converter.close()
+
+
+def agent_reply(paragraphs: int) -> str:
+    """Reply từ editor On-Premise: đoạn văn, danh sách, link, entity"""
+    block = ("<p>Chào anh/chị,</p>"
+             "<p>Đơn hàng <strong>#12345</strong> đã được giao cho đơn vị vận chuyển.&nbsp;"
+             "Anh/chị theo dõi <a href=\"https://shop.example.vn/orders/12345?ref=support&amp;lang=vi\">tại đây</a>.</p>"
+             "<ul><li>Thời gian giao: 2&ndash;3 ngày</li><li>Phí ship: 30.000&#8363;</li>"
+             "<li>Hotline: <a href=\"tel:19001234\">1900 1234</a></li></ul>"
+             "<div>Trân trọng,<br>CSKH</div>")
+    return block * paragraphs
+
+
+def email_thread(replies: int) -> str:
+    """Reply kèm lịch sử email được trích dẫn lồng nhau"""
+    thread = agent_reply(1)
+    for i in range(replies):
+        thread = (f"<p>Phản hồi #{i}: cảm ơn anh/chị đã liên hệ.</p>"
+                  f"<div>Vào {i + 1}/10/2026, khách hàng đã viết:</div><blockquote>{thread}</blockquote>")
+    return f"<html><head><style>p{{margin:0}}</style></head><body>{thread}</body></html>"
+
+
+def build_corpus() -> dict:
+    return {
+        'short_reply': '<p>Dạ vâng ạ,&nbsp;shop kiểm tra và báo lại ngay!</p>',
+        'formatted_2kb': agent_reply(4),
+        'formatted_50kb': agent_reply(100),
+        'email_thread_60kb': email_thread(60),
+        'huge_reply_1mb': agent_reply(2000),
+        'plain_text_10kb': 'Dạ shop đã nhận &amp; xử lý.\nCảm ơn anh/chị!\n' * 200,
+    }
+
+
+def customer_texts() -> dict:
+    line = "Shop ơi cho mình hỏi đơn https://shop.example.vn/orders/12345?a=1&b=2 khi nào giao <gấp> ạ?"
+    return {
+        'short_text': "Chào shop, mình muốn hỏi về đơn hàng #12345 ạ",
+        'multiline_5kb': '\n'.join([line] * 50),
+        'paragraphs_100kb': '\n\n'.join(['\n'.join([line] * 10)] * 100),
+    }
+
+
+def per_call(func, iterations: int, size: int) -> float:
+    number = max(1, iterations * 2000 // max(size, 2000))
+    return timeit.timeit(func, number=number) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chuyển đổi nội dung message")
+    parser.add_argument('--iterations', '-n', type=int, default=200,
+                        help='Số lần chuyển đổi mỗi message ~2KB (message lớn hơn chạy ít lần hơn)')
+    parser.add_argument('--max-length', type=int, default=Config.MESSAGE_MAX_LENGTH,
+                        help='MESSAGE_MAX_LENGTH khi chuyển đổi (0 = không cắt)')
+    args = parser.parse_args()
+    max_length = args.max_length
+
+    print(f"📊 HTML -> text (agent reply, MESSAGE_MAX_LENGTH={max_length or 'không giới hạn'})")
+    print("-" * 112)
+    print(f"  {'reply':<20} {'KB':>7} {'legacy µs':>11} {'new µs':>10} {'stream µs':>10} {'new MB/s':>9} "
+          f"{'ratio':>6}  {'lines old/new':>13} {'links old/new':>13}")
+    print("-" * 112)
+    for name, message in build_corpus().items():
+        size = len(message.encode('utf-8'))
+        legacy_out = legacy_clean(message)
+        new_out = message_transform.html_to_text(message, max_length)
+        assert streamed(message, max_length) == new_out, name
+        legacy_time = per_call(lambda: legacy_clean(message), args.iterations, size)
+        new_time = per_call(lambda: message_transform.html_to_text(message, max_length), args.iterations, size)
+        stream_time = per_call(lambda: streamed(message, max_length), args.iterations, size)
+        lines = f"{legacy_out.count(chr(10)) + 1}/{new_out.count(chr(10)) + 1}"
+        links = f"{len(_URL_COUNT.findall(legacy_out))}/{len(_URL_COUNT.findall(new_out))}"
+        print(f"  {name:<20} {size / 1024:>7.1f} {legacy_time * 1e6:>11.1f} {new_time * 1e6:>10.1f} "
+              f"{stream_time * 1e6:>10.1f} {size / new_time / 1e6:>9.1f} {new_time / legacy_time:>5.1f}x"
+              f"  {lines:>13} {links:>13}")
+    print("-" * 112)
+
+    print(f"\n📊 text -> HTML (tin khách hàng gửi On-Premise)")
+    print("-" * 64)
+    print(f"  {'message':<20} {'KB':>7} {'µs':>10} {'MB/s':>9} {'links':>7}")
+    print("-" * 64)
+    for name, text in customer_texts().items():
+        size = len(text.encode('utf-8'))
+        out = message_transform.text_to_html(text, max_length)
+        elapsed = per_call(lambda: message_transform.text_to_html(text, max_length), args.iterations, size)
+        print(f"  {name:<20} {size / 1024:>7.1f} {elapsed * 1e6:>10.1f} {size / elapsed / 1e6:>9.1f} "
+              f"{out.count('<a href='):>7}")
+    print("-" * 64)
+
+
+if __name__ == '__main__':
+    main()
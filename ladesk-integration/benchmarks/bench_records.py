@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Benchmark record types
+So sánh cách cũ (dict dựng theo chỉ số cột, data.get(...) lặp lại) với
+records.py (Mapping qua row_factory, WebhookEvent đọc payload một lần):
+thời gian đọc N mapping từ SQLite và bộ nhớ giữ N object
+
+    python benchmarks/bench_records.py --rows 10000 --iterations 20
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import sqlite3
+import tempfile
+import timeit
+import argparse
+import tracemalloc
+
+from records import Mapping, WebhookEvent
+from storage import MAPPING_FIELDS
+
+SELECT_MAPPINGS = f"SELECT {', '.join(MAPPING_FIELDS)} FROM conversation_mappings ORDER BY id DESC LIMIT ?"
+
+WEBHOOK_PAYLOAD = {
+    "event_type": "message_added", "message_type": "M", "status": "C", "channel_type": "A",
+    "conversation_id": "k8s9d7f6", "ticket_id": "QQX-DGGBS-123", "contact_id": "c1a2b3",
+    "agent_id": "{$user_id}", "agent_name": "{$user_firstname} {$user_lastname}",
+    "message": "Xin chào, tôi cần hỗ trợ đơn hàng", "subject": "Facebook Message",
+}
+
+
+def create_database(path: str, rows: int):
+    with sqlite3.connect(path) as conn:
+        conn.execute('''
+            CREATE TABLE conversation_mappings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, cloud_conversation_id TEXT, onpremise_ticket_id TEXT,
+                onpremise_contact_id TEXT, customer_name TEXT, customer_email TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+        ''')
+        conn.executemany(
+            'INSERT INTO conversation_mappings (cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id, '
+            'customer_name, customer_email) VALUES (?, ?, ?, ?, ?)',
+            [(f"conv-{i}", f"QQX-{i:05d}-001", f"contact-{i}", f"Customer {i}", f"c{i}@example.com")
+             for i in range(rows)])
+
+
+def legacy_fetch(path: str, limit: int) -> list:
+    """Cách cũ của get_all_mappings"""
+    with sqlite3.connect(path) as conn:
+        mappings = []
+        for result in conn.execute(SELECT_MAPPINGS, (limit,)).fetchall():
+            mappings.append({
+                'id': result[0],
+                'cloud_conversation_id': result[1],
+                'onpremise_ticket_id': result[2],
+                'onpremise_contact_id': result[3],
+                'customer_name': result[4],
+                'customer_email': result[5],
+                'created_at': result[6],
+                'updated_at': result[7]
+            })
+        return mappings
+
+
+def record_fetch(path: str, limit: int) -> list:
+    with sqlite3.connect(path) as conn:
+        conn.row_factory = Mapping.row_factory
+        return conn.execute(SELECT_MAPPINGS, (limit,)).fetchall()
+
+
+def legacy_handle(data: dict) -> tuple:
+    """Các data.get(...) mà handler cũ gọi cho một webhook Cloud"""
+    return (data.get('event_type'), data.get('message_type'), data.get('agent_name', ''),
+            data.get('agent_id', ''), data.get('channel_type', ''), data.get('status', ''),
+            data.get('conversation_id'), data.get('contact_id'), data.get('message', ''),
+            data.get('subject', 'Facebook Message'), data.get('agent_name', ''))
+
+
+def event_handle(data: dict) -> tuple:
+    event = WebhookEvent(data)
+    return (event.event_type, event.message_type, event.agent_name, event.agent_id, event.channel_type,
+            event.status, event.conversation_id, event.contact_id, event.message, event.subject, event.agent_name)
+
+
+def retained_bytes(fetch, path: str, limit: int) -> int:
+    """Bộ nhớ còn giữ sau khi đọc limit dòng (chuỗi giá trị được tính cho cả hai cách)"""
+    tracemalloc.start()
+    result = fetch(path, limit)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark record types")
+    parser.add_argument('--rows', type=int, default=10000, help='Số mapping trong database')
+    parser.add_argument('--iterations', '-n', type=int, default=20, help='Số lần đọc toàn bộ mapping')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        create_database(path, args.rows)
+
+        print(f"📊 Record benchmark ({args.rows} mappings, {args.iterations} lần)")
+        print("-" * 72)
+        print(f"  {'case':<28} {'legacy':>12} {'records':>12} {'ratio':>8}")
+        print("-" * 72)
+        legacy_time = timeit.timeit(lambda: legacy_fetch(path, args.rows), number=args.iterations) / args.iterations
+        record_time = timeit.timeit(lambda: record_fetch(path, args.rows), number=args.iterations) / args.iterations
+        print(f"  {'fetch all (ms)':<28} {legacy_time * 1e3:>12.2f} {record_time * 1e3:>12.2f} "
+              f"{legacy_time / record_time:>7.2f}x")
+
+        legacy_size = retained_bytes(legacy_fetch, path, args.rows)
+        record_size = retained_bytes(record_fetch, path, args.rows)
+        print(f"  {'retained (bytes/row)':<28} {legacy_size / args.rows:>12.0f} {record_size / args.rows:>12.0f} "
+              f"{legacy_size / record_size:>7.2f}x")
+
+    number = args.iterations * 5000
+    legacy_time = timeit.timeit(lambda: legacy_handle(WEBHOOK_PAYLOAD), number=number) / number
+    event_time = timeit.timeit(lambda: event_handle(WEBHOOK_PAYLOAD), number=number) / number
+    print(f"  {'webhook fields (µs)':<28} {legacy_time * 1e6:>12.2f} {event_time * 1e6:>12.2f} "
+          f"{legacy_time / event_time:>7.2f}x")
+    print("-" * 72)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark thời gian khởi động worker
+Đo trong process Python mới (như một worker gunicorn vừa fork/spawn):
+import app, create_app(), request /health đầu tiên, webhook đầu tiên, và chi
+phí mở database mới (chạy migration) so với database đã ở SCHEMA_VERSION
+
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --max-import-ms 500   # exit 1 nếu vượt (dùng trong CI)
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import json
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Chạy trong subprocess: in ra JSON các mốc thời gian (ms)
+PROBE = r'''
+import sys, time, json, os
+t0 = time.perf_counter()
+sys.path.insert(0, os.environ['APP_DIR'])
+import app as appmod
+t1 = time.perf_counter()
+application = appmod.create_app(configure_logging=False)
+t2 = time.perf_counter()
+client = application.test_client()
+client.get('/health')
+t3 = time.perf_counter()
+client.post('/webhook/ladesk-cloud', data=json.dumps({"event_type": "message_added", "status": "X"}))
+t4 = time.perf_counter()
+import database_simple
+t5 = time.perf_counter()
+database_simple.SimpleDatabaseManager(os.environ['FRESH_DB_PATH'])
+t6 = time.perf_counter()
+database_simple.SimpleDatabaseManager(os.environ['FRESH_DB_PATH'])
+t7 = time.perf_counter()
+print(json.dumps({
+    'import_app': (t1 - t0) * 1000,
+    'create_app': (t2 - t1) * 1000,
+    'first_health': (t3 - t2) * 1000,
+    'first_webhook': (t4 - t3) * 1000,
+    'open_db_migrate': (t6 - t5) * 1000,
+    'open_db_ready': (t7 - t6) * 1000,
+}))
+'''
+
+
+def run_probe(workdir: str, index: int) -> dict:
+    env = dict(os.environ,
+               APP_DIR=APP_DIR,
+               DB_PATH=os.path.join(workdir, 'app.db'),
+               FRESH_DB_PATH=os.path.join(workdir, f'fresh-{index}.db'))
+    # Chạy trong thư mục tạm để không tạo agent_mapping.json / database trong repo
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thời gian khởi động worker")
+    parser.add_argument('--runs', '-n', type=int, default=10, help='Số process đo')
+    parser.add_argument('--max-import-ms', type=float, default=None,
+                        help='Ngưỡng median import app (ms), exit 1 nếu vượt')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Lần đầu tạo database của app (migration), không tính vào kết quả
+        run_probe(workdir, -1)
+        samples = [run_probe(workdir, i) for i in range(args.runs)]
+
+    print(f"📊 Worker startup ({args.runs} process)")
+    print("-" * 56)
+    print(f"  {'step':<20} {'median ms':>10} {'min ms':>10} {'max ms':>10}")
+    print("-" * 56)
+    medians = {}
+    for step in samples[0]:
+        values = [s[step] for s in samples]
+        medians[step] = statistics.median(values)
+        print(f"  {step:<20} {medians[step]:>10.1f} {min(values):>10.1f} {max(values):>10.1f}")
+    print("-" * 56)
+
+    if args.max_import_ms is not None and medians['import_app'] > args.max_import_ms:
+        print(f"❌ import app median {medians['import_app']:.1f} ms > {args.max_import_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Benchmark tra ticket theo prefix
+So sánh LIKE 'QQX-DGGBS-%' trên schema version 2 (chưa có index NOCASE, duyệt cả
+bảng) với cùng LIKE, get_mapping_by_ticket_prefix và một trang query_mappings
+(ticket_prefix=...) trên schema hiện tại, kèm EXPLAIN QUERY PLAN của từng câu SQL.
+
+Thoát với mã 1 nếu tra theo prefix không dùng idx_conversation_mappings_ticket_nocase
+(dùng được làm bước kiểm tra trong CI):
+
+    python benchmarks/bench_ticket_prefix.py --mappings 200000 -n 500
+    python benchmarks/bench_ticket_prefix.py --db /data/bench.db -o prefix.json
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import json
+import random
+import shutil
+import sqlite3
+import argparse
+import logging
+import tempfile
+from typing import Callable, Dict, List
+
+from bench_database import Keys, generate, print_plans, query_plans, row_counts, run_operation
+from database_simple import SimpleDatabaseManager
+
+PREFIX_INDEX = 'idx_conversation_mappings_ticket_nocase'
+
+# (tên, schema, thao tác); schema 'v2' chạy trên bản sao database đã bỏ index NOCASE
+CASES: List[tuple] = [
+    ('like (schema v2)', 'v2', lambda db, rng, keys: db.get_mapping_by_ticket_pattern(
+        rng.choice(keys.ticket_patterns))),
+    ('like', 'current', lambda db, rng, keys: db.get_mapping_by_ticket_pattern(
+        rng.choice(keys.ticket_patterns))),
+    ('prefix newest', 'current', lambda db, rng, keys: db.get_mapping_by_ticket_prefix(
+        rng.choice(keys.ticket_prefixes))),
+    ('prefix page (50)', 'current', lambda db, rng, keys: db.query_mappings(
+        limit=50, ticket_prefix=rng.choice(keys.ticket_prefixes)[:5])[0]),
+]
+
+# Các case phải dùng PREFIX_INDEX
+INDEXED_CASES = ('prefix newest', 'prefix page (50)')
+
+
+def uses_prefix_index(plans: List[Dict]) -> bool:
+    return bool(plans) and all(
+        not entry['scan'] and any(PREFIX_INDEX in step for step in entry['plan']) for entry in plans)
+
+
+def schema_v2_copy(path: str, copy_path: str):
+    """Bản sao database như trước migration version 3"""
+    shutil.copyfile(path, copy_path)
+    with sqlite3.connect(copy_path) as conn:
+        conn.execute(f'DROP INDEX IF EXISTS {PREFIX_INDEX}')
+        conn.execute('PRAGMA user_version = 2')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tra ticket theo prefix")
+    parser.add_argument('--db', help='File database (giữ lại và dùng lại ở lần chạy sau)')
+    parser.add_argument('--mappings', type=int, default=200000, help='Số mapping khi sinh database')
+    parser.add_argument('--days', type=int, default=90, help='created_at rải trong số ngày này')
+    parser.add_argument('--iterations', '-n', type=int, default=500, help='Số lần gọi mỗi case')
+    parser.add_argument('--threads', type=int, default=1, help='Số thread đồng thời')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', '-o', help='Ghi kết quả JSON ra file')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        if not os.path.exists(path):
+            print(f"🛠️ Generating {args.mappings} mappings -> {path}")
+            generate(path, args.mappings, 0, 0, 0, args.days, args.seed)
+        databases = {'current': SimpleDatabaseManager(path, auto_migrate=True)}
+        v2_path = os.path.join(tmp, 'schema_v2.db')
+        schema_v2_copy(path, v2_path)
+        databases['v2'] = SimpleDatabaseManager(v2_path, auto_migrate=False)
+        paths = {'current': path, 'v2': v2_path}
+
+        keys = Keys(path, random.Random(args.seed))
+        print(f"📊 Ticket prefix benchmark ({row_counts(path)['conversation_mappings']} mappings, "
+              f"{args.iterations} lần, {args.threads} thread)")
+        print()
+
+        plans: Dict[str, List[Dict]] = {}
+        for name, schema, operation in CASES:
+            plans[name] = query_plans(paths[schema], databases[schema], operation,
+                                      random.Random(args.seed), keys)
+            print_plans(name, plans[name])
+        print()
+
+        results = {}
+        print("-" * 84)
+        print(f"  {'case':<20} {'ops/s':>9} {'mean ms':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'miss':>6} "
+              f"{'speedup':>8}")
+        print("-" * 84)
+        for name, schema, operation in CASES:
+            result = run_operation(databases[schema], operation, keys, args.iterations, args.threads, args.seed)
+            results[name] = result
+            baseline = results[CASES[0][0]]['mean_ms']
+            speedup = baseline / result['mean_ms'] if result['mean_ms'] else 0.0
+            print(f"  {name:<20} {result['ops_per_s']:>9.0f} {result['mean_ms']:>9.3f} {result['p50_ms']:>9.3f} "
+                  f"{result['p95_ms']:>9.3f} {result['p99_ms']:>9.3f} {result['failures']:>6} {speedup:>7.1f}x")
+        print("-" * 84)
+
+    missing = [name for name in INDEXED_CASES if not uses_prefix_index(plans[name])]
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'plans': plans, 'results': results, 'index_missing': missing}, f, indent=2)
+        print(f"💾 Saved results to {args.output}")
+
+    if missing:
+        print(f"❌ {', '.join(missing)}: query plan không dùng {PREFIX_INDEX}")
+        sys.exit(1)
+    print(f"✅ Prefix lookups dùng {PREFIX_INDEX}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark parser body webhook
+So sánh pipeline cũ (decode + regex + json.loads + json5) với webhook_parser
+trên một corpus các dạng payload thật từ LiveAgent
+
+    python benchmarks/bench_webhook_parser.py --iterations 2000
+"""
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import re
+import json
+import timeit
+import argparse
+
+import webhook_parser
+
+
+def legacy_parse(body: bytes):
+    """Pipeline cũ của parse_webhook_data (trước webhook_parser)"""
+    raw_data = body.decode('utf-8')
+    try:
+        cleaned_data = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', raw_data)
+        return json.loads(cleaned_data)
+    except json.JSONDecodeError:
+        try:
+            import json5
+            return json5.loads(raw_data)
+        except Exception:
+            return None
+
+
+def build_corpus() -> dict:
+    """Các dạng payload thường gặp"""
+    cloud_message = {
+        "event_type": "message_added",
+        "message_type": "M",
+        "status": "C",
+        "conversation_id": "abc123def",
+        "contact_id": "c0ntact1",
+        "channel_type": "A",
+        "agent_name": "{$user_firstname} {$user_lastname}",
+        "agent_id": "{$user_id}",
+        "subject": "Facebook Message",
+        "message": "Chào shop, mình muốn hỏi về đơn hàng #12345 ạ"
+    }
+    agent_reply = {
+        "event_type": "agent_reply",
+        "agent_id": "k6citev3",
+        "contactid": "k6citev3",
+        "agent_name": "Keith Nguyen",
+        "ticket_id": "QQX-DGGBS-123",
+        "conversation_id": "QQX-DGGBS-123",
+        "customer_email": "facebook_abc123def@facebook.com",
+        "channel_type": "E",
+        "message": "<p>Chào bạn,</p><p>Đơn hàng của bạn đang được giao.&nbsp;</p>" * 5
+    }
+    large_reply = dict(agent_reply, message="<p>" + "Nội dung dài. " * 4000 + "</p>")
+
+    # Template chèn message nguyên văn: xuống dòng thật trong chuỗi JSON
+    raw_newlines = json.dumps(cloud_message, ensure_ascii=False).replace(
+        "ạ\"", "ạ\nCảm ơn\tshop\"").encode('utf-8')
+    # Control characters lẫn trong message
+    control_chars = json.dumps(cloud_message, ensure_ascii=False).replace(
+        "ạ\"", "ạ\x08\x1f\"").encode('utf-8')
+    # Template có biến rỗng ở cuối sinh dấu phẩy thừa
+    trailing_comma = json.dumps(agent_reply, ensure_ascii=False)[:-1].encode('utf-8') + b', }'
+
+    return {
+        'cloud_message_added': json.dumps(cloud_message, ensure_ascii=False).encode('utf-8'),
+        'onpremise_agent_reply': json.dumps(agent_reply, ensure_ascii=False).encode('utf-8'),
+        'large_agent_reply_60kb': json.dumps(large_reply, ensure_ascii=False).encode('utf-8'),
+        'raw_newlines_in_message': raw_newlines,
+        'control_characters': control_chars,
+        'template_trailing_comma': trailing_comma,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parser body webhook")
+    parser.add_argument('--iterations', '-n', type=int, default=2000, help='Số lần parse mỗi payload')
+    args = parser.parse_args()
+
+    decoder = 'orjson' if webhook_parser.orjson is not None else 'json'
+    print(f"📊 Webhook parser benchmark ({args.iterations} lần/payload, fast decoder: {decoder})")
+    print("-" * 96)
+    print(f"  {'payload':<28} {'bytes':>8} {'legacy µs':>11} {'new µs':>10} {'speedup':>8}  {'legacy ok':>9} {'new ok':>7}")
+    print("-" * 96)
+
+    for name, body in build_corpus().items():
+        legacy_ok = legacy_parse(body) is not None
+        new_ok = webhook_parser.parse_body(body) is not None
+        legacy_time = timeit.timeit(lambda: legacy_parse(body), number=args.iterations) / args.iterations
+        new_time = timeit.timeit(lambda: webhook_parser.parse_body(body), number=args.iterations) / args.iterations
+        print(f"  {name:<28} {len(body):>8} {legacy_time * 1e6:>11.1f} {new_time * 1e6:>10.1f} "
+              f"{legacy_time / new_time:>7.1f}x  {str(legacy_ok):>9} {str(new_ok):>7}")
+    print("-" * 96)
+
+
+if __name__ == '__main__':
+    main()
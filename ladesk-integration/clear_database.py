@@ -1,47 +1,68 @@
 #!/usr/bin/env python3
 """
 Script để xóa dữ liệu trong database
+Xóa toàn bộ mapping, webhook log và timing theo lô (xem db_maintenance.py)
+để server đang chạy vẫn ghi được, đánh số id lại từ 1 cho bảng đã trống,
+rồi trả dung lượng trống về hệ điều hành.
+Cần lọc theo tuổi/loại webhook thì dùng `python db_maintenance.py purge`.
 """
 
-import sqlite3
+import sys
 import os
+from typing import List
+sys.path.append(os.path.dirname(__file__))
+
 from config import Config
+import db_maintenance
+
+# Bảng có id AUTOINCREMENT (bộ đếm nằm trong sqlite_sequence)
+SEQUENCE_TABLES = ('conversation_mappings', 'webhook_logs', 'webhook_timings')
+
+def reset_sequences(path: str) -> List[str]:
+    """Reset bộ đếm AUTOINCREMENT của các bảng đã trống, trả về tên các bảng đã reset"""
+    conn = db_maintenance.connect(path)
+    try:
+        # Kiểm tra và reset trong cùng transaction: bảng vừa được server ghi thêm thì giữ bộ đếm
+        conn.execute('BEGIN IMMEDIATE')
+        tables = [table for table in SEQUENCE_TABLES
+                  if conn.execute(f'SELECT NOT EXISTS (SELECT 1 FROM {table})').fetchone()[0]]
+        if tables:
+            conn.execute(f"DELETE FROM sqlite_sequence WHERE name IN ({', '.join('?' * len(tables))})", tables)
+        conn.execute('COMMIT')
+        return tables
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
 
 def clear_database():
     """Xóa tất cả dữ liệu trong database"""
-    db_path = Config.DB_PATH
-    
-    if not os.path.exists(db_path):
-        print(f"❌ Database file không tồn tại: {db_path}")
+    paths = [path for path in db_maintenance.database_paths() if os.path.exists(path)]
+    if not paths:
+        print(f"❌ Database file không tồn tại: {Config.DB_PATH}")
         return
-    
+
     try:
-        with sqlite3.connect(db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Xóa dữ liệu trong bảng conversation_mappings
-            cursor.execute("DELETE FROM conversation_mappings")
-            mappings_deleted = cursor.rowcount
-            
-            # Xóa dữ liệu trong bảng webhook_logs
-            cursor.execute("DELETE FROM webhook_logs")
-            logs_deleted = cursor.rowcount
-            
-            # Reset auto-increment counters
-            cursor.execute("DELETE FROM sqlite_sequence WHERE name='conversation_mappings'")
-            cursor.execute("DELETE FROM sqlite_sequence WHERE name='webhook_logs'")
-            
-            conn.commit()
-            
-            print(f"✅ Đã xóa thành công:")
-            print(f"   - {mappings_deleted} mappings")
-            print(f"   - {logs_deleted} webhook logs")
-            print(f"   - Reset auto-increment counters")
-            
+        for path in paths:
+            # timings trước logs để số dòng timing không bị tính gộp vào lúc xóa log
+            results = db_maintenance.run_purge(path, ['timings', 'logs', 'mappings'], {},
+                                               batch_size=1000, sleep=0.01, dry_run=False)
+            reset = reset_sequences(path)
+            db_maintenance.compact(path)
+
+            print(f"✅ Đã xóa thành công ({path}):")
+            print(f"   - {results['mappings']} mappings")
+            print(f"   - {results['logs']} webhook logs")
+            print(f"   - {results['timings']} webhook timings")
+            if reset:
+                print(f"   - Reset id về 1: {', '.join(reset)}")
+
     except Exception as e:
         print(f"❌ Lỗi khi xóa database: {e}")
 
 if __name__ == "__main__":
     print("🗑️ Xóa dữ liệu trong database...")
     clear_database()
-    print("✅ Hoàn thành!") 
\ No newline at end of file
+    print("✅ Hoàn thành!")
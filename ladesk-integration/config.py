@@ -24,12 +24,82 @@ class Config:
     # Application Configuration
     DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
     DB_PATH = os.getenv('DB_PATH', 'ladesk_integration.db')
+    # Tự tạo/cập nhật schema khi mở database (tắt nếu đã chạy `python database_simple.py` lúc deploy)
+    DB_AUTO_MIGRATE = os.getenv('DB_AUTO_MIGRATE', 'True').lower() == 'true'
+    # Backend lưu trữ: sqlite | memory | sharded (xem storage.py)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+    STORAGE_SHARDS = int(os.getenv('STORAGE_SHARDS', 4))
+    # Agent mapping On-Premise -> Cloud (xem agent_mapping_config.py); file JSON chỉ dùng để import lần đầu
+    AGENT_MAPPING_DB_PATH = os.getenv('AGENT_MAPPING_DB_PATH', 'agent_mapping.db')
+    AGENT_MAPPING_JSON = os.getenv('AGENT_MAPPING_JSON', 'agent_mapping.json')
+    AGENT_MAPPING_CHECK_INTERVAL = float(os.getenv('AGENT_MAPPING_CHECK_INTERVAL', 2))
     SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-here')
     HOST = os.getenv('HOST', '0.0.0.0')
     PORT = int(os.getenv('PORT', 3000))
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
     LOG_FILE = os.getenv('LOG_FILE', 'logs/app.log')
     WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', 'your-webhook-secret')
+    # Token cho /api/mappings và /api/webhook-logs (để trống là tắt các endpoint này)
+    QUERY_API_TOKEN = os.getenv('QUERY_API_TOKEN', '')
+    # Số dòng mỗi lô khi export (data_export.py, /api/export/<kind>)
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+    WEBHOOK_MAX_BODY_BYTES = int(os.getenv('WEBHOOK_MAX_BODY_BYTES', 1024 * 1024))
+    # Backfill lịch sử conversation (backfill.py): file checkpoint, số conversation xử lý song song,
+    # request/giây tối đa mỗi service (0 = không giới hạn), số lần thử lại và thời gian chờ gốc (giây)
+    BACKFILL_DB_PATH = os.getenv('BACKFILL_DB_PATH', 'backfill.db')
+    BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', 4))
+    BACKFILL_RATE_LIMIT = float(os.getenv('BACKFILL_RATE_LIMIT', 5))
+    BACKFILL_RETRIES = int(os.getenv('BACKFILL_RETRIES', 3))
+    BACKFILL_RETRY_BACKOFF = float(os.getenv('BACKFILL_RETRY_BACKOFF', 1))
+    # Timezone của thời gian trong API Cloud (datecreated, date_changed): 'UTC', '+07:00' hoặc 'Asia/Ho_Chi_Minh'
+    LADESK_CLOUD_TIMEZONE = os.getenv('LADESK_CLOUD_TIMEZONE', 'UTC')
+    # File đính kèm (attachments.py): kích thước tối đa mỗi file, ngưỡng chuyển từ RAM sang file tạm,
+    # kích thước chunk khi stream, số file tối đa mỗi message, timeout tải/upload (giây)
+    # và thời gian nhớ file đã chuyển theo URL/sha256 (giây, 0 = tắt)
+    ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', 25 * 1024 * 1024))
+    ATTACHMENT_SPOOL_BYTES = int(os.getenv('ATTACHMENT_SPOOL_BYTES', 1024 * 1024))
+    ATTACHMENT_CHUNK_BYTES = int(os.getenv('ATTACHMENT_CHUNK_BYTES', 64 * 1024))
+    ATTACHMENT_MAX_FILES = int(os.getenv('ATTACHMENT_MAX_FILES', 10))
+    ATTACHMENT_TIMEOUT = float(os.getenv('ATTACHMENT_TIMEOUT', 120))
+    ATTACHMENT_CACHE_TTL = int(os.getenv('ATTACHMENT_CACHE_TTL', 7 * 24 * 3600))
+    # Host được phép tải file ngoài các server Ladesk ở trên (cách nhau bởi dấu phẩy, '.fbcdn.net' = cả subdomain);
+    # các host này phải trỏ tới địa chỉ public, redirect được kiểm tra lại và tối đa ATTACHMENT_MAX_REDIRECTS lần
+    ATTACHMENT_ALLOWED_HOSTS = os.getenv('ATTACHMENT_ALLOWED_HOSTS', '.fbcdn.net,.fbsbx.com')
+    ATTACHMENT_MAX_REDIRECTS = int(os.getenv('ATTACHMENT_MAX_REDIRECTS', 3))
+    # Prefix path file trên server Ladesk (URL tải kèm apikey), URL khác trên server Ladesk bị từ chối
+    ATTACHMENT_LADESK_PATHS = os.getenv('ATTACHMENT_LADESK_PATHS', '/scripts/file.php')
+    # Nội dung message (message_transform.py): độ dài tối đa sau khi chuyển đổi (ký tự, 0 = không giới hạn)
+    # và có gửi tin của khách hàng sang On-Premise dạng HTML (đoạn văn, xuống dòng, link) hay không
+    MESSAGE_MAX_LENGTH = int(os.getenv('MESSAGE_MAX_LENGTH', 20000))
+    ONPREMISE_MESSAGE_HTML = os.getenv('ONPREMISE_MESSAGE_HTML', 'True').lower() == 'true'
+    # Số thread tối đa gọi upstream song song (0 = chạy tuần tự)
+    UPSTREAM_MAX_WORKERS = int(os.getenv('UPSTREAM_MAX_WORKERS', 16))
+    # Chế độ async (async_app.py): số kết nối tối đa của pool HTTP và timeout mỗi request (giây)
+    ASYNC_HTTP_POOL_SIZE = int(os.getenv('ASYNC_HTTP_POOL_SIZE', 100))
+    ASYNC_HTTP_TIMEOUT = float(os.getenv('ASYNC_HTTP_TIMEOUT', 30))
+    # Admission control mỗi process (ADMISSION_MAX_IN_FLIGHT = 0 là tắt, xem admission.py); mặc định cho async_app.py,
+    # với gunicorn gthread đặt bằng --threads, worker sync không có tác dụng
+    ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 64))
+    ADMISSION_LOW_PRIORITY_SHARE = float(os.getenv('ADMISSION_LOW_PRIORITY_SHARE', 0.75))
+    ADMISSION_MAX_QUEUED = int(os.getenv('ADMISSION_MAX_QUEUED', 256))
+    ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 5))
+    # Cache dùng chung giữa các worker (SHARED_CACHE_MAX_ENTRIES = 0 là tắt, xem shared_cache.py)
+    SHARED_CACHE_PATH = os.getenv('SHARED_CACHE_PATH', 'cache/shared_cache.db')
+    SHARED_CACHE_MAX_ENTRIES = int(os.getenv('SHARED_CACHE_MAX_ENTRIES', 10000))
+    SHARED_CACHE_LEASE_TIMEOUT = float(os.getenv('SHARED_CACHE_LEASE_TIMEOUT', 10))
+    CONTACT_CACHE_TTL = int(os.getenv('CONTACT_CACHE_TTL', 300))
+    AGENT_CACHE_TTL = int(os.getenv('AGENT_CACHE_TTL', 3600))
+    LOG_JSON = os.getenv('LOG_JSON', 'True').lower() == 'true'
+    LOG_MAX_PAYLOAD_LENGTH = int(os.getenv('LOG_MAX_PAYLOAD_LENGTH', 1000))
+    LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', 20))
+    LOG_SAMPLE_WINDOW = float(os.getenv('LOG_SAMPLE_WINDOW', 10))
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+    # Profiling Configuration (PROFILE_SAMPLE_RATE = 0 là tắt)
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_DIR = os.getenv('PROFILE_DIR', 'logs/profiles')
+    PROFILE_FLUSH_EVERY = int(os.getenv('PROFILE_FLUSH_EVERY', 50))
+    PROFILE_KEEP_FILES = int(os.getenv('PROFILE_KEEP_FILES', 20))
 
     # Webhook URL Configuration
     WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', 'https://45dc157d7046.ngrok-free.app').strip()
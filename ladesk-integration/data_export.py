@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Data Export
+Export toàn bộ conversation_mappings / webhook_logs ra NDJSON (mỗi dòng một
+JSON object), có thể nén gzip, với bộ nhớ không đổi theo số dòng: dữ liệu
+đọc theo lô EXPORT_BATCH_SIZE qua storage.scan() và ghi ra ngay.
+
+    python data_export.py webhook_logs -o webhook_logs.ndjson.gz
+    python data_export.py webhook_logs -o webhook_logs.ndjson.gz --resume   # tiếp tục lần chạy bị ngắt
+    python data_export.py mappings --after-id 12000 -o - | jq .
+
+Sau mỗi lô, id cuối cùng và kích thước file được lưu vào <output>.state;
+--resume đọc file này, bỏ phần ghi dở rồi ghi nối tiếp (file .gz gồm nhiều
+gzip member, đọc được bình thường bằng zcat/gzip.open).
+Endpoint HTTP tương ứng: GET /api/export/<kind>?after_id=&gzip=1
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+
+import gzip
+import json
+import zlib
+import argparse
+import logging
+from typing import Dict, Iterable, Iterator, Optional
+
+from config import Config
+from storage import SCAN_KINDS
+
+logger = logging.getLogger(__name__)
+
+
+def ndjson_batches(storage, kind: str, after_id: int = None, batch_size: int = None) -> Iterator[tuple]:
+    """(bytes NDJSON của một lô, id cuối của lô)"""
+    for batch in storage.scan(kind, after_id, batch_size or Config.EXPORT_BATCH_SIZE):
+        lines = [json.dumps(record, ensure_ascii=False, default=str) for record in batch]
+        yield ('\n'.join(lines) + '\n').encode('utf-8'), batch[-1]['id']
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """Nén gzip dạng stream (một member), không giữ toàn bộ dữ liệu trong bộ nhớ"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = header gzip
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(storage, kind: str, after_id: int = None, compress: bool = False,
+                  batch_size: int = None) -> Iterator[bytes]:
+    """Các chunk bytes của bản export, dùng cho response HTTP dạng stream"""
+    chunks = (data for data, _ in ndjson_batches(storage, kind, after_id, batch_size))
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def _state_path(output: str) -> str:
+    return f"{output}.state"
+
+
+def read_state(output: str) -> Optional[Dict]:
+    """{'kind', 'last_id', 'rows', 'offset'} của lần export trước vào output (None nếu chưa có)"""
+    try:
+        with open(_state_path(output), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_state(output: str, state: Dict):
+    tmp_path = _state_path(output) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, _state_path(output))
+
+
+def export_to_file(storage, kind: str, output: str, after_id: int = None, compress: bool = None,
+                   resume: bool = False, batch_size: int = None) -> Dict:
+    """Ghi export ra file (hoặc stdout nếu output là '-'), trả về state cuối cùng
+
+    Với gzip, mỗi lô là một gzip member hoàn chỉnh. State lưu offset của file sau
+    lô cuối cùng đã ghi xong; khi resume, phần ghi dở sau offset bị cắt bỏ trước
+    khi ghi tiếp, nên file không bao giờ có dòng trùng hay member hỏng. Nếu file
+    không còn hoặc ngắn hơn offset thì state bị bỏ và export lại từ after_id.
+    """
+    compress = output.endswith('.gz') if compress is None else compress
+    state = {'kind': kind, 'last_id': after_id, 'rows': 0, 'offset': 0}
+    if resume and output != '-':
+        previous = read_state(output)
+        if previous:
+            if previous['kind'] != kind:
+                raise ValueError(f"{output} is an export of {previous['kind']}, not {kind}")
+            size = os.path.getsize(output) if os.path.exists(output) else None
+            if size is None or size < previous['offset']:
+                # File đã bị xoá/ghi đè: các lô trong state không còn trong file, export lại từ đầu
+                logger.warning("⚠️ %s is missing or shorter than its checkpoint (%s < %s bytes), restarting export",
+                               output, size, previous['offset'])
+                os.remove(_state_path(output))
+            else:
+                state = previous
+
+    elif output != '-' and os.path.exists(_state_path(output)):
+        os.remove(_state_path(output))
+
+    if output == '-':
+        out = sys.stdout.buffer
+    else:
+        out = open(output, 'r+b' if resume and os.path.exists(output) else 'wb')
+        out.truncate(state['offset'])
+        out.seek(state['offset'])
+    try:
+        for data, last_id in ndjson_batches(storage, kind, state['last_id'], batch_size):
+            out.write(gzip.compress(data, mtime=0) if compress else data)
+            out.flush()
+            state['rows'] += data.count(b'\n')
+            state['last_id'] = last_id
+            if out is not sys.stdout.buffer:
+                state['offset'] = out.tell()
+                _write_state(output, state)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export mapping/webhook log ra NDJSON (có thể gzip)")
+    parser.add_argument('kind', choices=sorted(SCAN_KINDS), help='Dữ liệu cần export')
+    parser.add_argument('--output', '-o', required=True, help="File output ('.gz' là nén gzip, '-' là stdout)")
+    parser.add_argument('--after-id', type=int, help='Chỉ export id lớn hơn giá trị này')
+    parser.add_argument('--resume', action='store_true', help='Tiếp tục từ <output>.state và ghi nối tiếp')
+    parser.add_argument('--gzip', action='store_true', default=None, help='Nén gzip (mặc định theo đuôi .gz)')
+    parser.add_argument('--batch-size', type=int, help=f'Số dòng mỗi lô (mặc định: {Config.EXPORT_BATCH_SIZE})')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    from database_simple import db
+
+    result = export_to_file(db, args.kind, args.output, args.after_id, args.gzip, args.resume, args.batch_size)
+    if args.output != '-':
+        print(f"✅ Đã export {result['rows']} dòng {args.kind} ra {args.output} (id cuối: {result['last_id']})")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,82 +2,199 @@ import sqlite3
 import json
 import logging
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 from config import Config
+from metrics import track_db
+from lazy import LazyProxy
+from records import Mapping, WebhookLog
+from storage import (StorageBackend, Page, MAPPING_FIELDS, MAPPING_UPDATE_FIELDS, WEBHOOK_LOG_FIELDS,
+                     MAPPING_QUERY_FILTERS, MAPPING_PREFIX_FILTERS, WEBHOOK_LOG_QUERY_FILTERS,
+                     WEBHOOK_LOG_GROUP_COLUMNS, WEBHOOK_PAYLOAD_COLUMNS, SCAN_KINDS,
+                     create_storage, ticket_prefix_range)
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-class SimpleDatabaseManager:
+# Tăng khi thay đổi create_tables() để database cũ được cập nhật
+SCHEMA_VERSION = 4
+# Thời gian chờ (giây) khi worker khác đang giữ lock migration
+MIGRATION_LOCK_TIMEOUT = 30
+
+class SimpleDatabaseManager(StorageBackend):
     """Database manager đơn giản: 1 conversation = 1 mapping"""
     
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, auto_migrate: bool = None):
         self.db_path = db_path or Config.DB_PATH
-        self.create_tables()
+        if Config.DB_AUTO_MIGRATE if auto_migrate is None else auto_migrate:
+            self.ensure_schema()
+    
+    def schema_version(self) -> int:
+        """Version schema hiện tại của file database (PRAGMA user_version)"""
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
     
-    def create_tables(self):
-        """Tạo bảng đơn giản cho logic mới"""
+    def ensure_schema(self) -> bool:
+        """Tạo bảng/index nếu database chưa ở SCHEMA_VERSION, trả về True nếu có chạy migration
+        
+        Database đã cập nhật chỉ tốn một lần đọc PRAGMA user_version, nên worker
+        khởi động sau lần deploy đầu tiên không chạy lại các lệnh CREATE.
+        
+        Các worker cùng khởi động với database cũ: migration chạy trong BEGIN IMMEDIATE
+        (mỗi lúc một worker), user_version được đọc lại sau khi có lock nên worker đến
+        sau thấy schema đã cập nhật và bỏ qua thay vì ALTER TABLE lần nữa.
+        """
+        if self.schema_version() >= SCHEMA_VERSION:
+            return False
+        conn = sqlite3.connect(self.db_path, timeout=MIGRATION_LOCK_TIMEOUT, isolation_level=None)
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Bảng chính: conversation_mappings (hỗ trợ nhiều ticket cho 1 conversation)
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS conversation_mappings (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        cloud_conversation_id TEXT NOT NULL,
-                        onpremise_ticket_id TEXT NOT NULL,
-                        onpremise_contact_id TEXT NOT NULL,
-                        customer_name TEXT,
-                        customer_email TEXT NOT NULL,
-                        last_agent_reply TEXT,
-                        last_agent_name TEXT,
-                        last_reply_time TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                
-                # Index cho performance
-                cursor.execute('''
-                    CREATE INDEX IF NOT EXISTS idx_conversation_mappings_cloud_id 
-                    ON conversation_mappings(cloud_conversation_id)
-                ''')
-                
-                cursor.execute('''
-                    CREATE INDEX IF NOT EXISTS idx_conversation_mappings_ticket_id 
-                    ON conversation_mappings(onpremise_ticket_id)
-                ''')
-                
-                cursor.execute('''
-                    CREATE INDEX IF NOT EXISTS idx_conversation_mappings_email 
-                    ON conversation_mappings(customer_email)
-                ''')
-                
-                # Bảng webhook logs (giữ nguyên)
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS webhook_logs (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        webhook_type TEXT NOT NULL,
-                        conversation_id TEXT,
-                        ticket_id TEXT,
-                        contact_id TEXT,
-                        event_type TEXT,
-                        raw_data TEXT,
-                        processed_data TEXT,
-                        status TEXT,
-                        error_message TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
+            # Chỉ có tác dụng với file mới (trước khi tạo bảng, ngoài transaction): cho phép
+            # db_maintenance.py trả dung lượng bằng incremental_vacuum mà không cần VACUUM khóa cả database
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+                conn.execute('ROLLBACK')
+                return False
+            self.create_tables(conn)
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        logger.info("✅ Database schema migrated to version %s", SCHEMA_VERSION)
+        return True
+    
+    def create_tables(self, conn: sqlite3.Connection):
+        """Tạo bảng đơn giản cho logic mới (trong transaction của ensure_schema, người gọi commit)"""
+        try:
+            cursor = conn.cursor()
+            
+            # Bảng chính: conversation_mappings (hỗ trợ nhiều ticket cho 1 conversation)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS conversation_mappings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    cloud_conversation_id TEXT NOT NULL,
+                    onpremise_ticket_id TEXT NOT NULL,
+                    onpremise_contact_id TEXT NOT NULL,
+                    customer_name TEXT,
+                    customer_email TEXT NOT NULL,
+                    last_agent_reply TEXT,
+                    last_agent_name TEXT,
+                    last_reply_time TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Index cho performance
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_conversation_mappings_cloud_id 
+                ON conversation_mappings(cloud_conversation_id)
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_conversation_mappings_ticket_id 
+                ON conversation_mappings(onpremise_ticket_id)
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_conversation_mappings_email 
+                ON conversation_mappings(customer_email)
+            ''')
+            
+            # Bảng webhook logs (giữ nguyên)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS webhook_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    webhook_type TEXT NOT NULL,
+                    conversation_id TEXT,
+                    ticket_id TEXT,
+                    contact_id TEXT,
+                    event_type TEXT,
+                    raw_data TEXT,
+                    processed_data TEXT,
+                    status TEXT,
+                    error_message TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Bảng thời gian xử lý từng stage của webhook (1 dòng / stage, stage 'total' = tổng)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS webhook_timings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    webhook_log_id INTEGER,
+                    webhook_type TEXT NOT NULL,
+                    outcome TEXT,
+                    stage TEXT NOT NULL,
+                    duration_ms REAL NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_webhook_timings_stage_created 
+                ON webhook_timings(stage, created_at)
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_webhook_timings_created 
+                ON webhook_timings(created_at)
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_webhook_timings_log_id 
+                ON webhook_timings(webhook_log_id)
+            ''')
+            
+            # Version 2: index cho query_mappings / query_webhook_logs (mỗi index gồm cả rowid
+            # nên lọc bằng một cột rồi phân trang theo id không phải sort)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_conversation_mappings_created 
+                ON conversation_mappings(created_at)
+            ''')
+            
+            for column in ('conversation_id', 'ticket_id', 'webhook_type', 'status', 'created_at'):
+                cursor.execute(f'''
+                    CREATE INDEX IF NOT EXISTS idx_webhook_logs_{column} 
+                    ON webhook_logs({column})
                 ''')
-                
-                conn.commit()
-                logger.info("✅ Simple database tables created successfully")
+            
+            # Version 3: index không phân biệt hoa thường cho tra ticket theo prefix; cũng cho
+            # phép SQLite dùng index với LIKE 'QQX-DGGBS-%' (LIKE mặc định không phân biệt
+            # hoa thường nên không dùng được idx_conversation_mappings_ticket_id)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_conversation_mappings_ticket_nocase 
+                ON conversation_mappings(onpremise_ticket_id COLLATE NOCASE)
+            ''')
+            
+            # Version 4: cột VIRTUAL trích từ raw_data bằng JSON1 (không tốn dung lượng, tính khi
+            # đọc) và index trên các cột dùng làm bộ lọc, để tra log theo agent/channel/status/email
+            # không phải LIKE '%...%' trên raw_data. ALTER TABLE chỉ thêm được cột VIRTUAL.
+            existing = {row[1] for row in cursor.execute('PRAGMA table_xinfo(webhook_logs)')}
+            for field, column in WEBHOOK_PAYLOAD_COLUMNS.items():
+                if column not in existing:
+                    cursor.execute(f'''
+                        ALTER TABLE webhook_logs ADD COLUMN {column} GENERATED ALWAYS AS
+                        (CASE WHEN json_valid(raw_data) THEN json_extract(raw_data, '$.{field}') END) VIRTUAL
+                    ''')
+            
+            for column in WEBHOOK_PAYLOAD_COLUMNS.values():
+                if column in WEBHOOK_LOG_QUERY_FILTERS.values():
+                    cursor.execute(f'''
+                        CREATE INDEX IF NOT EXISTS idx_webhook_logs_{column} 
+                        ON webhook_logs({column})
+                    ''')
+            
+            logger.info("✅ Simple database tables created successfully")
                 
         except Exception as e:
-            logger.error(f"❌ Database initialization error: {e}")
+            logger.error("❌ Database initialization error: %s", e)
             raise
 
+    @track_db
     def create_mapping(self, cloud_conversation_id: str, onpremise_ticket_id: str, 
                       onpremise_contact_id: str, customer_name: str = None, 
                       customer_email: str = None) -> bool:
@@ -92,20 +209,22 @@ class SimpleDatabaseManager:
                 ''', (cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id, customer_name, customer_email))
                 
                 conn.commit()
-                logger.info(f"✅ Created mapping: {cloud_conversation_id} -> {onpremise_ticket_id}")
+                logger.info("✅ Created mapping: %s -> %s", cloud_conversation_id, onpremise_ticket_id)
                 return True
                 
         except sqlite3.IntegrityError:
-            logger.warning(f"⚠️ Mapping already exists for conversation: {cloud_conversation_id}")
+            logger.warning("⚠️ Mapping already exists for conversation: %s", cloud_conversation_id)
             return False
         except Exception as e:
-            logger.error(f"❌ Error creating mapping: {e}")
+            logger.error("❌ Error creating mapping: %s", e)
             return False
 
-    def get_mapping_by_conversation(self, cloud_conversation_id: str) -> Optional[Dict]:
+    @track_db
+    def get_mapping_by_conversation(self, cloud_conversation_id: str) -> Optional[Mapping]:
         """Lấy mapping theo conversation_id (ticket gần nhất)"""
         try:
             with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = Mapping.row_factory
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT id, cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id,
@@ -116,29 +235,18 @@ class SimpleDatabaseManager:
                     LIMIT 1
                 ''', (cloud_conversation_id,))
                 
-                result = cursor.fetchone()
-                
-                if result:
-                    return {
-                        'id': result[0],
-                        'cloud_conversation_id': result[1],
-                        'onpremise_ticket_id': result[2],
-                        'onpremise_contact_id': result[3],
-                        'customer_name': result[4],
-                        'customer_email': result[5],
-                        'created_at': result[6],
-                        'updated_at': result[7]
-                    }
-                return None
+                return cursor.fetchone()
                 
         except Exception as e:
-            logger.error(f"❌ Error getting mapping by conversation: {e}")
+            logger.error("❌ Error getting mapping by conversation: %s", e)
             return None
 
-    def get_mapping_by_ticket(self, onpremise_ticket_id: str) -> Optional[Dict]:
+    @track_db
+    def get_mapping_by_ticket(self, onpremise_ticket_id: str) -> Optional[Mapping]:
         """Lấy mapping theo ticket_id"""
         try:
             with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = Mapping.row_factory
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT id, cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id,
@@ -147,29 +255,18 @@ class SimpleDatabaseManager:
                     WHERE onpremise_ticket_id = ?
                 ''', (onpremise_ticket_id,))
                 
-                result = cursor.fetchone()
-                
-                if result:
-                    return {
-                        'id': result[0],
-                        'cloud_conversation_id': result[1],
-                        'onpremise_ticket_id': result[2],
-                        'onpremise_contact_id': result[3],
-                        'customer_name': result[4],
-                        'customer_email': result[5],
-                        'created_at': result[6],
-                        'updated_at': result[7]
-                    }
-                return None
+                return cursor.fetchone()
                 
         except Exception as e:
-            logger.error(f"❌ Error getting mapping by ticket: {e}")
+            logger.error("❌ Error getting mapping by ticket: %s", e)
             return None
 
-    def get_mapping_by_email(self, customer_email: str) -> Optional[Dict]:
+    @track_db
+    def get_mapping_by_email(self, customer_email: str) -> Optional[Mapping]:
         """Lấy mapping theo email"""
         try:
             with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = Mapping.row_factory
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT id, cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id,
@@ -180,29 +277,22 @@ class SimpleDatabaseManager:
                     LIMIT 1
                 ''', (customer_email,))
                 
-                result = cursor.fetchone()
-                
-                if result:
-                    return {
-                        'id': result[0],
-                        'cloud_conversation_id': result[1],
-                        'onpremise_ticket_id': result[2],
-                        'onpremise_contact_id': result[3],
-                        'customer_name': result[4],
-                        'customer_email': result[5],
-                        'created_at': result[6],
-                        'updated_at': result[7]
-                    }
-                return None
+                return cursor.fetchone()
                 
         except Exception as e:
-            logger.error(f"❌ Error getting mapping by email: {e}")
+            logger.error("❌ Error getting mapping by email: %s", e)
             return None
 
-    def get_mapping_by_ticket_pattern(self, ticket_pattern: str) -> Optional[Dict]:
-        """Lấy mapping theo pattern của ticket ID (ví dụ: QQX-DGGBS-%)"""
+    @track_db
+    def get_mapping_by_ticket_pattern(self, ticket_pattern: str) -> Optional[Mapping]:
+        """Lấy mapping theo pattern của ticket ID (ví dụ: QQX-DGGBS-%)
+        
+        Pattern không bắt đầu bằng % hoặc _ được SQLite đổi thành khoảng trên
+        idx_conversation_mappings_ticket_nocase thay vì duyệt cả bảng.
+        """
         try:
             with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = Mapping.row_factory
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT id, cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id,
@@ -213,29 +303,41 @@ class SimpleDatabaseManager:
                     LIMIT 1
                 ''', (ticket_pattern,))
                 
-                result = cursor.fetchone()
-                
-                if result:
-                    return {
-                        'id': result[0],
-                        'cloud_conversation_id': result[1],
-                        'onpremise_ticket_id': result[2],
-                        'onpremise_contact_id': result[3],
-                        'customer_name': result[4],
-                        'customer_email': result[5],
-                        'created_at': result[6],
-                        'updated_at': result[7]
-                    }
-                return None
+                return cursor.fetchone()
                 
         except Exception as e:
-            logger.error(f"❌ Error getting mapping by ticket pattern: {e}")
+            logger.error("❌ Error getting mapping by ticket pattern: %s", e)
             return None
 
-    def get_all_mappings(self, limit: int = 100) -> List[Dict]:
+    @track_db
+    def get_mapping_by_ticket_prefix(self, prefix: str) -> Optional[Mapping]:
+        """Lấy mapping mới nhất có ticket ID bắt đầu bằng prefix (ví dụ: QQX-DGGBS)"""
+        try:
+            low, high = ticket_prefix_range(prefix)
+            with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = Mapping.row_factory
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id,
+                           customer_name, customer_email, created_at, updated_at
+                    FROM conversation_mappings 
+                    WHERE onpremise_ticket_id COLLATE NOCASE >= ? AND onpremise_ticket_id COLLATE NOCASE < ?
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT 1
+                ''', (low, high))
+                
+                return cursor.fetchone()
+                
+        except Exception as e:
+            logger.error("❌ Error getting mapping by ticket prefix: %s", e)
+            return None
+
+    @track_db
+    def get_all_mappings(self, limit: int = 100) -> List[Mapping]:
         """Lấy tất cả mappings (có giới hạn)"""
         try:
             with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = Mapping.row_factory
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT id, cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id,
@@ -245,27 +347,67 @@ class SimpleDatabaseManager:
                     LIMIT ?
                 ''', (limit,))
                 
-                results = cursor.fetchall()
-                mappings = []
-                
-                for result in results:
-                    mappings.append({
-                        'id': result[0],
-                        'cloud_conversation_id': result[1],
-                        'onpremise_ticket_id': result[2],
-                        'onpremise_contact_id': result[3],
-                        'customer_name': result[4],
-                        'customer_email': result[5],
-                        'created_at': result[6],
-                        'updated_at': result[7]
-                    })
-                
-                return mappings
+                return cursor.fetchall()
                 
         except Exception as e:
-            logger.error(f"❌ Error getting all mappings: {e}")
+            logger.error("❌ Error getting all mappings: %s", e)
             return []
 
+    @staticmethod
+    def _where(columns: Dict[str, str], before_id: Optional[int], since: str, until: str, filters: Dict,
+               prefix_columns: Dict[str, str] = None):
+        """(WHERE ..., params) cho các bộ lọc bằng, bộ lọc prefix (khoảng trên index
+        COLLATE NOCASE), id < before_id và khoảng created_at"""
+        prefix_columns = prefix_columns or {}
+        clauses, params = [], []
+        for name, value in filters.items():
+            if value is None:
+                continue
+            if name in prefix_columns:
+                column = prefix_columns[name]
+                clauses.append(f"{column} COLLATE NOCASE >= ? AND {column} COLLATE NOCASE < ?")
+                params.extend(ticket_prefix_range(value))
+            else:
+                clauses.append(f"{columns[name]} = ?")
+                params.append(value)
+        if before_id is not None:
+            clauses.append("id < ?")
+            params.append(before_id)
+        if since:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until:
+            clauses.append("created_at < ?")
+            params.append(until)
+        return (f"WHERE {' AND '.join(clauses)}" if clauses else ''), params
+
+    def _query_page(self, table: str, fields: tuple, columns: Dict[str, str], limit: int,
+                    before_id: int, since: str, until: str, filters: Dict,
+                    prefix_columns: Dict[str, str] = None) -> Page:
+        """Một trang keyset (id < before_id, id giảm dần) với các bộ lọc của _where"""
+        where, params = self._where(columns, before_id, since, until, filters, prefix_columns)
+        with sqlite3.connect(self.db_path) as conn:
+            # Lấy dư một dòng để biết còn trang sau hay không
+            rows = conn.execute(
+                f"SELECT {', '.join(fields)} FROM {table} {where} ORDER BY id DESC LIMIT ?",
+                params + [limit + 1]
+            ).fetchall()
+        items = [dict(zip(fields, row)) for row in rows[:limit]]
+        next_before_id = items[-1]['id'] if len(rows) > limit else None
+        return items, next_before_id
+
+    @track_db
+    def query_mappings(self, limit: int = 50, before_id: int = None, since: str = None,
+                       until: str = None, **filters) -> Page:
+        """Phân trang mapping theo id, lọc theo conversation/ticket/email/ticket_prefix/created_at"""
+        try:
+            return self._query_page('conversation_mappings', MAPPING_FIELDS, MAPPING_QUERY_FILTERS,
+                                    limit, before_id, since, until, filters, MAPPING_PREFIX_FILTERS)
+        except Exception as e:
+            logger.error("❌ Error querying mappings: %s", e)
+            return [], None
+
+    @track_db
     def update_mapping(self, cloud_conversation_id: str, **kwargs) -> bool:
         """Cập nhật mapping"""
         try:
@@ -277,8 +419,7 @@ class SimpleDatabaseManager:
                 values = []
                 
                 for key, value in kwargs.items():
-                    if key in ['onpremise_ticket_id', 'onpremise_contact_id', 'customer_name', 'customer_email', 
-                              'last_agent_reply', 'last_agent_name', 'last_reply_time']:
+                    if key in MAPPING_UPDATE_FIELDS:
                         update_fields.append(f"{key} = ?")
                         values.append(value)
                 
@@ -298,16 +439,17 @@ class SimpleDatabaseManager:
                 conn.commit()
                 
                 if cursor.rowcount > 0:
-                    logger.info(f"✅ Updated mapping for conversation: {cloud_conversation_id}")
+                    logger.info("✅ Updated mapping for conversation: %s", cloud_conversation_id)
                     return True
                 else:
-                    logger.warning(f"⚠️ No mapping found to update for conversation: {cloud_conversation_id}")
+                    logger.warning("⚠️ No mapping found to update for conversation: %s", cloud_conversation_id)
                     return False
                     
         except Exception as e:
-            logger.error(f"❌ Error updating mapping: {e}")
+            logger.error("❌ Error updating mapping: %s", e)
             return False
 
+    @track_db
     def delete_mapping(self, cloud_conversation_id: str) -> bool:
         """Xóa mapping"""
         try:
@@ -321,19 +463,20 @@ class SimpleDatabaseManager:
                 conn.commit()
                 
                 if cursor.rowcount > 0:
-                    logger.info(f"✅ Deleted mapping for conversation: {cloud_conversation_id}")
+                    logger.info("✅ Deleted mapping for conversation: %s", cloud_conversation_id)
                     return True
                 else:
-                    logger.warning(f"⚠️ No mapping found to delete for conversation: {cloud_conversation_id}")
+                    logger.warning("⚠️ No mapping found to delete for conversation: %s", cloud_conversation_id)
                     return False
                     
         except Exception as e:
-            logger.error(f"❌ Error deleting mapping: {e}")
+            logger.error("❌ Error deleting mapping: %s", e)
             return False
 
+    @track_db
     def log_webhook(self, webhook_type: str, data: Dict, status: str = 'received', 
-                   error_message: str = None) -> bool:
-        """Log webhook (giữ nguyên)"""
+                   error_message: str = None) -> Optional[int]:
+        """Log webhook, trả về id của dòng log (None nếu lỗi)"""
         try:
             with sqlite3.connect(self.db_path) as conn:
                 cursor = conn.cursor()
@@ -355,16 +498,18 @@ class SimpleDatabaseManager:
                 ))
                 
                 conn.commit()
-                return True
+                return cursor.lastrowid
                 
         except Exception as e:
-            logger.error(f"❌ Error logging webhook: {e}")
-            return False
+            logger.error("❌ Error logging webhook: %s", e)
+            return None
 
-    def get_webhook_logs(self, limit: int = 50) -> List[Dict]:
+    @track_db
+    def get_webhook_logs(self, limit: int = 50) -> List[WebhookLog]:
         """Lấy webhook logs (giữ nguyên)"""
         try:
             with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = WebhookLog.row_factory
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT id, webhook_type, conversation_id, ticket_id, contact_id, 
@@ -374,30 +519,164 @@ class SimpleDatabaseManager:
                     LIMIT ?
                 ''', (limit,))
                 
+                return cursor.fetchall()
+                
+        except Exception as e:
+            logger.error("❌ Error getting webhook logs: %s", e)
+            return []
+
+    @track_db
+    def query_webhook_logs(self, limit: int = 50, before_id: int = None, since: str = None,
+                           until: str = None, **filters) -> Page:
+        """Phân trang webhook log theo id, lọc theo conversation/ticket/type/status/created_at và các
+        cột payload (agent_id, channel_type, conversation_status, message_type, customer_email)"""
+        try:
+            return self._query_page('webhook_logs', WEBHOOK_LOG_FIELDS, WEBHOOK_LOG_QUERY_FILTERS,
+                                    limit, before_id, since, until, filters)
+        except Exception as e:
+            logger.error("❌ Error querying webhook logs: %s", e)
+            return [], None
+
+    @track_db
+    def count_webhook_logs(self, group_by: str, since: str = None, until: str = None,
+                           **filters) -> Dict[Optional[str], int]:
+        """Số webhook log theo giá trị của cột group_by, lọc như query_webhook_logs
+        
+        Ví dụ số log lỗi theo agent trong một giờ: count_webhook_logs('agent_id', since=..., status='error')
+        """
+        try:
+            column = WEBHOOK_LOG_GROUP_COLUMNS[group_by]
+            where, params = self._where(WEBHOOK_LOG_QUERY_FILTERS, None, since, until, filters)
+            with sqlite3.connect(self.db_path) as conn:
+                rows = conn.execute(
+                    f"SELECT {column}, COUNT(*) FROM webhook_logs {where} GROUP BY {column}", params
+                ).fetchall()
+            return dict(rows)
+        except Exception as e:
+            logger.error("❌ Error counting webhook logs: %s", e)
+            return {}
+
+    def scan(self, kind: str, after_id: int = None, batch_size: int = 1000) -> Iterator[List[Dict]]:
+        """Duyệt theo id tăng dần; mỗi lô là một query ngắn (WHERE id > ?) nên không giữ
+        lock đọc suốt quá trình export và webhook vẫn ghi được"""
+        table, fields = SCAN_KINDS[kind]
+        last_id = after_id or 0
+        while True:
+            with sqlite3.connect(self.db_path) as conn:
+                rows = conn.execute(
+                    f"SELECT {', '.join(fields)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            yield [dict(zip(fields, row)) for row in rows]
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    @track_db
+    def save_webhook_timings(self, webhook_log_id: Optional[int], webhook_type: str, outcome: str,
+                             stages: Dict[str, float], total: float) -> bool:
+        """Lưu thời gian từng stage (giây) của một webhook, kèm stage 'total'"""
+        try:
+            rows = [(webhook_log_id, webhook_type, outcome, name, seconds * 1000.0)
+                    for name, seconds in stages.items()]
+            rows.append((webhook_log_id, webhook_type, outcome, 'total', total * 1000.0))
+            
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT INTO webhook_timings 
+                    (webhook_log_id, webhook_type, outcome, stage, duration_ms)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', rows)
+                
+                conn.commit()
+                return True
+                
+        except Exception as e:
+            logger.error("❌ Error saving webhook timings: %s", e)
+            return False
+
+    @track_db
+    def get_slowest_webhooks(self, limit: int = 10, window_minutes: int = 60,
+                             webhook_type: str = None) -> List[Dict]:
+        """Lấy N webhook chậm nhất trong khoảng thời gian gần đây, kèm breakdown theo stage"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                query = '''
+                    SELECT t.id, t.webhook_log_id, t.webhook_type, t.outcome, t.duration_ms, t.created_at,
+                           l.conversation_id, l.ticket_id
+                    FROM webhook_timings t
+                    LEFT JOIN webhook_logs l ON l.id = t.webhook_log_id
+                    WHERE t.stage = 'total' AND t.created_at >= datetime('now', ?)
+                '''
+                params = [f'-{int(window_minutes)} minutes']
+                if webhook_type:
+                    query += ' AND t.webhook_type = ?'
+                    params.append(webhook_type)
+                query += ' ORDER BY t.duration_ms DESC LIMIT ?'
+                params.append(limit)
+                
+                cursor.execute(query, params)
                 results = cursor.fetchall()
-                logs = []
+                slowest = []
                 
                 for result in results:
-                    logs.append({
-                        'id': result[0],
-                        'webhook_type': result[1],
-                        'conversation_id': result[2],
-                        'ticket_id': result[3],
-                        'contact_id': result[4],
-                        'event_type': result[5],
-                        'raw_data': result[6],
-                        'processed_data': result[7],
-                        'status': result[8],
-                        'error_message': result[9],
-                        'created_at': result[10]
+                    stages = {}
+                    if result[1] is not None:
+                        cursor.execute('''
+                            SELECT stage, duration_ms FROM webhook_timings 
+                            WHERE webhook_log_id = ? AND stage != 'total'
+                            ORDER BY duration_ms DESC
+                        ''', (result[1],))
+                        stages = {row[0]: row[1] for row in cursor.fetchall()}
+                    
+                    slowest.append({
+                        'webhook_log_id': result[1],
+                        'webhook_type': result[2],
+                        'outcome': result[3],
+                        'total_ms': result[4],
+                        'created_at': result[5],
+                        'conversation_id': result[6],
+                        'ticket_id': result[7],
+                        'stages': stages
                     })
                 
-                return logs
+                return slowest
                 
         except Exception as e:
-            logger.error(f"❌ Error getting webhook logs: {e}")
+            logger.error("❌ Error getting slowest webhooks: %s", e)
             return []
 
+    @track_db
+    def get_stage_durations(self, window_minutes: int = 60, webhook_type: str = None) -> Dict[str, List[float]]:
+        """Lấy danh sách duration (ms) theo stage trong khoảng thời gian gần đây"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                query = '''
+                    SELECT stage, duration_ms FROM webhook_timings 
+                    WHERE created_at >= datetime('now', ?)
+                '''
+                params = [f'-{int(window_minutes)} minutes']
+                if webhook_type:
+                    query += ' AND webhook_type = ?'
+                    params.append(webhook_type)
+                
+                cursor.execute(query, params)
+                durations: Dict[str, List[float]] = {}
+                for stage, duration_ms in cursor:
+                    durations.setdefault(stage, []).append(duration_ms)
+                
+                return durations
+                
+        except Exception as e:
+            logger.error("❌ Error getting stage durations: %s", e)
+            return {}
+
+    @track_db
     def update_ticket_status(self, ticket_id: str, status: str) -> bool:
         """Cập nhật trạng thái ticket"""
         try:
@@ -410,13 +689,14 @@ class SimpleDatabaseManager:
                 ''', (ticket_id,))
                 
                 conn.commit()
-                logger.info(f"✅ Updated ticket status: {ticket_id} -> {status}")
+                logger.info("✅ Updated ticket status: %s -> %s", ticket_id, status)
                 return True
                 
         except Exception as e:
-            logger.error(f"❌ Error updating ticket status: {e}")
+            logger.error("❌ Error updating ticket status: %s", e)
             return False
 
+    @track_db
     def get_stats(self) -> Dict:
         """Lấy thống kê database"""
         try:
@@ -453,8 +733,20 @@ class SimpleDatabaseManager:
                 }
                 
         except Exception as e:
-            logger.error(f"❌ Error getting stats: {e}")
+            logger.error("❌ Error getting stats: %s", e)
             return {}
 
-# Tạo instance global
-db = SimpleDatabaseManager() 
\ No newline at end of file
+# Instance global theo STORAGE_BACKEND, chỉ mở database ở lần dùng đầu tiên (thay bằng db.set_instance(...))
+db = LazyProxy(create_storage)
+
+
+if __name__ == '__main__':
+    # Bước deploy: tạo/cập nhật schema một lần trước khi start worker
+    logging.basicConfig(level=logging.INFO)
+    Config.DB_AUTO_MIGRATE = False  # để ensure_schema bên dưới báo đúng có migrate hay không
+    storage = create_storage()
+    if storage.ensure_schema():
+        print(f"✅ Migrated {Config.DB_PATH} ({Config.STORAGE_BACKEND}) to schema version {SCHEMA_VERSION}")
+    else:
+        print(f"✅ {Config.DB_PATH} ({Config.STORAGE_BACKEND}) already at schema version {SCHEMA_VERSION}")
+ 
\ No newline at end of file
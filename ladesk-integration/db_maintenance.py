@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Database Maintenance
+Dọn dữ liệu cũ trong database khi server vẫn đang nhận webhook
+
+- Xóa theo lô nhỏ (--batch-size), mỗi lô một transaction ngắn và nghỉ
+  --sleep giây giữa các lô để webhook writer không phải chờ lâu
+- Xóa webhook log thì xóa luôn webhook_timings của log đó
+- Sau khi xóa: database bật auto_vacuum=INCREMENTAL thì trả dung lượng về
+  bằng incremental_vacuum theo từng đợt; database cũ chưa bật thì dùng
+  `compact --full` (một lần, lúc ít tải) hoặc `--vacuum-into`
+- --dry-run chỉ in số dòng sẽ xóa và dung lượng ước tính lấy lại được
+
+    python db_maintenance.py purge --target logs --older-than 30 --dry-run
+    python db_maintenance.py purge --target logs --older-than 7 --webhook-type cloud_incoming --status received
+    python db_maintenance.py purge --target mappings --older-than 90 --closed
+    python db_maintenance.py purge --target all
+    python db_maintenance.py compact [--full | --vacuum-into backup.db]
+
+Với STORAGE_BACKEND=sharded lệnh chạy lần lượt trên từng file shard.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+
+import time
+import sqlite3
+import argparse
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Status conversation Cloud coi là đã đóng: Resolved, Deleted, Spam
+DEFAULT_CLOSED_STATUSES = ('R', 'X', 'B')
+
+# Bảng dữ liệu theo từng target, và cột thời gian dùng cho --older-than
+TARGETS = {
+    'logs': ('webhook_logs', 'created_at'),
+    'timings': ('webhook_timings', 'created_at'),
+    'mappings': ('conversation_mappings', 'updated_at'),
+}
+
+# Cột có thể lớn, dùng để ước tính dung lượng khi không có dbstat
+_PAYLOAD_COLUMNS = {
+    'webhook_logs': ('raw_data', 'processed_data', 'error_message', 'conversation_id', 'ticket_id'),
+    'webhook_timings': ('stage', 'webhook_type', 'outcome'),
+    'conversation_mappings': ('last_agent_reply', 'customer_name', 'customer_email', 'onpremise_ticket_id'),
+}
+_ROW_OVERHEAD_BYTES = 40
+
+
+def database_paths(db_path: str = None) -> List[str]:
+    """Các file SQLite của backend đang cấu hình"""
+    db_path = db_path or Config.DB_PATH
+    if Config.STORAGE_BACKEND == 'sharded':
+        from storage_sharded import shard_paths
+        return shard_paths(db_path, Config.STORAGE_SHARDS)
+    return [db_path]
+
+
+class Purge:
+    """Một lệnh xóa theo bộ lọc trên một file database"""
+
+    def __init__(self, conn: sqlite3.Connection, target: str, older_than: Optional[float] = None,
+                 webhook_type: str = None, status: str = None, closed: bool = False,
+                 closed_statuses: Tuple[str, ...] = DEFAULT_CLOSED_STATUSES):
+        self.conn = conn
+        self.target = target
+        self.table, self.time_column = TARGETS[target]
+        self.where, self.params = self._build_filter(older_than, webhook_type, status, closed, closed_statuses)
+
+    def _build_filter(self, older_than, webhook_type, status, closed, closed_statuses) -> Tuple[str, list]:
+        clauses, params = [], []
+        if older_than is not None:
+            clauses.append(f"{self.time_column} < datetime('now', ?)")
+            params.append(f"-{older_than} days")
+        if webhook_type and self.target in ('logs', 'timings'):
+            clauses.append("webhook_type = ?")
+            params.append(webhook_type)
+        if status and self.target in ('logs', 'timings'):
+            clauses.append("status = ?" if self.target == 'logs' else "outcome = ?")
+            params.append(status)
+        if closed and self.target == 'mappings':
+            self._collect_closed_conversations(closed_statuses)
+            clauses.append("cloud_conversation_id IN (SELECT conversation_id FROM temp.closed_conversations)")
+        return (' AND '.join(clauses) or '1'), params
+
+    def _collect_closed_conversations(self, closed_statuses: Tuple[str, ...]):
+        """Conversation có webhook Cloud mới nhất mang status đóng (tính một lần cho cả lệnh)"""
+        self.conn.execute('DROP TABLE IF EXISTS temp.closed_conversations')
+        placeholders = ', '.join('?' for _ in closed_statuses)
+        self.conn.execute(f'''
+            CREATE TEMP TABLE closed_conversations AS
+            SELECT conversation_id FROM (
+                SELECT conversation_id, json_extract(raw_data, '$.status') AS status, MAX(id)
+                FROM webhook_logs
+                WHERE webhook_type = 'cloud_incoming' AND conversation_id IS NOT NULL
+                GROUP BY conversation_id
+            ) WHERE status IN ({placeholders})
+        ''', closed_statuses)
+
+    def count(self) -> int:
+        return self.conn.execute(f'SELECT COUNT(*) FROM {self.table} WHERE {self.where}', self.params).fetchone()[0]
+
+    def estimate_bytes(self, matched: int) -> int:
+        """Dung lượng ước tính của các dòng sẽ xóa (theo dbstat nếu SQLite hỗ trợ)"""
+        if not matched:
+            return 0
+        try:
+            table_bytes = self.conn.execute('''
+                SELECT SUM(pgsize) FROM dbstat
+                WHERE name = ? OR name IN (SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?)
+            ''', (self.table, self.table)).fetchone()[0] or 0
+            total = self.conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+            return int(table_bytes * matched / total) if total else 0
+        except sqlite3.OperationalError:
+            lengths = ' + '.join(f'COALESCE(LENGTH({column}), 0)' for column in _PAYLOAD_COLUMNS[self.table])
+            payload = self.conn.execute(
+                f'SELECT SUM({lengths}) FROM {self.table} WHERE {self.where}', self.params
+            ).fetchone()[0] or 0
+            return payload + matched * _ROW_OVERHEAD_BYTES
+
+    def delete_batch(self, batch_size: int) -> int:
+        """Xóa tối đa batch_size dòng trong một transaction, trả về số dòng đã xóa"""
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [row[0] for row in self.conn.execute(
+                f'SELECT id FROM {self.table} WHERE {self.where} ORDER BY id LIMIT ?', self.params + [batch_size]
+            )]
+            if ids:
+                placeholders = ', '.join('?' for _ in ids)
+                self.conn.execute(f'DELETE FROM {self.table} WHERE id IN ({placeholders})', ids)
+                if self.table == 'webhook_logs':
+                    self.conn.execute(f'DELETE FROM webhook_timings WHERE webhook_log_id IN ({placeholders})', ids)
+            self.conn.execute('COMMIT')
+            return len(ids)
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Connection autocommit: mỗi lô tự mở/đóng transaction"""
+    conn = sqlite3.connect(db_path, timeout=30.0, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout = 30000')
+    return conn
+
+
+def freelist_bytes(conn: sqlite3.Connection) -> int:
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    return conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size
+
+
+def run_purge(db_path: str, targets: List[str], filters: Dict, batch_size: int, sleep: float,
+              dry_run: bool, progress_every: int = 10) -> Dict[str, int]:
+    """Xóa (hoặc chỉ đếm nếu dry_run) theo từng target, trả về số dòng theo target"""
+    conn = connect(db_path)
+    results = {}
+    try:
+        for target in targets:
+            purge = Purge(conn, target, **filters)
+            matched = purge.count()
+            if dry_run:
+                estimate = purge.estimate_bytes(matched)
+                print(f"  🔎 {purge.table}: {matched} dòng sẽ bị xóa (~{estimate / 1024 / 1024:.2f} MB)")
+                results[target] = matched
+                continue
+
+            deleted, batches, started = 0, 0, time.monotonic()
+            while True:
+                count = purge.delete_batch(batch_size)
+                if not count:
+                    break
+                deleted += count
+                batches += 1
+                if batches % progress_every == 0:
+                    percent = deleted * 100 / matched if matched else 100
+                    print(f"  ⏳ {purge.table}: {deleted}/{matched} ({percent:.0f}%)")
+                if sleep:
+                    time.sleep(sleep)
+            print(f"  ✅ {purge.table}: đã xóa {deleted} dòng trong {time.monotonic() - started:.1f}s")
+            results[target] = deleted
+
+        if dry_run:
+            print(f"  🔎 Dung lượng trống sẵn có (freelist): {freelist_bytes(conn) / 1024 / 1024:.2f} MB")
+    finally:
+        conn.close()
+    return results
+
+
+def compact(db_path: str, full: bool = False, vacuum_into: str = None,
+            pages_per_step: int = 1000, sleep: float = 0.05) -> int:
+    """Trả dung lượng trống về hệ điều hành, trả về số byte đã lấy lại"""
+    conn = connect(db_path)
+    try:
+        before = os.path.getsize(db_path)
+        if vacuum_into:
+            # Bản nén ra file khác, không khóa ghi database đang chạy lâu như VACUUM
+            conn.execute('VACUUM INTO ?', (vacuum_into,))
+            print(f"  ✅ Đã tạo bản nén {vacuum_into} ({os.path.getsize(vacuum_into) / 1024 / 1024:.2f} MB)")
+            return 0
+
+        if full:
+            # Bật auto_vacuum=INCREMENTAL (chỉ có hiệu lực sau VACUUM) để lần sau dọn online được
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        elif conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            while free_pages:
+                # conn.execute chỉ step pragma này một lần (= 1 page), executescript chạy đủ số page
+                conn.executescript(f'PRAGMA incremental_vacuum({pages_per_step});')
+                remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if remaining >= free_pages:
+                    break
+                free_pages = remaining
+                if sleep:
+                    time.sleep(sleep)
+        else:
+            print(f"  ⚠️ {db_path} chưa bật auto_vacuum=INCREMENTAL: chạy `compact --full` lúc ít tải "
+                  f"(VACUUM khóa database) hoặc `compact --vacuum-into <file>`")
+            return 0
+
+        reclaimed = before - os.path.getsize(db_path)
+        print(f"  ✅ {db_path}: lấy lại {reclaimed / 1024 / 1024:.2f} MB")
+        return reclaimed
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dọn dữ liệu cũ trong database theo lô")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    purge = subparsers.add_parser('purge', help='Xóa dữ liệu theo bộ lọc')
+    purge.add_argument('--target', '-t', choices=sorted(TARGETS) + ['all'], action='append', required=True,
+                       help='Bảng cần dọn (có thể lặp lại)')
+    purge.add_argument('--older-than', type=float, help='Chỉ xóa dòng cũ hơn số ngày này')
+    purge.add_argument('--webhook-type', help='logs/timings: chỉ xóa webhook_type này')
+    purge.add_argument('--status', help='logs: status, timings: outcome')
+    purge.add_argument('--closed', action='store_true', help='mappings: chỉ xóa conversation đã đóng')
+    purge.add_argument('--closed-statuses', default=','.join(DEFAULT_CLOSED_STATUSES),
+                       help='Status Cloud coi là đã đóng (mặc định: %(default)s)')
+    purge.add_argument('--batch-size', type=int, default=500, help='Số dòng mỗi lô (mặc định: %(default)s)')
+    purge.add_argument('--sleep', type=float, default=0.05, help='Nghỉ giữa các lô, giây (mặc định: %(default)s)')
+    purge.add_argument('--dry-run', action='store_true', help='Chỉ in số dòng và dung lượng sẽ lấy lại')
+    purge.add_argument('--no-compact', action='store_true', help='Không chạy incremental_vacuum sau khi xóa')
+
+    compact_parser = subparsers.add_parser('compact', help='Trả dung lượng trống về hệ điều hành')
+    compact_parser.add_argument('--full', action='store_true',
+                                help='VACUUM toàn bộ và bật auto_vacuum=INCREMENTAL (khóa database khi chạy)')
+    compact_parser.add_argument('--vacuum-into', help='Ghi bản nén ra file khác (VACUUM INTO)')
+
+    for sub in (purge, compact_parser):
+        sub.add_argument('--db', help='File database (mặc định: DB_PATH)')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if Config.STORAGE_BACKEND == 'memory':
+        print("ℹ️ STORAGE_BACKEND=memory: không có file database để dọn")
+        return
+
+    paths = [path for path in database_paths(args.db) if os.path.exists(path)]
+    if not paths:
+        print(f"❌ Database file không tồn tại: {args.db or Config.DB_PATH}")
+        sys.exit(1)
+
+    for path in paths:
+        print(f"🗄️ {path}")
+        if args.command == 'compact':
+            if args.vacuum_into and len(paths) > 1:
+                # Mỗi shard một file: backup.db -> backup.ladesk_integration.shard0.db, ...
+                compact(path, vacuum_into=f"{os.path.splitext(args.vacuum_into)[0]}.{os.path.basename(path)}")
+            else:
+                compact(path, full=args.full, vacuum_into=args.vacuum_into)
+            continue
+
+        targets = sorted(TARGETS) if 'all' in args.target else list(dict.fromkeys(args.target))
+        filters = {
+            'older_than': args.older_than,
+            'webhook_type': args.webhook_type,
+            'status': args.status,
+            'closed': args.closed,
+            'closed_statuses': tuple(s.strip() for s in args.closed_statuses.split(',') if s.strip()),
+        }
+        run_purge(path, targets, filters, args.batch_size, args.sleep, args.dry_run)
+        if not args.dry_run and not args.no_compact:
+            compact(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Upstream Fan-out
+Executor có giới hạn để chạy song song các bước độc lập của một webhook
+(DB lookup, gọi Ladesk Cloud/On-Premise)
+
+Mỗi task chạy trong bản sao contextvars của request nên timing
+(webhook_timing) vẫn được ghi vào đúng webhook.
+"""
+
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def get_executor() -> Optional[ThreadPoolExecutor]:
+    """Tạo executor lần đầu cần dùng (None nếu UPSTREAM_MAX_WORKERS = 0: chạy tuần tự)"""
+    global _executor
+    if Config.UPSTREAM_MAX_WORKERS <= 0:
+        return None
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=Config.UPSTREAM_MAX_WORKERS,
+                    thread_name_prefix='ladesk-upstream'
+                )
+    return _executor
+
+
+def _update_pending(delta: int):
+    global _pending
+    with _pending_lock:
+        _pending += delta
+        metrics.set_queue_depth('upstream_fanout', _pending)
+
+
+def pending() -> int:
+    """Số task upstream đang chờ hoặc đang chạy"""
+    return _pending
+
+
+def submit(func: Callable, *args, **kwargs) -> Future:
+    """Chạy func trên executor, trả về Future"""
+    executor = get_executor()
+    if executor is None:
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    context = contextvars.copy_context()
+    _update_pending(1)
+    future = executor.submit(context.run, func, *args, **kwargs)
+    future.add_done_callback(lambda _: _update_pending(-1))
+    return future
+
+
+def completed(value) -> Future:
+    """Future đã có sẵn kết quả (cho nhánh không cần gọi upstream)"""
+    future = Future()
+    future.set_result(value)
+    return future
@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+"""
+Ladesk API Clients
+Client đồng bộ cho Ladesk Cloud và Ladesk On-Premise
+
+Phần diễn giải response (các hàm *_result) dùng chung với client async
+trong ladesk_async.py để hai bên luôn trả về cùng một format.
+"""
+
+import re
+import json
+import logging
+from config import Config
+from metrics import instrumented_request
+from shared_cache import cache
+from records import AgentRef
+from attachments import (AttachmentForbidden, AttachmentTooLarge, MultipartStream, SpooledAttachment, REDIRECT_STATUSES,
+                         check_download_url, redirect_target, same_origin)
+from message_transform import html_to_text
+
+logger = logging.getLogger(__name__)
+
+_EXISTING_CONTACT_ID = re.compile(r'Id: ([a-zA-Z0-9]+)')
+
+
+def clean_agent_message(message: str) -> str:
+    """Chuyển reply HTML của agent sang text cho Cloud, giữ đoạn văn, danh sách và link (xem message_transform.py)"""
+    return html_to_text(message)
+
+
+def json_result(status_code: int, text: str) -> dict:
+    """Kết quả cho request chỉ thành công với status 200 + JSON body"""
+    if status_code == 200:
+        return {'success': True, 'data': json.loads(text)}
+    return {'success': False, 'error': text, 'status_code': status_code}
+
+
+def conversation_messages_result(status_code: int, text: str) -> dict:
+    """Message của conversation (API v1 trả về theo nhóm) thành một list phẳng theo thứ tự;
+    mỗi message có id, type, message, userid, datecreated (lấy từ nhóm nếu message không có)"""
+    result = json_result(status_code, text)
+    if not result['success']:
+        return result
+    response = result['data'].get('response', result['data'])
+    messages = []
+    for group in response.get('groups') or [{'messages': response.get('messages') or []}]:
+        for message in group.get('messages') or []:
+            messages.append({
+                'id': str(message.get('id') or ''),
+                'type': message.get('type') or group.get('rtype'),
+                'message': message.get('message') or '',
+                'userid': message.get('userid') or group.get('userid'),
+                'datecreated': message.get('datecreated') or group.get('datecreated') or '',
+            })
+    return {'success': True, 'data': messages}
+
+
+def message_post_result(status_code: int, text: str, default_message: str) -> dict:
+    """Kết quả cho POST message (API v1 có thể trả body rỗng hoặc không phải JSON)"""
+    if status_code == 200:
+        # Kiểm tra xem response có body không
+        if text.strip():
+            try:
+                return {'success': True, 'data': json.loads(text)}
+            except json.JSONDecodeError:
+                return {'success': True, 'data': {'message': default_message}}
+        return {'success': True, 'data': {'message': default_message}}
+    return {'success': False, 'error': text, 'status_code': status_code}
+
+
+def contact_creation_result(status_code: int, text: str) -> dict:
+    """Kết quả tạo contact: 400 "already exist" được coi là thành công với ID có sẵn"""
+    if status_code == 200:
+        return {'success': True, 'data': json.loads(text)}
+    if status_code == 400 and "already exist" in text:
+        # Contact đã tồn tại, trích xuất ID từ response
+        try:
+            error_data = json.loads(text)
+            # Tìm ID trong message text
+            id_match = _EXISTING_CONTACT_ID.search(text)
+            if id_match:
+                contact_id = id_match.group(1)
+                logger.info("✅ Extracted existing contact ID: %s", contact_id)
+                return {'success': True, 'contact_id': contact_id, 'exists': True}
+            # Thử parse JSON
+            contact_id = error_data.get('contact_id') or error_data.get('id')
+            if contact_id:
+                logger.info("✅ Found existing contact ID in JSON: %s", contact_id)
+                return {'success': True, 'contact_id': contact_id, 'exists': True}
+            logger.error("❌ Cannot extract contact ID from response: %s", text)
+            return {'success': False, 'error': 'Contact exists but cannot extract ID'}
+        except Exception as e:
+            logger.error("❌ Error parsing contact creation response: %s", e)
+            return {'success': False, 'error': 'Contact exists but cannot extract ID'}
+    return {'success': False, 'error': text}
+
+
+def agent_search_result(status_code: int, text: str, agent_name: str) -> dict:
+    """Kết quả tìm agent theo tên (response là list hoặc object)"""
+    if status_code != 200:
+        logger.error("❌ Agent search failed: %s - %s", status_code, text)
+        return {'success': False, 'error': text}
+    try:
+        result = json.loads(text)
+        if result and 'response' in result:
+            agent_data = result['response']
+            if isinstance(agent_data, list) and len(agent_data) > 0:
+                # Lấy agent đầu tiên tìm thấy
+                agent_data = agent_data[0]
+            if isinstance(agent_data, dict):
+                agent_id = agent_data.get('contactid') or agent_data.get('userid')
+                if agent_id:
+                    logger.info("✅ Found agent_id: %s for agent_name: %s", agent_id, agent_name)
+                    return {'success': True, 'agent_id': agent_id, 'agent_data': agent_data}
+
+        logger.warning("⚠️ No agent found for name: %s", agent_name)
+        return {'success': False, 'error': 'Agent not found'}
+    except json.JSONDecodeError:
+        logger.error("❌ Invalid JSON response: %s", text)
+        return {'success': False, 'error': 'Invalid JSON response'}
+
+
+def agent_info_result(status_code: int, text: str, contactid: str) -> dict:
+    """Kết quả lấy agent theo contactid"""
+    if status_code != 200:
+        logger.error("❌ Agent info failed: %s - %s", status_code, text)
+        return {'success': False, 'error': text}
+    try:
+        result = json.loads(text)
+        if result and 'response' in result:
+            agent_data = result['response']
+            agent_id = agent_data.get('contactid') or agent_data.get('userid')
+            if agent_id:
+                logger.info("✅ Found agent_id: %s for contactid: %s", agent_id, contactid)
+                return {'success': True, 'agent_id': agent_id, 'agent_data': agent_data}
+
+        logger.warning("⚠️ No agent found for contactid: %s", contactid)
+        return {'success': False, 'error': 'Agent not found'}
+    except json.JSONDecodeError:
+        logger.error("❌ Invalid JSON response: %s", text)
+        return {'success': False, 'error': 'Invalid JSON response'}
+
+
+def agent_list_result(status_code: int, text: str, service: str) -> dict:
+    """Kết quả lấy danh sách agent (response là list hoặc object chứa 'agents'), agents là list AgentRef"""
+    if status_code != 200:
+        logger.error("❌ %s agent list failed: %s - %s", service, status_code, text)
+        return {'success': False, 'error': text}
+    try:
+        result = json.loads(text)
+        agents = result.get('response', result) if isinstance(result, dict) else result
+        if isinstance(agents, dict):
+            agents = agents.get('agents', [])
+        if not isinstance(agents, list):
+            return {'success': False, 'error': 'Unexpected agent list format'}
+        agents = [AgentRef.from_api(agent) for agent in agents if isinstance(agent, dict)]
+        logger.info("✅ Got %s agents from %s", len(agents), service)
+        return {'success': True, 'agents': agents}
+    except json.JSONDecodeError:
+        logger.error("❌ Invalid JSON response: %s", text)
+        return {'success': False, 'error': 'Invalid JSON response'}
+
+
+def list_conversations_params(changed_since: str = None, page: int = 1, per_page: int = 100) -> dict:
+    """Query string của GET /tickets (API v3)"""
+    params = {'_page': page, '_perPage': per_page, '_sortField': 'date_created', '_sortDir': 'ASC'}
+    if changed_since:
+        params['_filters'] = json.dumps([['date_changed', 'D>=', changed_since]])
+    return params
+
+
+def attachment_field(file_ids) -> dict:
+    """Trường attachments (file id cách nhau bởi dấu phẩy) của ticket/message, rỗng nếu không có file"""
+    return {'attachments': ','.join(file_ids)} if file_ids else {}
+
+
+def stream_download(service: str, url: str, headers: dict, name: str, content_type: str = None) -> dict:
+    """Tải file theo chunk vào SpooledAttachment: {'success': True, 'attachment': ...} (người gọi đóng file).
+    URL và từng redirect phải qua check_download_url"""
+    try:
+        for _ in range(Config.ATTACHMENT_MAX_REDIRECTS + 1):
+            check_download_url(url)
+            response = instrumented_request(service, 'download_attachment', 'GET', url, headers=headers,
+                                            stream=True, allow_redirects=False, timeout=Config.ATTACHMENT_TIMEOUT)
+            if response.status_code not in REDIRECT_STATUSES:
+                break
+            response.close()
+            url, headers = redirect_target(url, response.headers.get('Location'), headers)
+        else:
+            raise AttachmentForbidden(f"Too many redirects: {url}")
+        with response:
+            if response.status_code != 200:
+                logger.error("❌ Attachment download failed: %s - %s", response.status_code, url)
+                return {'success': False, 'error': response.text[:500], 'status_code': response.status_code}
+            attachment = SpooledAttachment(name, content_type or response.headers.get('Content-Type'))
+            try:
+                attachment.check_declared_size(response.headers.get('Content-Length'))
+                for chunk in response.iter_content(Config.ATTACHMENT_CHUNK_BYTES):
+                    attachment.write(chunk)
+            except BaseException:
+                attachment.close()
+                raise
+            logger.info("✅ Downloaded attachment %s (%s bytes)", attachment.name, attachment.size)
+            return {'success': True, 'attachment': attachment}
+
+    except AttachmentTooLarge as e:
+        logger.warning("⚠️ Attachment too large: %s", e)
+        return {'success': False, 'error': str(e), 'status_code': 413}
+    except AttachmentForbidden as e:
+        logger.warning("🚫 Attachment download refused: %s", e)
+        return {'success': False, 'error': str(e), 'status_code': 403}
+    except Exception as e:
+        logger.error("Attachment download error: %s", e)
+        return {'success': False, 'error': str(e)}
+
+
+def stream_upload(service: str, url: str, headers: dict, attachment: SpooledAttachment) -> dict:
+    """Upload file (multipart, field file) đọc dần từ SpooledAttachment"""
+    try:
+        body = MultipartStream(attachment)
+        headers = {**headers, 'Content-Type': body.content_type}
+        response = instrumented_request(service, 'upload_attachment', 'POST', url, headers=headers, data=body,
+                                        timeout=Config.ATTACHMENT_TIMEOUT)
+        logger.info("Attachment upload response: %s", response.status_code)
+        return json_result(response.status_code, response.text)
+
+    except Exception as e:
+        logger.error("Attachment upload error: %s", e)
+        return {'success': False, 'error': str(e)}
+
+
+def should_lookup_agent(agent_id: str, default_user_identifier: str) -> bool:
+    """agent_id có cần tra qua API On-Premise không (không phải giá trị mặc định)"""
+    return bool(agent_id) and agent_id != 'default_agent' and agent_id != default_user_identifier
+
+
+class LadeskCloudAPI:
+    """API cho Ladesk Cloud"""
+
+    def __init__(self):
+        self.api_key_v3 = Config.LADESK_CLOUD_API_KEY_V3
+        self.base_url_v3 = Config.LADESK_CLOUD_BASE_URL_V3
+        self.api_key_v1 = Config.LADESK_CLOUD_API_KEY_V1
+        self.base_url_v1 = Config.LADESK_CLOUD_BASE_URL_V1
+        self.user_identifier = Config.LADESK_CLOUD_USER_IDENTIFIER
+
+    def get_conversation_details(self, conversation_id: str) -> dict:
+        """Lấy chi tiết conversation từ Cloud"""
+        try:
+            url = f"{self.base_url_v1}/conversations/{conversation_id}"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            response = instrumented_request('cloud', 'get_conversation_details', 'GET', url, headers=headers)
+            logger.info("Cloud conversation details response: %s", response.status_code)
+            return json_result(response.status_code, response.text)
+
+        except Exception as e:
+            logger.error("Cloud conversation details error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def get_conversation_messages(self, conversation_id: str) -> dict:
+        """Lấy toàn bộ message của conversation từ Cloud (list phẳng, xem conversation_messages_result)"""
+        try:
+            url = f"{self.base_url_v1}/conversations/{conversation_id}/messages"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            response = instrumented_request('cloud', 'get_conversation_messages', 'GET', url, headers=headers)
+            logger.info("Cloud conversation messages response: %s", response.status_code)
+            return conversation_messages_result(response.status_code, response.text)
+
+        except Exception as e:
+            logger.error("Cloud conversation messages error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def list_conversations(self, changed_since: str = None, page: int = 1, per_page: int = 100) -> dict:
+        """Một trang conversation (ticket) trên Cloud, sắp theo ngày tạo; changed_since lọc theo date_changed"""
+        try:
+            url = f"{self.base_url_v3}/tickets"
+            headers = {
+                'apikey': self.api_key_v3,
+                'Content-Type': 'application/json'
+            }
+            params = list_conversations_params(changed_since, page, per_page)
+
+            response = instrumented_request('cloud', 'list_conversations', 'GET', url, headers=headers, params=params)
+            logger.info("Cloud conversation list response: %s", response.status_code)
+            return json_result(response.status_code, response.text)
+
+        except Exception as e:
+            logger.error("Cloud conversation list error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def get_contact_details(self, contact_id: str) -> dict:
+        """Lấy chi tiết contact từ Cloud (qua cache dùng chung giữa các worker)"""
+        return cache.get_or_compute(f"cloud_contact:{contact_id}", lambda: self._fetch_contact_details(contact_id),
+                                    Config.CONTACT_CACHE_TTL, cache_name='cloud_contact')
+
+    def _fetch_contact_details(self, contact_id: str) -> dict:
+        try:
+            url = f"{self.base_url_v3}/contacts/{contact_id}"
+            headers = {
+                'apikey': self.api_key_v3,
+                'Content-Type': 'application/json'
+            }
+
+            response = instrumented_request('cloud', 'get_contact_details', 'GET', url, headers=headers)
+            logger.info("Cloud contact details response: %s", response.status_code)
+            return json_result(response.status_code, response.text)
+
+        except Exception as e:
+            logger.error("Cloud contact details error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def download_attachment(self, url: str, name: str, content_type: str = None) -> dict:
+        """Tải file đính kèm (apikey chỉ gửi khi file nằm trên server Cloud)"""
+        headers = {'apikey': self.api_key_v1} if same_origin(url, self.base_url_v1) else {}
+        return stream_download('cloud', url, headers, name, content_type)
+
+    def upload_attachment(self, attachment: SpooledAttachment) -> dict:
+        """Upload file lên Cloud, data['id'] là file id dùng trong send_reply"""
+        return stream_upload('cloud', f"{self.base_url_v3}/files", {'apikey': self.api_key_v3}, attachment)
+
+    def list_agents(self) -> dict:
+        """Lấy danh sách agent trên Cloud"""
+        try:
+            url = f"{self.base_url_v1}/agents"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            response = instrumented_request('cloud', 'list_agents', 'GET', url, headers=headers)
+            logger.info("Cloud agent list response: %s", response.status_code)
+            return agent_list_result(response.status_code, response.text, 'cloud')
+
+        except Exception as e:
+            logger.error("Cloud agent list error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def get_userid_from_api(self, agent_id: str = None) -> str:
+        """Lấy userid từ API khi agent_id không có sẵn"""
+        try:
+            # Import agent mapping config
+            from agent_mapping_config import agent_mapping
+
+            # Nếu có agent_id và có trong mapping, sử dụng mapping
+            if agent_id:
+                cloud_user_id = agent_mapping.get_cloud_userid(agent_id)
+                if cloud_user_id:
+                    logger.info("✅ Mapped agent_id %s to Cloud useridentifier: %s", agent_id, cloud_user_id)
+                    return cloud_user_id
+
+            # Nếu có agent_id và không phải default, thử lấy thông tin từ On-Premise API
+            if should_lookup_agent(agent_id, self.user_identifier):
+                try:
+                    # Gọi API On-Premise để lấy thông tin agent
+                    onpremise_api = LadeskOnPremiseAPI()
+                    agent_result = onpremise_api.get_agent_id_by_contactid(agent_id)
+                    if agent_result['success']:
+                        # Kiểm tra xem agent_id từ API có trong mapping không
+                        api_agent_id = agent_result['agent_id']
+                        cloud_user_id = agent_mapping.get_cloud_userid(api_agent_id)
+                        if cloud_user_id:
+                            logger.info("✅ Got useridentifier from API mapping: %s -> %s", api_agent_id, cloud_user_id)
+                            return cloud_user_id
+                        else:
+                            logger.warning("⚠️ Agent ID from API not in mapping: %s", api_agent_id)
+                    else:
+                        logger.warning("⚠️ API call failed for agent_id: %s", agent_id)
+                except Exception as e:
+                    logger.warning("⚠️ Could not get userid from API: %s", e)
+
+            # Nếu không lấy được hoặc agent_id là user_identifier mặc định, sử dụng user_identifier mặc định
+            logger.info("✅ Using default useridentifier: %s", self.user_identifier)
+            return self.user_identifier
+
+        except Exception as e:
+            logger.error("❌ Error getting userid from API: %s", e)
+            return self.user_identifier
+
+    def send_reply(self, conversation_id: str, message: str, agent_id: str = None, attachments: list = None) -> dict:
+        """Gửi reply đến Cloud (attachments: file id đã upload bằng upload_attachment)"""
+        try:
+            # Sử dụng endpoint đúng cho agent reply
+            url = f"{self.base_url_v1}/conversations/{conversation_id}/messages"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+
+            # Luôn gọi get_userid_from_api để lấy useridentifier hợp lệ cho Cloud API
+            useridentifier = self.get_userid_from_api(agent_id)
+
+            clean_message = clean_agent_message(message)
+
+            data = {
+                'message': clean_message,
+                'useridentifier': useridentifier,
+                'type': 'M',  # Theo tài liệu: M = Message, N = Note
+                'isagent': '1',  # Đánh dấu đây là agent reply
+                'agentid': useridentifier,  # ID của agent
+                **attachment_field(attachments)
+            }
+
+            logger.info("🔄 Sending agent reply to Cloud: %s, agent: %s", conversation_id, useridentifier)
+            logger.debug("🔄 Reply message: %s", clean_message)
+
+            # Gửi dưới dạng form data thay vì JSON
+            response = instrumented_request('cloud', 'send_reply', 'POST', url, headers=headers, data=data)
+            logger.info("Cloud reply response: %s", response.status_code)
+            logger.debug("Cloud reply response body: %s", response.text)
+            return message_post_result(response.status_code, response.text, 'Agent reply sent successfully')
+
+        except Exception as e:
+            logger.error("Cloud reply error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+class LadeskOnPremiseAPI:
+    """API cho Ladesk On-Premise"""
+
+    def __init__(self):
+        self.api_key = Config.LADESK_ONPREMISE_API_KEY_V3
+        self.base_url = Config.LADESK_ONPREMISE_BASE_URL_V3
+        self.api_key_v1 = Config.LADESK_ONPREMISE_API_KEY_V1
+        self.base_url_v1 = Config.LADESK_ONPREMISE_BASE_URL_V1
+
+    def create_contact(self, contact_data: dict) -> dict:
+        """Tạo contact trong On-Premise"""
+        try:
+            url = f"{self.base_url}/contacts"
+            headers = {
+                'apikey': self.api_key,
+                'Content-Type': 'application/json'
+            }
+
+            response = instrumented_request('onpremise', 'create_contact', 'POST', url, headers=headers, json=contact_data)
+            logger.info("Contact creation response: %s", response.status_code)
+            logger.debug("Contact creation response body: %s", response.text)
+            return contact_creation_result(response.status_code, response.text)
+
+        except Exception as e:
+            logger.error("Contact creation error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def create_ticket(self, ticket_data: dict) -> dict:
+        """Tạo ticket trong On-Premise"""
+        try:
+            url = f"{self.base_url}/tickets"
+            headers = {
+                'apikey': self.api_key,
+                'Content-Type': 'application/json'
+            }
+
+            response = instrumented_request('onpremise', 'create_ticket', 'POST', url, headers=headers, json=ticket_data)
+            logger.info("Ticket creation response: %s", response.status_code)
+            return json_result(response.status_code, response.text)
+
+        except Exception as e:
+            logger.error("Ticket creation error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def update_ticket_message(self, message_data: dict) -> dict:
+        """Cập nhật message vào ticket hiện tại"""
+        try:
+            # Sử dụng API v1 cho message update (conversation messages)
+            url = f"{self.base_url_v1}/conversations/{message_data['ticketid']}/messages"
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+
+            # Format đúng cho API v1 - sử dụng form data với apikey trong data
+            data = {
+                'message': message_data['message'],  # Message body (mandatory)
+                'apikey': self.api_key_v1,  # API key (mandatory)
+                'type': 'M',  # Message type (optional) - để hiển thị đúng message của khách hàng
+                'useridentifier': message_data['useridentifier'],  # Customer identifier (optional) - để hiển thị như customer message
+                **attachment_field(message_data.get('attachments'))  # File id đã upload (optional)
+            }
+
+            logger.info("🔄 Updating ticket message at URL: %s", url)
+            logger.debug("🔄 Message data: %s", data)
+
+            # Gửi dưới dạng form data thay vì JSON
+            response = instrumented_request('onpremise', 'update_ticket_message', 'POST', url, headers=headers, data=data)
+            logger.info("Ticket message update response: %s", response.status_code)
+            logger.debug("Ticket message update response body: %s", response.text)
+            return message_post_result(response.status_code, response.text, 'Message updated successfully')
+
+        except Exception as e:
+            logger.error("Ticket message update error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def download_attachment(self, url: str, name: str, content_type: str = None) -> dict:
+        """Tải file đính kèm (apikey chỉ gửi khi file nằm trên server On-Premise)"""
+        headers = {'apikey': self.api_key_v1} if same_origin(url, self.base_url_v1) else {}
+        return stream_download('onpremise', url, headers, name, content_type)
+
+    def upload_attachment(self, attachment: SpooledAttachment) -> dict:
+        """Upload file lên On-Premise, data['id'] là file id dùng trong create_ticket/update_ticket_message"""
+        return stream_upload('onpremise', f"{self.base_url}/files", {'apikey': self.api_key}, attachment)
+
+    def list_agents(self) -> dict:
+        """Lấy danh sách agent trên On-Premise"""
+        try:
+            url = f"{self.base_url_v1}/agents"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            response = instrumented_request('onpremise', 'list_agents', 'GET', url, headers=headers)
+            logger.info("On-Premise agent list response: %s", response.status_code)
+            return agent_list_result(response.status_code, response.text, 'onpremise')
+
+        except Exception as e:
+            logger.error("On-Premise agent list error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def get_agent_id_by_name(self, agent_name: str) -> dict:
+        """Lấy agent_id từ agent_name bằng cách gọi API Ladesk On-Premise (có cache)"""
+        return cache.get_or_compute(f"onpremise_agent_name:{agent_name}", lambda: self._fetch_agent_id_by_name(agent_name),
+                                    Config.AGENT_CACHE_TTL, cache_name='onpremise_agent')
+
+    def _fetch_agent_id_by_name(self, agent_name: str) -> dict:
+        try:
+            # Sử dụng API v1 để tìm agent theo tên
+            url = f"{self.base_url_v1}/agents"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            params = {
+                'search': agent_name
+            }
+
+            logger.info("🔍 Searching for agent by name: %s", agent_name)
+            logger.debug("🔍 API URL: %s", url)
+
+            response = instrumented_request('onpremise', 'get_agent_id_by_name', 'GET', url, headers=headers, params=params)
+            logger.info("Agent search response: %s", response.status_code)
+            logger.debug("Agent search response body: %s", response.text)
+            return agent_search_result(response.status_code, response.text, agent_name)
+
+        except Exception as e:
+            logger.error("❌ Agent search error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    def get_agent_id_by_contactid(self, contactid: str) -> dict:
+        """Lấy agent_id từ contactid bằng cách gọi API Ladesk On-Premise (có cache)"""
+        return cache.get_or_compute(f"onpremise_agent:{contactid}", lambda: self._fetch_agent_id_by_contactid(contactid),
+                                    Config.AGENT_CACHE_TTL, cache_name='onpremise_agent')
+
+    def _fetch_agent_id_by_contactid(self, contactid: str) -> dict:
+        try:
+            # Sử dụng API v1 để lấy thông tin agent theo contactid
+            url = f"{self.base_url_v1}/agents/{contactid}"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            logger.info("🔍 Getting agent info by contactid: %s", contactid)
+            logger.debug("🔍 API URL: %s", url)
+
+            response = instrumented_request('onpremise', 'get_agent_id_by_contactid', 'GET', url, headers=headers)
+            logger.info("Agent info response: %s", response.status_code)
+            logger.debug("Agent info response body: %s", response.text)
+            return agent_info_result(response.status_code, response.text, contactid)
+
+        except Exception as e:
+            logger.error("❌ Agent info error: %s", e)
+            return {'success': False, 'error': str(e)}
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Ladesk Async API Clients
+Phiên bản asyncio của LadeskCloudAPI / LadeskOnPremiseAPI (cùng tên method,
+cùng format kết quả) chạy trên một aiohttp.ClientSession dùng chung
+
+Session giữ pool kết nối keep-alive (ASYNC_HTTP_POOL_SIZE) tới Ladesk nên một
+process có thể chờ hàng trăm request upstream cùng lúc mà không cần thread.
+"""
+
+import time
+import logging
+from typing import Optional, Tuple
+
+import aiohttp
+
+import metrics
+from config import Config
+from shared_cache import cache
+from ladesk_api import (
+    clean_agent_message, json_result, message_post_result, contact_creation_result,
+    agent_search_result, agent_info_result, agent_list_result, should_lookup_agent,
+    conversation_messages_result, list_conversations_params, attachment_field
+)
+from attachments import (AttachmentForbidden, AttachmentTooLarge, SpooledAttachment, REDIRECT_STATUSES,
+                         check_download_url_async, redirect_target, same_origin)
+
+logger = logging.getLogger(__name__)
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Session dùng chung, tạo lần đầu cần dùng (phải gọi bên trong event loop)"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=Config.ASYNC_HTTP_POOL_SIZE)
+        timeout = aiohttp.ClientTimeout(total=Config.ASYNC_HTTP_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_session():
+    """Đóng session khi tắt app"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def instrumented_request(service: str, method: str, http_method: str, url: str,
+                               **kwargs) -> Tuple[int, str]:
+    """Gọi HTTP tới Ladesk, trả về (status_code, text) và ghi latency như bản sync"""
+    start = time.perf_counter()
+    status = 'exception'
+    try:
+        async with get_session().request(http_method, url, **kwargs) as response:
+            text = await response.text()
+            status = str(response.status)
+            return response.status, text
+    finally:
+        metrics.observe_upstream(service, method, status, time.perf_counter() - start)
+
+
+async def stream_download(service: str, url: str, headers: dict, name: str, content_type: str = None) -> dict:
+    """Tải file theo chunk vào SpooledAttachment như bản sync (latency tính cả thời gian tải),
+    URL và từng redirect phải qua check_download_url_async"""
+    start = time.perf_counter()
+    status = 'exception'
+    try:
+        timeout = aiohttp.ClientTimeout(total=Config.ATTACHMENT_TIMEOUT)
+        for _ in range(Config.ATTACHMENT_MAX_REDIRECTS + 1):
+            await check_download_url_async(url)
+            response = await get_session().get(url, headers=headers, timeout=timeout, allow_redirects=False)
+            if response.status not in REDIRECT_STATUSES:
+                break
+            response.release()
+            url, headers = redirect_target(url, response.headers.get('Location'), headers)
+        else:
+            raise AttachmentForbidden(f"Too many redirects: {url}")
+        async with response:
+            status = str(response.status)
+            if response.status != 200:
+                logger.error("❌ Attachment download failed: %s - %s", response.status, url)
+                return {'success': False, 'error': (await response.text())[:500], 'status_code': response.status}
+            attachment = SpooledAttachment(name, content_type or response.headers.get('Content-Type'))
+            try:
+                attachment.check_declared_size(response.headers.get('Content-Length'))
+                async for chunk in response.content.iter_chunked(Config.ATTACHMENT_CHUNK_BYTES):
+                    attachment.write(chunk)
+            except BaseException:
+                attachment.close()
+                raise
+            logger.info("✅ Downloaded attachment %s (%s bytes)", attachment.name, attachment.size)
+            return {'success': True, 'attachment': attachment}
+
+    except AttachmentTooLarge as e:
+        logger.warning("⚠️ Attachment too large: %s", e)
+        return {'success': False, 'error': str(e), 'status_code': 413}
+    except AttachmentForbidden as e:
+        status = 'forbidden'
+        logger.warning("🚫 Attachment download refused: %s", e)
+        return {'success': False, 'error': str(e), 'status_code': 403}
+    except Exception as e:
+        logger.error("Attachment download error: %s", e)
+        return {'success': False, 'error': str(e)}
+    finally:
+        metrics.observe_upstream(service, 'download_attachment', status, time.perf_counter() - start)
+
+
+async def stream_upload(service: str, url: str, headers: dict, attachment: SpooledAttachment) -> dict:
+    """Upload file (multipart, field file): aiohttp đọc file theo chunk trong thread"""
+    try:
+        attachment.rewind()
+        form = aiohttp.FormData(quote_fields=False)  # tên file UTF-8 giữ nguyên như bản sync
+        form.add_field('file', attachment.file, filename=attachment.name, content_type=attachment.content_type)
+        status_code, text = await instrumented_request(service, 'upload_attachment', 'POST', url, headers=headers,
+                                                       data=form,
+                                                       timeout=aiohttp.ClientTimeout(total=Config.ATTACHMENT_TIMEOUT))
+        logger.info("Attachment upload response: %s", status_code)
+        return json_result(status_code, text)
+
+    except Exception as e:
+        logger.error("Attachment upload error: %s", e)
+        return {'success': False, 'error': str(e)}
+
+
+class AsyncLadeskCloudAPI:
+    """API async cho Ladesk Cloud"""
+
+    def __init__(self):
+        self.api_key_v3 = Config.LADESK_CLOUD_API_KEY_V3
+        self.base_url_v3 = Config.LADESK_CLOUD_BASE_URL_V3
+        self.api_key_v1 = Config.LADESK_CLOUD_API_KEY_V1
+        self.base_url_v1 = Config.LADESK_CLOUD_BASE_URL_V1
+        self.user_identifier = Config.LADESK_CLOUD_USER_IDENTIFIER
+
+    async def get_conversation_details(self, conversation_id: str) -> dict:
+        """Lấy chi tiết conversation từ Cloud"""
+        try:
+            url = f"{self.base_url_v1}/conversations/{conversation_id}"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            status_code, text = await instrumented_request('cloud', 'get_conversation_details', 'GET', url, headers=headers)
+            logger.info("Cloud conversation details response: %s", status_code)
+            return json_result(status_code, text)
+
+        except Exception as e:
+            logger.error("Cloud conversation details error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def get_conversation_messages(self, conversation_id: str) -> dict:
+        """Lấy toàn bộ message của conversation từ Cloud (list phẳng, xem conversation_messages_result)"""
+        try:
+            url = f"{self.base_url_v1}/conversations/{conversation_id}/messages"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            status_code, text = await instrumented_request('cloud', 'get_conversation_messages', 'GET', url, headers=headers)
+            logger.info("Cloud conversation messages response: %s", status_code)
+            return conversation_messages_result(status_code, text)
+
+        except Exception as e:
+            logger.error("Cloud conversation messages error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def list_conversations(self, changed_since: str = None, page: int = 1, per_page: int = 100) -> dict:
+        """Một trang conversation (ticket) trên Cloud, sắp theo ngày tạo; changed_since lọc theo date_changed"""
+        try:
+            url = f"{self.base_url_v3}/tickets"
+            headers = {
+                'apikey': self.api_key_v3,
+                'Content-Type': 'application/json'
+            }
+            params = list_conversations_params(changed_since, page, per_page)
+
+            status_code, text = await instrumented_request('cloud', 'list_conversations', 'GET', url,
+                                                           headers=headers, params=params)
+            logger.info("Cloud conversation list response: %s", status_code)
+            return json_result(status_code, text)
+
+        except Exception as e:
+            logger.error("Cloud conversation list error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def get_contact_details(self, contact_id: str) -> dict:
+        """Lấy chi tiết contact từ Cloud (qua cache dùng chung với worker sync)"""
+        return await cache.get_or_compute_async(f"cloud_contact:{contact_id}", lambda: self._fetch_contact_details(contact_id),
+                                                Config.CONTACT_CACHE_TTL, cache_name='cloud_contact')
+
+    async def _fetch_contact_details(self, contact_id: str) -> dict:
+        try:
+            url = f"{self.base_url_v3}/contacts/{contact_id}"
+            headers = {
+                'apikey': self.api_key_v3,
+                'Content-Type': 'application/json'
+            }
+
+            status_code, text = await instrumented_request('cloud', 'get_contact_details', 'GET', url, headers=headers)
+            logger.info("Cloud contact details response: %s", status_code)
+            return json_result(status_code, text)
+
+        except Exception as e:
+            logger.error("Cloud contact details error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def download_attachment(self, url: str, name: str, content_type: str = None) -> dict:
+        """Tải file đính kèm (apikey chỉ gửi khi file nằm trên server Cloud)"""
+        headers = {'apikey': self.api_key_v1} if same_origin(url, self.base_url_v1) else {}
+        return await stream_download('cloud', url, headers, name, content_type)
+
+    async def upload_attachment(self, attachment: SpooledAttachment) -> dict:
+        """Upload file lên Cloud, data['id'] là file id dùng trong send_reply"""
+        return await stream_upload('cloud', f"{self.base_url_v3}/files", {'apikey': self.api_key_v3}, attachment)
+
+    async def list_agents(self) -> dict:
+        """Lấy danh sách agent trên Cloud"""
+        try:
+            url = f"{self.base_url_v1}/agents"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            status_code, text = await instrumented_request('cloud', 'list_agents', 'GET', url, headers=headers)
+            logger.info("Cloud agent list response: %s", status_code)
+            return agent_list_result(status_code, text, 'cloud')
+
+        except Exception as e:
+            logger.error("Cloud agent list error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def get_userid_from_api(self, agent_id: str = None) -> str:
+        """Lấy userid từ API khi agent_id không có sẵn"""
+        try:
+            # Import agent mapping config
+            from agent_mapping_config import agent_mapping
+
+            # Nếu có agent_id và có trong mapping, sử dụng mapping
+            if agent_id:
+                cloud_user_id = agent_mapping.get_cloud_userid(agent_id)
+                if cloud_user_id:
+                    logger.info("✅ Mapped agent_id %s to Cloud useridentifier: %s", agent_id, cloud_user_id)
+                    return cloud_user_id
+
+            # Nếu có agent_id và không phải default, thử lấy thông tin từ On-Premise API
+            if should_lookup_agent(agent_id, self.user_identifier):
+                try:
+                    agent_result = await AsyncLadeskOnPremiseAPI().get_agent_id_by_contactid(agent_id)
+                    if agent_result['success']:
+                        # Kiểm tra xem agent_id từ API có trong mapping không
+                        api_agent_id = agent_result['agent_id']
+                        cloud_user_id = agent_mapping.get_cloud_userid(api_agent_id)
+                        if cloud_user_id:
+                            logger.info("✅ Got useridentifier from API mapping: %s -> %s", api_agent_id, cloud_user_id)
+                            return cloud_user_id
+                        else:
+                            logger.warning("⚠️ Agent ID from API not in mapping: %s", api_agent_id)
+                    else:
+                        logger.warning("⚠️ API call failed for agent_id: %s", agent_id)
+                except Exception as e:
+                    logger.warning("⚠️ Could not get userid from API: %s", e)
+
+            # Nếu không lấy được hoặc agent_id là user_identifier mặc định, sử dụng user_identifier mặc định
+            logger.info("✅ Using default useridentifier: %s", self.user_identifier)
+            return self.user_identifier
+
+        except Exception as e:
+            logger.error("❌ Error getting userid from API: %s", e)
+            return self.user_identifier
+
+    async def send_reply(self, conversation_id: str, message: str, agent_id: str = None,
+                         attachments: list = None) -> dict:
+        """Gửi reply đến Cloud (attachments: file id đã upload bằng upload_attachment)"""
+        try:
+            url = f"{self.base_url_v1}/conversations/{conversation_id}/messages"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+
+            # Luôn gọi get_userid_from_api để lấy useridentifier hợp lệ cho Cloud API
+            useridentifier = await self.get_userid_from_api(agent_id)
+
+            clean_message = clean_agent_message(message)
+
+            data = {
+                'message': clean_message,
+                'useridentifier': useridentifier,
+                'type': 'M',  # Theo tài liệu: M = Message, N = Note
+                'isagent': '1',  # Đánh dấu đây là agent reply
+                'agentid': useridentifier,  # ID của agent
+                **attachment_field(attachments)
+            }
+
+            logger.info("🔄 Sending agent reply to Cloud: %s, agent: %s", conversation_id, useridentifier)
+            logger.debug("🔄 Reply message: %s", clean_message)
+
+            # Gửi dưới dạng form data thay vì JSON
+            status_code, text = await instrumented_request('cloud', 'send_reply', 'POST', url, headers=headers, data=data)
+            logger.info("Cloud reply response: %s", status_code)
+            logger.debug("Cloud reply response body: %s", text)
+            return message_post_result(status_code, text, 'Agent reply sent successfully')
+
+        except Exception as e:
+            logger.error("Cloud reply error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+
+class AsyncLadeskOnPremiseAPI:
+    """API async cho Ladesk On-Premise"""
+
+    def __init__(self):
+        self.api_key = Config.LADESK_ONPREMISE_API_KEY_V3
+        self.base_url = Config.LADESK_ONPREMISE_BASE_URL_V3
+        self.api_key_v1 = Config.LADESK_ONPREMISE_API_KEY_V1
+        self.base_url_v1 = Config.LADESK_ONPREMISE_BASE_URL_V1
+
+    async def create_contact(self, contact_data: dict) -> dict:
+        """Tạo contact trong On-Premise"""
+        try:
+            url = f"{self.base_url}/contacts"
+            headers = {
+                'apikey': self.api_key,
+                'Content-Type': 'application/json'
+            }
+
+            status_code, text = await instrumented_request('onpremise', 'create_contact', 'POST', url, headers=headers, json=contact_data)
+            logger.info("Contact creation response: %s", status_code)
+            logger.debug("Contact creation response body: %s", text)
+            return contact_creation_result(status_code, text)
+
+        except Exception as e:
+            logger.error("Contact creation error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def create_ticket(self, ticket_data: dict) -> dict:
+        """Tạo ticket trong On-Premise"""
+        try:
+            url = f"{self.base_url}/tickets"
+            headers = {
+                'apikey': self.api_key,
+                'Content-Type': 'application/json'
+            }
+
+            status_code, text = await instrumented_request('onpremise', 'create_ticket', 'POST', url, headers=headers, json=ticket_data)
+            logger.info("Ticket creation response: %s", status_code)
+            return json_result(status_code, text)
+
+        except Exception as e:
+            logger.error("Ticket creation error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def update_ticket_message(self, message_data: dict) -> dict:
+        """Cập nhật message vào ticket hiện tại"""
+        try:
+            # Sử dụng API v1 cho message update (conversation messages)
+            url = f"{self.base_url_v1}/conversations/{message_data['ticketid']}/messages"
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+
+            data = {
+                'message': message_data['message'],
+                'apikey': self.api_key_v1,
+                'type': 'M',
+                'useridentifier': message_data['useridentifier'],
+                **attachment_field(message_data.get('attachments'))
+            }
+
+            logger.info("🔄 Updating ticket message at URL: %s", url)
+            logger.debug("🔄 Message data: %s", data)
+
+            status_code, text = await instrumented_request('onpremise', 'update_ticket_message', 'POST', url, headers=headers, data=data)
+            logger.info("Ticket message update response: %s", status_code)
+            logger.debug("Ticket message update response body: %s", text)
+            return message_post_result(status_code, text, 'Message updated successfully')
+
+        except Exception as e:
+            logger.error("Ticket message update error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def download_attachment(self, url: str, name: str, content_type: str = None) -> dict:
+        """Tải file đính kèm (apikey chỉ gửi khi file nằm trên server On-Premise)"""
+        headers = {'apikey': self.api_key_v1} if same_origin(url, self.base_url_v1) else {}
+        return await stream_download('onpremise', url, headers, name, content_type)
+
+    async def upload_attachment(self, attachment: SpooledAttachment) -> dict:
+        """Upload file lên On-Premise, data['id'] là file id dùng trong create_ticket/update_ticket_message"""
+        return await stream_upload('onpremise', f"{self.base_url}/files", {'apikey': self.api_key}, attachment)
+
+    async def list_agents(self) -> dict:
+        """Lấy danh sách agent trên On-Premise"""
+        try:
+            url = f"{self.base_url_v1}/agents"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            status_code, text = await instrumented_request('onpremise', 'list_agents', 'GET', url, headers=headers)
+            logger.info("On-Premise agent list response: %s", status_code)
+            return agent_list_result(status_code, text, 'onpremise')
+
+        except Exception as e:
+            logger.error("On-Premise agent list error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def get_agent_id_by_name(self, agent_name: str) -> dict:
+        """Lấy agent_id từ agent_name bằng cách gọi API Ladesk On-Premise (có cache)"""
+        return await cache.get_or_compute_async(f"onpremise_agent_name:{agent_name}", lambda: self._fetch_agent_id_by_name(agent_name),
+                                                Config.AGENT_CACHE_TTL, cache_name='onpremise_agent')
+
+    async def _fetch_agent_id_by_name(self, agent_name: str) -> dict:
+        try:
+            url = f"{self.base_url_v1}/agents"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            params = {
+                'search': agent_name
+            }
+
+            logger.info("🔍 Searching for agent by name: %s", agent_name)
+            logger.debug("🔍 API URL: %s", url)
+
+            status_code, text = await instrumented_request('onpremise', 'get_agent_id_by_name', 'GET', url, headers=headers, params=params)
+            logger.info("Agent search response: %s", status_code)
+            logger.debug("Agent search response body: %s", text)
+            return agent_search_result(status_code, text, agent_name)
+
+        except Exception as e:
+            logger.error("❌ Agent search error: %s", e)
+            return {'success': False, 'error': str(e)}
+
+    async def get_agent_id_by_contactid(self, contactid: str) -> dict:
+        """Lấy agent_id từ contactid bằng cách gọi API Ladesk On-Premise (có cache)"""
+        return await cache.get_or_compute_async(f"onpremise_agent:{contactid}", lambda: self._fetch_agent_id_by_contactid(contactid),
+                                                Config.AGENT_CACHE_TTL, cache_name='onpremise_agent')
+
+    async def _fetch_agent_id_by_contactid(self, contactid: str) -> dict:
+        try:
+            url = f"{self.base_url_v1}/agents/{contactid}"
+            headers = {
+                'apikey': self.api_key_v1,
+                'Content-Type': 'application/json'
+            }
+
+            logger.info("🔍 Getting agent info by contactid: %s", contactid)
+            logger.debug("🔍 API URL: %s", url)
+
+            status_code, text = await instrumented_request('onpremise', 'get_agent_id_by_contactid', 'GET', url, headers=headers)
+            logger.info("Agent info response: %s", status_code)
+            logger.debug("Agent info response body: %s", text)
+            return agent_info_result(status_code, text, contactid)
+
+        except Exception as e:
+            logger.error("❌ Agent info error: %s", e)
+            return {'success': False, 'error': str(e)}
@@ -0,0 +1,678 @@
+#!/usr/bin/env python3
+"""
+Ladesk Simulator
+Server giả lập Ladesk Cloud và Ladesk On-Premise để load test/benchmark mà
+không gọi server thật. Chỉ cài các endpoint mà ladesk_api.py/ladesk_async.py
+sử dụng, giữ state trong bộ nhớ:
+
+    API v1: GET  /conversations/{id}, GET/POST /conversations/{id}/messages
+            GET  /agents (?search=), GET /agents/{id}
+    API v3: POST /contacts (400 "already exist. Id: ..." nếu email đã có),
+            GET  /contacts/{id}, POST /tickets, GET /tickets (_filters, _page, _perPage)
+            POST /files (multipart, field file; chỉ giữ kích thước và sha256)
+    GET /api/media/{name}?size=N: file N byte (nội dung cố định theo name) làm
+    URL file đính kèm trong webhook (base_urls() đặt ATTACHMENT_LADESK_PATHS
+    là path này); ticket/message nhận trường attachments
+    (file id cách nhau bởi dấu phẩy, --strict: 400 nếu id chưa upload)
+
+Mỗi service có prefix riêng: /cloud/api, /cloud/api/v3, /onpremise/api,
+/onpremise/api/v3. Độ trễ (lognormal theo median/p99), tỉ lệ lỗi 500, 429
+(ngẫu nhiên hoặc theo rate limit) và request bị treo cấu hình được bằng
+tham số dòng lệnh hoặc lúc đang chạy qua /_sim/faults.
+
+    python ladesk_simulator.py --port 9100 --latency-ms 80 --latency-p99-ms 400 --error-rate 0.01
+    # rồi trỏ app vào simulator (in ra khi khởi động):
+    LADESK_CLOUD_BASE_URL_V1=http://127.0.0.1:9100/cloud/api ... python app.py
+
+    curl localhost:9100/_sim/stats                       # số request theo service/operation/status
+    curl -X PUT localhost:9100/_sim/faults -d '{"onpremise": {"hang_rate": 0.05}}'
+    curl -X POST localhost:9100/_sim/reset               # xóa state và thống kê
+    curl -X POST localhost:9100/_sim/seed -d '{"conversations": 100, "messages": 5}'   # lịch sử cho backfill.py
+"""
+
+import re
+import json
+import hashlib
+import mimetypes
+import math
+import time
+import random
+import string
+import asyncio
+import argparse
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ('cloud', 'onpremise')
+
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Kích thước chunk khi đọc file upload / stream /media
+MEDIA_CHUNK_BYTES = 64 * 1024
+
+# Toán tử của _filters (API v3) -> so sánh chuỗi (ngày dạng 'YYYY-MM-DD HH:MM:SS' so sánh được như chuỗi)
+FILTER_OPERATORS = {
+    '=': lambda a, b: a == b,
+    'D>=': lambda a, b: a >= b,
+    'D>': lambda a, b: a > b,
+    'D<=': lambda a, b: a <= b,
+    'D<': lambda a, b: a < b,
+}
+
+FIRST_NAMES = ['An', 'Bình', 'Chi', 'Dũng', 'Đức', 'Giang', 'Hà', 'Hải', 'Hạnh', 'Hoa', 'Hùng', 'Khánh',
+               'Lan', 'Linh', 'Long', 'Mai', 'Minh', 'Nam', 'Ngọc', 'Phong', 'Quân', 'Sơn', 'Thảo', 'Trang']
+LAST_NAMES = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ']
+
+
+class FaultProfile:
+    """Độ trễ và lỗi giả lập của một service"""
+
+    FIELDS = ('latency_ms', 'latency_p99_ms', 'error_rate', 'throttle_rate', 'rate_limit',
+              'hang_rate', 'hang_seconds', 'retry_after')
+
+    def __init__(self, latency_ms: float = 0, latency_p99_ms: float = 0, error_rate: float = 0,
+                 throttle_rate: float = 0, rate_limit: float = 0, hang_rate: float = 0,
+                 hang_seconds: float = 60, retry_after: int = 1):
+        self.latency_ms = latency_ms          # median
+        self.latency_p99_ms = latency_p99_ms  # <= median: độ trễ cố định
+        self.error_rate = error_rate          # tỉ lệ 500
+        self.throttle_rate = throttle_rate    # tỉ lệ 429 ngẫu nhiên
+        self.rate_limit = rate_limit          # request/giây trước khi trả 429 (0 = không giới hạn)
+        self.hang_rate = hang_rate            # tỉ lệ request treo hang_seconds giây
+        self.hang_seconds = hang_seconds
+        self.retry_after = retry_after
+        self._tokens = rate_limit
+        self._refilled_at = time.monotonic()
+
+    def update(self, values: Dict):
+        unknown = set(values) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fault settings: {', '.join(sorted(unknown))}")
+        for name, value in values.items():
+            setattr(self, name, float(value))
+        self._tokens = min(self._tokens, self.rate_limit)
+
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def delay(self, rng: random.Random) -> float:
+        """Độ trễ (giây): lognormal có median latency_ms và p99 latency_p99_ms"""
+        if self.latency_ms <= 0:
+            return 0.0
+        if self.latency_p99_ms <= self.latency_ms:
+            return self.latency_ms / 1000
+        sigma = math.log(self.latency_p99_ms / self.latency_ms) / 2.326  # z của p99
+        return self.latency_ms * math.exp(rng.gauss(0, sigma)) / 1000
+
+    def take_token(self) -> bool:
+        """Token bucket của rate_limit; False nếu request vượt giới hạn"""
+        if self.rate_limit <= 0:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled_at) * self.rate_limit)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class SimulatedService:
+    """State trong bộ nhớ của một hệ thống Ladesk (contacts, conversations/tickets, agents)"""
+
+    def __init__(self, name: str, rng: random.Random, agents: int = 10, strict: bool = False):
+        self.name = name
+        self.rng = rng
+        self.strict = strict  # False: contact/conversation chưa biết được tạo khi được hỏi tới
+        self.contacts: Dict[str, Dict] = {}
+        self.contact_by_email: Dict[str, str] = {}
+        self.conversations: Dict[str, Dict] = {}
+        self.conversation_by_code: Dict[str, str] = {}
+        self.ticket_codes = set()
+        self.files: Dict[str, Dict] = {}
+        self.agents: Dict[str, Dict] = {}
+        self._create_agents(agents)
+
+    def _id(self, length: int = 8) -> str:
+        return ''.join(self.rng.choices(string.ascii_lowercase + string.digits, k=length))
+
+    def _ticket_code(self) -> str:
+        while True:
+            letters = ''.join(self.rng.choices(string.ascii_uppercase, k=8))
+            code = f"{letters[:3]}-{letters[3:]}-{self.rng.randint(0, 999):03d}"
+            if code not in self.ticket_codes:
+                self.ticket_codes.add(code)
+                return code
+
+    def _create_agents(self, count: int):
+        """Agent có cùng tên/email ở cả hai service (id khác nhau) để auto-sync ghép được"""
+        people = random.Random(count)  # giống nhau giữa hai service
+        for i in range(count):
+            firstname, lastname = people.choice(FIRST_NAMES), people.choice(LAST_NAMES)
+            agent_id = self._id()
+            self.agents[agent_id] = {
+                'contactid': agent_id, 'userid': agent_id,
+                'firstname': firstname, 'lastname': lastname,
+                'email': f"agent{i}@example.com", 'role': 'A', 'status': 'O',
+            }
+
+    # Contacts (API v3)
+    def create_contact(self, data: Dict) -> Tuple[int, Dict]:
+        emails = [email for email in data.get('emails') or [] if email]
+        for email in emails:
+            existing = self.contact_by_email.get(email.lower())
+            if existing:
+                return 400, {'message': f"Contact with email {email} already exist. Id: {existing}"}
+        contact = {
+            'id': self._id(), 'firstname': data.get('firstname', ''), 'lastname': data.get('lastname', ''),
+            'emails': emails, 'description': data.get('description', ''), 'type': data.get('type', 'V'),
+            'date_created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self.contacts[contact['id']] = contact
+        for email in emails:
+            self.contact_by_email[email.lower()] = contact['id']
+        return 200, contact
+
+    def get_contact(self, contact_id: str) -> Tuple[int, Dict]:
+        contact = self.contacts.get(contact_id)
+        if contact is None:
+            if self.strict:
+                return 404, {'message': 'Contact does not exist'}
+            # Khách Facebook nhắn tin thì luôn có contact trên Cloud
+            firstname, lastname = self.rng.choice(FIRST_NAMES), self.rng.choice(LAST_NAMES)
+            contact = {'id': contact_id, 'firstname': firstname, 'lastname': lastname,
+                       'emails': [f"{contact_id}@facebook.example.com"], 'type': 'V'}
+            self.contacts[contact_id] = contact
+            self.contact_by_email[contact['emails'][0]] = contact_id
+        return 200, contact
+
+    # Tickets (API v3) / conversations (API v1)
+    def create_ticket(self, data: Dict) -> Tuple[int, Dict]:
+        missing = [field for field in ('departmentid', 'subject', 'message', 'useridentifier') if not data.get(field)]
+        if missing:
+            return 400, {'message': f"Missing required fields: {', '.join(missing)}"}
+        file_ids, error = self._attachments(data.get('attachments'))
+        if error:
+            return 400, {'message': error}
+        now = time.strftime(_TIMESTAMP_FORMAT)
+        ticket = {
+            'id': self._id(), 'code': self._ticket_code(), 'subject': data['subject'],
+            'departmentid': data['departmentid'], 'status': data.get('status', 'N'),
+            'channel_type': data.get('channel_type', 'E'), 'owner_email': data.get('contactemail'),
+            'date_created': now, 'date_changed': now,
+        }
+        message = self._message(data['message'], 'M', data.get('useridentifier'), now, file_ids)
+        self._add_conversation({**ticket, 'messages': [message]})
+        return 200, ticket
+
+    def _add_conversation(self, conversation: Dict):
+        self.conversations[conversation['id']] = conversation
+        self.conversation_by_code[conversation['code']] = conversation['id']
+
+    def _message(self, text: str, message_type: str, userid: Optional[str], datecreated: str = None,
+                 attachments: List[str] = None) -> Dict:
+        message = {'id': self._id(), 'message': text, 'type': message_type, 'userid': userid,
+                   'datecreated': datecreated or time.strftime(_TIMESTAMP_FORMAT)}
+        if attachments:
+            message['attachments'] = attachments
+        return message
+
+    def _attachments(self, value: Optional[str]) -> Tuple[List[str], Optional[str]]:
+        """File id trong trường attachments, lỗi nếu --strict và có id chưa upload"""
+        file_ids = [file_id.strip() for file_id in (value or '').split(',') if file_id.strip()]
+        unknown = [file_id for file_id in file_ids if file_id not in self.files]
+        if unknown and self.strict:
+            return [], f"Unknown attachments: {', '.join(unknown)}"
+        return file_ids, None
+
+    # Files (API v3)
+    def add_file(self, name: str, content_type: str, size: int, sha256: str) -> Tuple[int, Dict]:
+        file_id = self._id(12)
+        self.files[file_id] = {'id': file_id, 'name': name, 'type': content_type, 'size': size, 'sha256': sha256}
+        return 200, {'id': file_id, 'name': name, 'type': content_type, 'size': size}
+
+    def _conversation(self, conversation_id: str) -> Optional[Dict]:
+        # Ticket cũng được tìm theo code (mapping lưu code, không lưu id)
+        conversation = self.conversations.get(self.conversation_by_code.get(conversation_id, conversation_id))
+        if conversation is None and not self.strict:
+            now = time.strftime(_TIMESTAMP_FORMAT)
+            conversation = {'id': conversation_id, 'code': self._ticket_code(), 'status': 'C',
+                            'date_created': now, 'date_changed': now, 'messages': []}
+            self._add_conversation(conversation)
+        return conversation
+
+    def seed_conversations(self, count: int, messages: int = 3, replies: int = 1, days: int = 7) -> List[str]:
+        """Tạo count conversation đã có sẵn (khách hàng nhắn messages tin, agent trả lời replies lần),
+        ngày tạo rải trong days ngày gần đây; trả về id các conversation"""
+        agents = list(self.agents)
+        now = datetime.utcnow()
+        ids = []
+        for _ in range(count):
+            contact_id = self._id()
+            firstname, lastname = self.rng.choice(FIRST_NAMES), self.rng.choice(LAST_NAMES)
+            email = f"{contact_id}@facebook.example.com"
+            self.contacts[contact_id] = {'id': contact_id, 'firstname': firstname, 'lastname': lastname,
+                                         'emails': [email], 'type': 'V'}
+            self.contact_by_email[email] = contact_id
+            created = now - timedelta(seconds=self.rng.uniform(0, days * 86400))
+            # Tin đầu tiên của khách hàng, sau đó tin khách hàng và reply của agent xen kẽ ngẫu nhiên,
+            # mỗi tin cách nhau 1-30 phút
+            rest = [contact_id] * max(messages - 1, 0) + [self.rng.choice(agents) for _ in range(replies)]
+            self.rng.shuffle(rest)
+            order = ([contact_id] if messages else []) + rest
+            conversation_messages, at = [], created
+            for author in order:
+                text = 'Xin chào, tôi cần hỗ trợ đơn hàng' if author == contact_id else 'Dạ, em đã kiểm tra ạ.'
+                conversation_messages.append(self._message(text, 'M', author, at.strftime(_TIMESTAMP_FORMAT)))
+                at += timedelta(seconds=self.rng.uniform(60, 1800))
+            conversation_id = self._id()
+            self._add_conversation({
+                'id': conversation_id, 'code': self._ticket_code(), 'subject': 'Facebook Message', 'status': 'C',
+                'channel_type': 'A', 'owner_contactid': contact_id, 'owner_email': email,
+                'owner_name': f"{firstname} {lastname}", 'date_created': created.strftime(_TIMESTAMP_FORMAT),
+                'date_changed': (at if order else created).strftime(_TIMESTAMP_FORMAT),
+                'messages': conversation_messages,
+            })
+            ids.append(conversation_id)
+        return ids
+
+    def get_conversation(self, conversation_id: str) -> Tuple[int, Dict]:
+        conversation = self._conversation(conversation_id)
+        if conversation is None:
+            return 404, {'response': {'status': 'ERROR', 'errormessage': 'Conversation does not exist'}}
+        details = {key: value for key, value in conversation.items() if key != 'messages'}
+        return 200, {'response': {**details, 'messages_count': len(conversation['messages'])}}
+
+    def add_message(self, conversation_id: str, form: Dict) -> Tuple[int, Dict]:
+        conversation = self._conversation(conversation_id)
+        if conversation is None:
+            return 404, {'response': {'status': 'ERROR', 'errormessage': 'Conversation does not exist'}}
+        if not form.get('message'):
+            return 400, {'response': {'status': 'ERROR', 'errormessage': 'Message is mandatory'}}
+        file_ids, error = self._attachments(form.get('attachments'))
+        if error:
+            return 400, {'response': {'status': 'ERROR', 'errormessage': error}}
+        message = self._message(form['message'], form.get('type', 'M'), form.get('useridentifier'),
+                                attachments=file_ids)
+        conversation['messages'].append(message)
+        conversation['date_changed'] = message['datecreated']
+        return 200, {'response': {'status': 'OK', 'message_id': message['id']}}
+
+    def get_messages(self, conversation_id: str) -> Tuple[int, Dict]:
+        """Message theo nhóm như API v1 (mỗi nhóm một message)"""
+        conversation = self._conversation(conversation_id)
+        if conversation is None:
+            return 404, {'response': {'status': 'ERROR', 'errormessage': 'Conversation does not exist'}}
+        groups = [{'id': message['id'], 'rtype': message['type'], 'userid': message['userid'],
+                   'datecreated': message['datecreated'], 'messages': [message]}
+                  for message in conversation['messages']]
+        return 200, {'response': {'status': 'OK', 'groups': groups}}
+
+    def list_tickets(self, filters: List, page: int = 1, per_page: int = 100) -> Tuple[int, object]:
+        """Ticket/conversation theo _filters [[field, operator, value], ...], sắp theo date_created"""
+        try:
+            checks = [(field, FILTER_OPERATORS[operator], value) for field, operator, value in filters]
+        except (KeyError, TypeError, ValueError):
+            return 400, {'message': 'Invalid _filters'}
+        tickets = [{key: value for key, value in c.items() if key != 'messages'} for c in self.conversations.values()
+                   if all(check(c.get(field) or '', value) for field, check, value in checks)]
+        tickets.sort(key=lambda t: (t.get('date_created') or '', t['id']))
+        start = (max(page, 1) - 1) * per_page
+        return 200, tickets[start:start + per_page]
+
+    # Agents (API v1)
+    def list_agents(self, search: str = None) -> Tuple[int, Dict]:
+        agents = list(self.agents.values())
+        if search:
+            needle = search.lower()
+            agents = [agent for agent in agents
+                      if needle in f"{agent['firstname']} {agent['lastname']}".lower() or needle in agent['email']]
+        return 200, {'response': agents}
+
+    def get_agent(self, agent_id: str) -> Tuple[int, Dict]:
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            return 404, {'response': {'status': 'ERROR', 'errormessage': 'Agent does not exist'}}
+        return 200, {'response': agent}
+
+    def summary(self) -> Dict:
+        return {'contacts': len(self.contacts), 'conversations': len(self.conversations),
+                'messages': sum(len(c['messages']) for c in self.conversations.values()),
+                'attachments': sum(len(m.get('attachments') or ()) for c in self.conversations.values()
+                                   for m in c['messages']),
+                'files': len(self.files), 'file_bytes': sum(f['size'] for f in self.files.values()),
+                'agents': len(self.agents)}
+
+
+class LadeskSimulator:
+    """Các service giả lập, fault profile và thống kê request"""
+
+    def __init__(self, agents: int = 10, strict: bool = False, seed: int = None, api_key: str = None,
+                 faults: Dict = None):
+        self.agents, self.strict, self.seed, self.api_key = agents, strict, seed, api_key
+        self.faults = {name: FaultProfile(**(faults or {})) for name in SERVICES}
+        self.reset()
+
+    def reset(self):
+        self.rng = random.Random(self.seed)
+        self.services = {name: SimulatedService(name, self.rng, self.agents, self.strict) for name in SERVICES}
+        self.stats: Dict[Tuple[str, str, int], int] = {}
+
+    def seed_history(self, conversations: int, messages: int = 3, replies: int = 1, days: int = 7) -> List[str]:
+        """Lịch sử conversation trên Cloud (để chạy backfill.py)"""
+        return self.services['cloud'].seed_conversations(conversations, messages, replies, days)
+
+    def record(self, service: str, operation: str, status: int):
+        key = (service, operation, status)
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def stats_summary(self) -> Dict:
+        summary: Dict[str, Dict] = {}
+        for (service, operation, status), count in sorted(self.stats.items()):
+            summary.setdefault(service, {}).setdefault(operation, {})[str(status)] = count
+        return summary
+
+
+_SERVICE_PATH = re.compile(r'^/(cloud|onpremise)/api/')
+
+
+def _json(status: int, payload: Dict, headers: Dict = None) -> web.Response:
+    return web.Response(status=status, text=json.dumps(payload, ensure_ascii=False),
+                        content_type='application/json', headers=headers)
+
+
+@web.middleware
+async def fault_middleware(request: web.Request, handler):
+    """Kiểm tra apikey, áp dụng fault profile của service rồi mới gọi handler"""
+    match = _SERVICE_PATH.match(request.path)
+    if not match:
+        return await handler(request)
+
+    simulator: LadeskSimulator = request.app['simulator']
+    service = match.group(1)
+    operation = request.match_info.route.name or request.path
+    faults = simulator.faults[service]
+    rng = simulator.rng
+
+    status, response = None, None
+    if simulator.api_key:
+        form = (await request.post() if request.method == 'POST'
+                and request.content_type not in ('application/json', 'multipart/form-data') else {})
+        supplied = request.headers.get('apikey') or request.query.get('apikey') or form.get('apikey')
+        if supplied != simulator.api_key:
+            status, response = 401, _json(401, {'message': 'Invalid API key'})
+
+    if response is None and not faults.take_token():
+        status = 429
+        response = _json(429, {'message': 'Too many requests'}, {'Retry-After': str(int(faults.retry_after))})
+    elif response is None and faults.hang_rate and rng.random() < faults.hang_rate:
+        await asyncio.sleep(faults.hang_seconds)
+    if response is None and faults.throttle_rate and rng.random() < faults.throttle_rate:
+        status = 429
+        response = _json(429, {'message': 'Too many requests'}, {'Retry-After': str(int(faults.retry_after))})
+    elif response is None and faults.error_rate and rng.random() < faults.error_rate:
+        status, response = 500, _json(500, {'message': 'Internal server error'})
+
+    delay = faults.delay(rng)
+    if delay:
+        await asyncio.sleep(delay)
+    if response is None:
+        response = await handler(request)
+        status = response.status
+    simulator.record(service, operation, status)
+    return response
+
+
+def _service(request: web.Request) -> SimulatedService:
+    return request.app['simulator'].services[request.match_info['service']]
+
+
+async def create_contact(request: web.Request) -> web.Response:
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return _json(400, {'message': 'Invalid JSON body'})
+    return _json(*_service(request).create_contact(data))
+
+
+async def get_contact(request: web.Request) -> web.Response:
+    return _json(*_service(request).get_contact(request.match_info['id']))
+
+
+async def create_ticket(request: web.Request) -> web.Response:
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return _json(400, {'message': 'Invalid JSON body'})
+    return _json(*_service(request).create_ticket(data))
+
+
+async def get_conversation(request: web.Request) -> web.Response:
+    return _json(*_service(request).get_conversation(request.match_info['id']))
+
+
+async def add_message(request: web.Request) -> web.Response:
+    form = await request.post()
+    return _json(*_service(request).add_message(request.match_info['id'], dict(form)))
+
+
+async def get_messages(request: web.Request) -> web.Response:
+    return _json(*_service(request).get_messages(request.match_info['id']))
+
+
+async def list_tickets(request: web.Request) -> web.Response:
+    try:
+        filters = json.loads(request.query.get('_filters') or '[]')
+        page, per_page = int(request.query.get('_page', 1)), int(request.query.get('_perPage', 100))
+    except ValueError:
+        return _json(400, {'message': 'Invalid query parameters'})
+    return _json(*_service(request).list_tickets(filters, page, per_page))
+
+
+async def upload_file(request: web.Request) -> web.Response:
+    """Đọc multipart theo chunk, chỉ giữ kích thước và sha256 của field file"""
+    try:
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name != 'file':
+                continue
+            digest, size = hashlib.sha256(), 0
+            while True:
+                chunk = await part.read_chunk(MEDIA_CHUNK_BYTES)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+            content_type = part.headers.get('Content-Type', 'application/octet-stream')
+            return _json(*_service(request).add_file(part.filename or 'attachment', content_type, size,
+                                                     digest.hexdigest()))
+    except (ValueError, AssertionError) as e:
+        return _json(400, {'message': f"Invalid multipart body: {e}"})
+    return _json(400, {'message': 'Missing file field'})
+
+
+def media_bytes(name: str, size: int):
+    """Nội dung cố định của /media/{name}?size=N theo từng chunk"""
+    block = hashlib.sha256(name.encode('utf-8')).digest() * (MEDIA_CHUNK_BYTES // 32)
+    for start in range(0, size, len(block)):
+        yield block[:min(len(block), size - start)]
+
+
+async def download_media(request: web.Request) -> web.Response:
+    """File đính kèm giả lập: stream size byte, có Content-Length"""
+    name = request.match_info['name']
+    try:
+        size = int(request.query.get('size', 1024))
+    except ValueError:
+        return _json(400, {'message': 'Invalid size'})
+    response = web.StreamResponse(headers={
+        'Content-Type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+        'Content-Length': str(size),
+    })
+    await response.prepare(request)
+    for chunk in media_bytes(name, size):
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+async def list_agents(request: web.Request) -> web.Response:
+    return _json(*_service(request).list_agents(request.query.get('search')))
+
+
+async def get_agent(request: web.Request) -> web.Response:
+    return _json(*_service(request).get_agent(request.match_info['id']))
+
+
+async def sim_stats(request: web.Request) -> web.Response:
+    simulator: LadeskSimulator = request.app['simulator']
+    return _json(200, {'requests': simulator.stats_summary(),
+                       'state': {name: service.summary() for name, service in simulator.services.items()}})
+
+
+async def sim_reset(request: web.Request) -> web.Response:
+    request.app['simulator'].reset()
+    return _json(200, {'status': 'reset'})
+
+
+async def sim_seed(request: web.Request) -> web.Response:
+    """POST {"conversations": N, "messages": 3, "replies": 1, "days": 7}: tạo lịch sử conversation trên Cloud"""
+    try:
+        options = await request.json()
+        ids = request.app['simulator'].seed_history(int(options['conversations']), int(options.get('messages', 3)),
+                                                    int(options.get('replies', 1)), int(options.get('days', 7)))
+    except (ValueError, TypeError, KeyError) as e:
+        return _json(400, {'error': f"Invalid seed options: {e}"})
+    return _json(200, {'conversation_ids': ids})
+
+
+async def sim_faults(request: web.Request) -> web.Response:
+    """GET: fault profile hiện tại; PUT {"cloud": {...}, "onpremise": {...}} để đổi lúc đang chạy"""
+    simulator: LadeskSimulator = request.app['simulator']
+    if request.method == 'PUT':
+        try:
+            changes = await request.json()
+            for service, values in changes.items():
+                if service not in SERVICES:
+                    raise ValueError(f"Unknown service: {service}")
+                simulator.faults[service].update(values)
+        except (ValueError, TypeError) as e:
+            return _json(400, {'error': str(e)})
+    return _json(200, {name: profile.to_dict() for name, profile in simulator.faults.items()})
+
+
+def create_app(simulator: LadeskSimulator) -> web.Application:
+    app = web.Application(middlewares=[fault_middleware])
+    app['simulator'] = simulator
+    base = '/{service:cloud|onpremise}/api'
+    app.router.add_get(base + '/conversations/{id}', get_conversation, name='get_conversation')
+    app.router.add_get(base + '/conversations/{id}/messages', get_messages, name='get_messages')
+    app.router.add_post(base + '/conversations/{id}/messages', add_message, name='add_message')
+    app.router.add_get(base + '/agents', list_agents, name='list_agents')
+    app.router.add_get(base + '/agents/{id}', get_agent, name='get_agent')
+    app.router.add_post(base + '/v3/contacts', create_contact, name='create_contact')
+    app.router.add_get(base + '/v3/contacts/{id}', get_contact, name='get_contact')
+    app.router.add_post(base + '/v3/tickets', create_ticket, name='create_ticket')
+    app.router.add_get(base + '/v3/tickets', list_tickets, name='list_tickets')
+    app.router.add_post(base + '/v3/files', upload_file, name='upload_file')
+    app.router.add_get(base + '/media/{name}', download_media, name='download_media')
+    app.router.add_get('/_sim/stats', sim_stats)
+    app.router.add_post('/_sim/reset', sim_reset)
+    app.router.add_post('/_sim/seed', sim_seed)
+    app.router.add_route('*', '/_sim/faults', sim_faults)
+    return app
+
+
+def base_urls(host: str, port: int) -> Dict[str, str]:
+    """Biến môi trường Config để trỏ app vào simulator"""
+    root = f"http://{host}:{port}"
+    return {
+        'LADESK_CLOUD_BASE_URL_V1': f"{root}/cloud/api",
+        'LADESK_CLOUD_BASE_URL_V3': f"{root}/cloud/api/v3",
+        'LADESK_ONPREMISE_BASE_URL_V1': f"{root}/onpremise/api",
+        'LADESK_ONPREMISE_BASE_URL_V3': f"{root}/onpremise/api/v3",
+        'ATTACHMENT_LADESK_PATHS': '/cloud/api/media/,/onpremise/api/media/',
+    }
+
+
+class SimulatorThread:
+    """Chạy simulator trong thread nền (cho benchmark chạy cùng process)"""
+
+    def __init__(self, simulator: LadeskSimulator, host: str = '127.0.0.1', port: int = 0):
+        self.simulator = simulator
+        self.host = host
+        self.port = port
+        self._loop = asyncio.new_event_loop()
+        self._runner: Optional[web.AppRunner] = None
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ladesk-simulator', daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._start())
+        self._started.set()
+        self._loop.run_forever()
+
+    async def _start(self):
+        self._runner = web.AppRunner(create_app(self.simulator), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]  # port thật khi port=0
+
+    def start(self) -> 'SimulatorThread':
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    @property
+    def base_urls(self) -> Dict[str, str]:
+        return base_urls(self.host, self.port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server giả lập Ladesk Cloud/On-Premise")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--agents', type=int, default=10, help='Số agent mỗi service')
+    parser.add_argument('--strict', action='store_true', help='404 cho contact/conversation chưa tạo')
+    parser.add_argument('--seed', type=int, help='Seed cho id, độ trễ và lỗi ngẫu nhiên')
+    parser.add_argument('--api-key', help='Chỉ chấp nhận apikey này (mặc định chấp nhận mọi key)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Median độ trễ (ms)')
+    parser.add_argument('--latency-p99-ms', type=float, default=0, help='p99 độ trễ (ms), mặc định bằng median')
+    parser.add_argument('--error-rate', type=float, default=0, help='Tỉ lệ response 500')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Tỉ lệ response 429 ngẫu nhiên')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Request/giây mỗi service trước khi trả 429')
+    parser.add_argument('--hang-rate', type=float, default=0, help='Tỉ lệ request bị treo')
+    parser.add_argument('--hang-seconds', type=float, default=60, help='Thời gian treo (giây)')
+    parser.add_argument('--seed-conversations', type=int, default=0,
+                        help='Tạo sẵn số conversation này trên Cloud (lịch sử cho backfill.py)')
+    parser.add_argument('--seed-messages', type=int, default=3, help='Số tin của khách hàng mỗi conversation tạo sẵn')
+    parser.add_argument('--seed-replies', type=int, default=1, help='Số reply của agent mỗi conversation tạo sẵn')
+    parser.add_argument('--seed-days', type=int, default=7, help='Ngày tạo rải trong số ngày gần đây này')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    faults = {name: getattr(args, name) for name in FaultProfile.FIELDS if hasattr(args, name)}
+    simulator = LadeskSimulator(args.agents, args.strict, args.seed, args.api_key, faults)
+    if args.seed_conversations:
+        simulator.seed_history(args.seed_conversations, args.seed_messages, args.seed_replies, args.seed_days)
+
+    print(f"🧪 Ladesk simulator: http://{args.host}:{args.port} (faults: {faults})")
+    for name, value in base_urls(args.host, args.port).items():
+        print(f"  export {name}={value}")
+    web.run_app(create_app(simulator), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
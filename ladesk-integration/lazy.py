@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Lazy Instance
+Proxy tạo object thật ở lần dùng đầu tiên, để import module không phải mở
+SQLite, đọc file mapping hay tạo API client
+
+    db = LazyProxy(SimpleDatabaseManager)   # chưa làm gì
+    db.get_mapping_by_ticket('QQX-1')       # tạo SimpleDatabaseManager() tại đây
+    db.set_instance(InMemoryDb())           # thay bằng instance khác (create_app, test)
+"""
+
+import threading
+from typing import Any, Callable
+
+
+class LazyProxy:
+    """Chuyển mọi truy cập thuộc tính tới instance do factory tạo ra (tạo một lần, thread-safe)"""
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+                instance = self._instance
+        return instance
+
+    def __getattr__(self, name):
+        # Chỉ được gọi với thuộc tính không có trên proxy
+        return getattr(self._resolve(), name)
+
+    def set_instance(self, instance):
+        """Dùng instance có sẵn thay cho factory"""
+        with self._lock:
+            self._instance = instance
+
+    def reset(self, factory: Callable[[], Any] = None):
+        """Bỏ instance hiện tại (và đổi factory nếu truyền vào), tạo lại ở lần dùng kế tiếp"""
+        with self._lock:
+            if factory is not None:
+                self._factory = factory
+            self._instance = None
+
+    def is_resolved(self) -> bool:
+        """Instance thật đã được tạo chưa"""
+        return self._instance is not None
+
+    def __repr__(self):
+        state = repr(self._instance) if self._instance is not None else 'unresolved'
+        return f"<LazyProxy {state}>"
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Logging Pipeline
+Logging không chặn request: handler chỉ đẩy record vào queue, một thread
+QueueListener format (JSON) và ghi ra file/console
+
+- Format lazy: message chỉ được render trong thread listener
+- Payload dài (raw webhook, response body) bị cắt theo LOG_MAX_PAYLOAD_LENGTH
+- Dòng log lặp lại (cùng template) bị lấy mẫu theo LOG_SAMPLE_BURST / LOG_SAMPLE_WINDOW
+"""
+
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+import metrics
+from config import Config
+
+# Thuộc tính chuẩn của LogRecord, phần còn lại là field bổ sung qua extra={...}
+_RESERVED_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def truncate(value, max_length: int) -> str:
+    """Cắt chuỗi dài, giữ lại độ dài gốc để biết đã bị cắt bao nhiêu"""
+    text = value if isinstance(value, str) else str(value)
+    if max_length > 0 and len(text) > max_length:
+        return f"{text[:max_length]}...[truncated {len(text) - max_length} chars]"
+    return text
+
+
+class TruncatingMixin:
+    """Render message với từng argument đã bị cắt ngắn"""
+
+    max_payload_length = 1000
+
+    def render_message(self, record: logging.LogRecord) -> str:
+        msg = str(record.msg)
+        args = record.args
+        if args:
+            if isinstance(args, dict):
+                args = {key: truncate(value, self.max_payload_length) for key, value in args.items()}
+            else:
+                args = tuple(truncate(arg, self.max_payload_length) for arg in args)
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                msg = f"{msg} {args}"
+        # Message dạng f-string không có args: cắt toàn bộ message
+        return truncate(msg, self.max_payload_length * 4)
+
+
+class JsonFormatter(TruncatingMixin, logging.Formatter):
+    """Format LogRecord thành một dòng JSON"""
+
+    def __init__(self, max_payload_length: int = 1000):
+        super().__init__()
+        self.max_payload_length = max_payload_length
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': self.render_message(record),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith('_'):
+                entry[key] = value if isinstance(value, (int, float, bool, type(None))) \
+                    else truncate(value, self.max_payload_length)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(TruncatingMixin, logging.Formatter):
+    """Format dạng text cho console, cũng cắt payload dài"""
+
+    def __init__(self, fmt: str, max_payload_length: int = 1000):
+        super().__init__(fmt)
+        self.max_payload_length = max_payload_length
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = self.render_message(record)
+        return super().formatMessage(record)
+
+    def format(self, record: logging.LogRecord) -> str:
+        # Bỏ qua record.getMessage() của Formatter gốc, message đã render trong formatMessage
+        record.asctime = self.formatTime(record, self.datefmt)
+        text = self.formatMessage(record)
+        if record.exc_info:
+            text = f"{text}\n{self.formatException(record.exc_info)}"
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """Chỉ cho qua tối đa burst dòng cùng template trong mỗi window giây (WARNING trở lên luôn qua)"""
+
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, int, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0 or record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            # counter = [thời điểm bắt đầu window, số dòng đã cho qua, số dòng đã bỏ]
+            counter = self._counters.get(key)
+            if counter is None or now - counter[0] >= self.window:
+                suppressed = counter[2] if counter else 0
+                if len(self._counters) > 10000:
+                    self._counters.clear()
+                self._counters[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if counter[1] < self.burst:
+                counter[1] += 1
+                return True
+            counter[2] += 1
+            return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler không format trong thread request và bỏ record khi queue đầy"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Queue nằm trong cùng process nên không cần pickle: giữ nguyên msg/args để format lazy
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.record_log_dropped()
+
+
+class _DepthReportingListener(logging.handlers.QueueListener):
+    """QueueListener cập nhật metric độ sâu queue mỗi khi xử lý record"""
+
+    def handle(self, record: logging.LogRecord):
+        super().handle(record)
+        metrics.set_queue_depth('logging', self.queue.qsize())
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(log_file: str, level: str = None):
+    """Cấu hình root logger dùng queue, gọi một lần khi khởi động"""
+    global _listener
+    if _listener is not None:
+        return
+
+    max_length = Config.LOG_MAX_PAYLOAD_LENGTH
+
+    file_handler = logging.FileHandler(log_file, encoding='utf-8')
+    if Config.LOG_JSON:
+        file_handler.setFormatter(JsonFormatter(max_length))
+    else:
+        file_handler.setFormatter(TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', max_length))
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', max_length))
+
+    log_queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(Config.LOG_SAMPLE_BURST, Config.LOG_SAMPLE_WINDOW))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level or Config.LOG_LEVEL)
+
+    _listener = _DepthReportingListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Dừng listener và ghi nốt các record còn trong queue"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -11,6 +11,13 @@ sys.path.append(os.path.dirname(__file__))
 from agent_mapping_config import agent_mapping
 import argparse
 import logging
+import csv
+import json
+import re
+import unicodedata
+from typing import Callable, Dict, List, Optional, Tuple
+
+from records import AgentRef
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -56,21 +63,192 @@ def test_mapping(onpremise_id: str):
     else:
         print(f"❌ Không tìm thấy mapping cho: {onpremise_id}")
 
+def test_reverse_mapping(cloud_id: str):
+    """Test mapping ngược Cloud -> On-Premise"""
+    onpremise_id = agent_mapping.get_onpremise_id(cloud_id)
+    if onpremise_id:
+        print(f"✅ Mapping tìm thấy: {onpremise_id} -> {cloud_id}")
+    else:
+        print(f"❌ Không tìm thấy mapping cho Cloud ID: {cloud_id}")
+
 def reload_mapping():
-    """Reload mapping từ file"""
+    """Reload mapping từ database (server đang chạy tự reload khi version đổi)"""
     print("🔄 Reloading mapping...")
     agent_mapping.reload_mapping()
-    print("✅ Reload mapping thành công!")
+    print(f"✅ Reload mapping thành công! (version {agent_mapping.version}, {len(agent_mapping.mapping)} mappings)")
+
+def _file_format(path: str, file_format: Optional[str]) -> str:
+    """csv/json theo --format hoặc đuôi file (mặc định json)"""
+    if file_format:
+        return file_format
+    return 'csv' if path.lower().endswith('.csv') else 'json'
+
+def _field(row: Dict, key: str) -> str:
+    value = row.get(key)
+    return '' if value is None else str(value).strip()
+
+def read_mapping_file(path: str, file_format: str) -> Dict[str, str]:
+    """Đọc mapping từ file CSV (onpremise_id,cloud_id) hoặc JSON ({onpremise_id: cloud_id} hoặc list object)
+
+    Mọi dạng được kiểm tra như nhau: id rỗng hoặc dòng không phải object là lỗi
+    (không bỏ qua, vì import --replace sẽ xóa mapping không có trong file).
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if file_format == 'csv':
+            rows = list(csv.DictReader(f))
+        else:
+            data = json.load(f)
+            if isinstance(data, dict):
+                rows = [{'onpremise_id': k, 'cloud_id': v} for k, v in data.items()]
+            elif isinstance(data, list):
+                rows = data
+            else:
+                raise ValueError("JSON phải là object {onpremise_id: cloud_id} hoặc list object")
+
+    mapping = {}
+    for row in rows:
+        if not isinstance(row, dict):
+            raise ValueError(f"Dòng không phải object: {row!r}")
+        onpremise_id = _field(row, 'onpremise_id')
+        cloud_id = _field(row, 'cloud_id')
+        if not onpremise_id or not cloud_id:
+            raise ValueError(f"Dòng thiếu onpremise_id hoặc cloud_id: {row}")
+        if mapping.get(onpremise_id, cloud_id) != cloud_id:
+            raise ValueError(f"onpremise_id bị trùng với cloud_id khác nhau: {onpremise_id}")
+        mapping[onpremise_id] = cloud_id
+    return mapping
+
+def import_mappings(path: str, file_format: Optional[str], replace: bool):
+    """Import nhiều mapping trong một transaction"""
+    file_format = _file_format(path, file_format)
+    try:
+        mappings = read_mapping_file(path, file_format)
+    except (OSError, ValueError) as e:
+        print(f"❌ Không đọc được {path}: {e}")
+        sys.exit(1)
+
+    current = agent_mapping.list_mappings()
+    added = sum(1 for k in mappings if k not in current)
+    changed = sum(1 for k, v in mappings.items() if k in current and current[k] != v)
+    removed = sum(1 for k in current if k not in mappings) if replace else 0
+    print(f"📥 Import {len(mappings)} mappings từ {path}: +{added} mới, ~{changed} thay đổi, -{removed} xóa")
+
+    if agent_mapping.apply_batch(mappings, replace=replace):
+        print("✅ Import thành công!")
+    else:
+        print("❌ Import thất bại, không có thay đổi nào được ghi!")
+        sys.exit(1)
+
+def export_mappings(path: str, file_format: Optional[str]):
+    """Export toàn bộ mapping ra file (hoặc stdout nếu path là '-')"""
+    file_format = _file_format(path, file_format)
+    mappings = agent_mapping.list_mappings()
+    out = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+    try:
+        if file_format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(['onpremise_id', 'cloud_id'])
+            writer.writerows(sorted(mappings.items()))
+        else:
+            json.dump(dict(sorted(mappings.items())), out, indent=2, ensure_ascii=False)
+            out.write('\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if path != '-':
+        print(f"📤 Đã export {len(mappings)} mappings ra {path}")
+
+# Auto-sync
+def _normalize_name(name: str) -> str:
+    """'Nguyễn  Văn Đức' -> 'nguyen van duc' để so tên giữa hai hệ thống"""
+    name = unicodedata.normalize('NFKD', name.replace('đ', 'd').replace('Đ', 'D'))
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return re.sub(r'\s+', ' ', name).strip().lower()
+
+def _unique_index(agents: List[AgentRef], key: Callable[[AgentRef], str]) -> Dict[str, Optional[str]]:
+    """email/tên -> id; giá trị trùng giữa nhiều agent thành None (không dùng để ghép)"""
+    index: Dict[str, Optional[str]] = {}
+    for agent in agents:
+        value = key(agent)
+        if agent.id and value:
+            index[value] = agent.id if value not in index else None
+    return index
+
+def _agent_name(agent: AgentRef) -> str:
+    return _normalize_name(agent.name)
+
+def match_agents(onpremise_agents: List[AgentRef], cloud_agents: List[AgentRef]) -> Tuple[Dict[str, str], List[str]]:
+    """Ghép agent hai bên theo email, rồi theo tên; trả về (mapping, agent On-Premise không ghép được)"""
+    cloud_by_email = _unique_index(cloud_agents, lambda agent: agent.email)
+    cloud_by_name = _unique_index(cloud_agents, _agent_name)
+    matched, unmatched = {}, []
+    for agent in onpremise_agents:
+        if not agent.id:
+            continue
+        email, name = agent.email, _agent_name(agent)
+        cloud_id = (email and cloud_by_email.get(email)) or (name and cloud_by_name.get(name))
+        if cloud_id:
+            matched[agent.id] = cloud_id
+        else:
+            unmatched.append(f"{agent.id} ({email or name or '?'})")
+    return matched, unmatched
+
+def auto_sync(apply: bool, overwrite: bool):
+    """Lấy danh sách agent hai bên song song, đề xuất (hoặc ghi) mapping trong một lần"""
+    import fanout
+    from ladesk_api import LadeskCloudAPI, LadeskOnPremiseAPI
+
+    print("🔄 Đang lấy danh sách agent từ On-Premise và Cloud...")
+    onpremise_future = fanout.submit(LadeskOnPremiseAPI().list_agents)
+    cloud_future = fanout.submit(LadeskCloudAPI().list_agents)
+    onpremise_result, cloud_result = onpremise_future.result(), cloud_future.result()
+    for label, result in (('On-Premise', onpremise_result), ('Cloud', cloud_result)):
+        if not result['success']:
+            print(f"❌ Không lấy được danh sách agent {label}: {result.get('error')}")
+            sys.exit(1)
+
+    matched, unmatched = match_agents(onpremise_result['agents'], cloud_result['agents'])
+    current = agent_mapping.list_mappings()
+    new = {k: v for k, v in matched.items() if k not in current}
+    conflicts = {k: v for k, v in matched.items() if k in current and current[k] != v}
+
+    print(f"📋 {len(onpremise_result['agents'])} agent On-Premise, {len(cloud_result['agents'])} agent Cloud, "
+          f"{len(matched)} ghép được")
+    for onpremise_id, cloud_id in sorted(new.items()):
+        print(f"  ➕ {onpremise_id} -> {cloud_id}")
+    for onpremise_id, cloud_id in sorted(conflicts.items()):
+        action = "ghi đè" if overwrite else "giữ nguyên, dùng --overwrite để ghi đè"
+        print(f"  ⚠️ {onpremise_id}: {current[onpremise_id]} -> {cloud_id} ({action})")
+    for description in unmatched:
+        print(f"  ❔ Không ghép được: {description}")
+
+    changes = {**new, **conflicts} if overwrite else new
+    if not changes:
+        print("✅ Không có mapping nào cần thay đổi")
+        return
+    if not apply:
+        print(f"ℹ️ Dry run: {len(changes)} mapping sẽ được ghi, chạy lại với --apply để áp dụng")
+        return
+    if agent_mapping.apply_batch(changes):
+        print(f"✅ Đã ghi {len(changes)} mappings")
+    else:
+        print("❌ Ghi mapping thất bại!")
+        sys.exit(1)
 
 def main():
     parser = argparse.ArgumentParser(description="Quản lý Agent Mapping")
-    parser.add_argument('action', choices=['list', 'add', 'remove', 'test', 'reload'], 
+    parser.add_argument('action', choices=['list', 'add', 'remove', 'test', 'reload', 'import', 'export', 'auto-sync'],
                        help='Hành động cần thực hiện')
     parser.add_argument('--onpremise-id', '-o', help='On-Premise Agent ID')
     parser.add_argument('--cloud-id', '-c', help='Cloud User Identifier')
-    
+    parser.add_argument('--file', '-f', help="File cho import/export ('-' là stdout khi export)")
+    parser.add_argument('--format', choices=['csv', 'json'], help='Định dạng file (mặc định theo đuôi file)')
+    parser.add_argument('--replace', action='store_true', help='import: xóa mapping không có trong file')
+    parser.add_argument('--apply', action='store_true', help='auto-sync: ghi mapping (mặc định chỉ in đề xuất)')
+    parser.add_argument('--overwrite', action='store_true', help='auto-sync: ghi đè mapping đang khác')
+
     args = parser.parse_args()
-    
+
     if args.action == 'list':
         list_mappings()
     
@@ -87,13 +265,28 @@ def main():
         remove_mapping(args.onpremise_id)
     
     elif args.action == 'test':
-        if not args.onpremise_id:
-            print("❌ Cần cung cấp --onpremise-id")
+        if args.onpremise_id:
+            test_mapping(args.onpremise_id)
+        elif args.cloud_id:
+            test_reverse_mapping(args.cloud_id)
+        else:
+            print("❌ Cần cung cấp --onpremise-id hoặc --cloud-id")
             sys.exit(1)
-        test_mapping(args.onpremise_id)
     
     elif args.action == 'reload':
         reload_mapping()
 
+    elif args.action in ('import', 'export'):
+        if not args.file:
+            print("❌ Cần cung cấp --file")
+            sys.exit(1)
+        if args.action == 'import':
+            import_mappings(args.file, args.format, args.replace)
+        else:
+            export_mappings(args.file, args.format)
+
+    elif args.action == 'auto-sync':
+        auto_sync(args.apply, args.overwrite)
+
 if __name__ == '__main__':
     main() 
\ No newline at end of file
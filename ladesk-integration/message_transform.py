@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Message Transform
+Chuyển nội dung message giữa hai hệ thống, dùng chung cho cả hai chiều và
+cho app sync/async:
+
+- html_to_text: reply của agent (HTML từ editor On-Premise) -> text gửi về
+  Cloud/Facebook. Tokenizer tăng dần (một regex cho thẻ, nhận được từng chunk) giữ
+  đoạn văn, xuống dòng, danh sách (- / 1.), trích dẫn (> ) và link dạng
+  "text (url)"; bỏ script/style/head. Message không có thẻ HTML chỉ được
+  decode entity, giữ nguyên xuống dòng
+- text_to_html: tin của khách hàng (text) -> HTML cho ticket On-Premise:
+  escape, link hóa URL, đoạn văn <p>, xuống dòng <br>
+- normalize_whitespace: NBSP/ký tự không hiển thị -> khoảng trắng thường,
+  gộp khoảng trắng, tối đa một dòng trống liên tiếp
+- truncate: cắt theo MESSAGE_MAX_LENGTH tại ranh giới từ; html_to_text dừng
+  parse khi đã đủ độ dài nên reply rất dài (kèm lịch sử email) không tốn
+  thêm thời gian
+
+Mọi regex được compile một lần khi import.
+"""
+
+import re
+import html
+from typing import List, Optional
+
+from config import Config
+
+# Có thẻ HTML (mở/đóng/comment/doctype) hay chỉ là text
+_HTML_HINT = re.compile(r'<(?:[a-zA-Z][a-zA-Z0-9]*[\s/>]|/[a-zA-Z]|!)')
+# Thẻ mở/đóng (nhóm 1 = '/', 2 = tên, 3 = thuộc tính), comment, doctype, processing instruction
+_TAG = re.compile(r'<(?:(/?)([a-zA-Z][a-zA-Z0-9:-]*)([^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*)>'
+                  r'|!--.*?-->|![^>]*>|\?[^>]*>)', re.DOTALL)
+_ATTRIBUTES = {
+    name: re.compile(r'(?:^|\s)' + name + r'\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.IGNORECASE)
+    for name in ('href', 'alt')
+}
+# Ký tự không hiển thị bị bỏ, khoảng trắng ngang (kể cả NBSP) thành dấu cách thường và được gộp
+# sau chữ (thụt đầu dòng của danh sách lồng nhau/<pre> được giữ). Các regex quét từng ký tự khá
+# chậm với text tiếng Việt nên chỉ chạy khi kiểm tra nhanh thấy có ký tự cần thay
+_INVISIBLE = re.compile('[\u00ad\u200b-\u200d\u2060\ufeff]')
+_HORIZONTAL_SPACE = re.compile('[\t\f\v\u00a0\u1680\u2000-\u200a\u202f\u205f\u3000]')
+_SPECIAL_SPACE = re.compile('[\t\f\v\u00a0\u00ad\u1680\u2000-\u200d\u202f\u205f\u2060\u3000\ufeff]')
+_SPACE_RUN = re.compile(r'(?<=\S) {2,}')
+_LINE_BREAK = re.compile('\r\n?|[\u2028\u2029\x85]')
+_LINE_BREAK_CHARS = ('\r', '\u2028', '\u2029', '\x85')
+_BLANK_LINES = re.compile(r'\n{3,}')
+_PARAGRAPH_BREAK = re.compile(r'\n{2,}')
+_URL = re.compile(r'(?:https?://|www\.)[^\s<>"]+')
+_URL_TRAILING = '.,;:!?)]}\'"'
+
+ELLIPSIS = '…'
+
+# Thẻ block: (số dòng trống trước/sau) 2 = tách đoạn, 1 = xuống dòng
+_BLOCK_BREAKS = {
+    'p': 2, 'h1': 2, 'h2': 2, 'h3': 2, 'h4': 2, 'h5': 2, 'h6': 2, 'blockquote': 2, 'pre': 2,
+    'table': 2, 'hr': 2, 'ul': 2, 'ol': 2, 'dl': 2, 'figure': 2,
+    'div': 1, 'section': 1, 'article': 1, 'header': 1, 'footer': 1, 'aside': 1, 'nav': 1,
+    'address': 1, 'tr': 1, 'li': 1, 'dt': 1, 'dd': 1, 'caption': 1, 'figcaption': 1,
+}
+_SKIPPED = {'script', 'style', 'head', 'title', 'template', 'noscript'}
+# Nội dung script/style không phải HTML ('<' trong code), bỏ qua tới thẻ đóng
+_RAW_TEXT_END = {tag: re.compile(r'</' + tag + r'\s*>', re.IGNORECASE) for tag in ('script', 'style')}
+_CELLS = {'td', 'th'}
+_VOID = {'br', 'img', 'hr', 'meta', 'link', 'input', 'wbr', 'col', 'source'}
+
+
+def normalize_whitespace(text: str) -> str:
+    """Chuẩn hóa khoảng trắng, giữ xuống dòng (tối đa một dòng trống liên tiếp) và thụt đầu dòng đầu tiên"""
+    if any(char in text for char in _LINE_BREAK_CHARS):
+        text = _LINE_BREAK.sub('\n', text)
+    if _SPECIAL_SPACE.search(text):
+        text = _HORIZONTAL_SPACE.sub(' ', _INVISIBLE.sub('', text))
+    if '  ' in text:
+        text = _SPACE_RUN.sub(' ', text)
+    if ' \n' in text:
+        text = '\n'.join(line.rstrip(' ') for line in text.split('\n'))
+    if '\n\n\n' in text:
+        text = _BLANK_LINES.sub('\n\n', text)
+    # Chỉ bỏ dòng trống ở đầu: khoảng trắng đầu dòng là thụt lề của <pre>/danh sách
+    return text.rstrip().lstrip('\n')
+
+
+def truncate(text: str, max_length: Optional[int] = None) -> str:
+    """Cắt text còn tối đa max_length ký tự (kể cả dấu …), ưu tiên cắt ở khoảng trắng; 0 = không giới hạn"""
+    max_length = Config.MESSAGE_MAX_LENGTH if max_length is None else max_length
+    if not max_length or len(text) <= max_length:
+        return text
+    cut = text[:max_length - len(ELLIPSIS)]
+    space = max(cut.rfind(' '), cut.rfind('\n'))
+    if space >= len(cut) * 0.8:
+        cut = cut[:space]
+    return cut.rstrip() + ELLIPSIS
+
+
+def looks_like_html(text: str) -> bool:
+    return bool(text) and _HTML_HINT.search(text) is not None
+
+
+class HtmlToText:
+    """Chuyển HTML sang text theo từng chunk: feed(chunk)... rồi close() trả về text.
+    Phần sau thẻ cuối cùng của chunk được giữ lại tới chunk sau (thẻ/entity bị cắt ngang
+    vẫn đúng); khi text đã dài hơn max_length, phần HTML còn lại được bỏ qua."""
+
+    def __init__(self, max_length: Optional[int] = None):
+        self.max_length = Config.MESSAGE_MAX_LENGTH if max_length is None else max_length
+        self._buffer = ''
+        self._parts: List[str] = []
+        self._length = 0
+        self._pending = 0       # số ký tự xuống dòng chờ ghi trước text tiếp theo
+        self._at_line_start = True
+        self._skip = 0          # đang trong script/style/...
+        self._pre = 0
+        self._quote = 0
+        self._lists: List[List] = []   # [ordered, số thứ tự hiện tại]
+        self._links: List[tuple] = []  # (href, vị trí bắt đầu trong _parts)
+        self._raw_text_end = None      # đang trong script/style: regex thẻ đóng
+        self._full = False
+
+    # Ghi output
+    def _emit(self, text: str):
+        self._parts.append(text)
+        self._length += len(text)
+        if self.max_length and self._length > self.max_length:
+            self._full = True
+
+    def _break(self, count: int):
+        if self._length:
+            self._pending = max(self._pending, count)
+
+    def _flush_break(self):
+        if self._pending:
+            self._emit('\n' * self._pending + '> ' * self._quote)
+            self._pending = 0
+            self._at_line_start = True
+
+    def _text(self, text: str):
+        if self._pending:
+            self._flush_break()
+        elif self._quote and not self._length and not text.startswith('\n'):
+            # Trích dẫn ở đầu message: chưa có xuống dòng nào ghi tiền tố '> ' của dòng đầu
+            text = '> ' * self._quote + text
+        self._emit(text)
+        self._at_line_start = text.endswith('\n')
+
+    # Tokenizer
+    def _parse(self, data: str):
+        position = 0
+        while not self._full:
+            if self._raw_text_end:
+                end = self._raw_text_end.search(data, position)
+                if not end:
+                    return
+                self._raw_text_end = None
+                position = end.end()
+            match = _TAG.search(data, position)
+            if not match:
+                break
+            start = match.start()
+            if start > position:
+                self._data(data[position:start])
+            position = match.end()
+            name = match.group(2)
+            if not name:
+                continue
+            tag = name.lower()
+            if match.group(1):
+                self._end(tag)
+            elif tag in _RAW_TEXT_END:
+                self._raw_text_end = _RAW_TEXT_END[tag]
+            else:
+                attributes = match.group(3)
+                self._start(tag, attributes)
+                if attributes.endswith('/') and tag not in _VOID:
+                    self._end(tag)
+        if not self._full and position < len(data):
+            self._data(data[position:])
+
+    def _start(self, tag: str, attributes: str):
+        if tag in _SKIPPED:
+            self._skip += 1
+            return
+        if self._skip:
+            return
+        if tag == 'br':
+            self._flush_break()
+            self._text('\n' + '> ' * self._quote)
+        elif tag == 'li':
+            self._break(1)
+            indent = '  ' * max(len(self._lists) - 1, 0)
+            if self._lists and self._lists[-1][0]:
+                self._lists[-1][1] += 1
+                marker = f"{self._lists[-1][1]}. "
+            else:
+                marker = '- '
+            self._text(indent + marker)
+        elif tag in ('ul', 'ol'):
+            self._break(1 if self._lists else 2)
+            self._lists.append([tag == 'ol', 0])
+        elif tag == 'a':
+            self._links.append((_attribute(attributes, 'href'), len(self._parts)))
+        elif tag == 'img':
+            alt = _attribute(attributes, 'alt').strip()
+            if alt:
+                self._data(f"[{alt}]", escaped=False)
+        elif tag in _CELLS:
+            if not self._at_line_start and not self._pending and self._parts:
+                self._text(' ')
+        elif tag in _BLOCK_BREAKS:
+            self._break(_BLOCK_BREAKS[tag])
+            if tag == 'blockquote':
+                self._quote += 1
+            elif tag == 'pre':
+                self._pre += 1
+            elif tag == 'hr':
+                self._text('---')
+                self._break(2)
+
+    def _end(self, tag: str):
+        if tag in _SKIPPED:
+            self._skip = max(self._skip - 1, 0)
+            return
+        if self._skip:
+            return
+        if tag in ('ul', 'ol'):
+            if self._lists:
+                self._lists.pop()
+            self._break(1 if self._lists else 2)
+        elif tag == 'a':
+            if self._links:
+                self._close_link(*self._links.pop())
+        elif tag in _BLOCK_BREAKS and tag not in ('hr', 'li'):
+            if tag == 'blockquote':
+                self._quote = max(self._quote - 1, 0)
+            elif tag == 'pre':
+                self._pre = max(self._pre - 1, 0)
+            self._break(_BLOCK_BREAKS[tag])
+
+    def _close_link(self, href: str, start: int):
+        """Link được giữ dạng "text (url)", bỏ qua nếu text đã là url hoặc là link nội bộ"""
+        target = href[7:] if href.lower().startswith('mailto:') else href
+        if not target or href.startswith('#') or href.lower().startswith('javascript:'):
+            return
+        label = ''.join(self._parts[start:]).strip()
+        if not label:
+            self._text(target)
+        elif target.rstrip('/') not in label:
+            self._text(f" ({target})")
+
+    def _data(self, data: str, escaped: bool = True):
+        if self._skip or not data:
+            return
+        if escaped and '&' in data:
+            data = html.unescape(data)
+        if self._pre:
+            self._text(data.replace('\n', '\n' + '> ' * self._quote) if self._quote else data)
+            return
+        # Gộp khoảng trắng/xuống dòng trong text như trình duyệt (str.split nhanh hơn regex \s+)
+        words = ' '.join(data.split())
+        if not words:
+            if not (self._at_line_start or self._pending):
+                self._text(' ')
+            return
+        if data[0].isspace() and not (self._at_line_start or self._pending):
+            words = ' ' + words
+        if data[-1].isspace():
+            words += ' '
+        self._text(words)
+
+    # API
+    def feed(self, chunk: str):
+        if self._full:
+            return
+        data = self._buffer + chunk
+        # Giữ lại từ '<' cuối cùng (thẻ có thể chưa trọn), hoặc từ comment chưa đóng
+        cut = data.rfind('<')
+        comment = data.rfind('<!--')
+        if comment != -1:
+            comment_end = data.find('-->', comment + 4)
+            if comment_end == -1:
+                cut = comment
+            elif cut < comment_end:
+                cut = -1
+        if cut == -1:
+            # Không còn thẻ dở dang: giữ lại phần sau '&' cuối cùng phòng entity bị cắt ngang
+            cut = data.rfind('&')
+            if cut == -1 or ';' in data[cut:]:
+                cut = len(data)
+        self._buffer = data[cut:]
+        self._parse(data[:cut])
+
+    def close(self) -> str:
+        if not self._full and self._buffer:
+            self._parse(self._buffer)
+        self._buffer = ''
+        return truncate(normalize_whitespace(''.join(self._parts)), self.max_length)
+
+
+def _attribute(attributes: str, name: str) -> str:
+    match = _ATTRIBUTES[name].search(attributes)
+    if not match:
+        return ''
+    return html.unescape(next(value for value in match.groups() if value is not None))
+
+
+def html_to_text(message: str, max_length: Optional[int] = None) -> str:
+    """Text gửi về Cloud từ reply HTML của agent (text không có thẻ HTML chỉ được decode entity)"""
+    if not message:
+        return ''
+    if not looks_like_html(message):
+        return truncate(normalize_whitespace(html.unescape(message)), max_length)
+    converter = HtmlToText(max_length)
+    converter._parse(message)
+    return converter.close()
+
+
+def _linkify(escaped: str) -> str:
+    def link(match):
+        url = match.group(0)
+        trailing = ''
+        while url and url[-1] in _URL_TRAILING:
+            trailing = url[-1] + trailing
+            url = url[:-1]
+        href = url if '://' in url else f"https://{url}"
+        return f'<a href="{href}">{url}</a>{trailing}'
+    return _URL.sub(link, escaped)
+
+
+def text_to_html(text: str, max_length: Optional[int] = None) -> str:
+    """HTML cho ticket On-Premise từ tin của khách hàng: escape, link hóa URL, <p> mỗi đoạn, <br> mỗi dòng"""
+    text = truncate(normalize_whitespace(text or ''), max_length)
+    if not text:
+        return ''
+    paragraphs = []
+    for paragraph in _PARAGRAPH_BREAK.split(text):
+        paragraphs.append('<p>' + '<br>\n'.join(_linkify(html.escape(line, quote=False))
+                                                 for line in paragraph.split('\n')) + '</p>')
+    return '\n'.join(paragraphs)
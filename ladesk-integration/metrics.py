@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Prometheus Metrics
+Đo latency/throughput cho webhook, upstream Ladesk API và SQLite
+
+Chạy nhiều worker gunicorn: đặt biến môi trường PROMETHEUS_MULTIPROC_DIR
+(thư mục rỗng, ghi được) trước khi start. Mỗi worker ghi giá trị vào file
+mmap riêng, endpoint /metrics gộp lại từ tất cả worker.
+"""
+
+import os
+import time
+import inspect
+import functools
+import logging
+from typing import Callable, Optional, Tuple
+
+import requests
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram,
+    CONTENT_TYPE_LATEST, REGISTRY, generate_latest, multiprocess
+)
+
+import webhook_timing
+
+logger = logging.getLogger(__name__)
+
+# Bucket cho latency (giây): từ vài ms của SQLite đến timeout của upstream
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+WEBHOOK_REQUESTS = Counter(
+    'ladesk_webhook_requests_total',
+    'Số webhook đã xử lý theo route và kết quả',
+    ['route', 'outcome']
+)
+
+WEBHOOK_LATENCY = Histogram(
+    'ladesk_webhook_request_duration_seconds',
+    'Thời gian xử lý webhook theo route và kết quả',
+    ['route', 'outcome'],
+    buckets=LATENCY_BUCKETS
+)
+
+WEBHOOK_IN_PROGRESS = Gauge(
+    'ladesk_webhook_in_progress',
+    'Số webhook đang xử lý',
+    ['route'],
+    multiprocess_mode='livesum'
+)
+
+UPSTREAM_LATENCY = Histogram(
+    'ladesk_upstream_request_duration_seconds',
+    'Thời gian gọi Ladesk API theo service, method và HTTP status',
+    ['service', 'method', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+
+DB_LATENCY = Histogram(
+    'ladesk_db_operation_duration_seconds',
+    'Thời gian thực thi method của SimpleDatabaseManager',
+    ['method'],
+    buckets=LATENCY_BUCKETS
+)
+
+CACHE_REQUESTS = Counter(
+    'ladesk_cache_requests_total',
+    'Số lần tra cache theo kết quả (hit/miss), hit ratio = hit / (hit + miss)',
+    ['cache', 'result']
+)
+
+WEBHOOK_PARSE_RESULTS = Counter(
+    'ladesk_webhook_parse_total',
+    'Số body webhook đã parse theo decoder được dùng (fast, lenient, json5, failed, too_large)',
+    ['decoder']
+)
+
+ATTACHMENT_TRANSFERS = Counter(
+    'ladesk_attachments_total',
+    'Số file đính kèm theo service đích và kết quả (uploaded, cached, deduplicated, too_large, failed)',
+    ['target', 'outcome']
+)
+
+ATTACHMENT_BYTES = Counter(
+    'ladesk_attachment_bytes_total',
+    'Số byte file đính kèm đã tải về (download) và upload theo service đích',
+    ['target', 'direction']
+)
+
+LOG_RECORDS_DROPPED = Counter(
+    'ladesk_log_records_dropped_total',
+    'Số log record bị bỏ vì queue logging đầy (LOG_QUEUE_SIZE)'
+)
+
+QUEUE_DEPTH = Gauge(
+    'ladesk_queue_depth',
+    'Độ sâu hàng đợi nội bộ',
+    ['queue'],
+    multiprocess_mode='livesum'
+)
+
+
+def outcome_from_payload(payload, status_code: int) -> str:
+    """Xác định outcome từ JSON body + status code: success, skipped_<reason>, shed, error"""
+    if status_code == 503 and isinstance(payload, dict) and payload.get('status') == 'shed':
+        return 'shed'
+    if status_code >= 400:
+        return 'error'
+    if isinstance(payload, dict) and payload.get('status') == 'skipped':
+        return f"skipped_{payload.get('reason', 'unknown')}"
+    return 'success'
+
+
+def webhook_outcome(response, status_code: int) -> str:
+    """Xác định outcome từ response của webhook (Flask Response hoặc dict của handler async)"""
+    if isinstance(response, dict):
+        return outcome_from_payload(response, status_code)
+    payload = response.get_json(silent=True) if hasattr(response, 'get_json') else None
+    return outcome_from_payload(payload, status_code)
+
+
+def result_outcome(result) -> str:
+    """Outcome từ giá trị trả về của handler: (response, status) hoặc response"""
+    if isinstance(result, tuple):
+        return webhook_outcome(result[0], result[1])
+    return webhook_outcome(result, getattr(result, 'status_code', 200))
+
+
+def track_webhook(route: str) -> Callable:
+    """Decorator đo số lượng và latency của một webhook route (handler sync hoặc async)"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                in_progress = WEBHOOK_IN_PROGRESS.labels(route=route)
+                in_progress.inc()
+                start = time.perf_counter()
+                outcome = 'error'
+                try:
+                    result = await func(*args, **kwargs)
+                    outcome = result_outcome(result)
+                    return result
+                finally:
+                    in_progress.dec()
+                    observe_webhook(route, outcome, time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            in_progress = WEBHOOK_IN_PROGRESS.labels(route=route)
+            in_progress.inc()
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = func(*args, **kwargs)
+                outcome = result_outcome(result)
+                return result
+            finally:
+                in_progress.dec()
+                observe_webhook(route, outcome, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def observe_webhook(route: str, outcome: str, duration: float):
+    """Ghi một webhook đã xử lý xong"""
+    WEBHOOK_REQUESTS.labels(route=route, outcome=outcome).inc()
+    WEBHOOK_LATENCY.labels(route=route, outcome=outcome).observe(duration)
+
+
+def observe_upstream(service: str, method: str, status: str, duration: float):
+    """Ghi latency một lần gọi Ladesk (dùng chung cho client sync và async)"""
+    UPSTREAM_LATENCY.labels(service=service, method=method, status=status).observe(duration)
+    webhook_timing.record(f"upstream.{service}.{method}", duration)
+
+
+def instrumented_request(service: str, method: str, http_method: str, url: str,
+                         **kwargs) -> requests.Response:
+    """Gọi HTTP tới Ladesk và ghi latency theo service/method/status"""
+    start = time.perf_counter()
+    status = 'exception'
+    try:
+        response = requests.request(http_method, url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        observe_upstream(service, method, status, time.perf_counter() - start)
+
+
+def track_db(func: Callable) -> Callable:
+    """Decorator đo latency của method trong SimpleDatabaseManager"""
+    histogram = DB_LATENCY.labels(method=func.__name__)
+    stage_name = f"db.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            histogram.observe(duration)
+            webhook_timing.record(stage_name, duration)
+    return wrapper
+
+
+def record_cache(cache: str, hit: bool):
+    """Ghi nhận một lần tra cache"""
+    CACHE_REQUESTS.labels(cache=cache, result='hit' if hit else 'miss').inc()
+
+
+def record_parse(decoder: str):
+    """Ghi nhận decoder đã dùng để parse body webhook"""
+    WEBHOOK_PARSE_RESULTS.labels(decoder=decoder).inc()
+
+
+def record_attachment(target: str, outcome: str):
+    """Ghi nhận một file đính kèm đã xử lý"""
+    ATTACHMENT_TRANSFERS.labels(target=target, outcome=outcome).inc()
+
+
+def record_attachment_bytes(target: str, direction: str, size: int):
+    """Ghi nhận số byte file đính kèm đã tải về/upload"""
+    ATTACHMENT_BYTES.labels(target=target, direction=direction).inc(size)
+
+
+def set_queue_depth(queue: str, depth: int):
+    """Cập nhật độ sâu hàng đợi"""
+    QUEUE_DEPTH.labels(queue=queue).set(depth)
+
+
+def record_log_dropped():
+    """Ghi nhận một log record bị bỏ khi queue logging đầy"""
+    LOG_RECORDS_DROPPED.inc()
+
+
+def render_latest() -> Tuple[bytes, str]:
+    """Xuất metrics theo định dạng Prometheus (gộp nhiều process nếu có)"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_worker_dead(pid: Optional[int]):
+    """Dọn file metrics của worker đã chết (gọi từ hook child_exit của gunicorn)"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR') and pid:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Sampling Profiler
+Chạy cProfile trên một tỉ lệ request của webhook handler, gộp kết quả và ghi
+ra thư mục xoay vòng dưới dạng .pstats
+
+Bật bằng biến môi trường PROFILE_SAMPLE_RATE (0 < rate <= 1). Khi rate = 0
+(mặc định) decorator trả về nguyên hàm gốc nên không tốn chi phí nào.
+
+Mỗi process chỉ profile một request mỗi lúc (từ Python 3.12 cProfile dùng
+sys.monitoring chung cho cả process, profiler thứ hai sẽ lỗi "Another
+profiling tool is already active"): request được lấy mẫu trong lúc đang có
+request khác được profile thì chạy bình thường, không lấy mẫu. Với handler
+async, profile bao cả các coroutine khác chạy trên event loop trong lúc
+handler chờ I/O.
+
+Xem kết quả:
+    python -m pstats logs/profiles/profile-<pid>-<time>.pstats
+    snakeviz / flameprof logs/profiles/profile-<pid>-<time>.pstats
+"""
+
+import os
+import time
+import atexit
+import random
+import inspect
+import cProfile
+import pstats
+import functools
+import logging
+import threading
+from typing import Callable, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """Gộp profile của các request được lấy mẫu và ghi ra file theo lô"""
+
+    def __init__(self, sample_rate: float, output_dir: str, flush_every: int = 50, keep_files: int = 20):
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.flush_every = max(1, flush_every)
+        self.keep_files = max(1, keep_files)
+        self._lock = threading.Lock()
+        # Giữ trong lúc một request đang được profile (không chờ, xem docstring module)
+        self._active = threading.Lock()
+        self._stats: Optional[pstats.Stats] = None
+        self._samples = 0
+
+    def should_sample(self) -> bool:
+        """Quyết định request hiện tại có được profile không"""
+        return random.random() < self.sample_rate
+
+    def profile(self, func: Callable) -> Callable:
+        """Decorator profile một phần request gọi tới func (sync hoặc async)"""
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                request_profiler = self._start()
+                if request_profiler is None:
+                    return await func(*args, **kwargs)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._stop(request_profiler)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            request_profiler = self._start()
+            if request_profiler is None:
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._stop(request_profiler)
+        return wrapper
+
+    def _start(self) -> Optional[cProfile.Profile]:
+        """Bắt đầu profile request hiện tại; None nếu không lấy mẫu hoặc đang profile request khác"""
+        if not self.should_sample() or not self._active.acquire(blocking=False):
+            return None
+        request_profiler = cProfile.Profile()
+        try:
+            request_profiler.enable()
+        except ValueError as e:
+            # Công cụ profile khác (ngoài profiler này) đang chạy trong process
+            self._active.release()
+            logger.debug("Skipping profile sample: %s", e)
+            return None
+        return request_profiler
+
+    def _stop(self, request_profiler: cProfile.Profile):
+        request_profiler.disable()
+        self._active.release()
+        self._collect(request_profiler)
+
+    def _collect(self, profiler: cProfile.Profile):
+        """Gộp profile của một request, ghi ra file khi đủ số mẫu"""
+        try:
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profiler)
+                else:
+                    self._stats.add(profiler)
+                self._samples += 1
+                if self._samples >= self.flush_every:
+                    self._flush_locked()
+        except Exception as e:
+            logger.error("❌ Error collecting profile: %s", e)
+
+    def flush(self):
+        """Ghi ngay các mẫu đang gộp ra file"""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self._stats is None:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        filename = os.path.join(
+            self.output_dir,
+            f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-{self._samples}.pstats"
+        )
+        self._stats.dump_stats(filename)
+        logger.info("✅ Saved profile of %s sampled requests to %s", self._samples, filename)
+        self._stats = None
+        self._samples = 0
+        self._rotate()
+
+    def _rotate(self):
+        """Chỉ giữ lại keep_files file .pstats mới nhất"""
+        files = [os.path.join(self.output_dir, name) for name in os.listdir(self.output_dir)
+                 if name.startswith('profile-') and name.endswith('.pstats')]
+        files.sort(key=os.path.getmtime)
+        for old_file in files[:-self.keep_files]:
+            try:
+                os.remove(old_file)
+            except OSError:
+                pass
+
+
+def _create_profiler() -> Optional[SamplingProfiler]:
+    """Tạo profiler từ Config, None nếu profiling đang tắt"""
+    if Config.PROFILE_SAMPLE_RATE <= 0:
+        return None
+    logger.info("🔬 Webhook profiling enabled: sample_rate=%s, dir=%s", Config.PROFILE_SAMPLE_RATE, Config.PROFILE_DIR)
+    sampling_profiler = SamplingProfiler(
+        sample_rate=min(Config.PROFILE_SAMPLE_RATE, 1.0),
+        output_dir=Config.PROFILE_DIR,
+        flush_every=Config.PROFILE_FLUSH_EVERY,
+        keep_files=Config.PROFILE_KEEP_FILES
+    )
+    # Ghi nốt các mẫu chưa đủ lô khi worker thoát
+    atexit.register(sampling_profiler.flush)
+    return sampling_profiler
+
+
+profiler = _create_profiler()
+
+
+def maybe_profile(func: Callable) -> Callable:
+    """Decorator cho webhook handler: trả về hàm gốc khi profiling tắt"""
+    if profiler is None:
+        return func
+    return profiler.profile(func)
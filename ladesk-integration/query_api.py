@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Query API
+Phần dùng chung của các endpoint chỉ đọc /api/mappings, /api/webhook-logs và
+/api/webhook-logs/counts (app.py và async_app.py): kiểm tra token, đọc tham số
+query, gọi storage.query_* / count_* và trả về (payload, status) như các route webhook.
+
+    GET /api/webhook-logs?conversation_id=123&status=error&since=2024-05-01T00:00:00Z&limit=100
+    GET /api/webhook-logs?conversation_id=123&before_id=<next_before_id của trang trước>
+    GET /api/webhook-logs/counts?group_by=agent_id&status=error&since=2024-05-01T00:00:00Z
+    GET /api/export/webhook_logs?after_id=<id cuối đã nhận>&gzip=1    (NDJSON stream, xem data_export.py)
+
+Endpoint chỉ bật khi có QUERY_API_TOKEN; client gửi `Authorization: Bearer <token>`.
+"""
+
+import hmac
+import logging
+from datetime import datetime, timedelta, timezone, tzinfo
+from typing import Callable, Dict, Mapping, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from config import Config
+from storage import MAX_PAGE_SIZE, SCAN_KINDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50
+
+
+class QueryError(ValueError):
+    """Tham số query không hợp lệ (400)"""
+
+
+def parse_timezone(name: str) -> tzinfo:
+    """Timezone từ cấu hình: 'UTC', offset ('+07:00') hoặc tên IANA ('Asia/Ho_Chi_Minh')"""
+    name = (name or '').strip()
+    if not name or name.upper() in ('UTC', 'Z'):
+        return timezone.utc
+    if name[0] in '+-':
+        try:
+            hours, _, minutes = name[1:].partition(':')
+            offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+        except ValueError:
+            raise ValueError(f"Invalid timezone: {name}")
+        return timezone(-offset if name[0] == '-' else offset)
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Invalid timezone: {name}")
+
+
+def normalize_timestamp(value: str, tz: tzinfo = timezone.utc) -> str:
+    """ISO 8601 -> 'YYYY-MM-DD HH:MM:SS' UTC như created_at; giá trị không có timezone được hiểu theo tz"""
+    try:
+        parsed = datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise QueryError(f"Invalid timestamp: {value}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=tz)
+    return parsed.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def utc_to_local(value: str, tz: tzinfo) -> str:
+    """'YYYY-MM-DD HH:MM:SS' UTC -> cùng định dạng theo giờ tz (ví dụ để lọc theo date_changed của Cloud)"""
+    parsed = datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return parsed.astimezone(tz).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _positive_int(name: str, value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise QueryError(f"{name} must be an integer")
+    if number < 1:
+        raise QueryError(f"{name} must be >= 1")
+    return number
+
+
+def parse_filters(args: Mapping[str, str], filters: Dict[str, str], extra: Tuple[str, ...] = ()) -> Dict:
+    """Bộ lọc và since/until -> kwargs; tham số trong extra được bỏ qua (QueryError nếu có tham số lạ)"""
+    unknown = set(args) - set(filters) - {'since', 'until'} - set(extra)
+    if unknown:
+        raise QueryError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+
+    kwargs = {name: args[name] for name in filters if args.get(name)}
+    for name in ('since', 'until'):
+        if args.get(name):
+            kwargs[name] = normalize_timestamp(args[name])
+    return kwargs
+
+
+def parse_query(args: Mapping[str, str], filters: Dict[str, str]) -> Dict:
+    """Tham số query -> kwargs cho storage.query_* (QueryError nếu sai)"""
+    kwargs = parse_filters(args, filters, ('limit', 'before_id'))
+    kwargs['limit'] = min(_positive_int('limit', args['limit']), MAX_PAGE_SIZE) if args.get('limit') else DEFAULT_PAGE_SIZE
+    if args.get('before_id'):
+        kwargs['before_id'] = _positive_int('before_id', args['before_id'])
+    return kwargs
+
+
+def authorize(headers: Mapping[str, str]) -> Tuple[bool, int]:
+    """(được phép?, status lỗi): 403 nếu chưa cấu hình token, 401 nếu token sai"""
+    token = Config.QUERY_API_TOKEN
+    if not token:
+        return False, 403
+    supplied = headers.get('Authorization', '')
+    if supplied.startswith('Bearer ') and hmac.compare_digest(supplied[len('Bearer '):], token):
+        return True, 200
+    return False, 401
+
+
+def auth_error(headers: Mapping[str, str]) -> Optional[Tuple[Dict, int]]:
+    """(payload, status) lỗi nếu request không được phép, None nếu hợp lệ"""
+    allowed, status = authorize(headers)
+    if allowed:
+        return None
+    return {"error": "Query API disabled" if status == 403 else "Unauthorized"}, status
+
+
+def handle(query: Callable, filters: Dict[str, str], args: Mapping[str, str],
+           headers: Mapping[str, str]) -> Tuple[Dict, int]:
+    """Chạy một query phân trang, trả về (payload, status)"""
+    error = auth_error(headers)
+    if error:
+        return error
+    try:
+        kwargs = parse_query(args, filters)
+    except QueryError as e:
+        return {"error": str(e)}, 400
+
+    items, next_before_id = query(**kwargs)
+    logger.debug("🔍 Query %s returned %s rows", kwargs, len(items))
+    return {"items": items, "count": len(items), "next_before_id": next_before_id}, 200
+
+
+def handle_counts(count: Callable, filters: Dict[str, str], group_columns: Dict[str, str],
+                  args: Mapping[str, str], headers: Mapping[str, str]) -> Tuple[Dict, int]:
+    """Đếm theo group_by (storage.count_*), trả về (payload, status); counts giảm dần theo số lượng"""
+    error = auth_error(headers)
+    if error:
+        return error
+    group_by = args.get('group_by')
+    if group_by not in group_columns:
+        return {"error": f"group_by must be one of: {', '.join(group_columns)}"}, 400
+    try:
+        kwargs = parse_filters(args, filters, ('group_by',))
+    except QueryError as e:
+        return {"error": str(e)}, 400
+
+    counts = sorted(count(group_by, **kwargs).items(), key=lambda item: (-item[1], str(item[0])))
+    logger.debug("🔍 Count by %s %s returned %s groups", group_by, kwargs, len(counts))
+    return {"group_by": group_by, "counts": [{"value": value, "count": n} for value, n in counts],
+            "total": sum(n for _, n in counts)}, 200
+
+
+def export_options(kind: str, args: Mapping[str, str], headers: Mapping[str, str]) -> Tuple[Dict, int]:
+    """Tham số của /api/export/<kind>: ({'after_id', 'compress', 'headers'}, 200) hoặc (lỗi, status)"""
+    error = auth_error(headers)
+    if error:
+        return error
+    if kind not in SCAN_KINDS:
+        return {"error": f"Unknown export: {kind}"}, 404
+    unknown = set(args) - {'after_id', 'gzip'}
+    if unknown:
+        return {"error": f"Unknown parameters: {', '.join(sorted(unknown))}"}, 400
+    try:
+        after_id = _positive_int('after_id', args['after_id']) if args.get('after_id') else None
+    except QueryError as e:
+        return {"error": str(e)}, 400
+
+    compress = args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    filename = f"{kind}.ndjson.gz" if compress else f"{kind}.ndjson"
+    response_headers = {
+        'Content-Type': 'application/gzip' if compress else 'application/x-ndjson',
+        'Content-Disposition': f'attachment; filename="{filename}"',
+    }
+    return {"after_id": after_id, "compress": compress, "headers": response_headers}, 200
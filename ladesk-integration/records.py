@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Records
+Kiểu dữ liệu gọn (__slots__, không có __dict__ mỗi object) dùng chung giữa các module:
+
+- Mapping, WebhookLog: một dòng conversation_mappings / webhook_logs trả về
+  từ các hàm get_* của storage. SQLite tạo record thẳng từ tuple qua
+  row_factory, không dựng dict theo chỉ số cột ở từng hàm
+- WebhookEvent: payload webhook đã parse, các trường được đọc một lần khi
+  nhận thay vì data.get(...) lặp lại ở từng bước xử lý
+- AgentRef: một agent trong danh sách agent của Cloud/On-Premise API
+
+Mapping và WebhookLog vẫn đọc được như dict (record['id'], record.get(...),
+dict(record), set(record)) nên code và script cũ không phải đổi; query_* và
+scan() vẫn trả về dict vì kết quả được serialize JSON ngay.
+"""
+
+from typing import Dict, Optional
+
+from storage import MAPPING_FIELDS, WEBHOOK_LOG_FIELDS
+
+
+class _Record:
+    """Record có các trường cố định theo __slots__, dùng được như dict"""
+    __slots__ = ()
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        """sqlite3 row_factory: conn.row_factory = Mapping.row_factory"""
+        return cls(*row)
+
+    def __getitem__(self, key: str):
+        if key in self.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__slots__
+
+    def copy(self):
+        return type(self)(*[getattr(self, name) for name in self.__slots__])
+
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, _Record):
+            return type(other) is type(self) and self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Mapping(_Record):
+    """Một dòng conversation_mappings (các trường MAPPING_FIELDS)"""
+    __slots__ = MAPPING_FIELDS
+
+    def __init__(self, id, cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id,
+                 customer_name, customer_email, created_at, updated_at):
+        self.id = id
+        self.cloud_conversation_id = cloud_conversation_id
+        self.onpremise_ticket_id = onpremise_ticket_id
+        self.onpremise_contact_id = onpremise_contact_id
+        self.customer_name = customer_name
+        self.customer_email = customer_email
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+
+class WebhookLog(_Record):
+    """Một dòng webhook_logs (các trường WEBHOOK_LOG_FIELDS)"""
+    __slots__ = WEBHOOK_LOG_FIELDS
+
+    def __init__(self, id, webhook_type, conversation_id, ticket_id, contact_id,
+                 event_type, raw_data, processed_data, status, error_message, created_at):
+        self.id = id
+        self.webhook_type = webhook_type
+        self.conversation_id = conversation_id
+        self.ticket_id = ticket_id
+        self.contact_id = contact_id
+        self.event_type = event_type
+        self.raw_data = raw_data
+        self.processed_data = processed_data
+        self.status = status
+        self.error_message = error_message
+        self.created_at = created_at
+
+
+class WebhookEvent:
+    """Webhook Cloud/On-Premise đã parse; giá trị mặc định giống data.get(...) của handler cũ
+
+    payload là dict gốc (để log_webhook lưu nguyên văn).
+    """
+    __slots__ = ('payload', 'event_type', 'message_type', 'status', 'channel_type',
+                 'conversation_id', 'ticket_id', 'contact_id', 'customer_email',
+                 'agent_id', 'agent_name', 'contactid', 'userid', 'message', 'subject', 'attachments')
+
+    def __init__(self, payload: Dict):
+        get = payload.get
+        self.payload = payload
+        self.event_type = get('event_type')
+        self.message_type = get('message_type')
+        self.status = get('status', '')
+        self.channel_type = get('channel_type', '')
+        self.conversation_id = get('conversation_id')
+        self.ticket_id = get('ticket_id')
+        self.contact_id = get('contact_id')
+        self.customer_email = get('customer_email', '')
+        self.agent_id = get('agent_id', '')
+        self.agent_name = get('agent_name', '')
+        self.contactid = get('contactid', '')
+        self.userid = get('userid', '')
+        self.message = get('message', '')
+        self.subject = get('subject', 'Facebook Message')
+        self.attachments = get('attachments')  # Giá trị gốc, xem attachments.attachment_refs
+
+    @classmethod
+    def parse(cls, payload: Optional[Dict]) -> Optional['WebhookEvent']:
+        """None nếu payload rỗng hoặc không parse được"""
+        return cls(payload) if payload else None
+
+    def __repr__(self) -> str:
+        return (f"WebhookEvent(event_type={self.event_type!r}, conversation_id={self.conversation_id!r}, "
+                f"ticket_id={self.ticket_id!r})")
+
+
+class AgentRef:
+    """Agent trong danh sách agent của API: id (contactid/userid/id), email, tên hiển thị"""
+    __slots__ = ('id', 'email', 'name')
+
+    def __init__(self, id: Optional[str], email: str = '', name: str = ''):
+        self.id = id
+        self.email = email
+        self.name = name
+
+    @classmethod
+    def from_api(cls, agent: Dict) -> 'AgentRef':
+        """Từ một object agent của Cloud/On-Premise API (trường có thể khác nhau giữa hai bên)"""
+        agent_id = agent.get('contactid') or agent.get('userid') or agent.get('id')
+        name = agent.get('name') or f"{agent.get('firstname') or ''} {agent.get('lastname') or ''}"
+        return cls(str(agent_id) if agent_id else None, (agent.get('email') or '').strip().lower(), name.strip())
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, AgentRef):
+            return NotImplemented
+        return (self.id, self.email, self.name) == (other.id, other.email, other.name)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"AgentRef(id={self.id!r}, email={self.email!r}, name={self.name!r})"
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Regression Checks
+Các kiểm tra hồi quy cho lỗi đã sửa (ngoài storage_conformance.py): mỗi kiểm
+tra chạy trong thư mục tạm riêng, Config được trả lại như cũ sau khi chạy, các
+kiểm tra cần Ladesk dùng simulator (ladesk_simulator.py) trong cùng process
+
+    python regression_checks.py                   # tất cả
+    python regression_checks.py -k attachment -v  # kiểm tra có tên chứa 'attachment', in lỗi chi tiết
+
+Exit code 1 nếu có kiểm tra không đạt.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+
+import asyncio
+import argparse
+import logging
+import tempfile
+import traceback
+import contextlib
+from typing import Callable, List
+
+from config import Config
+
+CHECKS: List[Callable] = []
+
+
+def check(func: Callable) -> Callable:
+    """Đăng ký một kiểm tra (nhận thư mục tạm, assert khi sai)"""
+    CHECKS.append(func)
+    return func
+
+
+@contextlib.contextmanager
+def patched_config(**values):
+    """Đặt tạm các giá trị Config, trả lại giá trị cũ khi ra khỏi block"""
+    saved = {name: getattr(Config, name) for name in values}
+    for name, value in values.items():
+        setattr(Config, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(Config, name, value)
+
+
+@contextlib.contextmanager
+def simulator(**kwargs):
+    """Simulator chạy nền, Config trỏ vào simulator trong block"""
+    from ladesk_simulator import LadeskSimulator, SimulatorThread
+    sim = LadeskSimulator(seed=1, **kwargs)
+    thread = SimulatorThread(sim).start()
+    try:
+        with patched_config(**thread.base_urls):
+            yield sim
+    finally:
+        thread.stop()
+
+
+# File đính kèm
+@check
+def attachment_rejects_ladesk_api_path(workdir):
+    """URL file trong webhook trỏ vào API của server Ladesk không được tải (request kèm apikey)"""
+    import ladesk_async
+    from ladesk_api import LadeskOnPremiseAPI
+    keys = {'LADESK_ONPREMISE_API_KEY_V1': 'sim-key', 'LADESK_ONPREMISE_API_KEY_V3': 'sim-key'}
+    with simulator(api_key='sim-key') as sim, patched_config(**keys):
+        base = Config.LADESK_ONPREMISE_BASE_URL_V1
+        forbidden = [f"{base}/conversations/abc/messages", f"{base}/agents",
+                     f"{base}/media/../agents", f"{base}/media/%2e%2e/agents"]
+        media = f"{base}/media/photo.jpg?size=2048"
+
+        api = LadeskOnPremiseAPI()
+        for url in forbidden:
+            result = api.download_attachment(url, 'photo.jpg')
+            assert not result['success'] and result['status_code'] == 403, (url, result)
+        result = api.download_attachment(media, 'photo.jpg')
+        assert result['success'] and result['attachment'].size == 2048, result
+        result['attachment'].close()
+
+        async def download_async():
+            async_api = ladesk_async.AsyncLadeskOnPremiseAPI()
+            try:
+                for url in forbidden:
+                    result = await async_api.download_attachment(url, 'photo.jpg')
+                    assert not result['success'] and result['status_code'] == 403, (url, result)
+                result = await async_api.download_attachment(media, 'photo.jpg')
+                assert result['success'] and result['attachment'].size == 2048, result
+                result['attachment'].close()
+            finally:
+                await ladesk_async.close_session()
+        asyncio.run(download_async())
+
+        operations = {operation for (_, operation, _) in sim.stats}
+        assert operations == {'download_media'}, operations
+
+
+# Backfill
+@check
+def backfill_compares_cloud_time_in_utc(workdir):
+    """Cloud ở +07:00: tin trước lúc tạo mapping (UTC) không bị gửi lại, --since/--until được đổi sang UTC"""
+    from datetime import datetime, timedelta, timezone
+    from database_simple import SimpleDatabaseManager
+    from backfill import BackfillCheckpoint, BackfillJob
+    from query_api import normalize_timestamp, parse_timezone
+    cloud_tz = parse_timezone('+07:00')
+
+    def cloud_time(moment: datetime) -> str:
+        return moment.astimezone(cloud_tz).strftime('%Y-%m-%d %H:%M:%S')
+
+    with simulator() as sim, patched_config(LADESK_CLOUD_TIMEZONE='+07:00', SHARED_CACHE_MAX_ENTRIES=0):
+        db = SimpleDatabaseManager(os.path.join(workdir, 'app.db'), auto_migrate=True)
+        [conversation_id] = sim.seed_history(1, messages=2, replies=1, days=1)
+        # Mapping do luồng webhook tạo: ticket không nằm trong checkpoint của job backfill bên dưới
+        live = BackfillJob(db, BackfillCheckpoint(os.path.join(workdir, 'live.db')), 'live', rate_limit=0)
+        assert live.run([conversation_id])['done'] == 1
+        mapping = db.get_mapping_by_conversation(conversation_id)
+        created = datetime.strptime(mapping.created_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+
+        cloud = sim.services['cloud']
+        conversation = cloud.conversations[conversation_id]
+        for text, offset in (('forwarded live', -1800), ('missed during outage', 30), ('after outage', 90)):
+            conversation['messages'].append(cloud._message(text, 'M', conversation['owner_contactid'],
+                                                           cloud_time(created + timedelta(seconds=offset))))
+        ticket = sim.services['onpremise']._conversation(mapping.onpremise_ticket_id)
+        before = len(ticket['messages'])
+
+        # Như main(): --since không có timezone (giờ Cloud), --until có offset
+        since = normalize_timestamp(cloud_time(created - timedelta(hours=1)), cloud_tz)
+        until = normalize_timestamp((created + timedelta(seconds=60)).astimezone(cloud_tz).isoformat(), cloud_tz)
+        job = BackfillJob(db, BackfillCheckpoint(os.path.join(workdir, 'backfill.db')), 'outage', rate_limit=0,
+                          since=since, until=until)
+        stats = job.run([conversation_id])
+        assert stats['done'] == 1 and stats['messages_synced'] == 1, stats
+        assert len(ticket['messages']) == before + 1
+        assert 'missed during outage' in ticket['messages'][-1]['message'], ticket['messages'][-1]
+
+
+# Admission control
+@check
+def admission_admits_cloud_customer_message(workdir):
+    """Phần LOW đã đầy: tin nhắn khách hàng từ Cloud vẫn được nhận, event bị bỏ qua thì bị từ chối (503)"""
+    import admission
+    import app as flask_app
+    import async_app
+    from aiohttp.test_utils import TestClient, TestServer
+    from database_simple import SimpleDatabaseManager
+    from ladesk_api import LadeskCloudAPI, LadeskOnPremiseAPI
+    from ladesk_async import AsyncLadeskCloudAPI, AsyncLadeskOnPremiseAPI
+
+    with simulator() as sim, patched_config(SHARED_CACHE_MAX_ENTRIES=0):
+        db = SimpleDatabaseManager(os.path.join(workdir, 'app.db'), auto_migrate=True)
+        cloud = sim.services['cloud']
+        conversation_ids = sim.seed_history(2, messages=1, replies=0, days=1)
+
+        def customer_message(conversation_id: str) -> dict:
+            return {'event_type': 'message_added', 'message_type': 'M', 'status': 'C', 'channel_type': 'A',
+                    'conversation_id': conversation_id,
+                    'contact_id': cloud.conversations[conversation_id]['owner_contactid'],
+                    'agent_id': '{$user_id}', 'agent_name': '{$user_firstname} {$user_lastname}',
+                    'message': 'xin chào', 'subject': 'Facebook Message'}
+        system_event = {'event_type': 'conversation_transferred', 'conversation_id': conversation_ids[0]}
+
+        saved = admission.controller
+        admission.controller = admission.AdmissionController(max_in_flight=4, low_priority_share=0.5, max_queued=0)
+        admission.controller.in_flight = admission.controller.low_priority_limit
+        try:
+            client = flask_app.create_app(db=db, cloud_api=LadeskCloudAPI(), onpremise_api=LadeskOnPremiseAPI(),
+                                          configure_logging=False).test_client()
+            response = client.post('/webhook/ladesk-cloud', json=customer_message(conversation_ids[0]))
+            assert response.status_code == 200 and response.get_json()['status'] == 'success', response.get_json()
+            response = client.post('/webhook/ladesk-cloud', json=system_event)
+            assert response.status_code == 503, response.get_json()
+
+            async def post_async():
+                application = async_app.create_app(db=db, cloud_api=AsyncLadeskCloudAPI(),
+                                                   onpremise_api=AsyncLadeskOnPremiseAPI(), configure_logging=False)
+                async with TestClient(TestServer(application)) as async_client:
+                    response = await async_client.post('/webhook/ladesk-cloud', json=customer_message(conversation_ids[1]))
+                    payload = await response.json()
+                    assert response.status == 200 and payload['status'] == 'success', payload
+                    response = await async_client.post('/webhook/ladesk-cloud', json=system_event)
+                    assert response.status == 503, await response.json()
+            asyncio.run(post_async())
+            assert admission.controller.in_flight == admission.controller.low_priority_limit
+        finally:
+            admission.controller = saved
+        assert all(db.get_mapping_by_conversation(conversation_id) for conversation_id in conversation_ids)
+
+
+@check
+def async_cloud_webhook_cancels_attachments_on_error(workdir):
+    """Handler async lỗi ở bước 1: task chuyển file đính kèm bị huỷ và được await, không chạy tiếp"""
+    import async_app
+    from aiohttp.test_utils import TestClient, TestServer
+    from database_simple import SimpleDatabaseManager
+    from ladesk_async import AsyncLadeskCloudAPI, AsyncLadeskOnPremiseAPI
+    downloads = {'started': asyncio.Event(), 'cancelled': False}
+
+    class FailingCloudAPI(AsyncLadeskCloudAPI):
+        async def get_contact_details(self, contact_id: str) -> dict:
+            await downloads['started'].wait()
+            raise RuntimeError('contact lookup failed')
+
+        async def download_attachment(self, url: str, name: str, content_type: str = None) -> dict:
+            downloads['started'].set()
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                downloads['cancelled'] = True
+                raise
+            return {'success': False, 'error': 'not reached'}
+
+    payload = {'event_type': 'message_added', 'message_type': 'M', 'status': 'C', 'channel_type': 'A',
+               'conversation_id': 'conv-1', 'contact_id': 'contact-1', 'message': 'xem ảnh',
+               'attachments': [{'url': 'https://files.example.com/photo.jpg', 'name': 'photo.jpg'}]}
+
+    async def post():
+        db = SimpleDatabaseManager(os.path.join(workdir, 'app.db'), auto_migrate=True)
+        application = async_app.create_app(db=db, cloud_api=FailingCloudAPI(), onpremise_api=AsyncLadeskOnPremiseAPI(),
+                                           configure_logging=False)
+        async with TestClient(TestServer(application)) as client:
+            response = await asyncio.wait_for(client.post('/webhook/ladesk-cloud', json=payload), 10)
+            assert response.status == 500, await response.json()
+            # Đã huỷ trước khi handler trả về, không phải khi event loop đóng
+            assert downloads['cancelled']
+        return db.get_mapping_by_conversation('conv-1')
+
+    with patched_config(SHARED_CACHE_MAX_ENTRIES=0):
+        assert asyncio.run(post()) is None
+
+
+# Export
+@check
+def export_resume_restarts_without_output(workdir):
+    """--resume khi file output đã mất hoặc ngắn hơn checkpoint: export lại từ đầu, không bỏ sót dòng"""
+    import gzip
+    import json
+    from database_simple import SimpleDatabaseManager
+    from data_export import export_to_file, read_state
+    db = SimpleDatabaseManager(os.path.join(workdir, 'app.db'), auto_migrate=True)
+    for i in range(25):
+        db.log_webhook('cloud_incoming', {'conversation_id': f'conv-{i}', 'event_type': 'message_added'})
+
+    for output in (os.path.join(workdir, 'logs.ndjson'), os.path.join(workdir, 'logs.ndjson.gz')):
+        def exported_ids():
+            with (gzip.open if output.endswith('.gz') else open)(output, 'rb') as f:
+                return [json.loads(line)['id'] for line in f]
+
+        first = export_to_file(db, 'webhook_logs', output, batch_size=10)
+        assert first['rows'] == 25 and read_state(output)['offset'] == os.path.getsize(output)
+
+        os.remove(output)
+        state = export_to_file(db, 'webhook_logs', output, resume=True, batch_size=10)
+        assert state['rows'] == 25 and len(set(exported_ids())) == 25, state
+
+        # File bị ghi đè bằng bản ngắn hơn (chỉ lô đầu)
+        export_to_file(db, 'webhook_logs', output, batch_size=10)
+        with open(output, 'rb') as f:
+            partial = f.read(read_state(output)['offset'] // 3)
+        with open(output, 'wb') as f:
+            f.write(partial)
+        state = export_to_file(db, 'webhook_logs', output, resume=True, batch_size=10)
+        assert state['rows'] == 25 and len(set(exported_ids())) == 25, state
+
+
+# Profiling
+@check
+def profiler_skips_overlapping_samples(workdir):
+    """Request trùng lúc với request đang được profile chạy bình thường, handler async được profile cả phần await"""
+    import threading
+    import pstats
+    from profiling import SamplingProfiler
+    profiler = SamplingProfiler(sample_rate=1.0, output_dir=workdir, flush_every=1000)
+    started, release = threading.Event(), threading.Event()
+
+    @profiler.profile
+    def slow_handler():
+        started.set()
+        assert release.wait(5)
+        return 'slow'
+
+    @profiler.profile
+    def fast_handler():
+        return 'fast'
+
+    results = []
+    worker = threading.Thread(target=lambda: results.append(slow_handler()))
+    worker.start()
+    assert started.wait(5)
+    assert fast_handler() == 'fast'
+    release.set()
+    worker.join(5)
+    assert results == ['slow'] and profiler._samples == 1, (results, profiler._samples)
+
+    @profiler.profile
+    async def async_handler(delay: float):
+        await asyncio.sleep(delay)
+        return delay
+
+    async def run_handlers():
+        return await asyncio.gather(async_handler(0.05), async_handler(0.01))
+    assert asyncio.run(run_handlers()) == [0.05, 0.01]
+    assert profiler._samples == 2, profiler._samples
+
+    profiler.flush()
+    [filename] = [name for name in os.listdir(workdir) if name.endswith('.pstats')]
+    functions = {name for (_, _, name) in pstats.Stats(os.path.join(workdir, filename)).stats}
+    assert {'slow_handler', 'async_handler', 'sleep'} <= functions, functions
+
+
+def run_checks(pattern: str, verbose: bool) -> int:
+    """Chạy các check có tên chứa pattern, trả về số check lỗi"""
+    failures = 0
+    for func in CHECKS:
+        if pattern and pattern not in func.__name__:
+            continue
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                func(workdir)
+                print(f"  ✅ {func.__name__}")
+            except Exception as e:
+                failures += 1
+                print(f"  ❌ {func.__name__}: {type(e).__name__} {e}")
+                if verbose:
+                    traceback.print_exc()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kiểm tra hồi quy các lỗi đã sửa")
+    parser.add_argument('-k', dest='pattern', help='Chỉ chạy check có tên chứa chuỗi này')
+    parser.add_argument('--verbose', '-v', action='store_true', help='In traceback khi lỗi')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    failures = run_checks(args.pattern, args.verbose)
+    print("-" * 60)
+    if failures:
+        print(f"❌ {failures} check(s) failed")
+        sys.exit(1)
+    print("✅ All regression checks passed")
+
+
+if __name__ == '__main__':
+    main()
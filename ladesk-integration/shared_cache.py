@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Shared Cache
+Cache dùng chung giữa các worker gunicorn trên cùng một máy, lưu trong một
+file SQLite (WAL) nên worker mới fork/restart dùng ngay dữ liệu worker khác
+đã lấy, thay vì mỗi worker tự gọi lại Ladesk
+
+- TTL theo từng key, giá trị lưu dạng JSON
+- Giới hạn SHARED_CACHE_MAX_ENTRIES: bỏ entry hết hạn trước, rồi đến entry
+  sắp hết hạn nhất (đọc không ghi gì nên không tranh lock với writer)
+- get_or_compute: chỉ một process/thread tính cho mỗi key tại một thời điểm
+  (lease trong bảng cache_leases), các bên khác chờ kết quả; lease hết hạn
+  sau SHARED_CACHE_LEASE_TIMEOUT để process chết giữa chừng không chặn mãi
+- Lỗi cache không bao giờ làm hỏng lookup: chỉ log và gọi thẳng compute
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import Any, Awaitable, Callable, Optional
+
+import metrics
+from config import Config
+from lazy import LazyProxy
+
+logger = logging.getLogger(__name__)
+
+_MISS = object()
+
+
+def is_success(result) -> bool:
+    """Chỉ cache kết quả thành công của các API client ({'success': True, ...})"""
+    return isinstance(result, dict) and result.get('success') is True
+
+
+class SharedCache:
+    """Cache key/value có TTL trong file SQLite dùng chung giữa các process"""
+
+    def __init__(self, path: str, max_entries: int = 10000, lease_timeout: float = 10.0,
+                 poll_interval: float = 0.05, evict_every: int = 100):
+        self.path = path
+        self.max_entries = max_entries
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.evict_every = evict_every
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """Một connection cho mỗi thread của mỗi process (không dùng lại connection sau fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_entries_expires ON cache_entries(expires_at)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_leases (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    # Thao tác cơ bản
+    def _lookup(self, key: str):
+        row = self._connect().execute(
+            'SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else _MISS
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Giá trị còn hạn của key (default nếu không có)"""
+        if not self.enabled:
+            return default
+        try:
+            value = self._lookup(key)
+            return default if value is _MISS else value
+        except Exception as e:
+            logger.warning("⚠️ Shared cache get error: %s", e)
+            return default
+
+    def set(self, key: str, value: Any, ttl: float) -> bool:
+        """Lưu value (phải serialize được JSON) trong ttl giây"""
+        if not self.enabled:
+            return False
+        try:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), time.time() + ttl)
+            )
+            self._maybe_evict(conn)
+            return True
+        except Exception as e:
+            logger.warning("⚠️ Shared cache set error: %s", e)
+            return False
+
+    def delete(self, key: str):
+        if self.enabled:
+            try:
+                self._connect().execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+            except Exception as e:
+                logger.warning("⚠️ Shared cache delete error: %s", e)
+
+    def clear(self):
+        if self.enabled:
+            conn = self._connect()
+            conn.execute('DELETE FROM cache_entries')
+            conn.execute('DELETE FROM cache_leases')
+
+    def __len__(self) -> int:
+        if not self.enabled:
+            return 0
+        return self._connect().execute('SELECT COUNT(*) FROM cache_entries').fetchone()[0]
+
+    def _maybe_evict(self, conn: sqlite3.Connection):
+        """Cứ evict_every lần ghi (trong process) thì dọn một lần"""
+        with self._writes_lock:
+            self._writes += 1
+            if self._writes % self.evict_every:
+                return
+        self.evict(conn)
+
+    def evict(self, conn: sqlite3.Connection = None) -> int:
+        """Xóa entry hết hạn, rồi entry sắp hết hạn nhất cho đến khi về max_entries"""
+        conn = conn or self._connect()
+        now = time.time()
+        removed = conn.execute('DELETE FROM cache_entries WHERE expires_at <= ?', (now,)).rowcount
+        conn.execute('DELETE FROM cache_leases WHERE expires_at <= ?', (now,))
+        overflow = conn.execute('SELECT COUNT(*) FROM cache_entries').fetchone()[0] - self.max_entries
+        if overflow > 0:
+            removed += conn.execute('''
+                DELETE FROM cache_entries WHERE key IN (
+                    SELECT key FROM cache_entries ORDER BY expires_at LIMIT ?
+                )
+            ''', (overflow,)).rowcount
+        return removed
+
+    # Lease cho get_or_compute
+    def _acquire_lease(self, key: str) -> Optional[str]:
+        owner = uuid.uuid4().hex
+        conn = self._connect()
+        now = time.time()
+        conn.execute('DELETE FROM cache_leases WHERE key = ? AND expires_at <= ?', (key, now))
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO cache_leases (key, owner, expires_at) VALUES (?, ?, ?)',
+            (key, owner, now + self.lease_timeout)
+        )
+        return owner if cursor.rowcount == 1 else None
+
+    def _release_lease(self, key: str, owner: str):
+        try:
+            self._connect().execute('DELETE FROM cache_leases WHERE key = ? AND owner = ?', (key, owner))
+        except Exception as e:
+            logger.warning("⚠️ Shared cache lease release error: %s", e)
+
+    def _lease_held(self, key: str) -> bool:
+        row = self._connect().execute(
+            'SELECT 1 FROM cache_leases WHERE key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def _begin(self, key: str, cache_name: str):
+        """(value, owner): value khác _MISS nếu hit; owner là lease nếu process này phải tính"""
+        value = self._lookup(key)
+        metrics.record_cache(cache_name, value is not _MISS)
+        if value is not _MISS:
+            return value, None
+        return _MISS, self._acquire_lease(key)
+
+    def _poll(self, key: str):
+        """Một lượt chờ: (value, tiếp tục chờ?)"""
+        value = self._lookup(key)
+        if value is not _MISS:
+            return value, False
+        return _MISS, self._lease_held(key)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any], ttl: float,
+                       cache_name: str = 'shared', should_cache: Callable[[Any], bool] = is_success) -> Any:
+        """Lấy từ cache, nếu không có thì compute() (một bên tính, các bên khác chờ) và lưu lại"""
+        if not self.enabled:
+            return compute()
+        try:
+            value, owner = self._begin(key, cache_name)
+            if value is not _MISS:
+                return value
+            if owner is None:
+                # Process/thread khác đang tính: chờ kết quả tối đa lease_timeout
+                deadline = time.monotonic() + self.lease_timeout
+                while time.monotonic() < deadline:
+                    time.sleep(self.poll_interval)
+                    value, waiting = self._poll(key)
+                    if value is not _MISS:
+                        return value
+                    if not waiting:
+                        break
+        except Exception as e:
+            logger.warning("⚠️ Shared cache error, computing directly: %s", e)
+            return compute()
+
+        try:
+            value = compute()
+            if should_cache(value):
+                self.set(key, value, ttl)
+            return value
+        finally:
+            if owner is not None:
+                self._release_lease(key, owner)
+
+    async def get_or_compute_async(self, key: str, compute: Callable[[], Awaitable[Any]], ttl: float,
+                                   cache_name: str = 'shared',
+                                   should_cache: Callable[[Any], bool] = is_success) -> Any:
+        """get_or_compute cho coroutine: SQLite chạy trong thread, chờ bằng asyncio.sleep"""
+        if not self.enabled:
+            return await compute()
+        try:
+            value, owner = await asyncio.to_thread(self._begin, key, cache_name)
+            if value is not _MISS:
+                return value
+            if owner is None:
+                deadline = time.monotonic() + self.lease_timeout
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(self.poll_interval)
+                    value, waiting = await asyncio.to_thread(self._poll, key)
+                    if value is not _MISS:
+                        return value
+                    if not waiting:
+                        break
+        except Exception as e:
+            logger.warning("⚠️ Shared cache error, computing directly: %s", e)
+            return await compute()
+
+        try:
+            value = await compute()
+            if should_cache(value):
+                await asyncio.to_thread(self.set, key, value, ttl)
+            return value
+        finally:
+            if owner is not None:
+                await asyncio.to_thread(self._release_lease, key, owner)
+
+
+def _create_cache() -> SharedCache:
+    return SharedCache(
+        Config.SHARED_CACHE_PATH,
+        max_entries=Config.SHARED_CACHE_MAX_ENTRIES,
+        lease_timeout=Config.SHARED_CACHE_LEASE_TIMEOUT
+    )
+
+
+# Instance dùng chung, mở file cache ở lần dùng đầu tiên
+cache = LazyProxy(_create_cache)
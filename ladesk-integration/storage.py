@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Storage Backend
+Interface lưu trữ mapping, webhook log, timing và thống kê, cùng factory
+chọn backend theo cấu hình (STORAGE_BACKEND):
+
+- sqlite: SimpleDatabaseManager (database_simple.py), một file DB_PATH
+- memory: InMemoryStorage (storage_memory.py), cho test và benchmark
+- sharded: ShardedSQLiteStorage (storage_sharded.py), STORAGE_SHARDS file
+  SQLite chia theo hash của cloud_conversation_id
+
+Mọi backend phải qua được `python storage_conformance.py`.
+"""
+
+import json
+import string
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+from config import Config
+
+if TYPE_CHECKING:  # records.py import MAPPING_FIELDS/WEBHOOK_LOG_FIELDS từ module này
+    from records import Mapping, WebhookLog
+
+# Các cột update_mapping được phép cập nhật
+MAPPING_UPDATE_FIELDS = (
+    'onpremise_ticket_id', 'onpremise_contact_id', 'customer_name', 'customer_email',
+    'last_agent_reply', 'last_agent_name', 'last_reply_time'
+)
+
+# Các trường mapping trả về từ các hàm get_mapping_*
+MAPPING_FIELDS = (
+    'id', 'cloud_conversation_id', 'onpremise_ticket_id', 'onpremise_contact_id',
+    'customer_name', 'customer_email', 'created_at', 'updated_at'
+)
+
+# Các trường webhook log trả về từ get_webhook_logs
+WEBHOOK_LOG_FIELDS = (
+    'id', 'webhook_type', 'conversation_id', 'ticket_id', 'contact_id',
+    'event_type', 'raw_data', 'processed_data', 'status', 'error_message', 'created_at'
+)
+
+# Bộ lọc của query_mappings / query_webhook_logs: tên tham số -> cột (so sánh bằng)
+MAPPING_QUERY_FILTERS = {
+    'conversation_id': 'cloud_conversation_id',
+    'ticket_id': 'onpremise_ticket_id',
+    'email': 'customer_email',
+}
+# Bộ lọc theo prefix của query_mappings: tên tham số -> cột (không phân biệt hoa thường ASCII)
+MAPPING_PREFIX_FILTERS = {
+    'ticket_prefix': 'onpremise_ticket_id',
+}
+# Cột VIRTUAL của webhook_logs sinh từ raw_data bằng JSON1 (schema version 4): trường payload -> cột.
+# Prefix payload_ vì webhook_logs.status là trạng thái xử lý, không phải status của conversation
+WEBHOOK_PAYLOAD_COLUMNS = {
+    'agent_id': 'payload_agent_id',
+    'channel_type': 'payload_channel_type',
+    'status': 'payload_status',
+    'message_type': 'payload_message_type',
+    'customer_email': 'payload_customer_email',
+    'subject': 'payload_subject',
+}
+# Cột payload nằm trong bộ lọc dưới đây đều có index
+WEBHOOK_LOG_QUERY_FILTERS = {
+    'conversation_id': 'conversation_id',
+    'ticket_id': 'ticket_id',
+    'webhook_type': 'webhook_type',
+    'status': 'status',
+    'agent_id': 'payload_agent_id',
+    'channel_type': 'payload_channel_type',
+    'conversation_status': 'payload_status',
+    'message_type': 'payload_message_type',
+    'customer_email': 'payload_customer_email',
+}
+# Cột count_webhook_logs nhóm được: các bộ lọc cùng event_type và subject (không có index,
+# chỉ đọc các dòng đã qua bộ lọc)
+WEBHOOK_LOG_GROUP_COLUMNS = {
+    **WEBHOOK_LOG_QUERY_FILTERS,
+    'event_type': 'event_type',
+    'subject': 'payload_subject',
+}
+
+# Số dòng tối đa một trang của query_*
+MAX_PAGE_SIZE = 500
+
+# Dữ liệu scan() được: tên -> (bảng SQLite, các trường trả về)
+SCAN_KINDS = {
+    'mappings': ('conversation_mappings', MAPPING_FIELDS),
+    'webhook_logs': ('webhook_logs', WEBHOOK_LOG_FIELDS),
+}
+
+# Một trang kết quả: (các dòng theo id giảm dần, before_id của trang sau hoặc None nếu hết)
+Page = Tuple[List[Dict], Optional[int]]
+
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def ticket_prefix_range(prefix: str) -> Tuple[str, str]:
+    """Khoảng [low, high) theo collation NOCASE của các ticket_id bắt đầu bằng prefix
+
+    NOCASE của SQLite so sánh sau khi đổi chữ hoa ASCII thành chữ thường, nên
+    prefix được đổi theo đúng quy tắc đó trước khi tăng ký tự cuối (QQZ -> [qqz, qq{)).
+    ValueError nếu prefix rỗng.
+    """
+    if not prefix:
+        raise ValueError("ticket prefix must not be empty")
+    low = prefix.translate(_ASCII_LOWER)
+    return low, low[:-1] + chr(ord(low[-1]) + 1)
+
+
+def payload_columns(data: Dict) -> Dict:
+    """Giá trị các cột WEBHOOK_PAYLOAD_COLUMNS như json_extract của SQLite trả về cho json.dumps(data)"""
+    columns = {}
+    for field, column in WEBHOOK_PAYLOAD_COLUMNS.items():
+        value = data.get(field)
+        if isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value, separators=(',', ':'))
+        columns[column] = value
+    return columns
+
+
+def matches_ticket_prefix(ticket_id: Optional[str], prefix: str) -> bool:
+    """So khớp giống ticket_prefix_range (cho backend không phải SQLite)"""
+    return bool(ticket_id) and ticket_id.translate(_ASCII_LOWER).startswith(prefix.translate(_ASCII_LOWER))
+
+
+class StorageBackend(ABC):
+    """Các thao tác lưu trữ mà app, webhook_timing và các tool sử dụng
+
+    Quy ước chung (giống SimpleDatabaseManager): lỗi không raise ra ngoài mà
+    được log, hàm ghi trả về False/None, hàm đọc trả về None/[]/{}.
+    Thời gian created_at/updated_at là chuỗi UTC 'YYYY-MM-DD HH:MM:SS'.
+    Hàm get_* trả về record Mapping/WebhookLog (records.py), query_* và scan() trả về dict.
+    """
+
+    def ensure_schema(self) -> bool:
+        """Chuẩn bị schema nếu cần, trả về True nếu có thay đổi"""
+        return False
+
+    # Mappings
+    @abstractmethod
+    def create_mapping(self, cloud_conversation_id: str, onpremise_ticket_id: str,
+                       onpremise_contact_id: str, customer_name: str = None,
+                       customer_email: str = None) -> bool:
+        """Tạo mapping mới (False nếu thiếu trường bắt buộc hoặc lỗi)"""
+
+    @abstractmethod
+    def get_mapping_by_conversation(self, cloud_conversation_id: str) -> Optional['Mapping']:
+        """Mapping mới nhất của conversation"""
+
+    @abstractmethod
+    def get_mapping_by_ticket(self, onpremise_ticket_id: str) -> Optional['Mapping']:
+        """Mapping theo ticket_id On-Premise"""
+
+    @abstractmethod
+    def get_mapping_by_email(self, customer_email: str) -> Optional['Mapping']:
+        """Mapping mới nhất theo email khách hàng"""
+
+    @abstractmethod
+    def get_mapping_by_ticket_pattern(self, ticket_pattern: str) -> Optional['Mapping']:
+        """Mapping mới nhất có ticket_id khớp pattern LIKE (ví dụ: QQX-DGGBS-%)"""
+
+    @abstractmethod
+    def get_mapping_by_ticket_prefix(self, prefix: str) -> Optional['Mapping']:
+        """Mapping mới nhất có ticket_id bắt đầu bằng prefix (không phân biệt hoa thường,
+        % và _ là ký tự thường); None nếu prefix rỗng"""
+
+    @abstractmethod
+    def get_all_mappings(self, limit: int = 100) -> List['Mapping']:
+        """Các mapping mới nhất (có giới hạn)"""
+
+    @abstractmethod
+    def query_mappings(self, limit: int = 50, before_id: int = None, since: str = None,
+                       until: str = None, **filters) -> Page:
+        """Keyset pagination theo id (mới nhất trước), lọc theo MAPPING_QUERY_FILTERS,
+        MAPPING_PREFIX_FILTERS (ticket_prefix) và created_at trong [since, until)"""
+
+    @abstractmethod
+    def update_mapping(self, cloud_conversation_id: str, **kwargs) -> bool:
+        """Cập nhật các trường trong MAPPING_UPDATE_FIELDS, False nếu không có mapping nào"""
+
+    @abstractmethod
+    def delete_mapping(self, cloud_conversation_id: str) -> bool:
+        """Xóa mọi mapping của conversation, False nếu không có"""
+
+    @abstractmethod
+    def update_ticket_status(self, ticket_id: str, status: str) -> bool:
+        """Đánh dấu ticket vừa được cập nhật (updated_at)"""
+
+    # Webhook logs
+    @abstractmethod
+    def log_webhook(self, webhook_type: str, data: Dict, status: str = 'received',
+                    error_message: str = None) -> Optional[int]:
+        """Ghi webhook, trả về id (dùng cho save_webhook_timings)"""
+
+    @abstractmethod
+    def get_webhook_logs(self, limit: int = 50) -> List['WebhookLog']:
+        """Các webhook log mới nhất"""
+
+    @abstractmethod
+    def query_webhook_logs(self, limit: int = 50, before_id: int = None, since: str = None,
+                           until: str = None, **filters) -> Page:
+        """Như query_mappings, lọc theo WEBHOOK_LOG_QUERY_FILTERS"""
+
+    @abstractmethod
+    def count_webhook_logs(self, group_by: str, since: str = None, until: str = None,
+                           **filters) -> Dict[Optional[str], int]:
+        """Số webhook log theo từng giá trị của cột group_by (WEBHOOK_LOG_GROUP_COLUMNS),
+        lọc như query_webhook_logs; dòng không có giá trị được đếm ở key None"""
+
+    @abstractmethod
+    def scan(self, kind: str, after_id: int = None, batch_size: int = 1000) -> Iterator[List[Dict]]:
+        """Duyệt toàn bộ dữ liệu kind (SCAN_KINDS) theo id tăng dần, mỗi lần một lô;
+        after_id để tiếp tục từ id cuối đã đọc"""
+
+    # Timings
+    @abstractmethod
+    def save_webhook_timings(self, webhook_log_id: Optional[int], webhook_type: str, outcome: str,
+                             stages: Dict[str, float], total: float) -> bool:
+        """Lưu thời gian từng stage (giây) của một webhook, kèm stage 'total'"""
+
+    @abstractmethod
+    def get_slowest_webhooks(self, limit: int = 10, window_minutes: int = 60,
+                             webhook_type: str = None) -> List[Dict]:
+        """N webhook chậm nhất trong khoảng thời gian gần đây, kèm breakdown theo stage"""
+
+    @abstractmethod
+    def get_stage_durations(self, window_minutes: int = 60, webhook_type: str = None) -> Dict[str, List[float]]:
+        """Danh sách duration (ms) theo stage trong khoảng thời gian gần đây"""
+
+    # Stats
+    @abstractmethod
+    def get_stats(self) -> Dict:
+        """total_mappings, today_mappings, total_logs, today_logs"""
+
+
+def create_storage(config=None) -> StorageBackend:
+    """Tạo backend theo config.STORAGE_BACKEND"""
+    config = config or Config
+    backend = config.STORAGE_BACKEND.lower()
+
+    if backend == 'sqlite':
+        from database_simple import SimpleDatabaseManager
+        return SimpleDatabaseManager(config.DB_PATH)
+    if backend == 'memory':
+        from storage_memory import InMemoryStorage
+        return InMemoryStorage()
+    if backend == 'sharded':
+        from storage_sharded import ShardedSQLiteStorage
+        return ShardedSQLiteStorage(config.DB_PATH, config.STORAGE_SHARDS)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {config.STORAGE_BACKEND}")
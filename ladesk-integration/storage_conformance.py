@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Storage Conformance
+Chạy cùng một bộ kiểm tra hành vi trên mọi backend trong storage.py, mỗi
+kiểm tra dùng một storage mới (SQLite/sharded trong thư mục tạm)
+
+    python storage_conformance.py                 # tất cả backend
+    python storage_conformance.py -b memory -v    # một backend, in lỗi chi tiết
+
+Exit code 1 nếu có backend không đạt. Backend mới phải được thêm vào BACKENDS.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+
+import json
+import time
+import argparse
+import logging
+import tempfile
+import traceback
+from typing import Callable, Dict, List
+
+from storage import StorageBackend, MAPPING_FIELDS, WEBHOOK_LOG_FIELDS
+from records import Mapping, WebhookLog
+
+CHECKS: List[Callable] = []
+
+
+def check(func: Callable) -> Callable:
+    """Đăng ký một kiểm tra (nhận storage mới, assert khi sai)"""
+    CHECKS.append(func)
+    return func
+
+
+def _sqlite(workdir: str) -> StorageBackend:
+    from database_simple import SimpleDatabaseManager
+    return SimpleDatabaseManager(os.path.join(workdir, 'conformance.db'), auto_migrate=True)
+
+
+def _memory(workdir: str) -> StorageBackend:
+    from storage_memory import InMemoryStorage
+    return InMemoryStorage()
+
+
+def _sharded(workdir: str) -> StorageBackend:
+    from storage_sharded import ShardedSQLiteStorage
+    return ShardedSQLiteStorage(os.path.join(workdir, 'conformance.db'), shards=3)
+
+
+BACKENDS: Dict[str, Callable[[str], StorageBackend]] = {
+    'sqlite': _sqlite,
+    'memory': _memory,
+    'sharded': _sharded,
+}
+
+
+def _create(storage, conversation_id: str, ticket_id: str, email: str = None, contact_id: str = 'contact-1'):
+    return storage.create_mapping(conversation_id, ticket_id, contact_id,
+                                  f"Customer {conversation_id}", email or f"{conversation_id}@example.com")
+
+
+@check
+def implements_interface(storage):
+    assert isinstance(storage, StorageBackend)
+
+
+@check
+def create_and_get_by_conversation(storage):
+    assert _create(storage, 'conv-1', 'QQX-AAAAA-001') is True
+    mapping = storage.get_mapping_by_conversation('conv-1')
+    assert mapping is not None
+    assert set(mapping) == set(MAPPING_FIELDS), sorted(mapping)
+    assert mapping['cloud_conversation_id'] == 'conv-1'
+    assert mapping['onpremise_ticket_id'] == 'QQX-AAAAA-001'
+    assert mapping['onpremise_contact_id'] == 'contact-1'
+    assert mapping['customer_name'] == 'Customer conv-1'
+    assert mapping['customer_email'] == 'conv-1@example.com'
+    assert mapping['created_at'] and mapping['updated_at']
+    assert mapping.onpremise_ticket_id == 'QQX-AAAAA-001' and mapping.get('missing') is None
+    assert storage.get_mapping_by_conversation('missing') is None
+
+
+@check
+def missing_required_fields_rejected(storage):
+    assert storage.create_mapping('conv-1', 'QQX-AAAAA-001', None, 'A', 'a@example.com') is False
+    assert storage.create_mapping('conv-2', 'QQX-AAAAA-002', 'contact-1', 'A', None) is False
+    assert storage.get_mapping_by_conversation('conv-1') is None
+    assert storage.get_all_mappings() == []
+
+
+@check
+def latest_mapping_wins(storage):
+    _create(storage, 'conv-1', 'QQX-AAAAA-001', email='same@example.com')
+    time.sleep(1.1)  # created_at có độ chính xác giây
+    _create(storage, 'conv-1', 'QQX-AAAAA-002', email='same@example.com')
+    assert storage.get_mapping_by_conversation('conv-1')['onpremise_ticket_id'] == 'QQX-AAAAA-002'
+    assert storage.get_mapping_by_email('same@example.com')['onpremise_ticket_id'] == 'QQX-AAAAA-002'
+    assert storage.get_mapping_by_ticket_pattern('QQX-AAAAA-%')['onpremise_ticket_id'] == 'QQX-AAAAA-002'
+    assert storage.get_all_mappings()[0]['onpremise_ticket_id'] == 'QQX-AAAAA-002'
+
+
+@check
+def lookups_by_ticket_email_and_pattern(storage):
+    for i in range(10):
+        _create(storage, f'conv-{i}', f'QQX-BBBBB-{i:03d}')
+    assert storage.get_mapping_by_ticket('QQX-BBBBB-007')['cloud_conversation_id'] == 'conv-7'
+    assert storage.get_mapping_by_ticket('QQX-NOPE') is None
+    assert storage.get_mapping_by_email('conv-3@example.com')['onpremise_ticket_id'] == 'QQX-BBBBB-003'
+    assert storage.get_mapping_by_email('nobody@example.com') is None
+    assert storage.get_mapping_by_ticket_pattern('QQX-BBBBB-00_')['onpremise_ticket_id'].startswith('QQX-BBBBB-00')
+    assert storage.get_mapping_by_ticket_pattern('qqx-bbbbb-005') is not None  # LIKE không phân biệt hoa thường
+    assert storage.get_mapping_by_ticket_pattern('QQX-CCCCC-%') is None
+
+
+@check
+def ticket_prefix_lookup(storage):
+    _create(storage, 'conv-old', 'QQX-DDDDD-000')
+    time.sleep(1.1)  # created_at có độ chính xác giây
+    for i in range(1, 6):
+        _create(storage, f'conv-{i}', f'QQX-DDDDD-{i:03d}')
+    _create(storage, 'conv-z', 'QQZ-AAAAA-001')
+    _create(storage, 'conv-u', 'QQX_DDDDD-001')
+    assert storage.get_mapping_by_ticket_prefix('QQX-DDDDD')['onpremise_ticket_id'] != 'QQX-DDDDD-000'
+    assert storage.get_mapping_by_ticket_prefix('QQX-DDDDD-000')['cloud_conversation_id'] == 'conv-old'
+    assert storage.get_mapping_by_ticket_prefix('qqz')['cloud_conversation_id'] == 'conv-z'  # không phân biệt hoa thường
+    assert storage.get_mapping_by_ticket_prefix('QQX_')['cloud_conversation_id'] == 'conv-u'  # _ không phải wildcard
+    assert storage.get_mapping_by_ticket_prefix('QQX-E') is None
+    assert storage.get_mapping_by_ticket_prefix('') is None
+
+    page, next_before_id = storage.query_mappings(limit=4, ticket_prefix='qqx-ddddd')
+    assert len(page) == 4 and next_before_id is not None
+    rest, last = storage.query_mappings(limit=4, ticket_prefix='qqx-ddddd', before_id=next_before_id)
+    tickets = [m['onpremise_ticket_id'] for m in page + rest]
+    assert last is None and sorted(tickets) == [f'QQX-DDDDD-{i:03d}' for i in range(6)]
+    assert storage.query_mappings(ticket_prefix='QQX-DDDDD', conversation_id='conv-3')[0][0]['id'] == \
+        storage.get_mapping_by_conversation('conv-3')['id']
+
+
+@check
+def ids_are_unique(storage):
+    for i in range(20):
+        _create(storage, f'conv-{i}', f'QQX-CCCCC-{i:03d}')
+    ids = [m['id'] for m in storage.get_all_mappings(100)]
+    assert len(ids) == 20 and len(set(ids)) == 20
+
+
+@check
+def get_all_mappings_respects_limit(storage):
+    for i in range(15):
+        _create(storage, f'conv-{i}', f'QQX-DDDDD-{i:03d}')
+    assert len(storage.get_all_mappings(5)) == 5
+    assert len(storage.get_all_mappings()) == 15
+    assert all(isinstance(m, Mapping) and set(m) == set(MAPPING_FIELDS) for m in storage.get_all_mappings())
+
+
+@check
+def update_mapping(storage):
+    _create(storage, 'conv-1', 'QQX-EEEEE-001')
+    assert storage.update_mapping('conv-1', last_agent_reply='Hi', last_agent_name='Keith',
+                                  last_reply_time='2024-01-01T00:00:00') is True
+    assert storage.update_mapping('conv-1', onpremise_ticket_id='QQX-EEEEE-999', customer_email='new@example.com') is True
+    assert storage.get_mapping_by_ticket('QQX-EEEEE-999')['cloud_conversation_id'] == 'conv-1'
+    assert storage.get_mapping_by_ticket('QQX-EEEEE-001') is None
+    assert storage.get_mapping_by_email('new@example.com')['cloud_conversation_id'] == 'conv-1'
+    assert storage.update_mapping('conv-1', not_a_column='x') is False
+    assert storage.update_mapping('missing', customer_name='x') is False
+
+
+@check
+def delete_mapping(storage):
+    _create(storage, 'conv-1', 'QQX-FFFFF-001')
+    _create(storage, 'conv-2', 'QQX-FFFFF-002')
+    assert storage.delete_mapping('conv-1') is True
+    assert storage.delete_mapping('conv-1') is False
+    assert storage.get_mapping_by_conversation('conv-1') is None
+    assert storage.get_mapping_by_ticket('QQX-FFFFF-001') is None
+    assert storage.get_mapping_by_conversation('conv-2') is not None
+
+
+@check
+def update_ticket_status(storage):
+    _create(storage, 'conv-1', 'QQX-GGGGG-001')
+    assert storage.update_ticket_status('QQX-GGGGG-001', 'resolved') is True
+    assert storage.update_ticket_status('QQX-NOPE', 'resolved') is True
+
+
+@check
+def webhook_logs(storage):
+    payloads = [{'conversation_id': f'conv-{i}', 'ticket_id': f'T-{i}', 'event_type': 'message_added', 'message': 'xin chào'}
+                for i in range(5)]
+    payloads.append({'event_type': 'ping'})  # không có conversation/ticket
+    ids = [storage.log_webhook('cloud_incoming', payload) for payload in payloads]
+    assert all(isinstance(i, int) for i in ids) and len(set(ids)) == len(ids)
+
+    logs = storage.get_webhook_logs(50)
+    assert len(logs) == len(payloads)
+    assert all(isinstance(log, WebhookLog) and set(log) == set(WEBHOOK_LOG_FIELDS) for log in logs)
+    by_id = {log['id']: log for log in logs}
+    first = by_id[ids[0]]
+    assert first['webhook_type'] == 'cloud_incoming' and first['status'] == 'received'
+    assert first['conversation_id'] == 'conv-0' and first['ticket_id'] == 'T-0'
+    assert json.loads(first['raw_data']) == payloads[0]
+    assert len(storage.get_webhook_logs(2)) == 2
+
+
+@check
+def webhook_timings(storage):
+    log_id = storage.log_webhook('onpremise_incoming', {'conversation_id': 'conv-slow', 'ticket_id': 'T-1'})
+    assert storage.save_webhook_timings(log_id, 'onpremise_incoming', 'success',
+                                        {'parse': 0.001, 'upstream.cloud.send_reply': 0.5}, 0.6) is True
+    other_id = storage.log_webhook('cloud_incoming', {'conversation_id': 'conv-fast'})
+    storage.save_webhook_timings(other_id, 'cloud_incoming', 'skipped_non_customer_message', {'parse': 0.001}, 0.01)
+    storage.save_webhook_timings(None, 'cloud_incoming', 'error', {}, 0.02)
+
+    slowest = storage.get_slowest_webhooks(limit=10, window_minutes=60)
+    assert [round(w['total_ms']) for w in slowest] == [600, 20, 10]
+    top = slowest[0]
+    assert top['webhook_log_id'] == log_id and top['conversation_id'] == 'conv-slow' and top['ticket_id'] == 'T-1'
+    assert top['outcome'] == 'success'
+    assert list(top['stages']) == ['upstream.cloud.send_reply', 'parse']
+    assert round(top['stages']['upstream.cloud.send_reply']) == 500
+    assert slowest[2]['webhook_log_id'] == other_id
+
+    only_cloud = storage.get_slowest_webhooks(limit=10, window_minutes=60, webhook_type='cloud_incoming')
+    assert len(only_cloud) == 2
+    assert len(storage.get_slowest_webhooks(limit=1)) == 1
+
+    durations = storage.get_stage_durations(window_minutes=60)
+    assert sorted(durations) == ['parse', 'total', 'upstream.cloud.send_reply']
+    assert len(durations['total']) == 3 and len(durations['parse']) == 2
+    assert len(storage.get_stage_durations(60, 'onpremise_incoming')['total']) == 1
+
+
+def _all_pages(query, limit: int, **filters) -> list:
+    items, before_id = query(limit=limit, **filters)
+    pages = [items]
+    while before_id is not None:
+        items, before_id = query(limit=limit, before_id=before_id, **filters)
+        pages.append(items)
+    return pages
+
+
+@check
+def query_mappings_pagination(storage):
+    for i in range(23):
+        _create(storage, f'conv-{i % 5}', f'QQX-IIIII-{i:03d}', email=f'user{i % 2}@example.com')
+    pages = _all_pages(storage.query_mappings, 10)
+    assert [len(page) for page in pages] == [10, 10, 3]
+    ids = [m['id'] for page in pages for m in page]
+    assert ids == sorted(ids, reverse=True) and len(set(ids)) == 23
+    assert all(set(m) == set(MAPPING_FIELDS) for page in pages for m in page)
+
+    by_conversation = [m for page in _all_pages(storage.query_mappings, 2, conversation_id='conv-3') for m in page]
+    assert sorted(m['onpremise_ticket_id'] for m in by_conversation) == ['QQX-IIIII-003', 'QQX-IIIII-008',
+                                                                         'QQX-IIIII-013', 'QQX-IIIII-018']
+    items, before_id = storage.query_mappings(limit=5, ticket_id='QQX-IIIII-007')
+    assert [m['cloud_conversation_id'] for m in items] == ['conv-2'] and before_id is None
+    assert len(storage.query_mappings(limit=50, email='user1@example.com')[0]) == 11
+    assert storage.query_mappings(limit=50, since='2000-01-01 00:00:00', until='2000-01-02 00:00:00') == ([], None)
+    assert len(storage.query_mappings(limit=50, since='2000-01-01 00:00:00')[0]) == 23
+
+
+@check
+def query_webhook_logs_pagination(storage):
+    ids = [storage.log_webhook('cloud_incoming' if i % 2 else 'onpremise_incoming',
+                               {'conversation_id': f'conv-{i % 4}', 'ticket_id': f'T-{i}'},
+                               status='error' if i % 3 == 0 else 'received') for i in range(17)]
+    pages = _all_pages(storage.query_webhook_logs, 4)
+    assert [len(page) for page in pages] == [4, 4, 4, 4, 1]
+    found = [log['id'] for page in pages for log in page]
+    assert found == sorted(ids, reverse=True)
+    assert all(set(log) == set(WEBHOOK_LOG_FIELDS) for page in pages for log in page)
+
+    errors = [log for page in _all_pages(storage.query_webhook_logs, 2, status='error') for log in page]
+    assert len(errors) == 6 and all(log['status'] == 'error' for log in errors)
+    cloud_conv1 = storage.query_webhook_logs(limit=50, conversation_id='conv-1', webhook_type='cloud_incoming')[0]
+    assert sorted(log['ticket_id'] for log in cloud_conv1) == ['T-1', 'T-13', 'T-5', 'T-9']
+    assert storage.query_webhook_logs(limit=50, ticket_id='T-16')[0][0]['conversation_id'] == 'conv-0'
+    assert storage.query_webhook_logs(limit=50, until='2000-01-01 00:00:00') == ([], None)
+
+
+@check
+def webhook_payload_filters_and_counts(storage):
+    for i in range(12):
+        storage.log_webhook('cloud_incoming', {
+            'conversation_id': f'conv-{i % 3}', 'agent_id': f'agent-{i % 2}', 'channel_type': 'E' if i % 4 else 'A',
+            'status': 'C' if i < 8 else 'R', 'message_type': 'M', 'customer_email': f'user{i % 3}@example.com',
+            'subject': 'Đơn hàng',
+        }, status='error' if i % 3 == 0 else 'received')
+    storage.log_webhook('onpremise_incoming', {'conversation_id': 'conv-x', 'ticket_id': 'T-1'})
+
+    by_agent = [log for page in _all_pages(storage.query_webhook_logs, 2, agent_id='agent-1') for log in page]
+    assert len(by_agent) == 6 and all(json.loads(log['raw_data'])['agent_id'] == 'agent-1' for log in by_agent)
+    assert all(set(log) == set(WEBHOOK_LOG_FIELDS) for log in by_agent)
+    resolved = storage.query_webhook_logs(limit=50, conversation_status='R', channel_type='E')[0]
+    assert sorted(json.loads(log['raw_data'])['conversation_id'] for log in resolved) == ['conv-0', 'conv-1', 'conv-2']
+    assert len(storage.query_webhook_logs(limit=50, customer_email='user0@example.com', status='error')[0]) == 4
+    assert storage.query_webhook_logs(limit=50, message_type='X') == ([], None)
+
+    assert storage.count_webhook_logs('agent_id') == {'agent-0': 6, 'agent-1': 6, None: 1}
+    assert storage.count_webhook_logs('agent_id', status='error') == {'agent-0': 2, 'agent-1': 2}
+    assert storage.count_webhook_logs('subject', webhook_type='cloud_incoming') == {'Đơn hàng': 12}
+    assert storage.count_webhook_logs('conversation_status', agent_id='agent-1', channel_type='A') == {}
+    assert storage.count_webhook_logs('channel_type', until='2000-01-01 00:00:00') == {}
+
+
+@check
+def scan_in_batches_and_resume(storage):
+    for i in range(11):
+        _create(storage, f'conv-{i}', f'QQX-JJJJJ-{i:03d}')
+        storage.log_webhook('cloud_incoming', {'conversation_id': f'conv-{i}'})
+    batches = list(storage.scan('mappings', batch_size=4))
+    assert [len(batch) for batch in batches] == [4, 4, 3]
+    ids = [m['id'] for batch in batches for m in batch]
+    assert ids == sorted(ids) and len(set(ids)) == 11
+    assert all(set(m) == set(MAPPING_FIELDS) for batch in batches for m in batch)
+
+    resumed = [m['id'] for batch in storage.scan('mappings', after_id=ids[5], batch_size=4) for m in batch]
+    assert resumed == ids[6:]
+    assert list(storage.scan('mappings', after_id=ids[-1])) == []
+
+    logs = [log for batch in storage.scan('webhook_logs', batch_size=5) for log in batch]
+    assert len(logs) == 11 and all(set(log) == set(WEBHOOK_LOG_FIELDS) for log in logs)
+
+
+@check
+def stats(storage):
+    for i in range(3):
+        _create(storage, f'conv-{i}', f'QQX-HHHHH-{i:03d}')
+    for i in range(4):
+        storage.log_webhook('cloud_incoming', {'conversation_id': f'conv-{i}'})
+    assert storage.get_stats() == {'total_mappings': 3, 'today_mappings': 3, 'total_logs': 4, 'today_logs': 4}
+
+
+def run_backend(name: str, factory: Callable[[str], StorageBackend], verbose: bool) -> int:
+    """Chạy mọi check trên backend, trả về số check lỗi"""
+    failures = 0
+    for func in CHECKS:
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                func(factory(workdir))
+                print(f"  ✅ {name:<8} {func.__name__}")
+            except Exception as e:
+                failures += 1
+                print(f"  ❌ {name:<8} {func.__name__}: {type(e).__name__} {e}")
+                if verbose:
+                    traceback.print_exc()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kiểm tra các storage backend có cùng hành vi")
+    parser.add_argument('--backend', '-b', choices=sorted(BACKENDS), action='append',
+                        help='Backend cần kiểm tra (mặc định: tất cả)')
+    parser.add_argument('--verbose', '-v', action='store_true', help='In traceback khi lỗi')
+    args = parser.parse_args()
+
+    # Log của backend (Created mapping, ...) không cần thiết ở đây
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    total_failures = 0
+    for name in args.backend or BACKENDS:
+        total_failures += run_backend(name, BACKENDS[name], args.verbose)
+
+    print("-" * 60)
+    if total_failures:
+        print(f"❌ {total_failures} check(s) failed")
+        sys.exit(1)
+    print(f"✅ All backends passed {len(CHECKS)} checks")
+
+
+if __name__ == '__main__':
+    main()
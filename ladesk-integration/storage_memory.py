@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+In-Memory Storage
+Backend lưu mọi thứ trong dict/list của process, cùng hành vi với
+SimpleDatabaseManager (xem storage_conformance.py) nhưng không có I/O.
+Dùng cho test và benchmark; dữ liệu mất khi process kết thúc.
+"""
+
+import re
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+from metrics import track_db
+from records import Mapping, WebhookLog
+from storage import (StorageBackend, Page, MAPPING_FIELDS, MAPPING_UPDATE_FIELDS, WEBHOOK_LOG_FIELDS,
+                     MAPPING_QUERY_FILTERS, MAPPING_PREFIX_FILTERS, WEBHOOK_LOG_QUERY_FILTERS,
+                     WEBHOOK_LOG_GROUP_COLUMNS, SCAN_KINDS, matches_ticket_prefix, payload_columns)
+
+logger = logging.getLogger(__name__)
+
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _now() -> str:
+    """Giống CURRENT_TIMESTAMP của SQLite (UTC, độ chính xác giây)"""
+    return datetime.utcnow().strftime(_TIMESTAMP_FORMAT)
+
+
+def _since(window_minutes: int) -> str:
+    return (datetime.utcnow() - timedelta(minutes=int(window_minutes))).strftime(_TIMESTAMP_FORMAT)
+
+
+def like_to_regex(pattern: str):
+    """Pattern LIKE của SQLite (% và _, không phân biệt hoa thường ASCII) sang regex"""
+    parts = []
+    for char in pattern:
+        if char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+
+def _matching(records: Dict[int, Dict], columns: Dict[str, str], before_id: int, since: str, until: str,
+              filters: Dict, prefix_columns: Dict[str, str] = None) -> Iterator[Dict]:
+    """Các record qua bộ lọc như SimpleDatabaseManager._where, id giảm dần"""
+    prefix_columns = prefix_columns or {}
+    active = {name: value for name, value in filters.items() if value is not None}
+    if any(name in prefix_columns and not value for name, value in active.items()):
+        return  # prefix rỗng: SQLite trả về trang rỗng (ValueError được log)
+    conditions = [(columns[name], value) for name, value in active.items() if name not in prefix_columns]
+    prefixes = [(prefix_columns[name], value) for name, value in active.items() if name in prefix_columns]
+    for record_id in reversed(records):  # id tăng dần theo thứ tự chèn
+        if before_id is not None and record_id >= before_id:
+            continue
+        record = records[record_id]
+        if since and record['created_at'] < since or until and record['created_at'] >= until:
+            continue
+        if (all(record[column] == value for column, value in conditions) and
+                all(matches_ticket_prefix(record[column], value) for column, value in prefixes)):
+            yield record
+
+
+def _page(records: Dict[int, Dict], fields: tuple, columns: Dict[str, str], limit: int,
+          before_id: int, since: str, until: str, filters: Dict, prefix_columns: Dict[str, str] = None) -> Page:
+    """Keyset giống SimpleDatabaseManager._query_page trên dict id -> record"""
+    items = []
+    for record in _matching(records, columns, before_id, since, until, filters, prefix_columns):
+        if len(items) == limit:
+            return items, items[-1]['id']
+        items.append({field: record[field] for field in fields})
+    return items, None
+
+
+class InMemoryStorage(StorageBackend):
+    """Storage trong bộ nhớ, thread-safe"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._mappings: Dict[int, Dict] = {}
+        self._by_conversation: Dict[str, List[int]] = {}
+        self._by_ticket: Dict[str, List[int]] = {}
+        self._by_email: Dict[str, List[int]] = {}
+        self._logs: Dict[int, Dict] = {}
+        self._timings: List[Dict] = []
+        self._next_mapping_id = 1
+        self._next_log_id = 1
+
+    @staticmethod
+    def _public(record: Dict) -> Mapping:
+        return Mapping(*[record[field] for field in MAPPING_FIELDS])
+
+    def _latest(self, ids: List[int]) -> Optional[Mapping]:
+        """Mapping mới nhất trong danh sách id (created_at, rồi thứ tự chèn)"""
+        if not ids:
+            return None
+        record = max((self._mappings[i] for i in ids), key=lambda r: (r['created_at'], r['id']))
+        return self._public(record)
+
+    @staticmethod
+    def _index_add(index: Dict[str, List[int]], key, mapping_id: int):
+        if key is not None:
+            index.setdefault(key, []).append(mapping_id)
+
+    @staticmethod
+    def _index_remove(index: Dict[str, List[int]], key, mapping_id: int):
+        ids = index.get(key)
+        if ids and mapping_id in ids:
+            ids.remove(mapping_id)
+            if not ids:
+                del index[key]
+
+    @track_db
+    def create_mapping(self, cloud_conversation_id: str, onpremise_ticket_id: str,
+                       onpremise_contact_id: str, customer_name: str = None,
+                       customer_email: str = None) -> bool:
+        """Tạo mapping mới: 1 conversation = 1 mapping"""
+        # Cùng ràng buộc NOT NULL với bảng conversation_mappings
+        if None in (cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id, customer_email):
+            logger.warning("⚠️ Mapping already exists for conversation: %s", cloud_conversation_id)
+            return False
+
+        with self._lock:
+            mapping_id = self._next_mapping_id
+            self._next_mapping_id += 1
+            now = _now()
+            self._mappings[mapping_id] = {
+                'id': mapping_id,
+                'cloud_conversation_id': cloud_conversation_id,
+                'onpremise_ticket_id': onpremise_ticket_id,
+                'onpremise_contact_id': onpremise_contact_id,
+                'customer_name': customer_name,
+                'customer_email': customer_email,
+                'last_agent_reply': None,
+                'last_agent_name': None,
+                'last_reply_time': None,
+                'created_at': now,
+                'updated_at': now
+            }
+            self._index_add(self._by_conversation, cloud_conversation_id, mapping_id)
+            self._index_add(self._by_ticket, onpremise_ticket_id, mapping_id)
+            self._index_add(self._by_email, customer_email, mapping_id)
+
+        logger.info("✅ Created mapping: %s -> %s", cloud_conversation_id, onpremise_ticket_id)
+        return True
+
+    @track_db
+    def get_mapping_by_conversation(self, cloud_conversation_id: str) -> Optional[Mapping]:
+        """Lấy mapping theo conversation_id (ticket gần nhất)"""
+        with self._lock:
+            return self._latest(self._by_conversation.get(cloud_conversation_id, []))
+
+    @track_db
+    def get_mapping_by_ticket(self, onpremise_ticket_id: str) -> Optional[Mapping]:
+        """Lấy mapping theo ticket_id"""
+        with self._lock:
+            ids = self._by_ticket.get(onpremise_ticket_id)
+            return self._public(self._mappings[min(ids)]) if ids else None
+
+    @track_db
+    def get_mapping_by_email(self, customer_email: str) -> Optional[Mapping]:
+        """Lấy mapping theo email"""
+        with self._lock:
+            return self._latest(self._by_email.get(customer_email, []))
+
+    @track_db
+    def get_mapping_by_ticket_pattern(self, ticket_pattern: str) -> Optional[Mapping]:
+        """Lấy mapping theo pattern của ticket ID (ví dụ: QQX-DGGBS-%)"""
+        regex = like_to_regex(ticket_pattern)
+        with self._lock:
+            ids = [i for ticket_id, ticket_ids in self._by_ticket.items()
+                   if regex.fullmatch(ticket_id) for i in ticket_ids]
+            return self._latest(ids)
+
+    @track_db
+    def get_mapping_by_ticket_prefix(self, prefix: str) -> Optional[Mapping]:
+        """Lấy mapping mới nhất có ticket ID bắt đầu bằng prefix"""
+        if not prefix:
+            return None
+        with self._lock:
+            ids = [i for ticket_id, ticket_ids in self._by_ticket.items()
+                   if matches_ticket_prefix(ticket_id, prefix) for i in ticket_ids]
+            return self._latest(ids)
+
+    @track_db
+    def get_all_mappings(self, limit: int = 100) -> List[Mapping]:
+        """Lấy tất cả mappings (có giới hạn)"""
+        with self._lock:
+            records = sorted(self._mappings.values(), key=lambda r: (r['created_at'], r['id']), reverse=True)
+            return [self._public(r) for r in records[:limit]]
+
+    @track_db
+    def query_mappings(self, limit: int = 50, before_id: int = None, since: str = None,
+                       until: str = None, **filters) -> Page:
+        """Phân trang mapping theo id"""
+        with self._lock:
+            return _page(self._mappings, MAPPING_FIELDS, MAPPING_QUERY_FILTERS, limit, before_id, since, until, filters,
+                         MAPPING_PREFIX_FILTERS)
+
+    @track_db
+    def update_mapping(self, cloud_conversation_id: str, **kwargs) -> bool:
+        """Cập nhật mapping"""
+        updates = {key: value for key, value in kwargs.items() if key in MAPPING_UPDATE_FIELDS}
+        if not updates:
+            return False
+
+        with self._lock:
+            ids = list(self._by_conversation.get(cloud_conversation_id, []))
+            now = _now()
+            for mapping_id in ids:
+                record = self._mappings[mapping_id]
+                if 'onpremise_ticket_id' in updates:
+                    self._index_remove(self._by_ticket, record['onpremise_ticket_id'], mapping_id)
+                    self._index_add(self._by_ticket, updates['onpremise_ticket_id'], mapping_id)
+                if 'customer_email' in updates:
+                    self._index_remove(self._by_email, record['customer_email'], mapping_id)
+                    self._index_add(self._by_email, updates['customer_email'], mapping_id)
+                record.update(updates)
+                record['updated_at'] = now
+
+        if ids:
+            logger.info("✅ Updated mapping for conversation: %s", cloud_conversation_id)
+            return True
+        logger.warning("⚠️ No mapping found to update for conversation: %s", cloud_conversation_id)
+        return False
+
+    @track_db
+    def delete_mapping(self, cloud_conversation_id: str) -> bool:
+        """Xóa mapping"""
+        with self._lock:
+            ids = self._by_conversation.pop(cloud_conversation_id, [])
+            for mapping_id in ids:
+                record = self._mappings.pop(mapping_id)
+                self._index_remove(self._by_ticket, record['onpremise_ticket_id'], mapping_id)
+                self._index_remove(self._by_email, record['customer_email'], mapping_id)
+
+        if ids:
+            logger.info("✅ Deleted mapping for conversation: %s", cloud_conversation_id)
+            return True
+        logger.warning("⚠️ No mapping found to delete for conversation: %s", cloud_conversation_id)
+        return False
+
+    @track_db
+    def update_ticket_status(self, ticket_id: str, status: str) -> bool:
+        """Cập nhật trạng thái ticket"""
+        with self._lock:
+            now = _now()
+            for mapping_id in self._by_ticket.get(ticket_id, []):
+                self._mappings[mapping_id]['updated_at'] = now
+        logger.info("✅ Updated ticket status: %s -> %s", ticket_id, status)
+        return True
+
+    @track_db
+    def log_webhook(self, webhook_type: str, data: Dict, status: str = 'received',
+                    error_message: str = None) -> Optional[int]:
+        """Log webhook, trả về id của dòng log (None nếu lỗi)"""
+        try:
+            raw_data = json.dumps(data)
+            with self._lock:
+                log_id = self._next_log_id
+                self._next_log_id += 1
+                self._logs[log_id] = {
+                    'id': log_id,
+                    'webhook_type': webhook_type,
+                    'conversation_id': data.get('conversation_id'),
+                    'ticket_id': data.get('ticket_id'),
+                    'contact_id': data.get('contact_id'),
+                    'event_type': data.get('event_type'),
+                    'raw_data': raw_data,
+                    'processed_data': raw_data,  # processed_data = raw_data cho đơn giản
+                    'status': status,
+                    'error_message': error_message,
+                    'created_at': _now(),
+                    **payload_columns(data)
+                }
+                return log_id
+        except Exception as e:
+            logger.error("❌ Error logging webhook: %s", e)
+            return None
+
+    @track_db
+    def get_webhook_logs(self, limit: int = 50) -> List[WebhookLog]:
+        """Lấy webhook logs"""
+        with self._lock:
+            logs = sorted(self._logs.values(), key=lambda r: (r['created_at'], r['id']), reverse=True)
+            return [WebhookLog(*[log[field] for field in WEBHOOK_LOG_FIELDS]) for log in logs[:limit]]
+
+    @track_db
+    def query_webhook_logs(self, limit: int = 50, before_id: int = None, since: str = None,
+                           until: str = None, **filters) -> Page:
+        """Phân trang webhook log theo id"""
+        with self._lock:
+            return _page(self._logs, WEBHOOK_LOG_FIELDS, WEBHOOK_LOG_QUERY_FILTERS, limit, before_id, since, until, filters)
+
+    @track_db
+    def count_webhook_logs(self, group_by: str, since: str = None, until: str = None,
+                           **filters) -> Dict[Optional[str], int]:
+        """Số webhook log theo giá trị của cột group_by"""
+        column = WEBHOOK_LOG_GROUP_COLUMNS.get(group_by)
+        if column is None:
+            logger.error("❌ Error counting webhook logs: unknown group_by %s", group_by)
+            return {}
+        counts: Dict[Optional[str], int] = {}
+        with self._lock:
+            for record in _matching(self._logs, WEBHOOK_LOG_QUERY_FILTERS, None, since, until, filters):
+                counts[record[column]] = counts.get(record[column], 0) + 1
+        return counts
+
+    def scan(self, kind: str, after_id: int = None, batch_size: int = 1000) -> Iterator[List[Dict]]:
+        """Duyệt theo id tăng dần, mỗi lô copy dưới lock"""
+        records = self._mappings if kind == 'mappings' else self._logs
+        fields = SCAN_KINDS[kind][1]
+        last_id = after_id or 0
+        while True:
+            with self._lock:
+                ids = [record_id for record_id in records if record_id > last_id][:batch_size]
+                batch = [{field: records[record_id][field] for field in fields} for record_id in ids]
+            if not batch:
+                return
+            yield batch
+            last_id = ids[-1]
+
+    @track_db
+    def save_webhook_timings(self, webhook_log_id: Optional[int], webhook_type: str, outcome: str,
+                             stages: Dict[str, float], total: float) -> bool:
+        """Lưu thời gian từng stage (giây) của một webhook, kèm stage 'total'"""
+        now = _now()
+        rows = [{'webhook_log_id': webhook_log_id, 'webhook_type': webhook_type, 'outcome': outcome,
+                 'stage': name, 'duration_ms': seconds * 1000.0, 'created_at': now}
+                for name, seconds in stages.items()]
+        rows.append({'webhook_log_id': webhook_log_id, 'webhook_type': webhook_type, 'outcome': outcome,
+                     'stage': 'total', 'duration_ms': total * 1000.0, 'created_at': now})
+        with self._lock:
+            self._timings.extend(rows)
+        return True
+
+    def _recent_timings(self, window_minutes: int, webhook_type: str = None) -> List[Dict]:
+        since = _since(window_minutes)
+        return [t for t in self._timings
+                if t['created_at'] >= since and (not webhook_type or t['webhook_type'] == webhook_type)]
+
+    @track_db
+    def get_slowest_webhooks(self, limit: int = 10, window_minutes: int = 60,
+                             webhook_type: str = None) -> List[Dict]:
+        """Lấy N webhook chậm nhất trong khoảng thời gian gần đây, kèm breakdown theo stage"""
+        with self._lock:
+            totals = [t for t in self._recent_timings(window_minutes, webhook_type) if t['stage'] == 'total']
+            totals.sort(key=lambda t: t['duration_ms'], reverse=True)
+
+            slowest = []
+            for total in totals[:limit]:
+                log_id = total['webhook_log_id']
+                stages = {}
+                if log_id is not None:
+                    rows = [t for t in self._timings if t['webhook_log_id'] == log_id and t['stage'] != 'total']
+                    rows.sort(key=lambda t: t['duration_ms'], reverse=True)
+                    stages = {t['stage']: t['duration_ms'] for t in rows}
+                log = self._logs.get(log_id, {})
+                slowest.append({
+                    'webhook_log_id': log_id,
+                    'webhook_type': total['webhook_type'],
+                    'outcome': total['outcome'],
+                    'total_ms': total['duration_ms'],
+                    'created_at': total['created_at'],
+                    'conversation_id': log.get('conversation_id'),
+                    'ticket_id': log.get('ticket_id'),
+                    'stages': stages
+                })
+            return slowest
+
+    @track_db
+    def get_stage_durations(self, window_minutes: int = 60, webhook_type: str = None) -> Dict[str, List[float]]:
+        """Lấy danh sách duration (ms) theo stage trong khoảng thời gian gần đây"""
+        durations: Dict[str, List[float]] = {}
+        with self._lock:
+            for t in self._recent_timings(window_minutes, webhook_type):
+                durations.setdefault(t['stage'], []).append(t['duration_ms'])
+        return durations
+
+    @track_db
+    def get_stats(self) -> Dict:
+        """Lấy thống kê"""
+        today = _now()[:10]
+        with self._lock:
+            return {
+                'total_mappings': len(self._mappings),
+                'today_mappings': sum(1 for r in self._mappings.values() if r['created_at'][:10] == today),
+                'total_logs': len(self._logs),
+                'today_logs': sum(1 for r in self._logs.values() if r['created_at'][:10] == today)
+            }
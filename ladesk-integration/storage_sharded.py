@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Sharded SQLite Storage
+Chia dữ liệu ra N file SQLite theo hash (crc32) của cloud_conversation_id để
+các writer ghi vào file khác nhau không phải chờ lock của nhau
+
+- Mapping và webhook log của cùng một conversation nằm trong cùng shard
+- Tra cứu theo conversation chỉ đọc một shard; theo ticket/email/pattern
+  thì đọc mọi shard và lấy kết quả mới nhất
+- id trả ra ngoài = id trong shard * N + số shard, nên không trùng giữa các
+  shard và save_webhook_timings biết ghi vào shard nào
+
+Số shard phải giữ cố định cho một bộ file (đổi STORAGE_SHARDS cần migrate lại dữ liệu).
+"""
+
+import os
+import zlib
+import heapq
+import itertools
+import logging
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from database_simple import SimpleDatabaseManager
+from records import Mapping, WebhookLog
+from storage import StorageBackend, Page
+
+logger = logging.getLogger(__name__)
+
+
+def shard_paths(db_path: str, shards: int) -> List[str]:
+    """ladesk_integration.db -> ladesk_integration.shard0.db, ..."""
+    base, ext = os.path.splitext(db_path)
+    return [f"{base}.shard{i}{ext or '.db'}" for i in range(shards)]
+
+
+class ShardedSQLiteStorage(StorageBackend):
+    """N SimpleDatabaseManager, mỗi cái một file"""
+
+    def __init__(self, db_path: str, shards: int = 4):
+        if shards < 1:
+            raise ValueError("shards must be >= 1")
+        self.db_path = db_path
+        self.shards = [SimpleDatabaseManager(path) for path in shard_paths(db_path, shards)]
+        # Webhook không có conversation/ticket: chia đều theo vòng
+        self._round_robin = itertools.count()
+
+    def ensure_schema(self) -> bool:
+        changed = False
+        for shard in self.shards:
+            changed = shard.ensure_schema() or changed
+        return changed
+
+    # Chọn shard / mã hóa id
+    def shard_index(self, key: Optional[str]) -> int:
+        if key is None:
+            return next(self._round_robin) % len(self.shards)
+        return zlib.crc32(str(key).encode('utf-8')) % len(self.shards)
+
+    def _global_id(self, local_id: Optional[int], index: int) -> Optional[int]:
+        return None if local_id is None else local_id * len(self.shards) + index
+
+    def _split_id(self, global_id: int) -> Tuple[int, int]:
+        """(shard index, id trong shard)"""
+        return global_id % len(self.shards), global_id // len(self.shards)
+
+    def _with_global_id(self, record: Optional[Dict], index: int, field: str = 'id') -> Optional[Dict]:
+        if record is not None:
+            record = record.copy()
+            record[field] = self._global_id(record[field], index)
+        return record
+
+    def _newest(self, candidates: List[Tuple[int, Dict]]) -> Optional[Dict]:
+        """Kết quả mới nhất (created_at, id) trong các kết quả từ nhiều shard"""
+        found = [(index, record) for index, record in candidates if record]
+        if not found:
+            return None
+        index, record = max(found, key=lambda item: (item[1]['created_at'] or '', item[1]['id']))
+        return self._with_global_id(record, index)
+
+    # Mappings
+    def create_mapping(self, cloud_conversation_id: str, onpremise_ticket_id: str,
+                       onpremise_contact_id: str, customer_name: str = None,
+                       customer_email: str = None) -> bool:
+        shard = self.shards[self.shard_index(cloud_conversation_id)]
+        return shard.create_mapping(cloud_conversation_id, onpremise_ticket_id, onpremise_contact_id,
+                                    customer_name, customer_email)
+
+    def get_mapping_by_conversation(self, cloud_conversation_id: str) -> Optional[Mapping]:
+        index = self.shard_index(cloud_conversation_id)
+        return self._with_global_id(self.shards[index].get_mapping_by_conversation(cloud_conversation_id), index)
+
+    def get_mapping_by_ticket(self, onpremise_ticket_id: str) -> Optional[Mapping]:
+        for index, shard in enumerate(self.shards):
+            mapping = shard.get_mapping_by_ticket(onpremise_ticket_id)
+            if mapping:
+                return self._with_global_id(mapping, index)
+        return None
+
+    def get_mapping_by_email(self, customer_email: str) -> Optional[Mapping]:
+        return self._newest([(i, s.get_mapping_by_email(customer_email)) for i, s in enumerate(self.shards)])
+
+    def get_mapping_by_ticket_pattern(self, ticket_pattern: str) -> Optional[Mapping]:
+        return self._newest([(i, s.get_mapping_by_ticket_pattern(ticket_pattern)) for i, s in enumerate(self.shards)])
+
+    def get_mapping_by_ticket_prefix(self, prefix: str) -> Optional[Mapping]:
+        return self._newest([(i, s.get_mapping_by_ticket_prefix(prefix)) for i, s in enumerate(self.shards)])
+
+    def get_all_mappings(self, limit: int = 100) -> List[Mapping]:
+        mappings = [self._with_global_id(m, i) for i, s in enumerate(self.shards) for m in s.get_all_mappings(limit)]
+        mappings.sort(key=lambda m: (m['created_at'] or '', m['id']), reverse=True)
+        return mappings[:limit]
+
+    def _local_before_id(self, before_id: Optional[int], index: int) -> Optional[int]:
+        """before_id toàn cục -> before_id trong shard: local * N + index < before_id"""
+        if before_id is None:
+            return None
+        return -(-(before_id - index) // len(self.shards))  # ceil((before_id - index) / N)
+
+    def _query(self, method: str, limit: int, before_id: Optional[int], since: str, until: str,
+               filters: Dict) -> Page:
+        """Gộp trang của từng shard theo id toàn cục giảm dần"""
+        conversation_id = filters.get('conversation_id')
+        # Mapping và log của một conversation nằm trong một shard
+        indexes = [self.shard_index(conversation_id)] if conversation_id else range(len(self.shards))
+        items, more = [], False
+        for index in indexes:
+            page, next_before_id = getattr(self.shards[index], method)(
+                limit, self._local_before_id(before_id, index), since, until, **filters)
+            items.extend(self._with_global_id(item, index) for item in page)
+            more = more or next_before_id is not None
+        items.sort(key=lambda item: item['id'], reverse=True)
+        if len(items) > limit:
+            return items[:limit], items[limit - 1]['id']
+        return items, (items[-1]['id'] if more and items else None)
+
+    def query_mappings(self, limit: int = 50, before_id: int = None, since: str = None,
+                       until: str = None, **filters) -> Page:
+        return self._query('query_mappings', limit, before_id, since, until, filters)
+
+    def update_mapping(self, cloud_conversation_id: str, **kwargs) -> bool:
+        return self.shards[self.shard_index(cloud_conversation_id)].update_mapping(cloud_conversation_id, **kwargs)
+
+    def delete_mapping(self, cloud_conversation_id: str) -> bool:
+        return self.shards[self.shard_index(cloud_conversation_id)].delete_mapping(cloud_conversation_id)
+
+    def update_ticket_status(self, ticket_id: str, status: str) -> bool:
+        return all([shard.update_ticket_status(ticket_id, status) for shard in self.shards])
+
+    # Webhook logs
+    def log_webhook(self, webhook_type: str, data: Dict, status: str = 'received',
+                    error_message: str = None) -> Optional[int]:
+        index = self.shard_index(data.get('conversation_id') or data.get('ticket_id'))
+        return self._global_id(self.shards[index].log_webhook(webhook_type, data, status, error_message), index)
+
+    def get_webhook_logs(self, limit: int = 50) -> List[WebhookLog]:
+        logs = [self._with_global_id(log, i) for i, s in enumerate(self.shards) for log in s.get_webhook_logs(limit)]
+        logs.sort(key=lambda log: (log['created_at'] or '', log['id']), reverse=True)
+        return logs[:limit]
+
+    def query_webhook_logs(self, limit: int = 50, before_id: int = None, since: str = None,
+                           until: str = None, **filters) -> Page:
+        return self._query('query_webhook_logs', limit, before_id, since, until, filters)
+
+    def count_webhook_logs(self, group_by: str, since: str = None, until: str = None,
+                           **filters) -> Dict[Optional[str], int]:
+        counts: Dict[Optional[str], int] = {}
+        for shard in self.shards:
+            for value, count in shard.count_webhook_logs(group_by, since, until, **filters).items():
+                counts[value] = counts.get(value, 0) + count
+        return counts
+
+    def _scan_shard(self, index: int, kind: str, after_id: Optional[int], batch_size: int) -> Iterator[Dict]:
+        # local * N + index > after_id  <=>  local > floor((after_id - index) / N)
+        local_after = None if after_id is None else (after_id - index) // len(self.shards)
+        for batch in self.shards[index].scan(kind, local_after, batch_size):
+            for record in batch:
+                yield self._with_global_id(record, index)
+
+    def scan(self, kind: str, after_id: int = None, batch_size: int = 1000) -> Iterator[List[Dict]]:
+        """Trộn scan của từng shard theo id toàn cục tăng dần (mỗi shard giữ tối đa một lô)"""
+        merged = heapq.merge(*(self._scan_shard(i, kind, after_id, batch_size) for i in range(len(self.shards))),
+                             key=lambda record: record['id'])
+        while True:
+            batch = list(itertools.islice(merged, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    # Timings
+    def save_webhook_timings(self, webhook_log_id: Optional[int], webhook_type: str, outcome: str,
+                             stages: Dict[str, float], total: float) -> bool:
+        if webhook_log_id is None:
+            index, local_id = self.shard_index(None), None
+        else:
+            index, local_id = self._split_id(webhook_log_id)
+        return self.shards[index].save_webhook_timings(local_id, webhook_type, outcome, stages, total)
+
+    def get_slowest_webhooks(self, limit: int = 10, window_minutes: int = 60,
+                             webhook_type: str = None) -> List[Dict]:
+        slowest = [self._with_global_id(w, i, 'webhook_log_id') for i, s in enumerate(self.shards)
+                   for w in s.get_slowest_webhooks(limit, window_minutes, webhook_type)]
+        slowest.sort(key=lambda w: w['total_ms'], reverse=True)
+        return slowest[:limit]
+
+    def get_stage_durations(self, window_minutes: int = 60, webhook_type: str = None) -> Dict[str, List[float]]:
+        durations: Dict[str, List[float]] = {}
+        for shard in self.shards:
+            for stage, values in shard.get_stage_durations(window_minutes, webhook_type).items():
+                durations.setdefault(stage, []).extend(values)
+        return durations
+
+    # Stats
+    def get_stats(self) -> Dict:
+        totals = {'total_mappings': 0, 'today_mappings': 0, 'total_logs': 0, 'today_logs': 0}
+        for shard in self.shards:
+            for key, value in shard.get_stats().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+Webhook Logic
+Phân loại webhook, trích xuất thông tin khách hàng/agent và tra mapping
+
+Dùng chung cho handler Flask (app.py) và handler async (async_app.py) nên
+không phụ thuộc vào framework web: handler chỉ gọi API Ladesk (sync hoặc
+async) giữa các bước ở đây. Các hàm nhận db là hàm đồng bộ (SQLite), handler
+async gọi qua thread; các hàm complete_* trả về (payload, status) của response.
+"""
+
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import admission
+import attachments
+from config import Config
+from records import Mapping, WebhookEvent
+from message_transform import looks_like_html, normalize_whitespace, text_to_html, truncate
+
+logger = logging.getLogger(__name__)
+
+# Giá trị template LiveAgent chưa được thay thế
+TEMPLATE_AGENT_NAMES = ['{$user_firstname} {$user_lastname}', '{$user_email}', '']
+TEMPLATE_AGENT_IDS = ['{$user_id}', '']
+
+# Cách xử lý webhook Cloud (route_cloud_event)
+AGENT_REPLY = 'agent_reply'
+CUSTOMER_MESSAGE = 'customer_message'
+SKIP = 'skip'
+
+# Status conversation được xử lý: Open, Answered, Resolved, New, Open (cũ) hoặc trống
+PROCESSED_STATUSES = ['C', 'A', 'R', 'N', 'O', '']
+
+
+def _classify_cloud_event(event: WebhookEvent) -> Tuple[bool, bool]:
+    event_type = event.event_type
+    message_type = event.message_type
+    agent_name = event.agent_name
+    agent_id = event.agent_id
+    channel_type = event.channel_type
+
+    # Kiểm tra xem có phải là agent reply thực sự không
+    is_real_agent_reply = bool(
+        event_type == 'agent_reply' and
+        agent_name and
+        agent_name not in TEMPLATE_AGENT_NAMES and
+        agent_id and
+        agent_id.strip() and
+        agent_id not in TEMPLATE_AGENT_IDS and
+        channel_type == 'E'  # Email channel thường là agent reply
+    )
+
+    # Kiểm tra xem có phải là customer message không
+    is_customer_message = bool(
+        (event_type == 'message_added' and message_type in ['M', 'message']) or
+        (event_type == 'agent_reply' and
+         (not agent_name or
+          agent_name in TEMPLATE_AGENT_NAMES or
+          not agent_id or
+          not agent_id.strip() or
+          agent_id in TEMPLATE_AGENT_IDS or
+          channel_type == 'A'))  # Facebook channel thường là customer message
+    )
+    return is_real_agent_reply, is_customer_message
+
+
+def classify_cloud_event(event: WebhookEvent) -> Tuple[bool, bool]:
+    """Phân loại webhook Cloud: (is_real_agent_reply, is_customer_message)"""
+    is_real_agent_reply, is_customer_message = _classify_cloud_event(event)
+
+    # Log chi tiết về quá trình phân loại
+    logger.info("🔍 Webhook classification: event_type=%s, agent_name='%s', agent_id='%s', channel_type='%s'",
+                event.event_type, event.agent_name, event.agent_id, event.channel_type)
+    logger.info("🔍 is_real_agent_reply=%s, is_customer_message=%s", is_real_agent_reply, is_customer_message)
+    return is_real_agent_reply, is_customer_message
+
+
+def conversation_status_skip_reason(status: str) -> Optional[str]:
+    """Kiểm tra status - chỉ xử lý conversation mở hoặc mới. Trả về reason nếu cần bỏ qua"""
+    if status == 'C':  # Open - tiếp tục xử lý
+        logger.info("✅ Conversation is open (status: %s), continuing processing", status)
+    elif status == 'A':  # Answered - có thể tiếp tục xử lý
+        logger.info("✅ Conversation is answered (status: %s), continuing processing", status)
+    elif status == 'R':  # Resolved - có thể tiếp tục xử lý
+        logger.info("✅ Conversation is resolved (status: %s), continuing processing", status)
+    elif status not in PROCESSED_STATUSES:
+        logger.info("⏭️ Skipping conversation with status: %s", status)
+        return f"conversation_status_{status}"
+    return None
+
+
+def route_cloud_event(event: WebhookEvent) -> Tuple[str, Optional[str]]:
+    """Cách xử lý webhook Cloud: (AGENT_REPLY | CUSTOMER_MESSAGE, None) hoặc (SKIP, reason)"""
+    is_real_agent_reply, is_customer_message = classify_cloud_event(event)
+
+    # Nếu là agent reply thực sự, xử lý như On-Premise webhook
+    if is_real_agent_reply:
+        logger.info("🔄 Detected real agent reply from Cloud, processing as agent reply: %s", event.agent_name)
+        return AGENT_REPLY, None
+
+    # Nếu không phải customer message, bỏ qua
+    if not is_customer_message:
+        logger.info("⏭️ Skipping non-customer message: %s - %s - %s",
+                    event.event_type, event.message_type, event.agent_name)
+        return SKIP, 'non_customer_message'
+
+    skip_reason = conversation_status_skip_reason(event.status)
+    if skip_reason:
+        return SKIP, skip_reason
+
+    logger.info("✅ Processing customer message: %s, contact: %s", event.conversation_id, event.contact_id)
+    return CUSTOMER_MESSAGE, None
+
+
+def cloud_event_priority(event: Optional[WebhookEvent]) -> str:
+    """Mức ưu tiên admission của webhook Cloud (không log, gọi trước handler)
+
+    Chỉ event sẽ bị bỏ qua (echo, event hệ thống, conversation đã đóng, body
+    lỗi) là LOW; tin nhắn khách hàng và agent reply cần chuyển sang On-Premise
+    được xử lý như webhook On-Premise.
+    """
+    if event is None:
+        return admission.LOW
+    is_real_agent_reply, is_customer_message = _classify_cloud_event(event)
+    if is_real_agent_reply or (is_customer_message and event.status in PROCESSED_STATUSES):
+        return admission.HIGH
+    return admission.LOW
+
+
+def _is_valid_id(value: str) -> bool:
+    return bool(value and value.strip() and value not in TEMPLATE_AGENT_IDS and '{' not in value)
+
+
+def extract_valid_agent_id(event: WebhookEvent) -> Optional[str]:
+    """Lấy agent_id hợp lệ từ agent_id, contactid hoặc userid của webhook On-Premise"""
+    agent_id = event.agent_id
+    contactid = event.contactid
+    userid = event.userid
+
+    if _is_valid_id(agent_id):
+        logger.info("✅ Using agent_id from webhook: %s", agent_id)
+        return agent_id
+    if _is_valid_id(contactid):
+        logger.info("✅ Using contactid as agent_id: %s", contactid)
+        return contactid
+    if _is_valid_id(userid):
+        logger.info("✅ Using userid as agent_id: %s", userid)
+        return userid
+    return None
+
+
+def onpremise_reply_agent(event: WebhookEvent) -> Tuple[Optional[str], Optional[str]]:
+    """agent_id gửi reply sang Cloud cho webhook On-Premise: (agent_id, None) hoặc (None, reason bỏ qua)"""
+    logger.info("🔍 OnPremise webhook received: event_type=%s, agent_name='%s', agent_id='%s', contactid='%s', "
+                "userid='%s', channel_type='%s'", event.event_type, event.agent_name, event.agent_id,
+                event.contactid, event.userid, event.channel_type)
+
+    # Chỉ xử lý agent_reply events
+    if event.event_type != 'agent_reply':
+        logger.info("⏭️ Skipping non-agent-reply event: %s", event.event_type)
+        return None, 'non_agent_reply_event'
+
+    # Kiểm tra xem có agent_id hợp lệ không (agent_id -> contactid -> userid)
+    valid_agent_id = extract_valid_agent_id(event)
+    if not valid_agent_id:
+        logger.warning("⚠️ No valid agent_id found, skipping agent_reply event")
+        logger.warning("⚠️ agent_id='%s', contactid='%s', userid='%s'", event.agent_id, event.contactid, event.userid)
+        return None, 'no_valid_agent_id'
+    return valid_agent_id, None
+
+
+def clean_agent_name(agent_name: str) -> str:
+    """Làm sạch agent_name nếu là template chưa thay thế"""
+    if not agent_name or agent_name in TEMPLATE_AGENT_NAMES:
+        logger.info("🔄 Cleaned agent_name to default: Agent")
+        return 'Agent'
+    return agent_name
+
+
+def default_customer_email(conversation_id: str) -> str:
+    """Email mặc định khi Cloud không có email của khách hàng"""
+    return f"facebook_{conversation_id}@facebook.com"
+
+
+def customer_from_contact(contact_result: Optional[Dict], conversation_id: str) -> Tuple[Dict, str, str]:
+    """Lấy (contact_data_cloud, customer_name, customer_email) từ kết quả get_contact_details"""
+    contact_data_cloud = {}
+    customer_name = 'Facebook Customer'  # Default
+    customer_email = default_customer_email(conversation_id)  # Default
+
+    if contact_result is None:
+        logger.warning("⚠️ No contact_id in webhook data")
+    elif contact_result['success']:
+        contact_data_cloud = contact_result['data']
+        customer_name = f"{contact_data_cloud.get('firstname', '')} {contact_data_cloud.get('lastname', '')}".strip()
+        if not customer_name:
+            customer_name = 'Facebook Customer'
+
+        emails = contact_data_cloud.get('emails', [])
+        if emails:
+            customer_email = emails[0]  # Lấy email đầu tiên
+
+        logger.info("✅ Retrieved contact info: %s, email: %s", customer_name, customer_email)
+    else:
+        logger.error("❌ Failed to get contact details: %s", contact_result['error'])
+
+    return contact_data_cloud, customer_name, customer_email
+
+
+def build_contact_data(contact_data_cloud: Dict, customer_name: str, customer_email: str) -> Dict:
+    """Dữ liệu tạo contact trong On-Premise với thông tin thật"""
+    return {
+        'firstname': contact_data_cloud.get('firstname', 'Facebook') if contact_data_cloud else 'Facebook',
+        'lastname': contact_data_cloud.get('lastname', 'Customer') if contact_data_cloud else 'Customer',
+        'emails': [customer_email],
+        'description': f'Facebook Customer - {customer_name}',
+        'type': 'V'
+    }
+
+
+def onpremise_message(message: str) -> str:
+    """Nội dung tin của khách hàng gửi sang On-Premise: HTML (ONPREMISE_MESSAGE_HTML) hoặc text đã chuẩn hóa"""
+    if Config.ONPREMISE_MESSAGE_HTML:
+        return text_to_html(message)
+    return truncate(normalize_whitespace(message or ''))
+
+
+def build_ticket_data(conversation_id: str, subject: str, message: str,
+                      customer_name: str, customer_email: str, file_ids: List[str] = None) -> Dict:
+    """Dữ liệu tạo ticket mới cho mỗi message (vì LiveAgent không cho phép update message),
+    file_ids là file đính kèm đã upload lên On-Premise"""
+    ticket_data = {
+        'departmentid': Config.LADESK_ONPREMISE_DEPARTMENT_ID,
+        # Tạo subject với conversation ID để dễ track
+        'subject': f"Facebook - {conversation_id} - {subject}",
+        'message': onpremise_message(message),
+        'contactemail': customer_email,
+        'contactname': customer_name,
+        'useridentifier': customer_email,
+        'recipient': Config.LADESK_ONPREMISE_RECIPIENT_EMAIL,
+        'status': 'N',
+        'channel_type': 'E'
+    }
+    if file_ids:
+        ticket_data['attachments'] = ','.join(file_ids)
+    return ticket_data
+
+
+def contact_id_from_result(contact_result: Dict) -> Optional[str]:
+    """Lấy contact_id On-Premise từ kết quả create_contact (None nếu thất bại)"""
+    if not contact_result['success']:
+        logger.error("❌ Failed to create contact: %s", contact_result['error'])
+        # Nếu contact tạo thất bại, vẫn tiếp tục tạo ticket với thông tin có sẵn
+        logger.warning("⚠️ Continuing with ticket creation despite contact creation failure")
+        return None
+    contact_id = contact_result.get('contact_id') or contact_result.get('data', {}).get('id')
+    logger.info("✅ Contact created/retrieved successfully: %s", contact_id)
+    return contact_id
+
+
+def log_missing_mapping(db, customer_email: str):
+    """Log tất cả mapping để debug khi không tìm thấy mapping"""
+    logger.error("❌ Customer email: %s", customer_email)
+
+    all_mappings = db.get_all_mappings()
+    logger.error("❌ All available mappings: %s", len(all_mappings))
+    for m in all_mappings:
+        logger.error("   - Cloud: %s -> OnPremise: %s (Email: %s)",
+                     m.cloud_conversation_id, m.onpremise_ticket_id, m.customer_email)
+
+
+def find_mapping_for_onpremise_reply(db, ticket_id: str, conversation_id: str,
+                                     customer_email: str) -> Optional[Mapping]:
+    """Tìm mapping cho webhook On-Premise: ticket_id -> conversation_id (cũng là ticket ID) -> email"""
+    mapping = None
+
+    # Thử tìm bằng ticket_id trước (vì đây là ticket ID của On-Premise)
+    if ticket_id:
+        mapping = db.get_mapping_by_ticket(ticket_id)
+        if mapping:
+            logger.info("✅ Found mapping by ticket_id: %s", ticket_id)
+
+    # Nếu không tìm thấy, thử tìm bằng conversation_id (cũng có thể là ticket ID)
+    if not mapping and conversation_id:
+        mapping = db.get_mapping_by_ticket(conversation_id)
+        if mapping:
+            logger.info("✅ Found mapping by conversation_id (as ticket_id): %s", conversation_id)
+
+    # Nếu vẫn không tìm thấy, thử tìm bằng email
+    if not mapping and customer_email:
+        mapping = db.get_mapping_by_email(customer_email)
+        if mapping:
+            logger.info("✅ Found mapping by email: %s -> ticket: %s", customer_email, mapping.onpremise_ticket_id)
+
+    if not mapping:
+        logger.error("❌ No mapping found for ticket_id: %s, conversation_id: %s", ticket_id, conversation_id)
+        log_missing_mapping(db, customer_email)
+    return mapping
+
+
+def find_mapping_for_cloud_reply(db, conversation_id: str, ticket_id: str,
+                                 customer_email: str) -> Optional[Mapping]:
+    """Tìm mapping cho agent reply từ Cloud: conversation_id -> ticket_id -> email"""
+    mapping = None
+
+    # Thử tìm bằng conversation_id trước (vì đây là conversation ID của Cloud)
+    if conversation_id:
+        mapping = db.get_mapping_by_conversation(conversation_id)
+        if mapping:
+            logger.info("✅ Found mapping by conversation_id: %s", conversation_id)
+
+    # Nếu không tìm thấy, thử tìm bằng ticket_id (có thể là ticket ID của On-Premise)
+    if not mapping and ticket_id:
+        mapping = db.get_mapping_by_ticket(ticket_id)
+        if mapping:
+            logger.info("✅ Found mapping by ticket_id: %s", ticket_id)
+
+    # Nếu vẫn không tìm thấy, thử tìm bằng email
+    if not mapping and customer_email:
+        mapping = db.get_mapping_by_email(customer_email)
+        if mapping:
+            logger.info("✅ Found mapping by email: %s -> ticket: %s", customer_email, mapping.onpremise_ticket_id)
+
+    if not mapping:
+        logger.error("❌ No mapping found for conversation_id: %s, ticket_id: %s", conversation_id, ticket_id)
+        log_missing_mapping(db, customer_email)
+    return mapping
+
+
+def record_agent_reply(db, cloud_conversation_id: str, message: str, agent_name: str) -> bool:
+    """Cập nhật mapping với thông tin reply"""
+    return db.update_mapping(
+        cloud_conversation_id=cloud_conversation_id,
+        last_agent_reply=message,
+        last_agent_name=agent_name,
+        last_reply_time=datetime.now().isoformat()
+    )
+
+
+def cloud_agent_reply(db, event: WebhookEvent) -> Tuple[Dict, int]:
+    """Xử lý agent reply từ Cloud (tương tự như On-Premise webhook): chỉ cần tìm và cập nhật mapping"""
+    try:
+        agent_name = event.agent_name or 'Agent'
+        logger.info("🔄 Processing agent reply from Cloud: %s, agent: %s", event.conversation_id, agent_name)
+
+        # Tìm mapping - webhook từ Cloud gửi conversation_id của Cloud
+        mapping = find_mapping_for_cloud_reply(db, event.conversation_id, event.ticket_id, event.customer_email)
+        if not mapping:
+            return {"error": "No mapping found"}, 404
+
+        cloud_conversation_id = mapping.cloud_conversation_id
+        logger.info("✅ Agent reply from Cloud processed: %s", cloud_conversation_id)
+
+        record_agent_reply(db, cloud_conversation_id, event.message, agent_name)
+        return {
+            "status": "success",
+            "conversation_id": cloud_conversation_id,
+            "message": "Agent reply from Cloud processed"
+        }, 200
+
+    except Exception as e:
+        logger.error("❌ Agent reply from Cloud error: %s", e)
+        return {"error": str(e)}, 500
+
+
+def prepare_customer_ticket(event: WebhookEvent, existing_mapping: Optional[Mapping], contact_result: Optional[Dict],
+                            attachment_refs: List[Dict], attachment_result: Optional[Tuple[List[str], List[Dict]]]) -> Dict:
+    """Contact/ticket tạo trong On-Premise cho tin nhắn khách hàng, từ kết quả bước 1 của handler
+    (mapping hiện tại, contact Cloud, file đính kèm đã chuyển)"""
+    conversation_id = event.conversation_id
+
+    # LiveAgent không cho phép update message: luôn tạo ticket mới, kể cả khi conversation đã có ticket
+    if existing_mapping is not None:
+        logger.info("🔗 Conversation %s already mapped to ticket %s",
+                    conversation_id, existing_mapping.onpremise_ticket_id)
+
+    contact_data_cloud, customer_name, customer_email = customer_from_contact(contact_result, conversation_id)
+
+    # File đã chuyển đi kèm ticket, file lỗi được thêm link vào nội dung
+    file_ids, failed_attachments = attachment_result if attachment_result is not None else ([], [])
+    message = attachments.message_with_attachments(event.message, attachment_refs, failed_attachments)
+
+    logger.info("🆕 Creating new ticket for message in conversation: %s", conversation_id)
+    return {
+        'customer_name': customer_name,
+        'customer_email': customer_email,
+        'contact_data': build_contact_data(contact_data_cloud, customer_name, customer_email),
+        'ticket_data': build_ticket_data(conversation_id, event.subject, message, customer_name, customer_email,
+                                         file_ids),
+        'file_ids': file_ids,
+        'failed_attachments': failed_attachments
+    }
+
+
+def complete_customer_ticket(db, conversation_id: str, ticket: Dict, upsert_result: Dict,
+                             ticket_result: Dict) -> Tuple[Dict, int]:
+    """Tạo mapping từ kết quả create_contact/create_ticket (bước 2 của handler)"""
+    contact_id = contact_id_from_result(upsert_result)
+
+    if not ticket_result['success']:
+        logger.error("❌ Failed to create ticket: %s", ticket_result['error'])
+        return {"error": "Ticket creation failed"}, 500
+
+    ticket_id = ticket_result['data']['id']
+    ticket_code = ticket_result['data'].get('code', ticket_id)  # Sử dụng code nếu có
+
+    # Tạo mapping cho message này - sử dụng ticket_code để match với webhook
+    db.create_mapping(
+        cloud_conversation_id=conversation_id,
+        onpremise_ticket_id=ticket_code,  # Sử dụng code thay vì id
+        onpremise_contact_id=contact_id,
+        customer_name=ticket['customer_name'],
+        customer_email=ticket['customer_email']
+    )
+
+    logger.info("✅ Successfully created ticket: %s (code: %s) for message in conversation: %s",
+                ticket_id, ticket_code, conversation_id)
+    return {
+        "status": "success",
+        "message": "New ticket created for message",
+        "conversation_id": conversation_id,
+        "ticket_id": ticket_id,
+        "ticket_code": ticket_code,
+        "attachments": len(ticket['file_ids']),
+        "attachments_failed": len(ticket['failed_attachments'])
+    }, 200
+
+
+def agent_reply_message(message: str, attachment_refs: List[Dict], failed_attachments: List[Dict]) -> str:
+    """Nội dung reply gửi sang Cloud: file đính kèm chuyển lỗi được thêm link vào nội dung"""
+    return attachments.message_with_attachments(message, attachment_refs, failed_attachments,
+                                                looks_like_html(message))
+
+
+def complete_agent_reply(db, cloud_conversation_id: str, message: str, agent_name: str, reply_result: Dict,
+                         file_ids: List[str], failed_attachments: List[Dict]) -> Tuple[Dict, int]:
+    """Cập nhật mapping từ kết quả send_reply sang Cloud"""
+    if not reply_result['success']:
+        logger.error("❌ Failed to send reply: %s", reply_result['error'])
+        return {"error": "Failed to send reply"}, 500
+
+    logger.info("✅ Reply sent successfully to Cloud: %s", cloud_conversation_id)
+    record_agent_reply(db, cloud_conversation_id, message, agent_name)
+    return {
+        "status": "success",
+        "conversation_id": cloud_conversation_id,
+        "message": "Reply sent to Cloud",
+        "attachments": len(file_ids),
+        "attachments_failed": len(failed_attachments)
+    }, 200
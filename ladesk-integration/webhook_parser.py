@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Webhook Body Parser
+Parse body của webhook theo pipeline nhanh -> chậm:
+
+1. Giới hạn kích thước body (WEBHOOK_MAX_BODY_BYTES) trước khi đọc
+2. Loại bỏ control characters (trừ \\n, \\r, \\t) ở mức bytes trong một lượt
+3. Decoder nhanh: orjson nếu có cài, không thì json
+4. json.loads(strict=False) cho chuỗi chứa xuống dòng thật (template LiveAgent
+   chèn {$message} nguyên văn vào JSON)
+5. json5 chỉ khi body có dấu hiệu lỗi template đã biết (dấu phẩy thừa, nháy đơn,
+   key không có nháy)
+
+Mỗi lần phải dùng bước 4/5 hoặc thất bại đều được đếm trong metric
+ladesk_webhook_parse_total{decoder}.
+"""
+
+import re
+import json
+import logging
+from typing import Optional
+
+import metrics
+from config import Config
+
+try:
+    import orjson
+    _fast_loads = orjson.loads
+    _FAST_DECODE_ERRORS = (orjson.JSONDecodeError, UnicodeDecodeError)
+except ImportError:  # orjson có trong requirements.txt, thiếu thì dùng json
+    orjson = None
+    _fast_loads = json.loads
+    _FAST_DECODE_ERRORS = (json.JSONDecodeError, UnicodeDecodeError)
+
+logger = logging.getLogger(__name__)
+
+# Control characters trừ \t (0x09), \n (0x0A), \r (0x0D). Các byte này không bao giờ
+# nằm trong chuỗi multi-byte UTF-8 nên xoá ở mức bytes là an toàn
+_CONTROL_BYTES = bytes([*range(0x00, 0x09), 0x0B, 0x0C, *range(0x0E, 0x20), 0x7F])
+
+# Dấu hiệu lỗi template LiveAgent mà json5 xử lý được
+_JSON5_QUIRKS = re.compile(rb",\s*[}\]]|[{,]\s*'|:\s*'|[{,]\s*[A-Za-z_$][\w$]*\s*:")
+
+
+_ASYNC_READ_CHUNK = 64 * 1024
+
+# Kết quả parse giữ trên request (environ của Flask, mapping của aiohttp request):
+# admission đã parse để phân loại event thì handler dùng lại, không đọc body lần nữa
+_PARSED_KEY = 'ladesk.webhook_body'
+
+
+class WebhookBodyTooLarge(Exception):
+    """Body webhook vượt quá WEBHOOK_MAX_BODY_BYTES"""
+
+
+def read_body(request, max_bytes: int = None) -> bytes:
+    """Đọc body với giới hạn kích thước, kiểm tra Content-Length trước khi đọc"""
+    max_bytes = max_bytes or Config.WEBHOOK_MAX_BODY_BYTES
+    if request.content_length is not None and request.content_length > max_bytes:
+        metrics.record_parse('too_large')
+        raise WebhookBodyTooLarge(f"Content-Length {request.content_length} > {max_bytes}")
+
+    # Không tin Content-Length (hoặc chunked): đọc tối đa max_bytes + 1 để phát hiện vượt giới hạn
+    body = request.stream.read(max_bytes + 1)
+    if len(body) > max_bytes:
+        metrics.record_parse('too_large')
+        raise WebhookBodyTooLarge(f"Body > {max_bytes} bytes")
+    return body
+
+
+def strip_control_bytes(body: bytes) -> bytes:
+    """Xoá control characters trong một lượt (bytes.translate)"""
+    return body.translate(None, _CONTROL_BYTES)
+
+
+def parse_body(body: bytes) -> Optional[dict]:
+    """Parse body đã đọc, trả về dict hoặc None nếu không parse được"""
+    cleaned = strip_control_bytes(body)
+
+    try:
+        data = _fast_loads(cleaned)
+        metrics.record_parse('fast')
+        return data
+    except _FAST_DECODE_ERRORS:
+        pass
+
+    text = cleaned.decode('utf-8', errors='replace')
+
+    # Xuống dòng/tab thật bên trong chuỗi JSON
+    try:
+        data = json.loads(text, strict=False)
+        metrics.record_parse('lenient')
+        logger.info("✅ JSON parsed with lenient decoder")
+        return data
+    except json.JSONDecodeError as e:
+        error = e
+
+    if _JSON5_QUIRKS.search(cleaned):
+        try:
+            import json5
+            data = json5.loads(text)
+            metrics.record_parse('json5')
+            logger.info("✅ JSON parsed successfully with json5")
+            return data
+        except Exception:
+            pass
+
+    metrics.record_parse('failed')
+    logger.error("❌ JSON parsing failed: %s", error)
+    logger.debug("Raw webhook data: %s", body)
+    return None
+
+
+def _as_object(data) -> Optional[dict]:
+    """Webhook hợp lệ phải là JSON object"""
+    if data is not None and not isinstance(data, dict):
+        logger.error("❌ Webhook body is not a JSON object: %s", type(data).__name__)
+        return None
+    return data
+
+
+def _cached_result(result) -> Optional[dict]:
+    if isinstance(result, WebhookBodyTooLarge):
+        raise result
+    return result
+
+
+def parse_request(request) -> Optional[dict]:
+    """Đọc body (có giới hạn) và parse; raise WebhookBodyTooLarge nếu body quá lớn
+
+    Gọi lại trong cùng request trả về kết quả (hoặc lỗi) của lần đầu.
+    """
+    if _PARSED_KEY not in request.environ:
+        try:
+            request.environ[_PARSED_KEY] = _as_object(parse_body(read_body(request)))
+        except WebhookBodyTooLarge as e:
+            request.environ[_PARSED_KEY] = e
+    return _cached_result(request.environ[_PARSED_KEY])
+
+
+async def read_body_async(request, max_bytes: int = None) -> bytes:
+    """Như read_body cho request aiohttp: đọc stream từng chunk, dừng ngay khi vượt giới hạn"""
+    max_bytes = max_bytes or Config.WEBHOOK_MAX_BODY_BYTES
+    if request.content_length is not None and request.content_length > max_bytes:
+        metrics.record_parse('too_large')
+        raise WebhookBodyTooLarge(f"Content-Length {request.content_length} > {max_bytes}")
+
+    chunks = []
+    size = 0
+    while True:
+        chunk = await request.content.read(_ASYNC_READ_CHUNK)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            metrics.record_parse('too_large')
+            raise WebhookBodyTooLarge(f"Body > {max_bytes} bytes")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+async def parse_request_async(request) -> Optional[dict]:
+    """parse_request cho aiohttp (parse chạy luôn trên event loop vì body đã bị giới hạn kích thước)"""
+    if _PARSED_KEY not in request:
+        try:
+            request[_PARSED_KEY] = _as_object(parse_body(await read_body_async(request)))
+        except WebhookBodyTooLarge as e:
+            request[_PARSED_KEY] = e
+    return _cached_result(request[_PARSED_KEY])
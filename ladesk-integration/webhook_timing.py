@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Webhook Timing
+Ghi lại thời gian từng bước xử lý của một webhook (parse, classify, DB, upstream)
+và lưu vào bảng webhook_timings liên kết với webhook_logs
+"""
+
+import math
+import asyncio
+import inspect
+import time
+import functools
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_current: ContextVar[Optional['WebhookTiming']] = ContextVar('webhook_timing', default=None)
+
+
+class WebhookTiming:
+    """Thời gian cộng dồn theo stage của một webhook"""
+
+    def __init__(self, webhook_type: str):
+        self.webhook_type = webhook_type
+        self.webhook_log_id: Optional[int] = None
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def add(self, stage_name: str, seconds: float):
+        """Cộng thêm thời gian cho một stage (gọi nhiều lần sẽ được cộng dồn)"""
+        with self._lock:
+            self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        """Tổng thời gian từ lúc bắt đầu webhook"""
+        return time.perf_counter() - self._start
+
+
+def current() -> Optional[WebhookTiming]:
+    """Timing của webhook đang xử lý trong context hiện tại (None nếu không có)"""
+    return _current.get()
+
+
+def record(stage_name: str, seconds: float):
+    """Ghi thời gian cho stage nếu đang trong một webhook"""
+    timing = _current.get()
+    if timing is not None:
+        timing.add(stage_name, seconds)
+
+
+@contextmanager
+def stage(stage_name: str):
+    """Context manager đo thời gian một đoạn code và ghi vào stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage_name, time.perf_counter() - start)
+
+
+def track(webhook_type: str) -> Callable:
+    """Decorator bật timing cho webhook handler và lưu kết quả sau khi xử lý xong
+
+    Handler async: mỗi request là một task riêng nên ContextVar không lẫn
+    giữa các request; việc lưu vào SQLite chạy trong thread để không chặn event loop.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                from metrics import result_outcome
+
+                timing = WebhookTiming(webhook_type)
+                token = _current.set(timing)
+                outcome = 'error'
+                try:
+                    result = await func(*args, **kwargs)
+                    outcome = result_outcome(result)
+                    return result
+                finally:
+                    total = timing.elapsed()
+                    _current.reset(token)
+                    await asyncio.to_thread(save, timing, outcome, total)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Import muộn vì metrics import module này
+            from metrics import result_outcome
+
+            timing = WebhookTiming(webhook_type)
+            token = _current.set(timing)
+            outcome = 'error'
+            try:
+                result = func(*args, **kwargs)
+                outcome = result_outcome(result)
+                return result
+            finally:
+                total = timing.elapsed()
+                _current.reset(token)
+                save(timing, outcome, total)
+        return wrapper
+    return decorator
+
+
+def save(timing: WebhookTiming, outcome: str, total: float):
+    """Lưu breakdown vào database (lỗi khi lưu không làm hỏng webhook)"""
+    try:
+        # Import muộn để tránh vòng import database_simple -> metrics -> webhook_timing
+        from database_simple import db
+        db.save_webhook_timings(
+            webhook_log_id=timing.webhook_log_id,
+            webhook_type=timing.webhook_type,
+            outcome=outcome,
+            stages=dict(timing.stages),
+            total=total
+        )
+    except Exception as e:
+        logger.error("❌ Error saving webhook timings: %s", e)
+
+
+def percentile(sorted_values, pct: float) -> float:
+    """Percentile theo nearest-rank trên danh sách đã sắp xếp"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Webhook Timing Report
+Script báo cáo p50/p95/p99 theo stage và các webhook chậm nhất
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+
+import argparse
+from database_simple import db
+from webhook_timing import percentile
+
+def stage_report(window_minutes: int, webhook_type: str = None):
+    """In p50/p95/p99 của từng stage"""
+    durations = db.get_stage_durations(window_minutes=window_minutes, webhook_type=webhook_type)
+    if not durations:
+        print(f"❌ Không có dữ liệu timing trong {window_minutes} phút gần đây")
+        return
+
+    print(f"📊 Thời gian theo stage ({window_minutes} phút gần đây, đơn vị ms):")
+    print("-" * 90)
+    print(f"  {'stage':<45} {'count':>7} {'p50':>10} {'p95':>10} {'p99':>10}")
+    print("-" * 90)
+
+    # Sắp xếp theo p95 giảm dần để stage chậm nhất nằm trên cùng
+    rows = []
+    for stage_name, values in durations.items():
+        values.sort()
+        rows.append((stage_name, len(values), percentile(values, 50),
+                     percentile(values, 95), percentile(values, 99)))
+    rows.sort(key=lambda row: row[3], reverse=True)
+
+    for stage_name, count, p50, p95, p99 in rows:
+        print(f"  {stage_name:<45} {count:>7} {p50:>10.1f} {p95:>10.1f} {p99:>10.1f}")
+    print("-" * 90)
+
+def slowest_report(limit: int, window_minutes: int, webhook_type: str = None):
+    """In N webhook chậm nhất kèm breakdown"""
+    slowest = db.get_slowest_webhooks(limit=limit, window_minutes=window_minutes, webhook_type=webhook_type)
+    if not slowest:
+        print(f"❌ Không có webhook nào trong {window_minutes} phút gần đây")
+        return
+
+    print(f"🐢 {len(slowest)} webhook chậm nhất ({window_minutes} phút gần đây):")
+    print("-" * 90)
+    for item in slowest:
+        print(f"  #{item['webhook_log_id']} {item['webhook_type']} [{item['outcome']}] "
+              f"{item['total_ms']:.1f} ms - {item['created_at']} "
+              f"(conversation: {item['conversation_id']}, ticket: {item['ticket_id']})")
+        for stage_name, duration_ms in item['stages'].items():
+            print(f"      {stage_name:<45} {duration_ms:>10.1f} ms")
+    print("-" * 90)
+
+def main():
+    parser = argparse.ArgumentParser(description="Báo cáo thời gian xử lý webhook")
+    parser.add_argument('action', choices=['stages', 'slowest'],
+                       help='stages: p50/p95/p99 theo stage, slowest: N webhook chậm nhất')
+    parser.add_argument('--window', '-w', type=int, default=60, help='Khoảng thời gian (phút)')
+    parser.add_argument('--type', '-t', choices=['cloud_incoming', 'onpremise_incoming'],
+                       help='Lọc theo loại webhook')
+    parser.add_argument('--limit', '-n', type=int, default=10, help='Số webhook chậm nhất cần hiển thị')
+
+    args = parser.parse_args()
+
+    if args.action == 'stages':
+        stage_report(args.window, args.type)
+    elif args.action == 'slowest':
+        slowest_report(args.limit, args.window, args.type)
+
+if __name__ == '__main__':
+    main()